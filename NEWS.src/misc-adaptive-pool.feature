@@ -0,0 +1 @@
+The worker node keeps more worker processes started ahead of time when tasks arrive in bursts, between "minIdleWorkers" and "maxIdleWorkers", so that tasks rarely wait for a worker process to load plugins.
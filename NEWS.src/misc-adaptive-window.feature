@@ -0,0 +1 @@
+Messages between nodes that go through the XMPP server use a send window that adapts to the measured round trip time, so large jobs and logs move faster over high-latency links.
@@ -0,0 +1 @@
+Troves that are ready for dependency resolution at the same time are now resolved together in one task, up to "resolveBatchSize" troves per task, with dependency queries shared between them. Results are reported for each trove as soon as it is resolved.
@@ -0,0 +1 @@
+The dispatcher now records how long each package takes to resolve, set up a chroot for and build. These times are used by critical-path scheduling and to estimate the time left on a running job in "rmake query". Set "recordBuildTimes" to False to disable this.
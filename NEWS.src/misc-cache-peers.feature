@@ -0,0 +1 @@
+Worker nodes can share their repository caches. Setting "cacheServerPort" makes a node serve its cache to other nodes, and nodes listed in "cachePeers" are asked for missing changesets and file contents before the repository is. Only nodes in "cacheServerAllow" (this host by default) may fetch from a cache server, "cacheServerInterface" selects the address it listens on, and fetched entries are checked against trove and file digests before they are used.
@@ -0,0 +1 @@
+The "local" chroot cache now writes and reads archives in-process, compressing on several threads at once, and with the new chrootCacheAsync option archives new chroots in the background so builds no longer wait for them. The new chrootCacheCodec option selects gzip (the default), bzip2, zstd, or no compression, and chrootCacheThreads sets the number of compression threads.
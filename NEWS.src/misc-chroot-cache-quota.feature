@@ -0,0 +1 @@
+The "local" chroot cache can now be limited with the chrootCacheMaxSize (in megabytes) and chrootCacheMaxCount options. The least recently stored or restored chroots are evicted first. "rmake list chrootcache" shows the cached chroots on each worker along with hit, miss and eviction counts.
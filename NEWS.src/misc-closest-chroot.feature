@@ -0,0 +1 @@
+When a build's exact chroot is not in the chroot cache, the cached chroot with the most build requirements in common is restored instead, and only the difference is installed on top of it.
@@ -0,0 +1 @@
+Message bus payloads are sent in a compact binary encoding instead of pickles between nodes that support it, making them 20-40% smaller and cheaper to encode. "scripts/bench_messages.py" compares the two formats.
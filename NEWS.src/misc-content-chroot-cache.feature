@@ -0,0 +1 @@
+Added "content" and "hardlink" chroot cache types, which keep each distinct file once in a content-addressed store and restore chroots by reflinking, copying, or hard linking files instead of unpacking a tar archive. For example: "chrootCache content /var/rmake/chrootcache"
@@ -0,0 +1 @@
+Added the "criticalPathScheduling" server option, which resolves and builds first the troves that have the longest chain of other troves waiting on them, weighted by expected build time.
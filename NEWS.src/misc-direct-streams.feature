@@ -0,0 +1 @@
+Nodes can exchange messages over a direct binary connection instead of base64-encoded XMPP frames by setting "xmppStreamPort" on the dispatcher; nodes that do not support it keep using XMPP.
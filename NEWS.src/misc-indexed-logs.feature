@@ -0,0 +1 @@
+Job and task logs are written with an index so that they can be read from a point in time without parsing the whole log, and the "since" argument to TAIL requests on the log server starts from that point.
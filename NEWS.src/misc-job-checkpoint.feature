@@ -0,0 +1 @@
+Job status changes no longer rewrite the whole saved build job; trove states are saved in their own rows as they change, and the whole job is saved every "jobCheckpointInterval" seconds.
@@ -0,0 +1 @@
+Worker log records are sent to the dispatcher in compressed batches, and are held back while the message bus is busy so that task status and heartbeats are not delayed behind them.
@@ -0,0 +1 @@
+Changesets missing from the repository cache are now downloaded in parallel, "changesetFetchThreads" connections at a time in batches of "changesetFetchBatchSize", and written straight into the cache.
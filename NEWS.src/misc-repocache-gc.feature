@@ -0,0 +1 @@
+The repository cache on worker nodes is now cleaned up periodically: dependency results expire after "cacheDepsMaxAge" hours, and the least recently used changesets and file contents are removed to stay under "cacheMaxSize" megabytes. "rmake-node cache" shows the cache size, entry counts and hit rate, and "--clean" cleans it up immediately.
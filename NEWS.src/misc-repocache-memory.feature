@@ -0,0 +1 @@
+Dependency results and known troves from the repository cache are now kept in memory, up to "cacheMemoryLimit" trove tuples per worker process. Hit and miss counts are logged after each resolve task.
@@ -0,0 +1 @@
+The resolver result cache is now a single indexed database that is prefetched once per job. Entries older than "resolverCacheMaxAge" days are expired, least recently used entries are evicted to stay under "resolverCacheMaxSize" megabytes, and hit and miss counts are reported in the final job status. Existing cache files are migrated into the new database.
@@ -0,0 +1 @@
+Worker processes now keep their repository client and resolveTroves contents between resolve tasks that share a configuration. Use "resolveContexts" and "resolveContextMaxTroves" in the node configuration to limit how much is kept.
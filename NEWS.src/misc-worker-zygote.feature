@@ -0,0 +1 @@
+Setting "forkWorkers" on a worker node forks worker processes from a process that has already loaded plugins and configuration, so that starting one takes milliseconds instead of seconds.
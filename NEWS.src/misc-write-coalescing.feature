@@ -0,0 +1 @@
+The dispatcher combines task and job status updates that arrive while an earlier update is being saved, writing only the newest for each and saving the rest in one statement.
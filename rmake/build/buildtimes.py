@@ -0,0 +1,298 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Historical record of how long each package took to resolve, to get a chroot
+for, and to build.
+
+Durations are kept per (name, flavor, node) as a moving average of recent
+builds, along with a per-name summary used when a package is scheduled
+before it is known which node will build it. Everything lives in memory in
+plain dictionaries so that lookups stay cheap no matter how many packages
+are tracked; the store is saved to a single marshalled file.
+"""
+
+import errno
+import logging
+import marshal
+import os
+import threading
+import time
+
+from conary.lib import util
+
+log = logging.getLogger(__name__)
+
+RESOLVE, CHROOT, BUILD = PHASES = range(3)
+
+# Weight given to the newest sample in the moving average.
+SMOOTHING = 0.3
+
+
+def _average(old, sample):
+    if old is None:
+        return sample
+    return old + SMOOTHING * (sample - old)
+
+
+class BuildTimeStore(object):
+    """Per-package durations of each build phase."""
+
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        # (name, flavor, node) -> [resolve, chroot, build, count]
+        self._times = {}
+        # name -> [resolve, chroot, build, count]
+        self._byName = {}
+        self._dirty = False
+        # save() may run in a thread while samples are being recorded.
+        self._lock = threading.Lock()
+        self._saveLock = threading.Lock()
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            fobj = open(self.path, 'rb')
+        except IOError, err:
+            if err.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            try:
+                version, times = marshal.loads(fobj.read())
+            except (EOFError, ValueError, TypeError):
+                log.warning("Discarding corrupt build time database %s",
+                        self.path)
+                return
+        finally:
+            fobj.close()
+        if version != self.VERSION:
+            return
+        self._times = dict((key, list(value))
+                for key, value in times.iteritems())
+        self._byName = {}
+        for (name, flavor, node), value in self._times.iteritems():
+            summary = self._byName.setdefault(name, [None, None, None, 0])
+            for phase in PHASES:
+                if value[phase] is not None:
+                    summary[phase] = _average(summary[phase], value[phase])
+            summary[3] += value[3]
+
+    def save(self):
+        """Write out the store if anything was recorded since the last
+        save."""
+        if not self.path:
+            return
+        self._saveLock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                if not self._dirty:
+                    return
+                times = dict((key, tuple(value))
+                        for key, value in self._times.iteritems())
+                self._dirty = False
+            finally:
+                self._lock.release()
+            try:
+                util.mkdirChain(os.path.dirname(self.path))
+                fobj = util.AtomicFile(self.path, 'wb', chmod=0644)
+                fobj.write(marshal.dumps((self.VERSION, times)))
+                fobj.commit()
+            except:
+                self._dirty = True
+                raise
+        finally:
+            self._saveLock.release()
+
+    def record(self, name, flavor, node, phase, seconds):
+        """Add one observed C{seconds}-long run of C{phase}."""
+        name = name.split(':')[0]
+        if seconds < 0:
+            return
+        self._lock.acquire()
+        try:
+            for entry in (
+                    self._times.setdefault((name, str(flavor), node or ''),
+                        [None, None, None, 0]),
+                    self._byName.setdefault(name, [None, None, None, 0]),
+                    ):
+                entry[phase] = _average(entry[phase], seconds)
+                if phase == BUILD:
+                    entry[3] += 1
+            self._dirty = True
+        finally:
+            self._lock.release()
+
+    def get(self, name, flavor=None, node=None):
+        """
+        Return a tuple of the expected resolve, chroot, and build times for
+        a package, or C{None} if it has never been seen.
+
+        Phases that haven't been seen for the exact flavor and node are
+        taken from the per-name average instead.
+        """
+        name = name.split(':')[0]
+        summary = self._byName.get(name)
+        if summary is None:
+            return None
+        entry = None
+        if flavor is not None:
+            entry = self._times.get((name, str(flavor), node or ''))
+        if entry is None:
+            return tuple(summary[:3])
+        return tuple(entry[phase] if entry[phase] is not None
+                else summary[phase] for phase in PHASES)
+
+    def getBuildTime(self, name, flavor=None, node=None):
+        """Return the expected chroot plus build time, or C{None}."""
+        times = self.get(name, flavor, node)
+        if times is None or times[BUILD] is None:
+            return None
+        return (times[CHROOT] or 0) + times[BUILD]
+
+    def getBuildTimes(self, names=None):
+        """
+        Return a dictionary mapping package names to their expected chroot
+        plus build time, for use in scheduling.
+        """
+        if names is None:
+            names = self._byName.iterkeys()
+        result = {}
+        for name in names:
+            buildTime = self.getBuildTime(name)
+            if buildTime is not None:
+                result[name] = buildTime
+        return result
+
+    def estimateRemaining(self, troves):
+        """
+        Return the total expected time needed to finish the given build
+        troves.
+        """
+        return estimateRemaining(troves,
+                lambda trove: self.get(trove.getName(), trove.getFlavor()))
+
+    def __len__(self):
+        return len(self._times)
+
+
+def estimateRemaining(troves, lookup):
+    """
+    Return the total expected time needed to finish C{troves}, counting only
+    the phases each trove has yet to go through.
+
+    @param lookup: Callable returning the expected resolve, chroot and build
+        times of a trove, or C{None} if they are not known.
+    """
+    remaining = []
+    unknown = 0
+    for trove in troves:
+        if trove.isFinished():
+            continue
+        times = lookup(trove)
+        if times is None:
+            unknown += 1
+            continue
+        resolveTime, chrootTime, buildTime = [x or 0 for x in times]
+        if trove.isBuilding():
+            elapsed = trove.start and time.time() - trove.start or 0
+            remaining.append(max(buildTime - elapsed, 0))
+        elif trove.isPreparing() or trove.isBuildable() or trove.isWaiting():
+            remaining.append(chrootTime + buildTime)
+        else:
+            remaining.append(resolveTime + chrootTime + buildTime)
+    total = sum(remaining)
+    if remaining and unknown:
+        # Assume packages never built before are about average.
+        total += unknown * total / float(len(remaining))
+    return total
+
+
+class BuildTimeRecorder(object):
+    """
+    Feed trove state transitions published by a
+    L{rmake.build.publisher.JobStatusPublisher} into a L{BuildTimeStore}.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # trove -> (phase, start time)
+        self._started = {}
+        # trove -> resolve duration, held until the chroot host is known so
+        # that all phases of a build are recorded under the same node.
+        self._resolved = {}
+
+    def attach(self, publisher):
+        publisher.addObserver(publisher.TROVE_RESOLVING, self.troveResolving)
+        publisher.addObserver(publisher.TROVE_RESOLVED, self.troveResolved)
+        publisher.addObserver(publisher.TROVE_PREPARING_CHROOT,
+                self.trovePreparing)
+        publisher.addObserver(publisher.TROVE_BUILDING, self.troveBuilding)
+        publisher.addObserver(publisher.TROVE_BUILT, self.troveBuilt)
+        publisher.addObserver(publisher.TROVE_FAILED, self.troveFailed)
+
+    def _finish(self, trove, phase, now=None):
+        started = self._started.pop(trove, None)
+        if started is None or started[0] != phase:
+            return None
+        if now is None:
+            now = time.time()
+        return now - started[1]
+
+    def _record(self, trove, phase, seconds):
+        if seconds is None:
+            return
+        self.store.record(trove.getName(), trove.getFlavor(),
+                trove.getChrootHost(), phase, seconds)
+
+    def _flushResolve(self, trove):
+        self._record(trove, RESOLVE, self._resolved.pop(trove, None))
+
+    def troveResolving(self, trove, *args):
+        self._resolved.pop(trove, None)
+        self._started[trove] = (RESOLVE, time.time())
+
+    def troveResolved(self, trove, *args):
+        seconds = self._finish(trove, RESOLVE)
+        if seconds is not None:
+            self._resolved[trove] = seconds
+
+    def trovePreparing(self, trove, *args):
+        self._flushResolve(trove)
+        self._started[trove] = (CHROOT, time.time())
+
+    def troveBuilding(self, trove, *args):
+        now = time.time()
+        self._flushResolve(trove)
+        self._record(trove, CHROOT, self._finish(trove, CHROOT, now))
+        self._started[trove] = (BUILD, trove.start or now)
+
+    def troveBuilt(self, trove, *args):
+        self._flushResolve(trove)
+        if trove.isPrebuilt():
+            self._started.pop(trove, None)
+            return
+        self._record(trove, BUILD, self._finish(trove, BUILD,
+            trove.finish or None))
+
+    def troveFailed(self, trove, *args):
+        self._flushResolve(trove)
+        self._started.pop(trove, None)
@@ -24,6 +24,7 @@ from conary.lib import util
 from rmake.build import buildjob
 from rmake.build import buildtrove
 from rmake.errors import InsufficientPermission
+from rmake.lib.apiutils import thaw
 from rmake.lib.rpc_pickle import PickleServerProxy
 from rmake.lib.rpcproxy import parseAddress, Address
 from rmake.lib.twisted_extras.firehose import FirehoseClient
@@ -69,6 +70,42 @@ class rMakeClient(object):
             cfg.conaryProxy['http'] = info['conaryProxy']
             cfg.conaryProxy['https'] = info['conaryProxy']
 
+    def getBuildTimes(self, names):
+        """
+            Get the expected resolve, chroot and build times of the given
+            packages, based on previous builds.
+
+            @param names: package names
+            @rtype: dict of name -> (resolve, chroot, build) seconds
+        """
+        return self.proxy.build.getBuildTimes(list(names))
+
+    def getChrootCacheStats(self):
+        """
+            Get chroot cache statistics from each worker that has a
+            chroot cache: the number and total size of cached chroots,
+            hits, misses, and evictions, and the C{(fingerprint, size,
+            lastUsed)} of each cached chroot, most recently used first.
+
+            @rtype: dict of worker JID -> dict of statistics
+        """
+        return self.proxy.build.getChrootCacheStats()
+
+    def listTrovesByState(self, jobId, state=None):
+        """
+            Lists troves in a job by state.
+            @param jobId: uuid for job.
+            @param state: (optional) state to list troves by.  All states if 
+                          left blank.
+            @type state: build.buildtrove.TroveState.* or None
+
+            @return: dict of trove lists by state.
+            @rtype: {TROVE_STATE_* : [(name, version, flavor, context)]} dict.
+        """
+        results = self.proxy.build.listTrovesByState(jobId, state)
+        return dict((x[0], thaw('troveContextTupleList', x[1]))
+                for x in results.iteritems())
+
     def buildJob(self, job, subscribe=True):
         sid = subscribe and self.firehose.sid or None
         import pickle; pickle.dump(job, open('job.pickle', 'wb'), 2)
@@ -141,22 +178,6 @@ class rMakeClient_UNPORTED(object):
             jobLimit = 0
         return self.proxy.listJobs(activeOnly, jobLimit)
 
-    def listTrovesByState(self, jobId, state=None):
-        """
-            Lists troves in a job by state.
-            @param jobId: jobId or uuid for job.
-            @param state: (optional) state to list troves by.  All states if 
-                          left blank.
-            @type state: build.buildtrove.TroveState.* or None
-
-            @return: dict of trove lists by state.
-            @rtype: {TROVE_STATE_* : [(name, version, flavor)]} dict.
-        """
-        if state is None:
-            state = ''
-        results = self.proxy.listTrovesByState(jobId, state)
-        return dict((x[0], thaw('troveContextTupleList', x[1])) for x in results)
-
     def getStatus(self, jobId):
         """
             Return status for job
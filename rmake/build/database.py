@@ -20,6 +20,8 @@ This module holds the database interface used by the trove build system, as an
 extension of the core build system.
 """
 
+from twisted.internet import defer
+
 
 class JobStore(object):
 
@@ -52,3 +54,47 @@ class JobStore(object):
         # Just return the new jobId
         d.addCallback(lambda _: ret[0])
         return d
+
+    def setTroveStates(self, job_uuid, troves):
+        """Record the current state of some of a job's troves.
+
+        Trove states change far more often than anything else in a job, so
+        they are kept in one row per trove instead of being saved with the
+        whole job.
+        """
+        rows = [(x.state, x.status, job_uuid, x.name, x.version.freeze(),
+            x.flavor.freeze(), x.context) for x in troves]
+        def interaction(cu):
+            d = defer.succeed(None)
+            for row in rows:
+                d.addCallback(self._setTroveState, cu, row)
+            return d
+        return self.pool.runInteraction(interaction)
+
+    @staticmethod
+    def _setTroveState(_, cu, row):
+        d = cu.execute("""UPDATE build.job_troves
+                SET trove_state = %s, trove_status = %s, time_updated = now()
+                WHERE job_uuid = %s AND source_name = %s
+                    AND source_version = %s AND build_flavor = %s
+                    AND build_context = %s""", row)
+        # Troves can be added to a job after it is created, e.g. when loading
+        # the contents of groups.
+        d.addCallback(lambda _: cu.execute("""INSERT INTO build.job_troves
+                ( trove_state, trove_status, time_updated, job_uuid,
+                source_name, source_version, build_flavor, build_context )
+                SELECT %s, %s, now(), %s, %s, %s, %s, %s
+                WHERE NOT EXISTS ( SELECT 1 FROM build.job_troves
+                    WHERE job_uuid = %s AND source_name = %s
+                    AND source_version = %s AND build_flavor = %s
+                    AND build_context = %s )""", row + row[2:]))
+        return d
+
+    def getTroveStates(self, job_uuid):
+        """Return a list of C{(name, version, flavor, context, state,
+        status)} for each trove of a job, with version and flavor frozen."""
+        d = self.pool.runQuery("""SELECT source_name, source_version,
+                    build_flavor, build_context, trove_state, trove_status
+                FROM build.job_troves WHERE job_uuid = %s""", (job_uuid,))
+        d.addCallback(lambda rows: [tuple(x) for x in rows])
+        return d
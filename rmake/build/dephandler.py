@@ -21,10 +21,15 @@ Dependency Handler and DependencyState classes
 
 import errno
 import itertools
+import marshal
 import os
+import sqlite3
 import sys
+import threading
+import time
 import traceback
 import xmlrpclib
+import zlib
 
 from conary.deps import deps
 from conary.lib import digestlib
@@ -37,8 +42,10 @@ from conary import versions
 from rmake import errors
 from rmake import failure
 from rmake.build.buildstate import AbstractBuildState
+from rmake.lib.apiutils import freeze, register, thaw
 
 from rmake.lib import flavorutil
+from rmake.lib import sccgraph
 
 FAILURE_REASON_FAILED = 0
 FAILURE_REASON_BUILDREQ = 1
@@ -106,10 +113,52 @@ class ResolveJob(object):
 register(ResolveJob)
 
 class DependencyGraph(graph.DirectedGraph):
+    """
+        Dependency graph that also keeps its cycles (strongly connected
+        components) up to date as troves and edges come and go, so that
+        they never have to be recomputed from the whole graph.
+    """
+
+    # Incremented on every change to the graph, so that values derived
+    # from it can be cached until it changes.
+    generation = 0
+
+    def __init__(self, *args, **kwargs):
+        graph.DirectedGraph.__init__(self, *args, **kwargs)
+        self.components = sccgraph.ComponentTracker()
+
     # FIXME: remove with next release of conary
     def __contains__(self, trove):
         return trove in self.data.hashedData
 
+    def addNode(self, item, *args, **kwargs):
+        self.generation += 1
+        self.components.addNode(item)
+        return graph.DirectedGraph.addNode(self, item, *args, **kwargs)
+
+    def addEdge(self, fromItem, toItem, *args, **kwargs):
+        self.generation += 1
+        self.components.addEdge(fromItem, toItem)
+        return graph.DirectedGraph.addEdge(self, fromItem, toItem,
+                                           *args, **kwargs)
+
+    def delete(self, item, *args, **kwargs):
+        self.generation += 1
+        self.components.delete(item)
+        return graph.DirectedGraph.delete(self, item, *args, **kwargs)
+
+    def deleteEdges(self, item, *args, **kwargs):
+        self.generation += 1
+        self.components.deleteEdges(item)
+        return graph.DirectedGraph.deleteEdges(self, item, *args, **kwargs)
+
+    def getLeafCycles(self):
+        """
+            Returns the sets of troves (single troves or cycles) that
+            do not depend on anything outside the set.
+        """
+        return [ frozenset(x.members) for x in self.components.getLeaves() ]
+
     def generateDotFile(self, out, filterFn=None):
         def formatNode(node):
             name, version, flavor, context = node.getNameVersionFlavor(True)
@@ -426,8 +475,15 @@ class DependencyBasedBuildState(AbstractBuildState):
     def getBuildReqTroves(self, trove):
         return self.buildReqTroves[trove]
 
-    def popBuildableTrove(self):
-        trove = self.buildReqTroves.keys()[0]
+    def popBuildableTrove(self, key=None):
+        """
+            Remove and return a buildable trove and its requirements.
+            If C{key} is given, the trove with the highest key is picked.
+        """
+        if key is None:
+            trove = self.buildReqTroves.keys()[0]
+        else:
+            trove = max(self.buildReqTroves, key=key)
         return (trove, self.buildReqTroves.pop(trove))
 
     def getDependencyGraph(self):
@@ -444,14 +500,26 @@ class DependencyHandler(object):
         Updates what troves are buildable based on dependency information.
     """
     def __init__(self, statusLog, logger, buildTroves, specialTroves,
-            logDir=None, dumbMode=False, resolverCachePath=None):
+            logDir=None, dumbMode=False, resolverCachePath=None,
+            criticalPath=False, buildTimes=None, resolverCache=None,
+            maxResolving=10, resolverPrefetch=None):
         self.depState = DependencyBasedBuildState(buildTroves, specialTroves,
                                                   logger)
         self.logger = logger
         self.dumbMode = dumbMode
+        # When criticalPath is set, troves with the longest chain of
+        # (estimated) build time depending on them are handed out first.
+        self.criticalPath = criticalPath
+        if buildTimes is None:
+            buildTimes = {}
+        self.buildTimes = buildTimes
+        self._criticalPaths = None
         self.graphCount = 0
         self._resolving = {}
+        # Limit on the number of troves being resolved at once.
+        self.maxResolving = maxResolving
         self.priorities = []
+        self._prioritized = set()
         self._delayed = {}
         self._cycleChecked = {}
         self._seenCycles = []
@@ -459,10 +527,13 @@ class DependencyHandler(object):
         self._possibleDuplicates = {}
         self._prebuiltBinaries = set()
         self._hasPrimaryTroves = self.depState.hasPrimaryTroves
-        if resolverCachePath:
-            self._resolverCache = ResolverCache(resolverCachePath)
-        else:
-            self._resolverCache = None
+        if resolverCache is None and resolverCachePath:
+            resolverCache = ResolverCache(resolverCachePath)
+        self._resolverCache = resolverCache
+        self.resolverCacheHits = self.resolverCacheMisses = 0
+        if resolverCache and resolverPrefetch is None:
+            resolverPrefetch = resolverCache.prefetch(buildTroves)
+        self._resolverPrefetch = resolverPrefetch or {}
 
         statusLog.addObserver(statusLog.TROVE_BUILT, self.troveBuilt)
         statusLog.addObserver(statusLog.TROVE_PREPARED, self.trovePrepared)
@@ -530,6 +601,8 @@ class DependencyHandler(object):
         self._seenCycles = [ x for x in self._seenCycles if trove not in x ]
 
     def popBuildableTrove(self):
+        if self.criticalPath:
+            return self.depState.popBuildableTrove(key=self._criticalPathKey)
         return self.depState.popBuildableTrove()
 
     def jobPassed(self):
@@ -708,21 +781,109 @@ class DependencyHandler(object):
                           inCycle=inCycle)
         if self._resolverCache:
             hash = job.getJobHash()
-            result = self._resolverCache.get(hash)
+            result = self._resolverCache.get(hash, self._resolverPrefetch,
+                    buildTrove)
             if result:
+                self.resolverCacheHits += 1
                 self.logger.info("Using cached resolver result %s", hash)
                 self.resolutionComplete(buildTrove, result)
                 return None
+            elif hash:
+                self.resolverCacheMisses += 1
         return job
 
     def prioritize(self, trv):
         self.priorities.append(trv)
+        self._prioritized.add(trv)
 
     def getPriority(self, trv):
+        if self.criticalPath:
+            critical = -self.getCriticalPath(trv)
+        else:
+            critical = 0
         if trv in self.priorities:
-            return self.priorities.index(trv), -trv.getPrebuiltTime()
+            return critical, self.priorities.index(trv), -trv.getPrebuiltTime()
         else:
-            return len(self.priorities), -trv.getPrebuiltTime()
+            return critical, len(self.priorities), -trv.getPrebuiltTime()
+
+    ## Critical path scheduling
+
+    def getBuildTime(self, trv, default=None):
+        """
+            Returns the expected time to build C{trv}, based on the
+            durations of previous builds of the same package.  Packages
+            that have never been built are assumed to take C{default},
+            or the average of those that have if not given.
+        """
+        name = trv.getName().split(':')[0]
+        buildTime = self.buildTimes.get(name)
+        if buildTime is None:
+            if default is None:
+                default = self._getDefaultBuildTime()
+            buildTime = default
+        return buildTime
+
+    def _getDefaultBuildTime(self):
+        if self.buildTimes:
+            return (sum(self.buildTimes.itervalues())
+                    / float(len(self.buildTimes)))
+        return 1
+
+    def getCriticalPath(self, trv):
+        """
+            Returns the expected time to build C{trv} plus the longest
+            chain of troves that must be built after it.
+        """
+        depGraph = self.depState.depGraph
+        if (self._criticalPaths is None
+                or self._criticalPaths[0] != depGraph.generation):
+            self._criticalPaths = (depGraph.generation,
+                                   self._computeCriticalPaths())
+        return self._criticalPaths[1].get(trv, 0)
+
+    def _criticalPathKey(self, trv):
+        # Explicitly prioritized troves win ties.
+        return self.getCriticalPath(trv), trv in self._prioritized
+
+    def _computeCriticalPaths(self):
+        """
+            Computes the longest remaining path, weighted by build time,
+            from each trove through all the troves that depend on it.
+            Troves in a cycle all have to be built before anything that
+            depends on the cycle, so each cycle is treated as one node.
+        """
+        components = self.depState.depGraph.components
+        default = self._getDefaultBuildTime()
+        weights = {}
+        for comp in components.iterComponents():
+            weights[comp] = sum(self.getBuildTime(x, default) for x in comp)
+
+        # Walk from the leaves up without recursing, since the graph can be
+        # thousands of troves deep.
+        paths = {}
+        for start in weights:
+            if start in paths:
+                continue
+            stack = [start]
+            while stack:
+                comp = stack[-1]
+                if comp in paths:
+                    stack.pop()
+                    continue
+                parents = components.getParentComponents(comp)
+                todo = [x for x in parents if x not in paths]
+                if todo:
+                    stack.extend(todo)
+                    continue
+                stack.pop()
+                longest = max([paths[x] for x in parents] or [0])
+                paths[comp] = weights[comp] + longest
+
+        result = {}
+        for comp, path in paths.iteritems():
+            for trv in comp:
+                result[trv] = path
+        return result
 
     def _filterTroves(self, troveList):
          return [ x for x in troveList
@@ -763,11 +924,10 @@ class DependencyHandler(object):
         depGraph = self.depState.depGraph
         if depGraph.isEmpty():
             return None
-        if len(self._resolving) >= 10:
+        if len(self._resolving) >= self.maxResolving:
             return None
 
-        compGraph = self.depState.depGraph.getStronglyConnectedGraph()
-        leafCycles = compGraph.getLeaves()
+        leafCycles = depGraph.getLeafCycles()
         if self._allowFastResolution:
             result = self._attemptFastResolve(breakCycles=breakCycles,
                                               nodeLists=leafCycles)
@@ -923,9 +1083,10 @@ class DependencyHandler(object):
 
         if trv in self.priorities:
             self.priorities.remove(trv)
+            self._prioritized.discard(trv)
         if results.success:
             if self._resolverCache:
-                self._resolverCache.put(results)
+                self._resolverCache.put(results, trv)
             buildReqs = results.getBuildReqs()
             crossReqs = results.getCrossReqs()
             bootstrapReqs = results.getBootstrapReqs()
@@ -1111,29 +1272,332 @@ class DependencyHandler(object):
 
 
 class ResolverCache(object):
+    """
+        Cache of successful resolver results, keyed by the hash of the
+        resolve job that produced them.
+
+        Results are kept in a single sqlite database as compressed
+        marshalled data, along with the trove they were resolved for so
+        that all the results for a job can be fetched at once.  Entries
+        not used for C{maxAge} seconds are dropped, and the least recently
+        used entries are dropped to keep the total under C{maxSize} bytes.
+
+        With C{writeBehind} set, L{get} and L{put} never touch the disk:
+        lookups are answered from the prefetched results and new results
+        are queued in memory until L{flush} writes them all in one
+        transaction.  L{prefetch} and L{flush} may then be run in a thread
+        so that a dispatcher's reactor is never blocked on sqlite.
+    """
 
-    def __init__(self, path):
-        self.path = path
+    VERSION = 1
+    # Seconds between eviction passes
+    EVICT_INTERVAL = 3600
 
-    def get(self, hash):
+    def __init__(self, path, maxAge=0, maxSize=0, writeBehind=False):
+        self.path = path
+        self.maxAge = maxAge
+        self.maxSize = maxSize
+        self.writeBehind = writeBehind
+        self.hits = self.misses = 0
+        self._lastEvict = 0
+        self._db = None
+        # Serializes all database access.
+        self._dbLock = threading.RLock()
+        # Protects the queues below, which are also read by the thread
+        # running flush().
+        self._queueLock = threading.Lock()
+        # hash -> (trove key, data, last used)
+        self._pending = {}
+        # hash -> (last used, trove key)
+        self._touched = {}
+        self._legacyMigrated = False
+
+    def _getDb(self):
+        if self._db is None:
+            util.mkdirChain(self.path)
+            dbPath = os.path.join(self.path, 'results.db')
+            try:
+                self._db = self._connect(dbPath)
+            except sqlite3.DatabaseError:
+                # It's only a cache, so start over rather than fail.
+                util.removeIfExists(dbPath)
+                self._db = self._connect(dbPath)
+        return self._db
+
+    def _connect(self, dbPath):
+        # Access is serialized by _dbLock, but flush() may run in a
+        # different thread each time.
+        db = sqlite3.connect(dbPath, timeout=30, check_same_thread=False)
+        db.text_factory = str
+        # Losing recent entries in a crash is harmless.
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("""CREATE TABLE IF NOT EXISTS results (
+            hash        TEXT PRIMARY KEY,
+            trove       TEXT,
+            version     INTEGER NOT NULL,
+            data        BLOB NOT NULL,
+            size        INTEGER NOT NULL,
+            last_used   INTEGER NOT NULL
+            )""")
+        db.execute("""CREATE INDEX IF NOT EXISTS results_trove
+            ON results ( trove )""")
+        db.execute("""CREATE INDEX IF NOT EXISTS results_last_used
+            ON results ( last_used )""")
+        db.commit()
+        return db
+
+    @staticmethod
+    def getTroveKey(trove):
+        return '%s=%s[%s]{%s}' % (trove.getName(), trove.getVersion(),
+                trove.getFlavor(), trove.getContext())
+
+    def prefetch(self, troves):
+        """
+            Load all cached results for the given build troves with one
+            query per batch.  The returned dictionary can be passed to
+            L{get} so that lookups don't touch the disk.
+        """
+        keys = [self.getTroveKey(x) for x in troves]
+        prefetched = {}
+        self._dbLock.acquire()
+        try:
+            if not self._legacyMigrated:
+                self._migrateLegacy()
+            db = self._getDb()
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                cu = db.execute("""SELECT hash, version, data FROM results
+                    WHERE trove IN ( %s )""" % ', '.join('?' * len(batch)),
+                    batch)
+                for hash, version, data in cu:
+                    if version == self.VERSION:
+                        prefetched[hash] = data
+            # Migrated results don't know which trove they belong to until
+            # they are used, so they are offered to every job until then.
+            cu = db.execute("""SELECT hash, version, data FROM results
+                WHERE trove IS NULL""")
+            for hash, version, data in cu:
+                if version == self.VERSION:
+                    prefetched[hash] = data
+        finally:
+            self._dbLock.release()
+        self._queueLock.acquire()
+        try:
+            keys = set(keys)
+            for hash, (troveKey, data, lastUsed) in self._pending.items():
+                if troveKey in keys:
+                    prefetched[hash] = data
+        finally:
+            self._queueLock.release()
+        return prefetched
+
+    def get(self, hash, prefetched=None, trove=None):
         if not hash:
             return None
+        data = None
+        if prefetched:
+            data = prefetched.pop(hash, None)
+        if data is None:
+            self._queueLock.acquire()
+            try:
+                if hash in self._pending:
+                    data = self._pending[hash][1]
+            finally:
+                self._queueLock.release()
+        if data is None and not self.writeBehind:
+            self._dbLock.acquire()
+            try:
+                row = self._getDb().execute("""SELECT version, data
+                    FROM results WHERE hash = ?""", (hash,)).fetchone()
+                if row and row[0] == self.VERSION:
+                    data = row[1]
+                else:
+                    data = self._getLegacy(hash)
+            finally:
+                self._dbLock.release()
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if trove is not None:
+            trove = self.getTroveKey(trove)
+        self._queueLock.acquire()
+        try:
+            self._touched[hash] = (int(time.time()), trove)
+        finally:
+            self._queueLock.release()
+        if not self.writeBehind:
+            self.flush()
+        return thaw('ResolveResult', marshal.loads(zlib.decompress(data)))
+
+    def _getLegacy(self, hash):
+        """Move a result from the old one-file-per-result format."""
         path = os.path.join(self.path, hash)
+        data = self._readLegacy(path)
+        if data is None:
+            return None
+        self._queueLock.acquire()
+        try:
+            self._pending[hash] = (None, data, int(time.time()))
+        finally:
+            self._queueLock.release()
+        self.flush()
+        os.unlink(path)
+        return data
+
+    def _migrateLegacy(self):
+        """
+            Move all results from the old one-file-per-result format, for
+            write-behind caches whose lookups never look for the files.
+        """
+        self._legacyMigrated = True
+        util.mkdirChain(self.path)
+        paths = []
+        now = int(time.time())
+        for name in os.listdir(self.path):
+            if name.startswith('results.db'):
+                continue
+            path = os.path.join(self.path, name)
+            if not os.path.isfile(path):
+                continue
+            try:
+                data = self._readLegacy(path)
+            except Exception:
+                # It's only a cache, so drop results that can't be read.
+                data = None
+            if data is not None:
+                self._queueLock.acquire()
+                try:
+                    self._pending.setdefault(name, (None, data, now))
+                finally:
+                    self._queueLock.release()
+            paths.append(path)
+        if paths:
+            self.flush()
+            for path in paths:
+                util.removeIfExists(path)
+
+    def _readLegacy(self, path):
         try:
             fobj = open(path)
         except IOError, err:
             if err.args[0] == errno.ENOENT:
                 return None
             raise
-        result = xmlrpclib.loads(fobj.read())[0][0]
-        fobj.close()
-        return thaw('ResolveResult', result)
+        try:
+            # Already frozen
+            frozen = xmlrpclib.loads(fobj.read())[0][0]
+        finally:
+            fobj.close()
+        return self._compress(frozen)
 
-    def put(self, result):
+    def put(self, result, trove=None):
         if not result.jobHash:
             return
-        path = os.path.join(self.path, result.jobHash)
-        result = freeze('ResolveResult', result)
-        fobj = util.AtomicFile(path, chmod=0644)
-        fobj.write(xmlrpclib.dumps((result,)))
-        fobj.commit()
+        if trove is not None:
+            trove = self.getTroveKey(trove)
+        data = self._compress(freeze('ResolveResult', result))
+        self._queueLock.acquire()
+        try:
+            self._pending[result.jobHash] = (trove, data, int(time.time()))
+        finally:
+            self._queueLock.release()
+        if not self.writeBehind:
+            self.flush()
+
+    @staticmethod
+    def _compress(frozen):
+        return zlib.compress(marshal.dumps(frozen), 1)
+
+    def flush(self):
+        """
+            Write all queued results and usage times in one transaction,
+            and evict old entries if it is time to.  Returns the number of
+            results written.
+        """
+        self._queueLock.acquire()
+        try:
+            pending = self._pending.copy()
+            touched = self._touched.copy()
+        finally:
+            self._queueLock.release()
+        self._dbLock.acquire()
+        try:
+            if pending or touched:
+                db = self._getDb()
+                db.executemany("""INSERT OR REPLACE INTO results
+                    ( hash, trove, version, data, size, last_used )
+                    VALUES ( ?, ?, ?, ?, ?, ? )""",
+                    [(hash, troveKey, self.VERSION, sqlite3.Binary(data),
+                        len(data), lastUsed) for hash, (troveKey, data,
+                            lastUsed) in pending.iteritems()])
+                # Results migrated from the old format learn their trove
+                # when they are first used.
+                db.executemany("""UPDATE results SET last_used = ?,
+                    trove = COALESCE(trove, ?) WHERE hash = ?""",
+                    [(lastUsed, troveKey, hash) for hash, (lastUsed,
+                        troveKey) in touched.iteritems()])
+                db.commit()
+            self._evictIfDue()
+        finally:
+            self._dbLock.release()
+        # Only forget entries that weren't replaced while writing.
+        self._queueLock.acquire()
+        try:
+            for hash, value in pending.iteritems():
+                if self._pending.get(hash) is value:
+                    del self._pending[hash]
+            for hash, value in touched.iteritems():
+                if self._touched.get(hash) == value:
+                    del self._touched[hash]
+        finally:
+            self._queueLock.release()
+        return len(pending)
+
+    def _evictIfDue(self):
+        now = time.time()
+        if now - self._lastEvict >= self.EVICT_INTERVAL:
+            self._lastEvict = now
+            self.evict()
+
+    def evict(self):
+        """
+            Drop expired entries, then the least recently used ones until
+            the cache fits in C{maxSize}.  Returns the number dropped.
+        """
+        self._dbLock.acquire()
+        try:
+            return self._evict()
+        finally:
+            self._dbLock.release()
+
+    def _evict(self):
+        db = self._getDb()
+        count = 0
+        if self.maxAge:
+            cu = db.execute("DELETE FROM results WHERE last_used < ?",
+                    (int(time.time() - self.maxAge),))
+            count += cu.rowcount
+        if self.maxSize:
+            total = 0
+            expired = []
+            cu = db.execute("""SELECT hash, size FROM results
+                ORDER BY last_used DESC""")
+            for hash, size in cu:
+                total += size
+                if total > self.maxSize:
+                    expired.append((hash,))
+            db.executemany("DELETE FROM results WHERE hash = ?", expired)
+            count += len(expired)
+        db.commit()
+        return count
+
+    def getStats(self):
+        self._dbLock.acquire()
+        try:
+            entries, size = self._getDb().execute(
+                    "SELECT count(*), sum(size) FROM results").fetchone()
+        finally:
+            self._dbLock.release()
+        return dict(hits=self.hits, misses=self.misses, entries=entries,
+                size=size or 0, pending=len(self._pending))
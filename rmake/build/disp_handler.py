@@ -21,9 +21,11 @@ Job handler used by the dispatcher to run trove build jobs.
 
 import logging
 from twisted.internet import defer
+from twisted.internet import threads
 
 from rmake import failure
 from rmake.build import buildjob
+from rmake.build import buildtimes
 from rmake.build import constants as buildconst
 from rmake.build import dephandler
 from rmake.build.publisher import JobStatusPublisher
@@ -37,12 +39,19 @@ class BuildHandler(handler.JobHandler):
 
     jobType = buildconst.BUILD_JOB
     firstState = 'load_troves'
+    # Seconds to collect trove state changes before saving them.
+    troveSaveDelay = 1
 
     def setup(self):
         self.build_plugin = self.dispatcher.plugins.getPlugin('build')
         self.cfg = self.build_plugin.cfg
         self.dh = None
         self.build_pending = None
+        self.buildTimes = self.build_plugin.buildTimes
+        self.resolverCache = self.build_plugin.resolverCache
+        self.changedTroves = {}
+        self.troveSaver = None
+        self.lastCheckpoint = 0
 
     def load_troves(self):
         job = self.getData()
@@ -73,6 +82,14 @@ class BuildHandler(handler.JobHandler):
     def _finish_load(self, job):
         publisher = JobStatusPublisher()
         job.setPublisher(publisher)
+        publisher.addObserver(publisher.TROVE_STATE_UPDATED,
+                self._troveChanged)
+        if self.buildTimes is not None:
+            buildtimes.BuildTimeRecorder(self.buildTimes).attach(publisher)
+            buildTimes = self.buildTimes.getBuildTimes(
+                    set(x.getName().split(':')[0] for x in job.iterTroves()))
+        else:
+            buildTimes = None
         self.buildJob = job
 
         troves = sorted(job.iterTroves())
@@ -90,15 +107,63 @@ class BuildHandler(handler.JobHandler):
         # TODO: match prebuilt troves
         assert not job.getMainConfig().jobContext
 
+        if self.resolverCache is None:
+            return self._start_build(job, troves, buildTimes, None)
+        # Load cached resolver results off the reactor thread.
+        d = threads.deferToThread(self.resolverCache.prefetch, troves)
+        def prefetch_failed(reason):
+            log.error("Error reading the resolver cache:\n%s",
+                    reason.getTraceback())
+            return {}
+        d.addErrback(prefetch_failed)
+        d.addCallback(lambda prefetched: self._start_build(job, troves,
+            buildTimes, prefetched))
+        return d
+
+    def _start_build(self, job, troves, buildTimes, prefetched):
         # TODO: proper per-job logging
         joblog = logging.getLogger('dephandler.' + self.job.job_uuid.short)
-        self.dh = dephandler.DependencyHandler(publisher, joblog, troves)
+        self.dh = dephandler.DependencyHandler(job.getPublisher(), joblog,
+                troves, criticalPath=self.cfg.criticalPathScheduling,
+                buildTimes=buildTimes, resolverCache=self.resolverCache,
+                maxResolving=max(10, self.cfg.resolveBatchSize),
+                resolverPrefetch=prefetched)
 
         # TODO: sanity check
 
         self.setData(job)
+        self.lastCheckpoint = self.clock.seconds()
         return 'build'
 
+    def _troveChanged(self, trove, *args):
+        """Queue a trove's new state to be saved."""
+        self.changedTroves[trove.getNameVersionFlavor(True)] = trove
+        if self.troveSaver is None:
+            self.troveSaver = self.clock.callLater(self.troveSaveDelay,
+                    self._saveTroves)
+
+    def _saveTroves(self, checkpoint=True):
+        """Save trove states that changed since the last call, and the whole
+        job if it hasn't been saved for a while."""
+        if self.troveSaver is not None:
+            if self.troveSaver.active():
+                self.troveSaver.cancel()
+            self.troveSaver = None
+        troves, self.changedTroves = self.changedTroves.values(), {}
+        dl = []
+        if troves:
+            dl.append(self.build_plugin.server.db.setTroveStates(
+                self.job.job_uuid, troves))
+        interval = self.cfg.jobCheckpointInterval
+        if (checkpoint and not self.job.status.final and interval
+                and self.clock.seconds() - self.lastCheckpoint >= interval):
+            self.lastCheckpoint = self.clock.seconds()
+            dl.append(self.saveData(self.buildJob))
+        d = defer.DeferredList(dl, fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda reason: self.failJob(reason.value.subFailure,
+            message="Error saving job state:"))
+        return d
+
     def build(self):
         self.setStatus(101, "Building troves")
         self.build_pending = defer.Deferred()
@@ -111,11 +176,17 @@ class BuildHandler(handler.JobHandler):
             return self._finish_build()
         did_something = False
 
+        resolveJobs = []
         while True:
             resolveJob = self.dh.getNextResolveJob()
             if not resolveJob:
                 break
-            self._do_resolve(resolveJob)
+            resolveJobs.append(resolveJob)
+        for batch in self._batchResolveJobs(resolveJobs):
+            if len(batch) == 1:
+                self._do_resolve(batch[0])
+            else:
+                self._do_resolve_batch(batch)
             did_something = True
 
         while self.dh.hasBuildableTroves():
@@ -142,6 +213,74 @@ class BuildHandler(handler.JobHandler):
         d.addCallback(cb_done)
         d.addErrback(self.failJob, message="Internal error resolving trove:")
 
+    def _batchResolveJobs(self, resolveJobs):
+        """
+        Split resolve jobs into batches of troves with the same build
+        configuration, so that each batch can be resolved by one task.
+        """
+        batchSize = max(self.cfg.resolveBatchSize, 1)
+        byConfig = {}
+        batches = []
+        for resolveJob in resolveJobs:
+            # Troves in the same context share one config object.
+            key = id(resolveJob.getConfig())
+            batch = byConfig.get(key)
+            if batch is None or len(batch) >= batchSize:
+                batch = byConfig[key] = []
+                batches.append(batch)
+            batch.append(resolveJob)
+        return batches
+
+    def _do_resolve_batch(self, resolveJobs):
+        """Start the process of resolving several troves in one task."""
+        troves = [x.getTrove() for x in resolveJobs]
+        for trv in troves:
+            trv.troveQueued("Ready for dependency resolution")
+
+        task = self.newTask('resolve %d troves' % len(troves),
+                buildconst.RESOLVE_TASK, ResolveBatch(resolveJobs))
+
+        pending = set(range(len(troves)))
+        def troveDone(index, result, error):
+            if index not in pending:
+                return
+            pending.discard(index)
+            trv = troves[index]
+            if error:
+                trv.troveFailed(failure.InternalError(
+                    "Error resolving trove", error))
+            else:
+                trv.troveResolved(result)
+
+        def cb_updated(task):
+            # Results are streamed back one trove at a time as intermediate
+            # task data, before the task has finished.
+            if task.status.final:
+                return
+            results = task.task_data.getObject()
+            if isinstance(results, list):
+                for result in results:
+                    troveDone(*result)
+                self.clock.callLater(0, self._do_loop)
+        self.watchTask(task, cb_updated)
+
+        d = self.waitForTask(task)
+        def cb_done(task):
+            if task.status.failed:
+                fail = failure.InternalError(task.status.text,
+                        task.status.detail or '')
+                for index in sorted(pending):
+                    troves[index].troveFailed(fail)
+                pending.clear()
+            else:
+                # Intermediate updates can be superseded, so anything not seen
+                # yet is picked up from the full list of results.
+                for result in task.task_data.getObject():
+                    troveDone(*result)
+            self.clock.callLater(0, self._do_loop)
+        d.addCallback(cb_done)
+        d.addErrback(self.failJob, message="Internal error resolving troves:")
+
     def _do_build(self):
         trv, (buildReqs, crossReqs) = self.dh.popBuildableTrove()
         trv.troveQueued("Waiting to be assigned to chroot")
@@ -175,22 +314,37 @@ class BuildHandler(handler.JobHandler):
         d.addErrback(self.failJob, message="Internal error building trove:")
 
     def _finish_build(self):
+        self._saveTroves(checkpoint=False)
         if self.dh.jobPassed():
-            self.setStatus(200, "Build complete")
+            # Save the final state of the job along with its status.
+            self.setData(self.buildJob)
+            self.setStatus(200, "Build complete", self._resolverCacheStatus())
         else:
             detail = 'Build job had failures:\n'
             for trv in sorted(self.buildJob.iterPrimaryFailureTroves()):
                 fail = trv.getFailureReason()
                 detail += '   * %s: %s\n' % (trv.getName(), fail)
             self.buildJob.jobFailed(detail)
+            cacheStatus = self._resolverCacheStatus()
+            if cacheStatus:
+                detail += cacheStatus
+            self.setData(self.buildJob)
             self.setStatus(400, "Build failed", detail)
 
         self.build_pending.callback('done')
         self.build_pending = None
 
+    def _resolverCacheStatus(self):
+        hits, misses = self.dh.resolverCacheHits, self.dh.resolverCacheMisses
+        if not hits + misses:
+            return None
+        return 'Resolver cache: %d hits, %d misses (%d%% hit rate)\n' % (
+                hits, misses, 100 * hits / (hits + misses))
+
 
 TroveBuildJob = types.slottype('TroveBuildJob',
         'trove buildReqs crossReqs targetLabel builtTroves')
+ResolveBatch = types.slottype('ResolveBatch', 'resolveJobs')
 
 
 def register():
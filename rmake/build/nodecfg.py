@@ -24,7 +24,7 @@ from conary.deps import arch
 from conary.deps import deps
 from conary.lib.cfg import ConfigFile
 from conary.lib.cfgtypes import CfgType, ParseError
-from conary.lib.cfgtypes import CfgBool, CfgPath, CfgInt, CfgString
+from conary.lib.cfgtypes import CfgBool, CfgPath, CfgInt, CfgList, CfgString
 
 from rmake import constants
 from rmake import errors
@@ -47,13 +47,72 @@ class rMakeBuilderConfiguration(ConfigFile):
     helperDir         = (CfgPath, "/usr/libexec/rmake")
     slots             = (CfgInt, 1)
     useCache          = (CfgBool, False)
+    cacheServerPort   = (CfgInt, 0,
+            "Port on which to share this node's repository cache with other "
+            "nodes, or 0 to not share it")
+    cacheServerInterface = (CfgString, '',
+            "Address on which the repository cache server listens, or empty "
+            "to listen on all interfaces")
+    cacheServerAllow  = (CfgList(CfgString), [],
+            "Address or network, such as 10.0.0.0/8, of nodes allowed to "
+            "fetch from the repository cache server. May be given more than "
+            "once. Only this host is allowed if none are given.")
+    cachePeers        = (CfgList(CfgString), [],
+            "Base URL of another node's repository cache server, such as "
+            "http://node2:9998/, to ask for missing changesets and file "
+            "contents before going to the repository. May be given more than "
+            "once.")
+    cacheMemoryLimit  = (CfgInt, 100000,
+            "Number of trove tuples of dependency results and known troves "
+            "that each process keeps in memory in front of the repository "
+            "cache, or 0 to always read the cache from disk")
+    cacheMaxSize      = (CfgInt, 0,
+            "Maximum size in megabytes of the changesets and file contents "
+            "in the repository cache, or 0 for no limit. The least recently "
+            "used entries are removed first.")
+    cacheDepsMaxAge   = (CfgInt, 24,
+            "Hours after which cached dependency resolution results are "
+            "removed, or 0 to keep them")
+    cacheCollectInterval = (CfgInt, 60,
+            "Minutes between clean-ups of the repository cache, or 0 to only "
+            "clean it up with 'rmake-node cache --clean'")
     useTmpfs          = (CfgBool, False)
+    changesetFetchThreads = (CfgInt, 4,
+            "Number of connections used to download changesets missing from "
+            "the repository cache when creating a chroot")
+    changesetFetchBatchSize = (CfgInt, 10,
+            "Number of changesets each connection downloads before handing "
+            "them over and taking more work")
     chrootLimit       = (CfgInt, 4)
     chrootCache       = CfgChrootCache
+    chrootCacheCodec  = (CfgString, 'gzip',
+            "Compression used for archives in a 'local' chroot cache: "
+            "gzip, bzip2, none, or zstd if the zstandard module is installed")
+    chrootCacheThreads = (CfgInt, 0,
+            "Number of threads used to compress chroot archives, or 0 to "
+            "use one per CPU")
+    chrootCacheAsync  = (CfgBool, False,
+            "Archive chroots for a 'local' chroot cache in the background "
+            "instead of delaying the build. Each chroot is copied first, "
+            "which is cheap on filesystems that support reflinks.")
+    chrootCacheMaxSize = (CfgInt, 0,
+            "Maximum size of a 'local' chroot cache in megabytes, or 0 for "
+            "no limit. The least recently used chroots are evicted first.")
+    chrootCacheMaxCount = (CfgInt, 0,
+            "Maximum number of chroots in a 'local' chroot cache, or 0 for "
+            "no limit")
     chrootCaps        = (CfgBool, False,
             "Set capability masks as directed by chroot contents. "
             "This has the potential to be unsafe.")
     hostName          = (CfgString, 'localhost')
+    resolveContexts   = (CfgInt, 4,
+            "Number of distinct build configurations for which each worker "
+            "process keeps its repository client and resolveTroves contents "
+            "between resolve tasks, or 0 to set them up for every task")
+    resolveContextMaxTroves = (CfgInt, 1000000,
+            "Maximum number of resolveTroves entries and dependency answers "
+            "kept by each worker process across all of its resolve contexts, "
+            "or 0 for no limit")
     verbose           = False
 
     def getAuthUrl(self):
@@ -89,14 +148,28 @@ class rMakeBuilderConfiguration(ConfigFile):
         if not self.chrootCache:
             return None
         elif self.chrootCache[0] == 'local':
-            return chrootcache.LocalChrootCache(self.chrootCache[1])
+            try:
+                return chrootcache.LocalChrootCache(self.chrootCache[1],
+                        codec=self.chrootCacheCodec,
+                        threads=self.chrootCacheThreads,
+                        storeAsync=self.chrootCacheAsync,
+                        maxSize=self.chrootCacheMaxSize * 1024 * 1024,
+                        maxCount=self.chrootCacheMaxCount)
+            except KeyError:
+                raise errors.RmakeError('unknown or unavailable chroot cache '
+                        'codec "%s" specified' % self.chrootCacheCodec)
+        elif self.chrootCache[0] == 'content':
+            return chrootcache.ContentChrootCache(self.chrootCache[1])
+        elif self.chrootCache[0] == 'hardlink':
+            return chrootcache.ContentChrootCache(self.chrootCache[1],
+                    hardlink=True)
         else:
             raise errors.RmakeError('unknown chroot cache type of "%s" specified' %self.chrootCache[0])
 
     def _getChrootCacheDir(self):
         if not self.chrootCache:
             return None
-        elif self.chrootCache[0] == 'local':
+        elif self.chrootCache[0] in ('local', 'content', 'hardlink'):
             return self.chrootCache[1]
         return None
 
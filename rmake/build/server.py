@@ -33,6 +33,7 @@ from conary.lib import util
 from rmake import errors
 from rmake.core.types import RmakeJob
 from rmake.build import buildjob
+from rmake.build import buildtrove
 from rmake.build import constants as buildconst
 from rmake.build import database
 from rmake.server import auth
@@ -48,10 +49,11 @@ class BuildServer(RPCServer):
     Exposed under the "build" namespace, e.g. server.build.getRepositoryInfo()
     """
 
-    def __init__(self, dispatcher, tbs_cfg):
+    def __init__(self, dispatcher, tbs_cfg, buildTimes=None):
         self.dispatcher = dispatcher
         self.db = None
         self.tbs_cfg = tbs_cfg
+        self.buildTimes = buildTimes
 
     def _post_setup(self):
         self.db = database.JobStore(self.dispatcher.pool)
@@ -84,19 +86,63 @@ class BuildServer(RPCServer):
                 'conaryProxy': self.tbs_cfg.getProxyUrl() or '',
                 }
 
+    @expose
+    def getBuildTimes(self, names):
+        """Return the expected resolve, chroot and build times of packages.
+
+        Packages that have never been built are omitted.
+        """
+        result = {}
+        if self.buildTimes is None:
+            return result
+        for name in names:
+            times = self.buildTimes.get(name)
+            if times is not None:
+                result[name] = times
+        return result
+
+    @expose
+    def listTrovesByState(self, job_uuid, state=None):
+        """Return the troves of a job grouped by their last saved state.
+
+        Returns a dictionary mapping each state to a list of C{(name,
+        version, flavor, context)} tuples with version and flavor frozen. If
+        C{state} is given, only troves in that state are listed.
+        """
+        d = self.db.getTroveStates(job_uuid)
+        def group(rows):
+            result = {}
+            for name, version, flavor, context, troveState, _ in rows:
+                if troveState is None:
+                    # Not saved since the job was created.
+                    troveState = buildtrove.TroveState.INIT
+                if state is not None and troveState != state:
+                    continue
+                result.setdefault(troveState, []).append(
+                        (name, version, flavor, context))
+            return result
+        d.addCallback(group)
+        return d
+
+    @expose
+    def getChrootCacheStats(self):
+        """Return the chroot cache statistics last reported by each worker.
+
+        Workers without a chroot cache are omitted.
+        """
+        result = {}
+        for worker in self.dispatcher.workers.values():
+            stats = worker.stats.get('build', {}).get('chrootCache')
+            if stats is not None:
+                result[worker.jid.full()] = stats
+        return result
+
 
 class BuildServer_UNPORTED(object):
 
     def listJobs(self, callData, activeOnly, jobLimit):
         return self.db.listJobs(activeOnly=activeOnly, jobLimit=jobLimit)
 
-    def listTrovesByState(self, callData, jobId, state):
-        jobId = self.db.convertToJobId(jobId)
-        if state == '':
-            state = None
-        data = self.db.listTrovesByState(jobId, state)
-        return [(x[0], freeze('troveContextTupleList', x[1])) for x in data.iteritems()]
-
     def getJobs(self, callData, jobIds, withTroves=True, withConfigs=True):
         callData.logger.logRPCDetails('getJobs', jobIds=jobIds,
                                       withTroves=withTroves,
@@ -24,7 +24,7 @@ import urllib
 
 from conary import dbstore
 from conary.lib import log, cfg, util
-from conary.lib.cfgtypes import CfgPath, CfgString
+from conary.lib.cfgtypes import CfgBool, CfgInt, CfgPath, CfgString
 from conary.lib.cfgtypes import ParseError
 from conary.conarycfg import CfgUserInfo
 
@@ -66,6 +66,24 @@ class rMakeConfiguration(cfg.ConfigFile):
     caCertPath        = CfgPath
     reposUser         = CfgUserInfo
     useResolverCache  = (CfgBool, True)
+    resolverCacheMaxAge = (CfgInt, 30,
+            "Days after which an unused resolver result is dropped from the "
+            "resolver cache, or 0 to keep them forever.")
+    resolverCacheMaxSize = (CfgInt, 0,
+            "Maximum size of the resolver cache in megabytes, or 0 for no "
+            "limit.")
+    resolveBatchSize  = (CfgInt, 10,
+            "Maximum number of troves resolved together by one resolve "
+            "task. Set to 1 to resolve each trove in its own task.")
+    criticalPathScheduling = (CfgBool, False,
+            "Build the troves with the longest chain of dependent troves "
+            "first, weighted by how long each package took to build before.")
+    recordBuildTimes  = (CfgBool, True,
+            "Keep a record of how long each package takes to build, for use "
+            "in scheduling and in estimating job completion times.")
+    jobCheckpointInterval = (CfgInt, 300,
+            "Seconds between saves of a whole build job while it runs. The "
+            "state of each trove is saved as it changes regardless.")
 
     dbPath            = dbstore.CfgDriver
     chrootServerPorts = (CfgPortRange, (63000, 64000),
@@ -163,6 +181,9 @@ class rMakeConfiguration(cfg.ConfigFile):
     def getResolverCachePath(self):
         return self.serverDir + '/resolvercache'
 
+    def getBuildTimesPath(self):
+        return self.serverDir + '/buildtimes'
+
     def getRepositoryMap(self):
         url = self.translateUrl(self.reposUrl)
         return { self.reposName : url }
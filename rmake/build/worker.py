@@ -19,7 +19,10 @@
 Implementations of trove building tasks that are run on the worker node.
 """
 
+import traceback
+
 from conary import conaryclient
+from rmake.lib import cacheserver
 from rmake.lib import recipeutil
 from rmake.lib import repocache
 from rmake.worker import plug_worker
@@ -45,7 +48,7 @@ class LoadTask(_BuilderTask):
 
         repos = conaryclient.ConaryClient(job.getMainConfig()).getRepos()
         if self.cfg.useCache:
-           repos = repocache.CachingTroveSource(repos, self.cfg.getCacheDir())
+           repos = getCachingSource(self.cfg, repos)
 
         troves = [job.getTrove(*x) for x in job.iterLoadableTroveList()]
         if troves:
@@ -76,22 +79,109 @@ class LoadTask(_BuilderTask):
         self.sendStatus(200, "Troves loaded")
 
 
-class ResolveTask(_BuilderTask):
+def getCachingSource(cfg, repos):
+    """Wrap C{repos} in the repository cache set up by node config C{cfg}."""
+    return repocache.CachingTroveSource(repos, cfg.getCacheDir(),
+            memoryLimit=cfg.cacheMemoryLimit,
+            peers=cacheserver.getPeers(cfg.cachePeers))
 
-    def run_builder(self, resolveJob):
-        self.log.info("Resolving trove %s", resolveJob.trove.getTroveString())
 
-        client = conaryclient.ConaryClient(resolveJob.getConfig())
-        repos = client.getRepos()
-        if self.cfg.useCache:
-           repos = repocache.CachingTroveSource(repos, self.cfg.getCacheDir())
+def createResolveContextCache(cfg):
+    """
+    Return a L{resolver.ResolveContextCache} configured by node config
+    C{cfg}, or C{None} if resolve contexts should not be reused.
+    """
+    if cfg.resolveContexts <= 0:
+        return None
+    wrapRepos = None
+    if cfg.useCache:
+        wrapRepos = lambda repos: getCachingSource(cfg, repos)
+    return resolver.ResolveContextCache(cfg.resolveContexts,
+            cfg.resolveContextMaxTroves, wrapRepos=wrapRepos)
 
-        rsv = resolver.DependencyResolver(self.log, repos)
-        result = rsv.resolve(resolveJob)
 
-        self.setData(result)
+class ResolveTask(_BuilderTask):
+    """
+    Resolve build requirements for one trove, or for a batch of troves.
+
+    A batch is an object with a C{resolveJobs} list. As each trove finishes,
+    a C{[(index, result, error)]} list holding just that trove is sent as
+    intermediate task data, and the final task data holds the results for
+    every trove in the batch. C{error} is C{None} or the traceback of an
+    unexpected failure, in which case C{result} is C{None}.
+    """
+
+    resolveContexts = None  # poked in by BuildPlugin
+
+    def run_builder(self, data):
+        resolveJobs = getattr(data, 'resolveJobs', None)
+        if resolveJobs is None:
+            result = self._resolve(data)
+            self._logCacheStats()
+            self.setData(result)
+            self.sendStatus(200, "Resolution completed")
+            return
+
+        # Share dependency answers between the troves in the batch even when
+        # no context is kept from task to task.
+        shared = {}
+        results = []
+        for index, resolveJob in enumerate(resolveJobs):
+            try:
+                result = self._resolve(resolveJob, shared)
+            except:
+                self.log.exception("Error resolving trove %s:",
+                        resolveJob.trove.getTroveString())
+                results.append((index, None, traceback.format_exc()))
+            else:
+                results.append((index, result, None))
+            self.setData(results[-1:])
+            self.sendStatus(101, "Resolved %d of %d troves" % (
+                len(results), len(resolveJobs)))
+        self._logCacheStats()
+        self.setData(results)
         self.sendStatus(200, "Resolution completed")
 
+    def _logCacheStats(self):
+        if not self.cfg.useCache:
+            return
+        repocache.saveStats(self.cfg.getCacheDir())
+        memory = repocache.getMemoryCache(self.cfg.getCacheDir(),
+                self.cfg.cacheMemoryLimit)
+        if memory is None:
+            return
+        self.log.info("Repository cache memory tier: %(hits)d hits, "
+                "%(misses)d misses, %(entries)d entries (%(size)d of "
+                "%(limit)d)", memory.getStats())
+
+    def _resolve(self, resolveJob, shared=None):
+        self.log.info("Resolving trove %s", resolveJob.trove.getTroveString())
+
+        buildCfg = resolveJob.getConfig()
+        if self.resolveContexts is not None:
+            context = self.resolveContexts.get(buildCfg)
+            rsv = resolver.DependencyResolver(self.log, context=context)
+        else:
+            client = conaryclient.ConaryClient(buildCfg)
+            repos = client.getRepos()
+            if self.cfg.useCache:
+               repos = getCachingSource(self.cfg, repos)
+            if shared is not None:
+                key = resolver.getContextKey(buildCfg)
+                if key not in shared:
+                    shared[key] = resolver.SharedDepSource(repos,
+                            maxEntries=self.cfg.resolveContextMaxTroves or None)
+                repos = shared[key]
+            rsv = resolver.DependencyResolver(self.log, repos)
+        try:
+            return rsv.resolve(resolveJob)
+        except:
+            # Don't keep a client that may be in a bad state around for the
+            # next task.
+            if self.resolveContexts is not None:
+                self.resolveContexts.invalidate(buildCfg)
+            raise
+
 
 class BuildTask(_BuilderTask):
 
@@ -732,7 +732,9 @@ class ListCommand(rMakeCommand):
     List information about the given rmake server.
 
     Types Available:
-        list [ch]roots - lists chroots on this rmake server"""
+        list [ch]roots - lists chroots on this rmake server
+        list chrootcache - shows the contents and hit rate of the chroot
+                           cache"""
     commands = ['list']
     paramHelp = "<type>"
     help = 'List various information about this rmake server'
@@ -759,6 +761,9 @@ class ListCommand(rMakeCommand):
         allChroots = not argSet.pop('active', False)
         query.listChroots(client, cfg, allChroots=allChroots)
     listRoots = listChroots
+
+    def listChrootcache(self, client, cfg, argSet):
+        query.listChrootCache(client, cfg)
 register(ListCommand)
 
 class ChrootCommand(rMakeCommand):
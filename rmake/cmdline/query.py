@@ -26,6 +26,7 @@ import time
 from conary.deps import deps
 
 from rmake.cmdline import cmdutil
+from rmake.build import buildtimes
 from rmake.build import buildtrove
 from rmake.lib import flavorutil
 
@@ -249,10 +250,24 @@ def displayJobDetail(dcfg, job, out=sys.stdout):
         else:
             totalTime = 'Never finished'
         write('       Started:  %-20s Build Time: %s' % (startTime, totalTime))
+        if job.isBuilding():
+            remaining = getEstimatedTimeRemaining(dcfg, job)
+            if remaining:
+                write('       Remaining: about %s' %
+                        getTimeDifference(remaining))
     write('       To Build: %-20s Building: %s' % (unbuilt, building + waiting + preparing))
     write('       Built:    %-20s Failed:   %s' % (built, failed))
     write()
 
+def getEstimatedTimeRemaining(dcfg, job):
+    troves = list(job.iterTroves())
+    names = set(x.getName().split(':')[0] for x in troves)
+    times = dcfg.getClient().client.getBuildTimes(names)
+    if not times:
+        return None
+    return buildtimes.estimateRemaining(troves,
+            lambda trove: times.get(trove.getName().split(':')[0]))
+
 def printTroves(dcfg, job, troveTupList, out=sys.stdout):
     if troveTupList or dcfg.displayTroveDetail:
         if troveTupList is None:
@@ -419,6 +434,49 @@ def listChroots(client, cfg, allChroots=False):
             if chroot.active or allChroots:
                 displayChroot(chroot)
 
+def listChrootCache(client, cfg):
+    statsByWorker = client.client.getChrootCacheStats()
+    if not statsByWorker:
+        print 'No worker has reported a chroot cache'
+        return
+    for worker in sorted(statsByWorker):
+        print '%s:' % worker
+        displayChrootCache(statsByWorker[worker])
+
+def displayChrootCache(stats):
+    limits = []
+    if stats['maxSize']:
+        limits.append(_formatSize(stats['maxSize']))
+    if stats['maxCount']:
+        limits.append('%d chroots' % stats['maxCount'])
+    if limits:
+        limits = ' (limit %s)' % ', '.join(limits)
+    else:
+        limits = ''
+    print 'Chroot cache: %d chroots, %s%s' % (stats['count'],
+            _formatSize(stats['size']), limits)
+    lookups = stats['hits'] + stats['misses']
+    if lookups:
+        hitRate = ' (%d%% hit rate)' % (100 * stats['hits'] / lookups)
+    else:
+        hitRate = ''
+    print 'Hits: %d  Misses: %d%s  Evictions: %d' % (stats['hits'],
+            stats['misses'], hitRate, stats['evictions'])
+    for fingerprint, size, lastUsed in stats['entries']:
+        print '   %s %9s  %s' % (fingerprint, _formatSize(size),
+                time.strftime('%x %X', time.localtime(lastUsed)))
+
+def _formatSize(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return '%d B' % size
+    return '%.1f %s' % (size, unit)
+
 def displayChroot(chroot):
     if chroot.active:
         active = ' (Building)'
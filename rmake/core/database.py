@@ -98,16 +98,24 @@ class CoreDB(object):
         d.addCallback(_grabOne, func=_oneJob)
         return d
 
-    def updateJob(self, job, frozen_handler=None):
+    def updateJob(self, job, frozen_handler=None, withData=True):
+        """
+        Save a job's status and, if C{withData} is true, its data.
+
+        The data of a big job can run to megabytes, so callers that know it
+        hasn't changed since it was last saved should leave it out. The
+        returned job then carries the data passed in rather than reading it
+        back.
+        """
         stmt = SQL("""
             UPDATE jobs.jobs SET
                 status_code = %s, status_text = %s, status_detail = %s,
-                time_updated = now(), time_ticks = %s, frozen_data = %s,
-                job_priority = %s
+                time_updated = now(), time_ticks = %s, job_priority = %s
                 """, job.status.code, job.status.text, job.status.detail,
-                job.times.ticks, self._coerceBuffer(job.data),
-                job.job_priority,
+                job.times.ticks, job.job_priority,
                 )
+        if withData:
+            stmt += SQL(", frozen_data = %s", self._coerceBuffer(job.data))
         if job.status.final:
             stmt += SQL(", time_finished = now()")
         elif frozen_handler is not None:
@@ -116,10 +124,72 @@ class CoreDB(object):
         stmt += SQL(" WHERE job_uuid = %s", job.job_uuid)
         if job.times.ticks != types.JobTimes.TICK_OVERRIDE:
             stmt += SQL(" AND time_ticks < %s", job.times.ticks)
-        stmt += SQL(" RETURNING jobs.jobs.*")
+        if withData:
+            stmt += SQL(" RETURNING jobs.jobs.*")
+            func = _oneJob
+        else:
+            stmt += SQL(" RETURNING " + _jobColumns)
+            data = job.data
+            if not isinstance(data, types.FrozenObject):
+                data = types.FrozenObject.fromObject(data)
+            func = lambda row: _oneJob(row, data)
 
         d = self.pool.runQuery(stmt)
-        d.addCallback(_grabOne, func=_oneJob)
+        d.addCallback(_grabOne, func=func)
+        return d
+
+    def updateJobs(self, updates):
+        """
+        Save several jobs in one statement.
+
+        @param updates: List of C{(job, frozen_handler, withData)} with the
+            same meaning as the arguments to L{updateJob}.
+        @return: List of the updated jobs, or C{None} for those that were
+            superseded, in the same order.
+        """
+        values = []
+        args = []
+        for job, frozen_handler, withData in updates:
+            values.append("(%s::uuid, %s::smallint, %s::text, %s::text, "
+                    "%s::integer, %s::integer, %s::boolean, %s::bytea, "
+                    "%s::bytea)")
+            args.extend((job.job_uuid, job.status.code, job.status.text,
+                job.status.detail, job.times.ticks, job.job_priority,
+                bool(job.status.final),
+                withData and self._coerceBuffer(job.data) or None,
+                frozen_handler))
+        args.append(types.JobTimes.TICK_OVERRIDE)
+        d = self.pool.runQuery("""
+            UPDATE jobs.jobs AS j SET
+                status_code = v.status_code, status_text = v.status_text,
+                status_detail = v.status_detail, time_updated = now(),
+                time_ticks = v.time_ticks, job_priority = v.job_priority,
+                frozen_data = COALESCE(v.frozen_data, j.frozen_data),
+                time_finished = CASE WHEN v.is_final THEN now()
+                    ELSE j.time_finished END,
+                frozen_handler = CASE WHEN v.is_final THEN j.frozen_handler
+                    ELSE COALESCE(v.frozen_handler, j.frozen_handler) END
+            FROM ( VALUES %s ) AS v ( job_uuid, status_code, status_text,
+                status_detail, time_ticks, job_priority, is_final,
+                frozen_data, frozen_handler )
+            WHERE j.job_uuid = v.job_uuid
+                AND ( v.time_ticks = %%s OR j.time_ticks < v.time_ticks )
+            RETURNING %s
+            """ % (', '.join(values), _prefixColumns('j', _jobColumns)),
+            tuple(args))
+        def cb_merge(rows):
+            byUUID = dict((x[0], x) for x in rows)
+            out = []
+            for job, frozen_handler, withData in updates:
+                row = byUUID.get(job.job_uuid)
+                if row is not None:
+                    data = job.data
+                    if not isinstance(data, types.FrozenObject):
+                        data = types.FrozenObject.fromObject(data)
+                    row = _oneJob(row, data)
+                out.append(row)
+            return out
+        d.addCallback(cb_merge)
         return d
 
     def deleteJobs(self, job_uuids):
@@ -177,6 +247,43 @@ class CoreDB(object):
         d.addCallback(_grabOne, func=_oneTask)
         return d
 
+    def updateTasks(self, tasks):
+        """
+        Save several tasks in one statement.
+
+        Returns a list of the updated tasks, or C{None} for those that were
+        superseded, in the same order as C{tasks}.
+        """
+        values = []
+        args = []
+        for task in tasks:
+            values.append("(%s::uuid, %s::smallint, %s::text, %s::text, "
+                    "%s::integer, %s::text, %s::integer, %s::boolean, "
+                    "%s::bytea)")
+            args.extend((task.task_uuid, task.status.code, task.status.text,
+                task.status.detail, task.times.ticks, task.node_assigned,
+                task.task_priority, bool(task.status.final), task.task_data))
+        args.append(types.JobTimes.TICK_OVERRIDE)
+        d = self.pool.runQuery("""
+            UPDATE jobs.tasks AS t SET
+                status_code = v.status_code, status_text = v.status_text,
+                status_detail = v.status_detail, time_updated = now(),
+                time_ticks = v.time_ticks, node_assigned = v.node_assigned,
+                task_priority = v.task_priority,
+                time_finished = CASE WHEN v.is_final THEN now()
+                    ELSE t.time_finished END,
+                task_data = COALESCE(v.task_data, t.task_data)
+            FROM ( VALUES %s ) AS v ( task_uuid, status_code, status_text,
+                status_detail, time_ticks, node_assigned, task_priority,
+                is_final, task_data )
+            WHERE t.task_uuid = v.task_uuid
+                AND ( v.time_ticks = %%s OR t.time_ticks < v.time_ticks )
+            RETURNING t.*
+            """ % (', '.join(values),), tuple(args))
+        d.addCallback(_mergeThings, pkeys=[x.task_uuid for x in tasks],
+                func=_oneTask)
+        return d
+
     ## Administration
 
     def registerWorker(self, jid):
@@ -244,11 +351,23 @@ def _grabOne(rows, func):
     return func(rows[0])
 
 
-def _oneJob(row):
+# Columns of jobs.jobs other than the job data.
+_jobColumns = """job_uuid, job_type, owner, status_code, status_text,
+    status_detail, time_started, time_updated, time_finished, expires_after,
+    time_ticks, job_priority"""
+
+
+def _prefixColumns(alias, columns):
+    return ', '.join('%s.%s' % (alias, x.strip()) for x in columns.split(','))
+
+
+def _oneJob(row, data=None):
     kwargs = dict(row)
     kwargs['status'] = _popStatus(kwargs)
     kwargs['times'] = _popTimes(kwargs)
-    kwargs['data'] = types.FrozenObject(str(kwargs.pop('frozen_data')))
+    if data is None:
+        data = types.FrozenObject(str(kwargs.pop('frozen_data')))
+    kwargs['data'] = data
     kwargs.pop('frozen_handler', None)
     return types.FrozenRmakeJob(**kwargs)
 
@@ -34,8 +34,10 @@ from rmake.core import admin
 from rmake.core import constants as core_const
 from rmake.core import database as coredb
 from rmake.core import log_server
+from rmake.core import scheduler
 from rmake.core import support
 from rmake.core import types
+from rmake.core import writebehind
 from rmake.core.handler import getHandlerClass
 from rmake.errors import RmakeError
 from rmake.lib import dbpool
@@ -82,7 +84,22 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
         self.jobLoggers = {}
         self.workers = {}
         self.tasks = {}
-        self.taskQueue = []
+        self.taskQueue = scheduler.TaskQueue()
+        self.workerIndex = scheduler.WorkerIndex()
+        # Queue buckets that need to be re-examined on the next assignment
+        # pass.
+        self._dirtyKeys = set()
+        # Status updates that arrive while an earlier one is being written
+        # are combined and written together.
+        self._taskWriter = writebehind.WriteBehind(
+                lambda task: self.db.updateTask(task),
+                lambda tasks: self.db.updateTasks(tasks),
+                merge=_mergeTaskUpdates)
+        self._jobWriter = writebehind.WriteBehind(
+                lambda update: self.db.updateJob(update[0],
+                    frozen_handler=update[1], withData=update[2]),
+                lambda updates: self.db.updateJobs(updates),
+                merge=_mergeJobUpdates)
 
         self.plugins.p.dispatcher.pre_setup(self)
         self._start_db()
@@ -255,18 +272,18 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
                 task_info.worker.tasks.pop(task_uuid, None)
 
         # Discard tasks that never got assigned
-        for task in self.taskQueue[:]:
-            if task.job_uuid == job_uuid:
-                log.debug("Discarding task %s from queue", task.task_uuid)
-                self.taskQueue.remove(task)
+        for task in self.taskQueue.discardJob(job_uuid):
+            log.debug("Discarding task %s from queue", task.task_uuid)
 
         logManager = self.jobLoggers.pop(job_uuid, None)
         if logManager:
             logManager.close()
         del self.jobs[job_uuid]
 
-    def updateJob(self, job, frozen_handler=None):
-        d = self.db.updateJob(job, frozen_handler=frozen_handler)
+    def updateJob(self, job, frozen_handler=None, withData=True):
+        job = job.freeze()
+        d = self._jobWriter.write(job.job_uuid, job.times.ticks,
+                (job, frozen_handler, withData))
         @d.addCallback
         def post_update(newJob):
             if not newJob:
@@ -284,7 +301,7 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
             newTask = newTask.thaw()
             handler = self.jobs[newTask.job_uuid]
             self.tasks[newTask.task_uuid] = TaskInfo(newTask, handler)
-            self.taskQueue.append(newTask)
+            self._dirtyKeys.add(self.taskQueue.add(newTask))
             self._setLogActive(newTask.job_uuid, newTask.task_uuid, True)
             # Try to assign the task immediately
             self._assignTasks()
@@ -329,7 +346,8 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
     ## Message bus API
 
     def updateTask(self, task):
-        d = self.db.updateTask(task)
+        task = task.freeze()
+        d = self._taskWriter.write(task.task_uuid, task.times.ticks, task)
         d.addCallback(self._taskUpdated)
         d.addErrback(self._failJob, task.job_uuid)
         d.addErrback(logFailure)
@@ -346,6 +364,8 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
             info = self.tasks.pop(newTask.task_uuid, None)
             if info and info.worker:
                 info.worker.tasks.pop(newTask.task_uuid, None)
+                # A slot opened up on this worker
+                self._workerChanged(info.worker.jid)
             self.clock.callLater(0, self._assignTasks)
             self._setLogActive(newTask.job_uuid, newTask.task_uuid, False)
         handler = self.jobs.get(newTask.job_uuid)
@@ -362,9 +382,19 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
             worker.setCaps(msg)
             self.plugins.p.dispatcher.worker_up(self, worker)
         else:
+            # Tasks in buckets the worker could serve until now may have no
+            # worker left if it dropped a capability, so look at those too.
+            self._workerChanged(jid)
             worker.setCaps(msg)
+        self.workerIndex.update(worker)
+        self._workerChanged(jid)
         self._assignTasks()
 
+    def workerStats(self, jid, stats):
+        worker = self.workers.get(jid)
+        if worker is not None:
+            worker.stats = stats
+
     def workerDown(self, jid):
         worker = self.workers.get(jid)
         if worker is None:
@@ -376,7 +406,11 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
             task.status = types.JobStatus(400,
                     "The worker processing this task has gone offline.")
             self.updateTask(task)
+        # Tasks that only this worker could have run must now be failed.
+        self._workerChanged(jid)
+        self.workerIndex.remove(worker)
         del self.workers[jid]
+        self.clock.callLater(0, self._assignTasks)
 
         self.plugins.p.dispatcher.worker_down(self, worker)
 
@@ -390,20 +424,33 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
 
     ## Task assignment
 
+    def _workerChanged(self, jid):
+        """Mark the queue buckets that C{jid} can serve for reassignment."""
+        self._dirtyKeys.update(
+                self.workerIndex.keysFor(jid, self.taskQueue.keys()))
+
     def _assignTasks(self):
-        # Sort by priority but preserve the insertion order within each level
-        buckets = {}
-        for task in self.taskQueue:
-            buckets.setdefault(task.task_priority, []).append(task)
-        for priority, tasks in sorted(buckets.iteritems()):
-            for task in tasks:
-                result = self._assignTask(task)
-                if result != core_const.A_LATER:
-                    # Task is no longer queued (assigned or failed)
-                    self.taskQueue.remove(task)
-                if result == core_const.A_NOW:
-                    # Update task now that node_assigned is set.
-                    self.updateTask(task)
+        """Try to assign queued tasks in buckets affected by recent events."""
+        if not self._dirtyKeys:
+            return
+        keys, self._dirtyKeys = self._dirtyKeys, set()
+        # Handlers score all tasks of a given type and zone alike, so once a
+        # task is deferred the rest of that job's tasks in the same bucket
+        # can be deferred without rescoring them against every worker.
+        deferred = set()
+        for entry in self.taskQueue.drain(keys):
+            task = entry[2]
+            deferKey = (task.job_uuid,) + self.taskQueue.keyFor(task)
+            if deferKey in deferred:
+                self.taskQueue.requeue(entry)
+                continue
+            result = self._assignTask(task)
+            if result == core_const.A_LATER:
+                deferred.add(deferKey)
+                self.taskQueue.requeue(entry)
+            elif result == core_const.A_NOW:
+                # Update task now that node_assigned is set.
+                self.updateTask(task)
 
     def _assignTask(self, task):
         """Attempt to assign a task to a node.
@@ -417,12 +464,10 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
                 task.job_uuid)
         scores = {}
         laters = 0
-        wrong_zone = 0
-        for worker in self.workers.values():
-            if not worker.active:
-                log.debug("Worker %s is offline and can't run new tasks",
-                        worker.jid.full())
-                continue
+        jids, wrong_zone = self.workerIndex.candidates(task.task_type,
+                task.task_zone)
+        for jid in jids:
+            worker = self.workers[jid]
             result, score = self._scoreTask(task, worker)
             if result == core_const.A_NOW:
                 log.debug("Worker %s can run task %s now: score=%s",
@@ -434,7 +479,7 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
                 laters += 1
             else:
                 if result == core_const.A_WRONG_ZONE:
-                    wrong_zone += 1
+                    wrong_zone = True
                 log.debug("Worker %s cannot run task %s", worker.jid.full(),
                         task.task_uuid)
 
@@ -490,6 +535,26 @@ class Dispatcher(deferred_service.MultiService, RPCServer):
         self.updateTask(task)
 
 
+
+def _mergeTaskUpdates(old, new):
+    """Keep task data from a superseded update if the newer one has none."""
+    if new.task_data is None and old.task_data is not None:
+        new = new._replace(task_data=old.task_data)
+    return new
+
+
+def _mergeJobUpdates(old, new):
+    """
+    Keep the handler state and the job data flag from a superseded job
+    update if the newer one would not save them.
+    """
+    oldJob, oldHandler, oldData = old
+    newJob, newHandler, newData = new
+    if newHandler is None:
+        newHandler = oldHandler
+    return newJob, newHandler, oldData or newData
+
+
 class WorkerInfo(object):
 
     def __init__(self, jid):
@@ -498,6 +563,8 @@ class WorkerInfo(object):
         self.tasks = {}
         self.slots = {}
         self.addresses = set()
+        # Latest statistics reported by each of the worker's plugins
+        self.stats = {}
         self.protocol = 0
         self.active = None
         # expiring is incremented each time WorkerChecker runs and zeroed each
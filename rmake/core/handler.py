@@ -57,7 +57,8 @@ def getHandlerClass(jobType):
 
 
 class JobHandler(object):
-    __slots__ = ('dispatcher', 'job', 'state', 'tasks', 'clock', 'log')
+    __slots__ = ('dispatcher', 'job', 'state', 'tasks', 'clock', 'log',
+            'savedData')
 
     jobType = None
     jobVersion = 1
@@ -71,6 +72,8 @@ class JobHandler(object):
         self.log = log
         self.state = None
         self.tasks = {}
+        # Job data as last written to the database.
+        self.savedData = job.data
         self.setup()
 
     ## State machine methods
@@ -99,7 +102,7 @@ class JobHandler(object):
         # Wait for the job status to be updated successfully before moving to
         # the next state.
         log.debug("Job %s changing state to %s", self.job.job_uuid, state)
-        d = self.dispatcher.updateJob(self.job)
+        d = self._saveJob()
         d.addCallback(self._runState)
         def eb_failure(reason):
             # Try to fail a job; if it suceeds then change state to 'done'
@@ -159,11 +162,24 @@ class JobHandler(object):
                 '\n%s' % self.job.status.detail
                 if self.job.status.detail else '')
 
-        d = self.dispatcher.updateJob(self.job)
+        d = self._saveJob()
         d.addErrback(self.failJob, message="Error setting job status:",
                 failHard=self.job.status.failed)
         return d
 
+    def _saveJob(self):
+        """Persist the job, including its data only if that has changed."""
+        data = self.job.data
+        withData = data is not self.savedData
+        d = self.dispatcher.updateJob(self.job, withData=withData)
+        if withData:
+            def cb_saved(newJob):
+                if newJob:
+                    self.savedData = data
+                return newJob
+            d.addCallback(cb_saved)
+        return d
+
     def failJob(self, failure, message="Unhandled error in job handler:",
             failHard=False):
         """Log an exception and set the job status to 'failed'.
@@ -288,6 +304,10 @@ class JobHandler(object):
         """Score how able a given worker is to run the given task.
 
         Returns a tuple of an A_* constant and a number. Higher is better.
+
+        The dispatcher assumes that all of a job's tasks with the same type and
+        zone score alike; once one is deferred with A_LATER, the rest are
+        deferred too until the worker pool changes.
         """
         # Are there slots available to run this task in?
         assigned = len(worker.tasks)
@@ -304,10 +324,18 @@ class JobHandler(object):
         return self.job.data.getObject()
 
     def setData(self, obj):
+        """Replace the job's data. It is saved along with the next status
+        change."""
         if not isinstance(obj, rmk_types.FrozenObject):
             obj = rmk_types.FrozenObject.fromObject(obj)
         self.job.data = obj
 
+    def saveData(self, obj):
+        """Replace the job's data and save it immediately."""
+        self.setData(obj)
+        self.job.times.ticks += 1
+        return self._saveJob()
+
 
 TaskCallbacks = namedtuple('TaskCallbacks', 'deferred callbacks')
 
@@ -25,6 +25,8 @@ from twisted.web import http as tw_http
 from twisted.web import static as tw_static
 from zope.interface import implements
 
+from rmake.lib import structlog
+
 log = logging.getLogger(__name__)
 
 
@@ -99,19 +101,36 @@ class LogResource(tw_static.File):
         return self.render_GET(request)
 
     def makeProducer(self, request, fobj):
-        if request.method == 'TAIL' and self.manager.isNodeActive(self):
-            # TODO: accept a single range, as a point to start tailing
-            self._setContentHeaders(request, size=-1)
-            request.setResponseCode(tw_http.OK)
-            producer = FollowingProducer(request, fobj)
-            self.manager.subscribeToNode(self, producer)
-            d = request.notifyFinish()
-            @d.addBoth
-            def _cleanup(_):
-                self.manager.unsubscribeFromNode(self, producer)
-            return producer
-        else:
+        if request.method != 'TAIL':
             return tw_static.File.makeProducer(self, request, fobj)
+        active = self.manager.isNodeActive(self)
+        since = request.args.get('since')
+        if since:
+            # Start tailing from the first record at or after the given
+            # timestamp, if the log is indexed.
+            try:
+                offset = structlog.findOffset(self.path, float(since[0]))
+            except ValueError:
+                offset = None
+            if offset is not None:
+                fobj.seek(offset)
+            else:
+                since = None
+        if not active and not since:
+            return tw_static.File.makeProducer(self, request, fobj)
+
+        self._setContentHeaders(request, size=-1)
+        request.setResponseCode(tw_http.OK)
+        producer = FollowingProducer(request, fobj)
+        if not active:
+            producer.finished = True
+            return producer
+        self.manager.subscribeToNode(self, producer)
+        d = request.notifyFinish()
+        @d.addBoth
+        def _cleanup(_):
+            self.manager.unsubscribeFromNode(self, producer)
+        return producer
 
     def _setContentHeaders(self, request, size=None):
         tw_static.File._setContentHeaders(self, request, size)
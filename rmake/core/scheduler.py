@@ -0,0 +1,163 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Indexes used by the dispatcher to assign queued tasks to workers.
+
+Queued tasks are kept in per-(task type, zone) heaps ordered by priority and
+arrival, and workers are indexed by the task types and zones they advertise.
+This lets the dispatcher re-examine only the tasks that a given event (a new
+task, a heartbeat, or a finished task) could possibly affect.
+"""
+
+
+import heapq
+import itertools
+from rmake.core import types
+
+
+class TaskQueue(object):
+    """Queued tasks, bucketed by C{(task_type, task_zone)}."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._counter = itertools.count()
+
+    @staticmethod
+    def keyFor(task):
+        return (task.task_type, task.task_zone)
+
+    def add(self, task):
+        """Queue C{task} and return the key of the bucket it went into."""
+        key = self.keyFor(task)
+        self._push(key, (task.task_priority, self._counter.next(), task))
+        return key
+
+    def _push(self, key, entry):
+        heapq.heappush(self._buckets.setdefault(key, []), entry)
+
+    def drain(self, keys):
+        """Remove and return all entries in the given buckets.
+
+        Entries are C{(priority, sequence, task)} tuples sorted by priority
+        then by insertion order. Entries that can't be assigned yet must be
+        handed back to L{requeue}.
+        """
+        entries = []
+        for key in keys:
+            entries.extend(self._buckets.pop(key, ()))
+        entries.sort()
+        return entries
+
+    def requeue(self, entry):
+        self._push(self.keyFor(entry[2]), entry)
+
+    def discardJob(self, job_uuid):
+        """Remove and return all queued tasks belonging to C{job_uuid}."""
+        removed = []
+        for key, entries in self._buckets.items():
+            kept = []
+            for entry in entries:
+                if entry[2].job_uuid == job_uuid:
+                    removed.append(entry[2])
+                else:
+                    kept.append(entry)
+            if not kept:
+                del self._buckets[key]
+            elif len(kept) != len(entries):
+                heapq.heapify(kept)
+                self._buckets[key] = kept
+        return removed
+
+    def keys(self):
+        return self._buckets.keys()
+
+    def __len__(self):
+        return sum(len(x) for x in self._buckets.itervalues())
+
+    def __iter__(self):
+        """Iterate over queued tasks in assignment order."""
+        for entry in sorted(itertools.chain(*self._buckets.values())):
+            yield entry[2]
+
+
+class WorkerIndex(object):
+    """Maps task types and zones to the active workers that support them."""
+
+    def __init__(self):
+        self._types = {}
+        self._zones = {}
+        self._workers = {}
+
+    def update(self, worker):
+        """(Re-)index C{worker}.
+
+        Returns C{True} if the set of tasks the worker can accept changed.
+        """
+        if worker.active:
+            new = (frozenset(x.taskType
+                    for x in worker.caps[types.TaskCapability]),
+                frozenset(x.zoneName
+                    for x in worker.caps[types.ZoneCapability]))
+        else:
+            new = None
+        old = self._workers.get(worker.jid)
+        if old == new:
+            return False
+        self.remove(worker)
+        if new is not None:
+            self._workers[worker.jid] = new
+            taskTypes, zones = new
+            for taskType in taskTypes:
+                self._types.setdefault(taskType, set()).add(worker.jid)
+            for zone in zones:
+                self._zones.setdefault(zone, set()).add(worker.jid)
+        return True
+
+    def remove(self, worker):
+        old = self._workers.pop(worker.jid, None)
+        if old is None:
+            return
+        taskTypes, zones = old
+        for index, names in ((self._types, taskTypes), (self._zones, zones)):
+            for name in names:
+                jids = index[name]
+                jids.discard(worker.jid)
+                if not jids:
+                    del index[name]
+
+    def candidates(self, taskType, zone):
+        """Return the workers that can run tasks in the given bucket.
+
+        Returns a tuple of the set of worker JIDs and a boolean that is
+        C{True} if some workers would have been able to run the task were it
+        not for the zone.
+        """
+        jids = self._types.get(taskType, set())
+        if zone is None or not jids:
+            return jids, False
+        inZone = jids & self._zones.get(zone, set())
+        return inZone, not inZone
+
+    def keysFor(self, jid, keys):
+        """Return the members of C{keys} that worker C{jid} could serve."""
+        info = self._workers.get(jid)
+        if info is None:
+            return set()
+        taskTypes, zones = info
+        return set(key for key in keys
+                if key[0] in taskTypes and (key[1] is None or key[1] in zones))
@@ -18,6 +18,9 @@ CREATE TABLE job_troves (
     source_version text NOT NULL,
     build_flavor text NOT NULL,
     build_context text NOT NULL,
+    trove_state smallint,
+    trove_status text,
+    time_updated timestamp with time zone,
     PRIMARY KEY ( job_uuid, source_version, build_flavor, build_context )
 );
 
@@ -0,0 +1,3 @@
+ALTER TABLE build.job_troves ADD trove_state smallint;
+ALTER TABLE build.job_troves ADD trove_status text;
+ALTER TABLE build.job_troves ADD time_updated timestamp with time zone;
@@ -21,6 +21,7 @@ from rmake.lib.uuid import UUID
 from rmake.messagebus import message
 from rmake.messagebus.client import BusService
 from rmake.messagebus.interact import InteractiveHandler
+from rmake.messagebus.logger import decodeRecords
 from twisted.application.internet import TimerService
 
 log = logging.getLogger(__name__)
@@ -41,7 +42,19 @@ class DispatcherBusService(BusService):
             self.dispatcher.updateTask(msg.task)
         elif isinstance(msg, message.Heartbeat):
             self.dispatcher.workerHeartbeat(msg.info.sender, msg)
+        elif isinstance(msg, message.WorkerStats):
+            self.dispatcher.workerStats(msg.info.sender, msg.stats)
+        elif isinstance(msg, message.LogBatch):
+            try:
+                records = decodeRecords(msg.data)
+            except:
+                log.exception("Failed to decode log records from %s:",
+                        msg.info.sender)
+                return
+            self.dispatcher.workerLogging(records, msg.job_uuid,
+                    msg.task_uuid)
         elif isinstance(msg, message.LogRecords):
+            # Sent by older workers.
             self.dispatcher.workerLogging(msg.records, msg.job_uuid,
                     msg.task_uuid)
         else:
@@ -19,6 +19,7 @@ import copy
 import inspect
 import itertools
 import sys
+from rmake.lib import bincodec
 from rmake.lib import chutney
 from rmake.lib import uuid
 from rmake.lib.ninamori.types import namedtuple
@@ -54,6 +55,7 @@ def freezify(cls, frameCount=1):
     module = sys._getframe(frameCount).f_globals.get('__name__', '__main__')
     frozenType.__module__ = module
     chutney.register(frozenType, _force=True)
+    bincodec.register(frozenType)
 
     return frozenType
 
@@ -144,6 +146,7 @@ def slottype(name, attrs):
         '__module__': module,
         })
     chutney.register(cls, _force=True)
+    bincodec.register(cls)
     return cls
 
 
@@ -244,16 +247,19 @@ FrozenJobTimes = freezify(JobTimes)
 class VersionCapability(namedtuple('VersionCapability', 'versions')):
     """Worker supports these protocol versions."""
 chutney.register(VersionCapability)
+bincodec.register(VersionCapability)
 
 
 class TaskCapability(namedtuple('TaskCapability', 'taskType')):
     """Worker is capable of running the given task type."""
 chutney.register(TaskCapability)
+bincodec.register(TaskCapability)
 
 
 class ZoneCapability(namedtuple('ZoneCapability', 'zoneName')):
     """Worker participates in the given zone."""
 chutney.register(ZoneCapability)
+bincodec.register(ZoneCapability)
 
 
 class CapabilitySet(object):
@@ -302,6 +308,7 @@ class ThawedObject(namedtuple('ThawedObject', 'object')):
         return self
 
 chutney.register(ThawedObject)
+bincodec.register(ThawedObject)
 
 
 class FrozenObject(namedtuple('FrozenObject', 'data')):
@@ -342,3 +349,4 @@ class FrozenObject(namedtuple('FrozenObject', 'data')):
     __copy__ = __deepcopy__
 
 chutney.register(FrozenObject)
+bincodec.register(FrozenObject)
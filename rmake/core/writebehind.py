@@ -0,0 +1,127 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+"""
+Coalesce status updates on their way to the database.
+
+Tasks and jobs carry a tick count that goes up with each update, and the
+database ignores an update whose ticks are not higher than those already
+stored. So when several updates to one row are waiting to be written, only
+the one with the most ticks needs to be.
+"""
+
+from twisted.internet import defer
+
+from rmake.core import types
+from rmake.lib.logger import logFailure
+
+
+class _Pending(object):
+    __slots__ = ('ticks', 'item', 'waiters')
+
+    def __init__(self, ticks, item, waiters):
+        self.ticks = ticks
+        self.item = item
+        self.waiters = waiters
+
+
+class WriteBehind(object):
+    """
+    Write versioned updates to database rows, combining those that arrive
+    while a write is outstanding.
+
+    While nothing is being written an update goes out immediately. Updates
+    that arrive during a write wait for it to finish, and of several for the
+    same row only the newest is kept. Then all of the waiting updates are
+    written together by one call to C{writeMany}.
+
+    The deferred returned for each update fires with the row as written, or
+    with C{None} if the update was superseded, just as if it had been
+    written by itself.
+
+    @param writeOne: Callable that writes one item, returning a deferred
+        row or C{None}.
+    @param writeMany: Callable that writes a list of items, returning a
+        deferred list of rows or C{None} in the same order.
+    @param merge: Optional callable given a superseded item and the item
+        superseding it, returning the item to write instead of the latter.
+    """
+
+    def __init__(self, writeOne, writeMany, merge=None):
+        self.writeOne = writeOne
+        self.writeMany = writeMany
+        self.merge = merge
+        self.pending = {}
+        self.order = []
+        self.writing = False
+        self.written = self.batches = self.superseded = 0
+
+    def write(self, key, ticks, item):
+        """Queue C{item} with tick count C{ticks} to be written to the row
+        identified by C{key}."""
+        d = defer.Deferred()
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = _Pending(ticks, item, [d])
+            self.order.append(key)
+        elif (ticks >= types.JobTimes.TICK_OVERRIDE
+                or ticks > entry.ticks):
+            if self.merge:
+                item = self.merge(entry.item, item)
+            waiters = entry.waiters
+            entry.ticks, entry.item, entry.waiters = ticks, item, [d]
+            self.superseded += len(waiters)
+            for waiter in waiters:
+                waiter.callback(None)
+        else:
+            # The database would refuse it after the waiting update anyway.
+            self.superseded += 1
+            d.callback(None)
+            return d
+        if not self.writing:
+            self._flush()
+        return d
+
+    def _flush(self):
+        if not self.order:
+            return
+        batch = [self.pending.pop(key) for key in self.order]
+        self.order = []
+        self.writing = True
+        self.written += len(batch)
+        self.batches += 1
+        if len(batch) == 1:
+            d = defer.maybeDeferred(self.writeOne, batch[0].item)
+            d.addCallback(lambda result: [result])
+        else:
+            d = defer.maybeDeferred(self.writeMany, [x.item for x in batch])
+
+        def cb_written(results):
+            self.writing = False
+            for entry, result in zip(batch, results):
+                for waiter in entry.waiters:
+                    waiter.callback(result)
+
+        def eb_failed(reason):
+            self.writing = False
+            for entry in batch:
+                for waiter in entry.waiters:
+                    waiter.errback(reason)
+        d.addCallbacks(cb_written, eb_failed)
+        d.addCallback(lambda _: self._flush())
+        d.addErrback(logFailure, "Unhandled error writing updates:")
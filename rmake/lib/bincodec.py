@@ -0,0 +1,466 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+"""
+Compact binary encoding of plain values and registered record types.
+
+This is a faster and smaller alternative to L{rmake.lib.chutney} for data
+whose shape is known ahead of time. Only the builtin types handled below and
+classes passed to L{register} can be encoded, so decoding never has to
+decide whether a class is safe to create.
+
+A record is written as a reference to its type followed by its fields in
+order, without field names. The first time a type appears in an encoded
+string, its registered name and field count are written out and given the
+next number in a table that later references use. Both ends must register
+the type under the same name with the same fields; a different field count
+fails to decode instead of being misread.
+"""
+
+import datetime
+import struct
+
+from rmake.lib import uuid
+
+VERSION = 1
+
+_byte = struct.Struct('!b')
+_short = struct.Struct('!h')
+_int = struct.Struct('!i')
+_long = struct.Struct('!q')
+_count = struct.Struct('!I')
+_smallCount = struct.Struct('!B')
+_record = struct.Struct('!HI')
+_double = struct.Struct('!d')
+_uuid = struct.Struct('!QQ')
+_datetime = struct.Struct('!HBBBBBIh')
+_timedelta = struct.Struct('!iiI')
+
+# Offset value marking a datetime without a time zone
+_NAIVE = -0x8000
+_MASK64 = (1 << 64) - 1
+
+
+class EncodeError(TypeError):
+    """The value contains something that can't be encoded."""
+
+
+class DecodeError(ValueError):
+    """The encoded data is malformed or doesn't match the registered
+    types."""
+
+
+class _FixedOffset(datetime.tzinfo):
+    """Time zone with a constant offset from UTC, in minutes."""
+
+    def __init__(self, offset):
+        self._offset = datetime.timedelta(minutes=offset)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+    def __repr__(self):
+        return '_FixedOffset(%d)' % (self._offset.seconds // 60
+                + self._offset.days * 1440)
+
+
+class _RecordType(object):
+    __slots__ = ('name', 'count', 'reduce', 'construct')
+
+    def __init__(self, name, count, reduce, construct):
+        self.name = name
+        self.count = count
+        self.reduce = reduce
+        self.construct = construct
+
+
+# class -> _RecordType
+_typesByClass = {}
+# name -> _RecordType
+_typesByName = {}
+
+
+def register(cls, fields=None, reduce=None, construct=None, name=None):
+    """
+    Allow instances of C{cls} to be encoded.
+
+    By default named tuples are encoded by their C{_fields}, and other
+    classes by their C{__slots__}, which are restored without calling
+    C{__init__}. Other classes need C{reduce}, a callable returning a
+    sequence of field values for an instance, and C{construct}, a callable
+    building an instance from that sequence.
+    """
+    if name is None:
+        name = '%s.%s' % (cls.__module__, cls.__name__)
+    if reduce is None:
+        if fields is None:
+            fields = getattr(cls, '_fields', None)
+        if fields is not None and issubclass(cls, tuple):
+            reduce = tuple
+            construct = cls._make
+        else:
+            if fields is None:
+                fields = cls.__slots__
+            fields = tuple(fields)
+
+            def reduce(obj):
+                return [getattr(obj, x) for x in fields]
+
+            def construct(values):
+                obj = cls.__new__(cls)
+                for field, value in zip(fields, values):
+                    setattr(obj, field, value)
+                return obj
+        count = len(fields)
+    else:
+        assert construct is not None
+        count = None
+    rtype = _RecordType(name, count, reduce, construct)
+    _typesByClass[cls] = rtype
+    _typesByName[name] = rtype
+
+
+class Encoder(object):
+
+    def __init__(self):
+        self.out = []
+        self.types = {}
+
+    def getvalue(self):
+        return ''.join(self.out)
+
+    def encode(self, value):
+        func = _encoders.get(type(value))
+        if func is not None:
+            func(self, value)
+            return
+        rtype = _typesByClass.get(type(value))
+        if rtype is None:
+            raise EncodeError("Can't encode object of type %s.%s" % (
+                type(value).__module__, type(value).__name__))
+        self._encodeRecord(rtype, value)
+
+    def _encodeRecord(self, rtype, value):
+        out = self.out
+        index = self.types.get(rtype)
+        if index is None:
+            index = self.types[rtype] = len(self.types)
+            name = rtype.name
+            out.append('c' + _smallCount.pack(len(name)) + name)
+        values = rtype.reduce(value)
+        if rtype.count is not None and len(values) != rtype.count:
+            raise EncodeError("Record of type %s has %d fields, expected %d"
+                    % (rtype.name, len(values), rtype.count))
+        out.append('r' + _record.pack(index, len(values)))
+        encode = self.encode
+        for item in values:
+            encode(item)
+
+    def _none(self, value):
+        self.out.append('N')
+
+    def _bool(self, value):
+        self.out.append(value and 'T' or 'F')
+
+    def _int(self, value):
+        if -0x80 <= value < 0x80:
+            self.out.append('b' + _byte.pack(value))
+        elif -0x80000000 <= value < 0x80000000:
+            self.out.append('i' + _int.pack(value))
+        elif -0x8000000000000000 <= value < 0x8000000000000000:
+            self.out.append('q' + _long.pack(value))
+        else:
+            data = str(value)
+            self.out.append('L' + _smallCount.pack(len(data)) + data)
+
+    def _float(self, value):
+        self.out.append('d' + _double.pack(value))
+
+    def _str(self, value):
+        if len(value) < 0x100:
+            self.out.append('S' + _smallCount.pack(len(value)))
+        else:
+            self.out.append('s' + _count.pack(len(value)))
+        self.out.append(value)
+
+    def _unicode(self, value):
+        value = value.encode('utf8')
+        self.out.append('u' + _count.pack(len(value)))
+        self.out.append(value)
+
+    def _dict(self, value):
+        self.out.append('m' + _count.pack(len(value)))
+        encode = self.encode
+        for key, item in value.iteritems():
+            encode(key)
+            encode(item)
+
+    def _uuid(self, value):
+        self.out.append('U' + _uuid.pack(value >> 64, value & _MASK64))
+
+    def _datetime(self, value):
+        offset = value.utcoffset()
+        if offset is None:
+            offset = _NAIVE
+        else:
+            offset = offset.days * 1440 + offset.seconds // 60
+        self.out.append('D' + _datetime.pack(value.year, value.month,
+            value.day, value.hour, value.minute, value.second,
+            value.microsecond, offset))
+
+    def _timedelta(self, value):
+        self.out.append('R' + _timedelta.pack(value.days, value.seconds,
+            value.microseconds))
+
+
+def _sequenceEncoder(tag):
+    def encodeSequence(self, value):
+        self.out.append(tag + _count.pack(len(value)))
+        encode = self.encode
+        for item in value:
+            encode(item)
+    return encodeSequence
+
+
+_encoders = {
+        type(None): Encoder._none,
+        bool: Encoder._bool,
+        int: Encoder._int,
+        long: Encoder._int,
+        float: Encoder._float,
+        str: Encoder._str,
+        unicode: Encoder._unicode,
+        list: _sequenceEncoder('l'),
+        tuple: _sequenceEncoder('t'),
+        set: _sequenceEncoder('e'),
+        frozenset: _sequenceEncoder('f'),
+        dict: Encoder._dict,
+        uuid.UUID: Encoder._uuid,
+        datetime.datetime: Encoder._datetime,
+        datetime.timedelta: Encoder._timedelta,
+        }
+
+
+class Decoder(object):
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+        self.types = []
+
+    def decode(self):
+        data = self.data
+        offset = self.offset
+        try:
+            tag = data[offset]
+            if tag == 'S':
+                # Short strings are by far the most common value, so skip
+                # the dispatch for them.
+                start = offset + 2
+                end = self.offset = start + ord(data[offset + 1])
+                if end > len(data):
+                    raise DecodeError("Truncated data")
+                return data[start:end]
+            self.offset = offset + 1
+            return _decoders[tag](self)
+        except DecodeError:
+            raise
+        except KeyError:
+            if tag not in _decoders:
+                raise DecodeError("Unknown tag %r" % (tag,))
+            raise
+        except (struct.error, IndexError):
+            raise DecodeError("Truncated data")
+        except (ValueError, TypeError), err:
+            # Malformed numbers, unhashable keys or set members, and fields
+            # that a record type won't accept.
+            raise DecodeError("Invalid value: %s" % (err,))
+
+    def _unpack(self, fmt):
+        value = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def _take(self, size):
+        start = self.offset
+        end = self.offset = start + size
+        if end > len(self.data):
+            raise DecodeError("Truncated data")
+        return self.data[start:end]
+
+    def _typedef(self):
+        name = self._shortStr()
+        rtype = _typesByName.get(name)
+        if rtype is None:
+            raise DecodeError("Unknown record type %s" % (name,))
+        self.types.append(rtype)
+        return self.decode()
+
+    def _record(self):
+        index, count = self._unpack(_record)
+        try:
+            rtype = self.types[index]
+        except IndexError:
+            raise DecodeError("Undefined record type %d" % index)
+        if rtype.count is not None and count != rtype.count:
+            raise DecodeError("Record of type %s has %d fields, expected %d"
+                    % (rtype.name, count, rtype.count))
+        decode = self.decode
+        return rtype.construct([decode() for x in xrange(count)])
+
+    def _none(self):
+        return None
+
+    def _true(self):
+        return True
+
+    def _false(self):
+        return False
+
+    def _byte(self):
+        value = ord(self.data[self.offset])
+        self.offset += 1
+        if value >= 0x80:
+            value -= 0x100
+        return value
+
+    def _int(self):
+        return self._unpack(_int)[0]
+
+    def _long(self):
+        return self._unpack(_long)[0]
+
+    def _bigint(self):
+        size, = self._unpack(_smallCount)
+        return long(self._take(size))
+
+    def _float(self):
+        return self._unpack(_double)[0]
+
+    def _shortStr(self):
+        data = self.data
+        start = self.offset + 1
+        end = self.offset = start + ord(data[start - 1])
+        if end > len(data):
+            raise DecodeError("Truncated data")
+        return data[start:end]
+
+    def _str(self):
+        size, = self._unpack(_count)
+        return self._take(size)
+
+    def _unicode(self):
+        size, = self._unpack(_count)
+        try:
+            return self._take(size).decode('utf8')
+        except UnicodeDecodeError:
+            raise DecodeError("Invalid UTF-8 string")
+
+    def _items(self):
+        count, = self._unpack(_count)
+        decode = self.decode
+        return [decode() for x in xrange(count)]
+
+    def _tuple(self):
+        return tuple(self._items())
+
+    def _set(self):
+        return set(self._items())
+
+    def _frozenset(self):
+        return frozenset(self._items())
+
+    def _dict(self):
+        count, = self._unpack(_count)
+        decode = self.decode
+        out = {}
+        for x in xrange(count):
+            key = decode()
+            out[key] = decode()
+        return out
+
+    def _uuid(self):
+        high, low = self._unpack(_uuid)
+        return long.__new__(uuid.UUID, (high << 64) | low)
+
+    def _datetime(self):
+        (year, month, day, hour, minute, second, microsecond, offset
+                ) = self._unpack(_datetime)
+        tz = None
+        if offset != _NAIVE:
+            tz = _FixedOffset(offset)
+        try:
+            return datetime.datetime(year, month, day, hour, minute, second,
+                    microsecond, tz)
+        except ValueError, err:
+            raise DecodeError("Invalid datetime: %s" % (err,))
+
+    def _timedelta(self):
+        days, seconds, microseconds = self._unpack(_timedelta)
+        return datetime.timedelta(days, seconds, microseconds)
+
+
+_decoders = {
+        'c': Decoder._typedef,
+        'r': Decoder._record,
+        'N': Decoder._none,
+        'T': Decoder._true,
+        'F': Decoder._false,
+        'b': Decoder._byte,
+        'i': Decoder._int,
+        'q': Decoder._long,
+        'L': Decoder._bigint,
+        'd': Decoder._float,
+        'S': Decoder._shortStr,
+        's': Decoder._str,
+        'u': Decoder._unicode,
+        'l': Decoder._items,
+        't': Decoder._tuple,
+        'e': Decoder._set,
+        'f': Decoder._frozenset,
+        'm': Decoder._dict,
+        'U': Decoder._uuid,
+        'D': Decoder._datetime,
+        'R': Decoder._timedelta,
+        }
+
+
+def dumps(value):
+    """Encode C{value}, raising L{EncodeError} if that isn't possible."""
+    encoder = Encoder()
+    encoder.out.append(chr(VERSION))
+    encoder.encode(value)
+    return encoder.getvalue()
+
+
+def loads(data):
+    """Decode a value encoded by L{dumps}, raising L{DecodeError} if the
+    data is malformed."""
+    if not data or ord(data[0]) != VERSION:
+        raise DecodeError("Unsupported encoding version")
+    decoder = Decoder(data, 1)
+    value = decoder.decode()
+    if decoder.offset != len(data):
+        raise DecodeError("Trailing data")
+    return value
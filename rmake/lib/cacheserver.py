@@ -0,0 +1,332 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Share the contents of a repository cache with other nodes.
+
+Changesets and file contents in a L{rmake.lib.repocache.RepositoryCache}
+are named by hashes of the troves and files they hold, so any node can serve
+its entries to any other. A node
+runs L{CacheResource} in its launcher, and each worker asks the nodes listed
+as its peers for the entries it is missing before going to the repository.
+
+A request is a POST of newline-separated hashes. The response holds, for
+each hash the server has, a C{"<hash> <size>\\n"} header followed by exactly
+C{size} bytes of the raw datastore file. Hashes the server does not have are
+left out.
+
+The server only answers clients whose address is in its list of allowed
+networks. Clients don't take a peer's word for what an entry holds either:
+each entry is checked by the caller before it is added to the store.
+Dependency results can't be checked without asking the repository, so they
+are not shared.
+"""
+
+import binascii
+import errno
+import logging
+import os
+import re
+import socket
+import tempfile
+import time
+import urllib2
+from httplib import HTTPException
+
+from twisted.internet import defer
+from twisted.protocols.basic import FileSender
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from conary.lib import util
+
+from rmake.lib import repocache
+from rmake.lib.twisted_extras.ipv6 import TCP6Server
+
+log = logging.getLogger(__name__)
+
+# Most hashes asked for in one request.
+MAX_HASHES = 1000
+
+_hashRE = re.compile('^[0-9a-f]{40}$')
+
+# Clients allowed when no networks are configured.
+LOCAL_NETWORKS = ('127.0.0.0/8', '::1')
+
+
+class CacheProtocolError(Exception):
+    pass
+
+
+def parseNetworks(specs):
+    """
+    Parse addresses and networks such as C{10.1.2.3}, C{10.0.0.0/8} or
+    C{fd00::/8} for L{addressAllowed}.
+
+    @raise ValueError: If one of C{specs} is not an address or network.
+    """
+    networks = []
+    for spec in specs:
+        address, _, bits = spec.partition('/')
+        family = ':' in address and socket.AF_INET6 or socket.AF_INET
+        try:
+            packed = socket.inet_pton(family, address)
+        except socket.error:
+            raise ValueError("Invalid address %r" % (spec,))
+        width = len(packed) * 8
+        if bits:
+            bits = int(bits)
+            if not 0 <= bits <= width:
+                raise ValueError("Invalid network %r" % (spec,))
+        else:
+            bits = width
+        value = int(binascii.hexlify(packed), 16)
+        networks.append((family, value >> (width - bits), bits))
+    return networks
+
+
+def addressAllowed(address, networks):
+    """Return C{True} if C{address} is in one of C{networks}."""
+    if address.startswith('::ffff:') and '.' in address:
+        # IPv4 client of an IPv6 socket
+        address = address[7:]
+    family = ':' in address and socket.AF_INET6 or socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, address)
+    except socket.error:
+        return False
+    width = len(packed) * 8
+    value = int(binascii.hexlify(packed), 16)
+    for netFamily, network, bits in networks:
+        if netFamily == family and value >> (width - bits) == network:
+            return True
+    return False
+
+
+class CacheResource(Resource):
+    """Serve entries of a repository cache's datastore to other nodes."""
+
+    isLeaf = True
+
+    def __init__(self, store, allowed=LOCAL_NETWORKS):
+        Resource.__init__(self)
+        self.store = store
+        self.networks = parseNetworks(allowed)
+        self.requests = self.served = self.refused = 0
+
+    def render_POST(self, request):
+        client = request.getClientIP()
+        if client is None or not addressAllowed(client, self.networks):
+            self.refused += 1
+            request.setResponseCode(403)
+            return ''
+        request.content.seek(0, 0)
+        hashes = [x for x in request.content.read().split()
+                if _hashRE.match(x)][:MAX_HASHES]
+        request.setHeader('content-type', 'application/octet-stream')
+        self.requests += 1
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d = self._sendNext(request, iter(hashes), finished)
+
+        @d.addCallback
+        def done(_):
+            if not finished:
+                request.finish()
+
+        @d.addErrback
+        def send_failed(failure):
+            log.error("Error sending cache entries:\n%s",
+                    failure.getTraceback())
+            if not finished:
+                request.loseConnection()
+
+        return NOT_DONE_YET
+
+    def _sendNext(self, request, hashes, finished):
+        for hash in hashes:
+            if finished:
+                # Client went away.
+                return defer.succeed(None)
+            fobj = self._open(hash)
+            if fobj is None:
+                continue
+            size = os.fstat(fobj.fileno()).st_size
+            request.write('%s %d\n' % (hash, size))
+            self.served += 1
+            d = FileSender().beginFileTransfer(fobj, request)
+            def sent(_, fobj=fobj):
+                fobj.close()
+                return self._sendNext(request, hashes, finished)
+            def failed(failure, fobj=fobj):
+                fobj.close()
+                if finished:
+                    # Transfer was cut short by the client disconnecting.
+                    return None
+                return failure
+            d.addCallbacks(sent, failed)
+            return d
+        return defer.succeed(None)
+
+    def _open(self, hash):
+        try:
+            return open(self.store.hashToPath(hash), 'rb')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        return None
+
+
+def createService(cacheDir, port, interface='', allowed=None):
+    """
+    Return a service that serves the repository cache in C{cacheDir} on
+    C{port} to the nodes in the C{allowed} networks, or to this host only
+    if none are given.
+    """
+    util.mkdirChain(cacheDir)
+    resource = CacheResource(repocache.DataStore(cacheDir),
+            allowed or LOCAL_NETWORKS)
+    return TCP6Server(port, _QuietSite(resource), interface=interface)
+
+
+class _QuietSite(Site):
+
+    def log(self, request):
+        # Every resolve and chroot can make requests; don't log them all.
+        pass
+
+
+class CachePeers(object):
+    """
+    Synchronous client that fetches cache entries from other nodes'
+    L{CacheResource}.
+
+    A peer that cannot be reached is skipped for C{retryInterval} seconds.
+    """
+
+    def __init__(self, urls, timeout=10, retryInterval=60):
+        self.urls = [x.rstrip('/') + '/' for x in urls]
+        self.timeout = timeout
+        self.retryInterval = retryInterval
+        self._downUntil = {}
+        self.hits = self.misses = 0
+
+    def _livePeers(self):
+        now = time.time()
+        return [x for x in self.urls if self._downUntil.get(x, 0) <= now]
+
+    def fetch(self, hashes, store, verify):
+        """
+        Copy any of C{hashes} that a peer has into datastore C{store}.
+
+        Each entry is downloaded to a temporary file and passed to
+        C{verify(hash, path)}, which must return C{True} for it to be kept.
+        A peer that sends an entry failing the check is treated like one
+        that is down.
+
+        Returns the set of hashes that were fetched.
+        """
+        wanted = set(hashes)
+        fetched = set()
+        for url in self._livePeers():
+            if not wanted:
+                break
+            toAsk = sorted(wanted)
+            try:
+                for start in range(0, len(toAsk), MAX_HASHES):
+                    self._fetchFrom(url, toAsk[start:start + MAX_HASHES],
+                            store, verify, fetched)
+            except (IOError, socket.error, HTTPException,
+                    CacheProtocolError), err:
+                log.warning("Cache peer %s failed, not using it for %d "
+                        "seconds: %s", url, self.retryInterval, err)
+                self._downUntil[url] = time.time() + self.retryInterval
+            # Entries stored before a failure are kept.
+            wanted.difference_update(fetched)
+        self.hits += len(fetched)
+        self.misses += len(wanted)
+        return fetched
+
+    def _fetchFrom(self, url, hashes, store, verify, fetched):
+        """Fetch C{hashes} from C{url}, adding each one stored to
+        C{fetched}."""
+        request = urllib2.Request(url, '\n'.join(hashes),
+                {'Content-Type': 'text/plain'})
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        requested = set(hashes)
+        try:
+            while True:
+                header = response.readline()
+                if not header:
+                    break
+                try:
+                    hash, size = header.split()
+                    size = int(size)
+                except ValueError:
+                    raise CacheProtocolError("Bad entry header %r" %
+                            (header[:100],))
+                if hash not in requested or size < 0:
+                    raise CacheProtocolError("Unexpected entry %r" %
+                            (header[:100],))
+                self._storeEntry(response, hash, size, store, verify)
+                fetched.add(hash)
+        finally:
+            response.close()
+
+    def _storeEntry(self, response, hash, size, store, verify):
+        path = store.hashToPath(hash)
+        store.makeDir(path)
+        tmpFd, tmpName = tempfile.mkstemp(prefix=os.path.basename(path),
+                dir=os.path.dirname(path))
+        try:
+            fobj = os.fdopen(tmpFd, 'wb')
+            try:
+                remaining = size
+                while remaining:
+                    data = response.read(min(remaining, 65536))
+                    if not data:
+                        raise CacheProtocolError("Truncated entry %s" % hash)
+                    fobj.write(data)
+                    remaining -= len(data)
+            finally:
+                fobj.close()
+            if not verify(hash, tmpName):
+                raise CacheProtocolError("Entry %s failed verification" %
+                        hash)
+            store.addFileFromTemp(hash, tmpName)
+        except:
+            util.removeIfExists(tmpName)
+            raise
+
+
+_peers = {}
+
+
+def getPeers(urls):
+    """
+    Return a L{CachePeers} for C{urls} shared by the whole process, so that
+    peers found to be down are remembered between uses, or C{None} if there
+    are no peers.
+    """
+    if not urls:
+        return None
+    key = tuple(urls)
+    peers = _peers.get(key)
+    if peers is None:
+        peers = _peers[key] = CachePeers(urls)
+    return peers
@@ -20,13 +20,25 @@ Cache of chroots.
 """
 
 import errno
+import fcntl
+import logging
+import marshal
 import os
-import subprocess
+import shutil
+import stat
+import tarfile
 import tempfile
+import time
 
-from conary.lib import sha1helper, util
+from conary.lib import digestlib, sha1helper, util
+from rmake.lib import compression
 sha1ToString = sha1helper.sha1ToString
 
+log = logging.getLogger(__name__)
+
+# ioctl to share the data blocks of one file with another (btrfs, xfs)
+FICLONE = 0x40049409
+
 class ChrootCacheInterface(object):
     """
     ChrootCacheInterface defines the standard interface for a chroot
@@ -80,50 +92,811 @@ class ChrootCacheInterface(object):
         """
         raise NotImplementedError
 
+    def recordTroves(self, chrootFingerprint, baseFingerprint,
+            troveFingerprints):
+        """
+        Remember what went into the cached chroot with the given
+        fingerprint, so that it can serve as the starting point for a
+        similar chroot later.
+
+        @param chrootFingerprint: The fingerprint of the whole chroot
+        @type chrootFingerprint: str of length 20
+        @param baseFingerprint: Fingerprint of everything besides the
+        build requirements that the chroot depends on
+        @type baseFingerprint: str of length 20
+        @param troveFingerprints: Fingerprints of each build requirement
+        @type troveFingerprints: list of str
+        """
+
+    def findClosest(self, baseFingerprint, troveFingerprints):
+        """
+        Find the cached chroot with the same base fingerprint that has the
+        most troves in common with C{troveFingerprints}.
+
+        @return: The chroot fingerprint of the best match, or C{None} if
+        there is no close enough match.
+        """
+        return None
+
+    def getStats(self):
+        """
+        Return a dictionary of statistics about the cache, such as its
+        size and the number of hits, misses and evictions.
+        """
+        return {}
+
+
+class ChrootIndex(object):
+    """
+    Index of the build requirements installed in each cached chroot,
+    stored as one small file per chroot fingerprint.
+    """
+
+    VERSION = 1
+
+    def __init__(self, indexDir):
+        self.indexDir = indexDir
+        # fingerprint string -> (stat key, base fingerprint, trove fingerprints)
+        self._entries = {}
+
+    def add(self, chrootFingerprint, baseFingerprint, troveFingerprints):
+        util.mkdirChain(self.indexDir)
+        fobj = util.AtomicFile(self._getPath(chrootFingerprint), 'wb',
+                chmod=0600)
+        fobj.write(marshal.dumps((self.VERSION, baseFingerprint,
+            list(troveFingerprints))))
+        fobj.commit()
+
+    def remove(self, chrootFingerprint):
+        util.removeIfExists(self._getPath(chrootFingerprint))
+        self._entries.pop(sha1ToString(chrootFingerprint), None)
+
+    def findClosest(self, baseFingerprint, troveFingerprints, hasChroot):
+        """
+        Return the fingerprint of the indexed chroot with the most troves in
+        common with C{troveFingerprints}, or C{None}.
+
+        Like picking an old chroot to reuse, every matching trove counts
+        twice and every extra trove, which would have to be erased, counts
+        against the chroot. A chroot that doesn't score at least the number
+        of troves wanted would save too little to be worth restoring.
+        """
+        wanted = set(troveFingerprints)
+        best, bestRank = None, len(wanted)
+        for name, (base, troves) in self._refresh().iteritems():
+            if base != baseFingerprint:
+                continue
+            common = len(troves & wanted)
+            rank = 2 * common - (len(troves) - common)
+            if common and rank >= bestRank:
+                fingerprint = sha1helper.sha1FromString(name)
+                if hasChroot(fingerprint):
+                    best, bestRank = fingerprint, rank
+        return best
+
+    def _refresh(self):
+        """Re-read index files that changed since the last lookup."""
+        result = {}
+        if not os.path.isdir(self.indexDir):
+            return result
+        for name in os.listdir(self.indexDir):
+            if len(name) != 40:
+                continue
+            path = os.path.join(self.indexDir, name)
+            try:
+                st = os.stat(path)
+                # Files are replaced rather than rewritten, so a new inode
+                # also means new contents.
+                key = (st.st_ino, st.st_mtime)
+                cached = self._entries.get(name)
+                if not cached or cached[0] != key:
+                    fobj = open(path, 'rb')
+                    try:
+                        version, base, troves = marshal.loads(fobj.read())
+                    finally:
+                        fobj.close()
+                    if version != self.VERSION:
+                        continue
+                    cached = self._entries[name] = (key, base,
+                            frozenset(troves))
+            except (OSError, IOError, EOFError, ValueError, TypeError):
+                # Removed out from under us, or corrupt
+                continue
+            result[name] = cached[1:]
+        for name in set(self._entries) - set(result):
+            del self._entries[name]
+        return result
+
+    def _getPath(self, chrootFingerprint):
+        return os.path.join(self.indexDir, sha1ToString(chrootFingerprint))
+
+
+class CacheAccounting(object):
+    """
+    Size and last use time of each cached chroot, along with hit, miss and
+    eviction counters, kept in a file next to the archives.
+
+    Chroots are stored and restored by several build processes at once, so
+    every change is made while holding an exclusive lock and the file is
+    replaced atomically.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.path = os.path.join(cacheDir, 'accounting')
+        self.lockPath = os.path.join(cacheDir, 'accounting.lock')
+
+    def _read(self):
+        try:
+            fobj = open(self.path, 'rb')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        else:
+            try:
+                try:
+                    version, state = marshal.loads(fobj.read())
+                    if version == self.VERSION:
+                        return state
+                except (EOFError, ValueError, TypeError):
+                    log.warning("Discarding corrupt chroot cache accounting "
+                            "file %s", self.path)
+            finally:
+                fobj.close()
+        return {'entries': {}, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _update(self, func, *args):
+        """Call C{func} with the current state while holding the lock, then
+        save the state."""
+        util.mkdirChain(self.cacheDir)
+        lockFile = open(self.lockPath, 'a')
+        try:
+            fcntl.lockf(lockFile, fcntl.LOCK_EX)
+            state = self._read()
+            result = func(state, *args)
+            fobj = util.AtomicFile(self.path, 'wb', chmod=0600)
+            fobj.write(marshal.dumps((self.VERSION, state)))
+            fobj.commit()
+            return result
+        finally:
+            lockFile.close()
+
+    def recordStore(self, name, size):
+        def stored(state):
+            state['entries'][name] = (size, time.time())
+        self._update(stored)
+
+    def recordHit(self, name):
+        def hit(state):
+            state['hits'] += 1
+            entry = state['entries'].get(name)
+            if entry:
+                state['entries'][name] = (entry[0], time.time())
+        self._update(hit)
+
+    def recordMiss(self):
+        def miss(state):
+            state['misses'] += 1
+        self._update(miss)
+
+    def recordRemove(self, name):
+        def removed(state):
+            state['entries'].pop(name, None)
+        self._update(removed)
+
+    def evict(self, maxSize, maxCount, keep, listFiles, removeFunc):
+        """
+        Remove the least recently used chroots until the cache fits within
+        C{maxSize} bytes and C{maxCount} chroots, never removing C{keep}.
+        A limit of 0 means no limit.
+
+        @param listFiles: Callable returning a dictionary mapping the name
+            of every chroot actually in the cache to its size and
+            modification time, so that the accounting can be corrected for
+            archives that appeared or vanished behind its back.
+        @param removeFunc: Callable that deletes the named chroot.
+        @return: The names of the evicted chroots.
+        """
+        def evict(state):
+            entries = state['entries']
+            actual = listFiles()
+            for name in set(entries) - set(actual):
+                del entries[name]
+            for name, info in actual.iteritems():
+                if name not in entries:
+                    entries[name] = info
+            total = sum(x[0] for x in entries.itervalues())
+            byAge = sorted((x[1], name) for name, x in entries.iteritems()
+                    if name != keep)
+            evicted = []
+            for lastUsed, name in byAge:
+                if not ((maxSize and total > maxSize)
+                        or (maxCount and len(entries) > maxCount)):
+                    break
+                removeFunc(name)
+                total -= entries.pop(name)[0]
+                evicted.append(name)
+            state['evictions'] += len(evicted)
+            return evicted
+        return self._update(evict)
+
+    def getStats(self):
+        state = self._read()
+        entries = state.pop('entries')
+        state['count'] = len(entries)
+        state['size'] = sum(x[0] for x in entries.itervalues())
+        state['entries'] = sorted(((name,) + tuple(info)
+                for name, info in entries.iteritems()),
+                key=lambda x: x[2], reverse=True)
+        return state
+
 
 class LocalChrootCache(ChrootCacheInterface):
     """
     The LocalChrootCache class implements a chroot cache that uses the
     local file system to store tar archive of chroots.
+
+    Archives are written and read in-process, compressing blocks of the
+    archive on several threads at once. With C{storeAsync} set, C{store}
+    takes a snapshot of the chroot and leaves archiving it to a background
+    process, so the build can start right away. The snapshot is a reflinked
+    copy where the filesystem supports it and a plain copy otherwise, since
+    chroot setup goes on to modify files such as etc/passwd in place.
+
+    If C{maxSize} or C{maxCount} is set, the least recently stored or
+    restored chroots are evicted to keep the cache within those limits.
     """
-    def __init__(self, cacheDir):
+    def __init__(self, cacheDir, codec='gzip', threads=0, storeAsync=False,
+            maxSize=0, maxCount=0):
         """
         Instanciate a LocalChrootCache object
         @param cacheDir: The base directory for the chroot cache files
         @type cacheDir: str
+        @param codec: Name of the compression codec for new archives
+        @type codec: str
+        @param threads: Number of compression threads, 0 for one per CPU
+        @type threads: int
+        @param storeAsync: Archive chroots in a background process
+        @type storeAsync: bool
+        @param maxSize: Maximum total size of the archives in bytes
+        @type maxSize: int
+        @param maxCount: Maximum number of archives
+        @type maxCount: int
         """
         self.cacheDir = cacheDir
+        self.codec = compression.getCodec(codec)
+        self.threads = threads
+        self.storeAsync = storeAsync
+        self.maxSize = maxSize
+        self.maxCount = maxCount
+        self.index = ChrootIndex(os.path.join(cacheDir, 'index'))
+        self.accounting = CacheAccounting(cacheDir)
 
     def store(self, chrootFingerprint, root):
-        path = self._fingerPrintToPath(chrootFingerprint)
+        if self.storeAsync:
+            snapshot = self._snapshot(root)
+            self._storeInBackground(chrootFingerprint, snapshot)
+            return
+        self._store(chrootFingerprint, root)
+
+    def _store(self, chrootFingerprint, root):
+        path = self._fingerPrintToPath(chrootFingerprint, self.codec)
         prefix = sha1ToString(chrootFingerprint) + '.'
         util.mkdirChain(self.cacheDir)
-        fd, fn = tempfile.mkstemp('.tar.gz', prefix, self.cacheDir)
-        os.close(fd)
+        fd, fn = tempfile.mkstemp('.tar' + self.codec.extension, prefix,
+                self.cacheDir)
         try:
-            subprocess.call('tar cSpf - -C %s . | gzip -1 - > %s' %(root, fn),
-                            shell=True)
+            fobj = os.fdopen(fd, 'wb')
+            try:
+                writer = compression.CompressedWriter(fobj, self.codec,
+                        self.threads)
+                tar = tarfile.open(fileobj=writer, mode='w|',
+                        format=tarfile.GNU_FORMAT)
+                tar.add(root, arcname='.')
+                tar.close()
+                writer.close()
+            finally:
+                fobj.close()
             os.rename(fn, path)
         finally:
             util.removeIfExists(fn)
+        name = sha1ToString(chrootFingerprint)
+        self.accounting.recordStore(name, os.stat(path).st_size)
+        if self.maxSize or self.maxCount:
+            evicted = self.accounting.evict(self.maxSize, self.maxCount,
+                    name, self._listArchives, self._removeArchives)
+            if evicted:
+                log.info("Evicted %d chroots from the chroot cache",
+                        len(evicted))
+
+    def _snapshot(self, root):
+        """
+        Copy the tree at C{root} into a new directory in the cache, sharing
+        data blocks with the original where possible, and return its path.
+        """
+        util.mkdirChain(self.cacheDir)
+        snapshot = tempfile.mkdtemp('.snapshot', '.', self.cacheDir)
+        asRoot = os.getuid() == 0
+        canClone = True
+        inodes = {}
+        dirTimes = []
+        try:
+            for dirPath, dirNames, fileNames in os.walk(root):
+                destDir = snapshot + dirPath[len(root):]
+                for name in dirNames + fileNames:
+                    path = os.path.join(dirPath, name)
+                    dest = os.path.join(destDir, name)
+                    st = os.lstat(path)
+                    mode = stat.S_IMODE(st.st_mode)
+                    if stat.S_ISDIR(st.st_mode):
+                        os.mkdir(dest, 0700)
+                        dirTimes.append((dest, st.st_mtime))
+                    elif stat.S_ISLNK(st.st_mode):
+                        os.symlink(os.readlink(path), dest)
+                    elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in inodes:
+                        os.link(inodes[(st.st_dev, st.st_ino)], dest)
+                        continue
+                    elif stat.S_ISREG(st.st_mode):
+                        if st.st_nlink > 1:
+                            inodes[(st.st_dev, st.st_ino)] = dest
+                        canClone = _cloneFile(path, dest, canClone)
+                        os.utime(dest, (st.st_atime, st.st_mtime))
+                    else:
+                        try:
+                            os.mknod(dest, st.st_mode, st.st_rdev)
+                        except OSError, err:
+                            if err.errno != errno.EPERM:
+                                raise
+                            continue
+                    # Changing the owner clears setuid and setgid bits, so
+                    # the mode goes on last.
+                    if asRoot:
+                        os.lchown(dest, st.st_uid, st.st_gid)
+                    if not stat.S_ISLNK(st.st_mode):
+                        os.chmod(dest, mode)
+            st = os.stat(root)
+            if asRoot:
+                os.lchown(snapshot, st.st_uid, st.st_gid)
+            os.chmod(snapshot, stat.S_IMODE(st.st_mode))
+            dirTimes.append((snapshot, st.st_mtime))
+            for dest, mtime in reversed(dirTimes):
+                os.utime(dest, (mtime, mtime))
+        except:
+            util.rmtree(snapshot, ignore_errors=True)
+            raise
+        return snapshot
+
+    def _storeInBackground(self, chrootFingerprint, snapshot):
+        # Double fork so the archiver is not left as a zombie and does not
+        # die along with the build's process group.
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+        try:
+            try:
+                os.setsid()
+                if os.fork():
+                    os._exit(0)
+                try:
+                    self._store(chrootFingerprint, snapshot)
+                finally:
+                    util.rmtree(snapshot, ignore_errors=True)
+                os._exit(0)
+            except:
+                log.exception("Failed to store chroot %s:",
+                        sha1ToString(chrootFingerprint))
+        finally:
+            os._exit(1)
 
     def restore(self, chrootFingerprint, root):
-        path = self._fingerPrintToPath(chrootFingerprint)
-        subprocess.call('zcat %s | tar xSpf - -C %s' %(path, root),
-                        shell=True)
+        path, codec = self._findArchive(chrootFingerprint)
+        self.accounting.recordHit(sha1ToString(chrootFingerprint))
+        fobj = open(path, 'rb')
+        try:
+            reader = compression.DecompressedReader(fobj, codec)
+            tar = tarfile.open(fileobj=reader, mode='r|')
+            # Like tar, carry on past entries that can't be created, such as
+            # device nodes when unprivileged.
+            tar.errorlevel = 0
+            tar.extractall(root)
+            tar.close()
+        finally:
+            fobj.close()
+
+    def remove(self, chrootFingerprint):
+        name = sha1ToString(chrootFingerprint)
+        self._removeArchives(name)
+        self.accounting.recordRemove(name)
+
+    def _removeArchives(self, name):
+        chrootFingerprint = sha1helper.sha1FromString(name)
+        self.index.remove(chrootFingerprint)
+        for codec in compression.getCodecs().values():
+            path = self._fingerPrintToPath(chrootFingerprint, codec)
+            try:
+                os.unlink(path)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+    def _listArchives(self):
+        suffixes = set('.tar' + x.extension
+                for x in compression.getCodecs().values())
+        result = {}
+        for name in os.listdir(self.cacheDir):
+            if name[40:] not in suffixes:
+                continue
+            st = os.stat(os.path.join(self.cacheDir, name))
+            entry = result.get(name[:40], (0, 0))
+            result[name[:40]] = (entry[0] + st.st_size,
+                    max(entry[1], st.st_mtime))
+        return result
+
+    def hasChroot(self, chrootFingerprint):
+        if self._hasArchive(chrootFingerprint):
+            return True
+        self.accounting.recordMiss()
+        return False
+
+    def _hasArchive(self, chrootFingerprint):
+        return self._findArchive(chrootFingerprint)[0] is not None
+
+    def getStats(self):
+        stats = self.accounting.getStats()
+        stats['maxSize'] = self.maxSize
+        stats['maxCount'] = self.maxCount
+        return stats
+
+    def recordTroves(self, chrootFingerprint, baseFingerprint,
+            troveFingerprints):
+        self.index.add(chrootFingerprint, baseFingerprint, troveFingerprints)
+
+    def findClosest(self, baseFingerprint, troveFingerprints):
+        return self.index.findClosest(baseFingerprint, troveFingerprints,
+                self._hasArchive)
+
+    def _findArchive(self, chrootFingerprint):
+        """
+        Return the path of the archive for C{chrootFingerprint} and the
+        codec it was written with, preferring the configured codec.
+        """
+        codecs = compression.getCodecs()
+        del codecs[self.codec.name]
+        for codec in [self.codec] + codecs.values():
+            path = self._fingerPrintToPath(chrootFingerprint, codec)
+            if os.path.isfile(path):
+                return path, codec
+        return None, None
+
+    def _fingerPrintToPath(self, chrootFingerprint, codec):
+        tar = sha1ToString(chrootFingerprint) + '.tar' + codec.extension
+        return os.path.join(self.cacheDir, tar)
+
+
+class ContentChrootCache(ChrootCacheInterface):
+    """
+    The ContentChrootCache class implements a chroot cache that keeps each
+    distinct file once in a content-addressed object store, along with a
+    manifest per fingerprint describing the tree. Restoring a chroot links
+    or reflink-copies every file back out of the store, so nothing has to
+    be compressed or unpacked, and files shared between chroots only take
+    up space once.
+
+    With C{hardlink} set, restored files are hard links to the stored
+    objects. That is the fastest option but a build that modifies an
+    installed file in place would modify the cache as well, and the
+    modification times of restored files are those of the objects. Files
+    under C{PRIVATE_PATHS}, which chroot setup rewrites in place, and
+    setuid or setgid files are always copied. Otherwise files are reflinked
+    where the filesystem supports it and copied where it doesn't.
+
+    Objects are stored without their setuid and setgid bits, which are put
+    back on the restored copies.
+
+    The sizes in the statistics are the total size of the files in each
+    chroot. Objects are shared, so the cache itself may take up less.
+    """
+
+    VERSION = 1
+    # Unreferenced objects younger than this may belong to a store that
+    # hasn't written its manifest yet, so pruning leaves them be.
+    PRUNE_GRACE = 3600
+    # Chroot setup adds users to etc/passwd and etc/group and installs
+    # troves into the conary database, all in place.
+    PRIVATE_PATHS = ('etc', 'var/lib/conarydb')
+
+    def __init__(self, cacheDir, hardlink=False):
+        """
+        Instanciate a ContentChrootCache object
+        @param cacheDir: The base directory for the chroot cache files
+        @type cacheDir: str
+        @param hardlink: Restore files as hard links into the cache
+        @type hardlink: bool
+        """
+        self.cacheDir = cacheDir
+        self.objectDir = os.path.join(cacheDir, 'objects')
+        self.manifestDir = os.path.join(cacheDir, 'manifests')
+        self.hardlink = hardlink
+        self.index = ChrootIndex(os.path.join(cacheDir, 'index'))
+        self.accounting = CacheAccounting(cacheDir)
+        self._canClone = True
+
+    def store(self, chrootFingerprint, root):
+        if not os.path.isdir(self.objectDir):
+            util.mkdirChain(self.cacheDir)
+            os.mkdir(self.objectDir, 0700)
+        util.mkdirChain(self.manifestDir)
+        entries = []
+        inodes = {}
+        size = 0
+        for dirPath, dirNames, fileNames in os.walk(root):
+            relDir = dirPath[len(root):].lstrip('/')
+            for name in dirNames + fileNames:
+                path = os.path.join(dirPath, name)
+                relPath = os.path.join(relDir, name)
+                st = os.lstat(path)
+                mode = stat.S_IMODE(st.st_mode)
+                if stat.S_ISDIR(st.st_mode):
+                    entries.append(('d', relPath, mode, st.st_uid, st.st_gid,
+                        int(st.st_mtime)))
+                elif stat.S_ISLNK(st.st_mode):
+                    entries.append(('l', relPath, os.readlink(path),
+                        st.st_uid, st.st_gid))
+                elif st.st_nlink > 1 and (st.st_dev, st.st_ino) in inodes:
+                    entries.append(('h', relPath,
+                        inodes[(st.st_dev, st.st_ino)]))
+                elif stat.S_ISREG(st.st_mode):
+                    if st.st_nlink > 1:
+                        inodes[(st.st_dev, st.st_ino)] = relPath
+                    objName = self._storeObject(path, mode, st.st_uid,
+                            st.st_gid)
+                    size += st.st_size
+                    entries.append(('f', relPath, mode, st.st_uid, st.st_gid,
+                        int(st.st_mtime), objName))
+                else:
+                    entries.append(('s', relPath, st.st_mode, st.st_uid,
+                        st.st_gid, st.st_rdev))
+        fobj = util.AtomicFile(self._fingerPrintToPath(chrootFingerprint),
+                'wb', chmod=0600)
+        fobj.write(marshal.dumps((self.VERSION, entries)))
+        fobj.commit()
+        self.accounting.recordStore(sha1ToString(chrootFingerprint), size)
+
+    def restore(self, chrootFingerprint, root):
+        entries = self._readManifest(
+                self._fingerPrintToPath(chrootFingerprint))
+        self.accounting.recordHit(sha1ToString(chrootFingerprint))
+        asRoot = os.getuid() == 0
+        dirTimes = []
+        util.mkdirChain(root)
+        for entry in entries:
+            kind, relPath = entry[:2]
+            path = os.path.join(root, relPath)
+            if kind == 'd':
+                mode, uid, gid, mtime = entry[2:]
+                try:
+                    os.mkdir(path, 0700)
+                except OSError, err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                # Changing the owner clears setuid and setgid bits, so the
+                # mode goes on last.
+                if asRoot:
+                    os.lchown(path, uid, gid)
+                os.chmod(path, mode)
+                dirTimes.append((path, mtime))
+            elif kind == 'f':
+                mode, uid, gid, mtime, objName = entry[2:]
+                util.removeIfExists(path)
+                if (self.hardlink and self._canLink(relPath, mode, uid, gid,
+                        objName) and self._linkObject(objName, path)):
+                    continue
+                self._canClone = _cloneFile(self._objectPath(objName),
+                        path, self._canClone)
+                if asRoot:
+                    os.lchown(path, uid, gid)
+                os.chmod(path, mode)
+                os.utime(path, (mtime, mtime))
+            elif kind == 'l':
+                target, uid, gid = entry[2:]
+                util.removeIfExists(path)
+                os.symlink(target, path)
+                if asRoot:
+                    os.lchown(path, uid, gid)
+            elif kind == 'h':
+                util.removeIfExists(path)
+                os.link(os.path.join(root, entry[2]), path)
+            elif kind == 's':
+                mode, uid, gid, rdev = entry[2:]
+                util.removeIfExists(path)
+                try:
+                    os.mknod(path, mode, rdev)
+                except OSError, err:
+                    # Like tar, skip device nodes when not privileged.
+                    if err.errno != errno.EPERM:
+                        raise
+                    continue
+                if asRoot:
+                    os.lchown(path, uid, gid)
+                    os.chmod(path, stat.S_IMODE(mode))
+        # Creating entries touches their parent directory, so directory
+        # times can only be set once everything is in place.
+        for path, mtime in reversed(dirTimes):
+            os.utime(path, (mtime, mtime))
 
     def remove(self, chrootFingerprint):
+        self.index.remove(chrootFingerprint)
         path = self._fingerPrintToPath(chrootFingerprint)
         try:
             os.unlink(path)
         except OSError, err:
             if err.errno != errno.ENOENT:
                 raise
+        self.accounting.recordRemove(sha1ToString(chrootFingerprint))
+        self.prune()
 
     def hasChroot(self, chrootFingerprint):
+        if self._hasManifest(chrootFingerprint):
+            return True
+        self.accounting.recordMiss()
+        return False
+
+    def _hasManifest(self, chrootFingerprint):
         path = self._fingerPrintToPath(chrootFingerprint)
         return os.path.isfile(path)
 
+    def getStats(self):
+        stats = self.accounting.getStats()
+        stats['maxSize'] = stats['maxCount'] = 0
+        return stats
+
+    def recordTroves(self, chrootFingerprint, baseFingerprint,
+            troveFingerprints):
+        self.index.add(chrootFingerprint, baseFingerprint, troveFingerprints)
+
+    def findClosest(self, baseFingerprint, troveFingerprints):
+        return self.index.findClosest(baseFingerprint, troveFingerprints,
+                self._hasManifest)
+
+    def prune(self):
+        """
+        Delete objects that are not referenced by any cached chroot.
+
+        @return: The number of objects deleted
+        """
+        referenced = set()
+        if os.path.isdir(self.manifestDir):
+            for name in os.listdir(self.manifestDir):
+                if not name.endswith('.manifest'):
+                    continue
+                path = os.path.join(self.manifestDir, name)
+                for entry in self._readManifest(path):
+                    if entry[0] == 'f':
+                        referenced.add(entry[6])
+        if not os.path.isdir(self.objectDir):
+            return 0
+        cutoff = time.time() - self.PRUNE_GRACE
+        deleted = 0
+        for subdir in os.listdir(self.objectDir):
+            subPath = os.path.join(self.objectDir, subdir)
+            for name in os.listdir(subPath):
+                if subdir + name in referenced:
+                    continue
+                path = os.path.join(subPath, name)
+                if os.lstat(path).st_ctime > cutoff:
+                    continue
+                util.removeIfExists(path)
+                deleted += 1
+        return deleted
+
+    def _readManifest(self, path):
+        fobj = open(path, 'rb')
+        try:
+            version, entries = marshal.loads(fobj.read())
+        finally:
+            fobj.close()
+        if version != self.VERSION:
+            raise RuntimeError("Unsupported chroot manifest version %r"
+                    % (version,))
+        return entries
+
+    def _storeObject(self, path, mode, uid, gid):
+        """
+        Add the contents of C{path} to the object store and return the
+        object name.
+        """
+        digest = digestlib.sha1()
+        fobj = open(path, 'rb')
+        try:
+            while True:
+                buf = fobj.read(1 << 20)
+                if not buf:
+                    break
+                digest.update(buf)
+        finally:
+            fobj.close()
+        # Hard-linked restores share the object's inode, ownership and
+        # permissions included, so identical contents with different modes
+        # or owners are kept apart.
+        mode &= ~(stat.S_ISUID | stat.S_ISGID)
+        objName = '%s-%04o-%d-%d' % (digest.hexdigest(), mode, uid, gid)
+        objPath = self._objectPath(objName)
+        if os.path.exists(objPath):
+            return objName
+        objDir = os.path.dirname(objPath)
+        util.mkdirChain(objDir)
+        fd, tmpPath = tempfile.mkstemp('.tmp', '.', objDir)
+        os.close(fd)
+        os.unlink(tmpPath)
+        try:
+            self._canClone = _cloneFile(path, tmpPath, self._canClone)
+            if os.getuid() == 0:
+                os.lchown(tmpPath, uid, gid)
+            os.chmod(tmpPath, mode)
+            os.rename(tmpPath, objPath)
+        finally:
+            util.removeIfExists(tmpPath)
+        return objName
+
+    def _canLink(self, relPath, mode, uid, gid, objName):
+        """
+        Return C{True} if the file at C{relPath} can be restored as a hard
+        link to its object.
+        """
+        if mode & (stat.S_ISUID | stat.S_ISGID):
+            return False
+        for private in self.PRIVATE_PATHS:
+            if relPath == private or relPath.startswith(private + '/'):
+                return False
+        # Objects stored before they were kept apart by owner don't carry
+        # the owner in their name and may be shared between owners.
+        return objName.endswith('-%d-%d' % (uid, gid))
+
+    def _linkObject(self, objName, path):
+        try:
+            os.link(self._objectPath(objName), path)
+        except OSError, err:
+            if err.errno in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                return False
+            raise
+        return True
+
+    def _objectPath(self, objName):
+        return os.path.join(self.objectDir, objName[:2], objName[2:])
+
     def _fingerPrintToPath(self, chrootFingerprint):
-        tar = sha1ToString(chrootFingerprint) + '.tar.gz'
-        return os.path.join(self.cacheDir, tar)
+        manifest = sha1ToString(chrootFingerprint) + '.manifest'
+        return os.path.join(self.manifestDir, manifest)
+
+
+def _cloneFile(source, dest, clone=True):
+    """
+    Copy C{source} to a new file at C{dest}, sharing data blocks if the
+    filesystem supports it.
+
+    @return: C{False} if reflinking is known not to work here, so that
+        callers can skip trying next time.
+    """
+    inFile = open(source, 'rb')
+    try:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        outFile = os.fdopen(fd, 'wb')
+        try:
+            if clone:
+                try:
+                    fcntl.ioctl(outFile.fileno(), FICLONE, inFile.fileno())
+                    return True
+                except IOError, err:
+                    if err.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                            errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                        raise
+                    clone = err.errno == errno.EXDEV
+            shutil.copyfileobj(inFile, outFile, 1 << 20)
+            return clone
+        finally:
+            outFile.close()
+    finally:
+        inFile.close()
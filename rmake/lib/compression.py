@@ -0,0 +1,307 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+"""
+Streaming compression with pluggable codecs.
+
+Block codecs compress fixed-size pieces of the stream independently on a
+pool of threads and concatenate the results, the same way pigz and pbzip2
+do, so the output is still readable by the ordinary command-line tools.
+zlib and bz2 release the interpreter lock while they work, so the threads
+really do run in parallel.
+"""
+
+import bz2
+import collections
+import os
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BLOCK_SIZE = 1 << 20
+
+
+def cpuCount():
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+
+class Codec(object):
+    """Base class for compression codecs.
+
+    @cvar name: Name used to select the codec in configuration
+    @cvar extension: Suffix of files written with the codec
+    @cvar parallel: If C{True}, L{compressBlock} output can be concatenated
+        and blocks are compressed in parallel.
+    """
+
+    name = None
+    extension = ''
+    parallel = False
+
+    def compressBlock(self, data):
+        """Compress C{data} as a standalone member of the stream."""
+        raise NotImplementedError
+
+    def compressor(self, threads):
+        """Return an object with C{compress} and C{flush} methods."""
+        return _BlockCompressor(self)
+
+    def decompressor(self):
+        """Return an object with a C{decompress} method that accepts a
+        stream of concatenated members."""
+        raise NotImplementedError
+
+
+class _BlockCompressor(object):
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def compress(self, data):
+        return self.codec.compressBlock(data)
+
+    def flush(self):
+        return ''
+
+
+class NullCodec(Codec):
+    name = 'none'
+    parallel = True
+
+    def compressBlock(self, data):
+        return data
+
+    def decompressor(self):
+        return _NullDecompressor()
+
+
+class _NullDecompressor(object):
+
+    def decompress(self, data):
+        return data
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    extension = '.gz'
+    parallel = True
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compressBlock(self, data):
+        # 16 + MAX_WBITS selects the gzip header and trailer
+        obj = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return obj.compress(data) + obj.flush()
+
+    def decompressor(self):
+        return _MemberDecompressor(
+                lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+
+class Bzip2Codec(Codec):
+    name = 'bzip2'
+    extension = '.bz2'
+    parallel = True
+
+    def __init__(self, level=9):
+        self.level = level
+
+    def compressBlock(self, data):
+        return bz2.compress(data, self.level)
+
+    def decompressor(self):
+        return _MemberDecompressor(bz2.BZ2Decompressor)
+
+
+class _MemberDecompressor(object):
+    """Decompress a stream of concatenated, independently compressed
+    members."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.obj = factory()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            try:
+                out.append(self.obj.decompress(data))
+            except EOFError:
+                # bz2 refuses input after the end of a stream
+                self.obj = self.factory()
+                continue
+            data = self.obj.unused_data
+            if data:
+                self.obj = self.factory()
+        return ''.join(out)
+
+
+class ZstdCodec(Codec):
+    """Zstandard, using the library's own worker threads.
+
+    Requires the optional C{zstandard} module.
+    """
+    name = 'zstd'
+    extension = '.zst'
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compressor(self, threads):
+        return zstandard.ZstdCompressor(level=self.level,
+                threads=threads).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {}
+
+
+def registerCodec(codec):
+    CODECS[codec.name] = codec
+
+
+def getCodec(name):
+    """Return the codec called C{name}, or raise C{KeyError} if it is not
+    known or its module is not installed."""
+    return CODECS[name]
+
+
+def getCodecs():
+    """Return all available codecs, keyed by name."""
+    return dict(CODECS)
+
+
+registerCodec(NullCodec())
+registerCodec(GzipCodec())
+registerCodec(Bzip2Codec())
+if zstandard is not None:
+    registerCodec(ZstdCodec())
+
+
+class CompressedWriter(object):
+    """File-like object that compresses everything written to it into
+    C{fobj}.
+
+    @param threads: Number of blocks to compress at once for codecs that
+        support it; 0 means one per CPU.
+    """
+
+    def __init__(self, fobj, codec, threads=0, blockSize=BLOCK_SIZE):
+        self.fobj = fobj
+        self.codec = codec
+        self.threads = threads or cpuCount()
+        self.blockSize = blockSize
+        self._buf = []
+        self._bufLen = 0
+        self._pending = collections.deque()
+        self._pool = None
+        if codec.parallel and self.threads > 1:
+            self._pool = ThreadPool(self.threads)
+            self._compressor = None
+        else:
+            self._compressor = codec.compressor(self.threads)
+
+    def write(self, data):
+        self._buf.append(data)
+        self._bufLen += len(data)
+        if self._bufLen >= self.blockSize:
+            self._flushBlocks(final=False)
+
+    def _flushBlocks(self, final):
+        data = ''.join(self._buf)
+        end = len(data)
+        if not final:
+            end -= end % self.blockSize
+        for start in xrange(0, end, self.blockSize):
+            self._submit(data[start:start + self.blockSize])
+        self._buf = [data[end:]]
+        self._bufLen = len(data) - end
+
+    def _submit(self, block):
+        if self._pool is None:
+            self.fobj.write(self._compressor.compress(block))
+            return
+        self._pending.append(self._pool.apply_async(
+            self.codec.compressBlock, (block,)))
+        # Bound memory use by never running too far ahead of the output.
+        while len(self._pending) > 2 * self.threads:
+            self.fobj.write(self._pending.popleft().get())
+
+    def close(self):
+        """Finish the compressed stream. C{fobj} is left open."""
+        if self._buf is None:
+            return
+        try:
+            self._flushBlocks(final=True)
+            while self._pending:
+                self.fobj.write(self._pending.popleft().get())
+            if self._compressor is not None:
+                self.fobj.write(self._compressor.flush())
+        finally:
+            self._buf = None
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+
+class DecompressedReader(object):
+    """File-like object that reads and decompresses C{fobj}."""
+
+    def __init__(self, fobj, codec, chunkSize=BLOCK_SIZE):
+        self.fobj = fobj
+        self.chunkSize = chunkSize
+        self._decompressor = codec.decompressor()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        available = len(self._buf) - self._pos
+        if size >= 0 and available >= size:
+            data = self._buf[self._pos:self._pos + size]
+            self._pos += size
+            return data
+        parts = [self._buf[self._pos:]]
+        while not self._eof and (size < 0 or available < size):
+            chunk = self.fobj.read(self.chunkSize)
+            if not chunk:
+                self._eof = True
+                break
+            chunk = self._decompressor.decompress(chunk)
+            parts.append(chunk)
+            available += len(chunk)
+        data = ''.join(parts)
+        if size < 0 or len(data) <= size:
+            self._buf, self._pos = '', 0
+            return data
+        self._buf, self._pos = data, size
+        return data[:size]
+
+    def close(self):
+        pass
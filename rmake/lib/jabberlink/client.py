@@ -24,9 +24,10 @@ from wokkel import generic
 from wokkel import subprotocols
 from wokkel.client import XMPPClient
 
-from rmake.lib.jabberlink.handlers.link import LinkHandler
+from rmake.lib.jabberlink.handlers.link import LinkHandler, StreamFactory
 from rmake.lib.jabberlink.handlers.presence import FriendlyPresenceProtocol
 from rmake.lib.jabberlink.initializers.register import RegisteringAuthenticator
+from rmake.lib.twisted_extras.ipv6 import TCP6Server
 
 log = logging.getLogger(__name__)
 
@@ -57,6 +58,7 @@ class LinkClient(XMPPClient):
         subprotocols.StreamManager.__init__(self, factory)
 
         self._handlers = {}
+        self.streamServer = None
 
         self._configureHandlers(handlers)
 
@@ -86,6 +88,30 @@ class LinkClient(XMPPClient):
     def deferUntilConnected(self):
         return self.link.deferUntilConnected()
 
+    def listenStreams(self, port, address=None, interface=''):
+        """
+        Accept direct binary streams from neighbors on C{port}, and invite
+        neighbors that connect to this node to open one. Messages then go
+        over the stream instead of through the XMPP server.
+
+        @param address: Host that neighbors should connect to. Defaults to
+            the local address of the XMPP connection.
+        """
+        self.streamServer = TCP6Server(port, StreamFactory(self.link),
+                interface=interface)
+        self.link.streamPort = port
+        self.link.streamAddress = address
+
+    def startService(self):
+        XMPPClient.startService(self)
+        if self.streamServer:
+            self.streamServer.startService()
+
+    def stopService(self):
+        if self.streamServer:
+            self.streamServer.stopService()
+        return XMPPClient.stopService(self)
+
     def connectNeighbor(self, jid):
         self.link.addNeighbor(jid, initiating=True)
 
@@ -107,6 +133,16 @@ class LinkClient(XMPPClient):
             out.append(neighbor.jid)
         return out
 
+    def getNeighborStats(self):
+        """Return a dictionary mapping JIDs of authenticated neighbors to
+        their transfer statistics."""
+        out = {}
+        for neighbor in self.link.neighbors.itervalues():
+            if not neighbor.isAuthenticated:
+                continue
+            out[neighbor.jid] = neighbor.getStats()
+        return out
+
 
 class XmlStreamFactory(xmlstream.XmlStreamFactory):
 
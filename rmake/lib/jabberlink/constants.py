@@ -16,3 +16,5 @@
 
 
 NS_JABBERLINK = 'http://rpath.com/permanent/xmpp/jabberlink-1.0'
+NS_JABBERLINK_STREAM = ('http://rpath.com/permanent/xmpp/'
+        'jabberlink-stream-1.0')
@@ -15,8 +15,15 @@
 #
 
 
+import collections
 import logging
+import os
+import struct
+import time
 from twisted.internet import defer
+from twisted.internet import interfaces
+from twisted.internet import protocol
+from twisted.protocols.basic import Int32StringReceiver
 from twisted.python import failure as tw_fail
 from twisted.words.protocols.jabber.error import StanzaError
 from twisted.words.protocols.jabber.xmlstream import (IQ, XMPPHandler,
@@ -36,6 +43,16 @@ log = logging.getLogger(__name__)
 XPATH_AUTHENTICATE = ("/iq[@type='set']/authenticate[@xmlns='%s']" %
         constants.NS_JABBERLINK)
 XPATH_FRAME = "/iq[@type='set']/frame[@xmlns='%s']" % constants.NS_JABBERLINK
+XPATH_STREAM = ("/iq[@type='set']/stream[@xmlns='%s']" %
+        constants.NS_JABBERLINK_STREAM)
+
+# Sent by each end of a direct stream before any messages.
+STREAM_HELLO = 'jabberlink-stream 2 '
+# Every later string on a direct stream starts with one of these.
+RECORD_MESSAGE = 'm'
+RECORD_ACK = 'a'
+# Sequence number of the last frame covered by the acknowledgement
+_ackRecord = struct.Struct('!q')
 
 
 class LinkHandler(XMPPHandler):
@@ -50,6 +67,13 @@ class LinkHandler(XMPPHandler):
         self._callbacks = {}
         self._messageHandlers = {}
         self._rosterReceived = False
+        # Extra features to advertise to neighbors
+        self.features = set()
+        # Address and port offered to neighbors for direct streams, if this
+        # end accepts them.
+        self.streamAddress = None
+        self.streamPort = None
+        self._streamTokens = {}
 
     def _addCallback(self, event):
         d = defer.Deferred()
@@ -102,6 +126,14 @@ class LinkHandler(XMPPHandler):
         self._findNeighbor(jid).sendWithCallbacks(message, callback,
                 *args, **kwargs)
 
+    def getFeatures(self, jid):
+        """Return the disco features advertised by neighbor C{jid}, or an
+        empty set if they are not known (yet)."""
+        neighbor = self.neighbors.get(toJID(jid).userhost())
+        if neighbor is None:
+            return frozenset()
+        return neighbor.features
+
     def deferUntilConnected(self):
         if self.jid:
             return defer.succeed(None)
@@ -118,6 +150,9 @@ class LinkHandler(XMPPHandler):
                 self.parent.clientType, desc))
         for handler in self._messageHandlers.values():
             ident.append(disco.DiscoFeature(handler.namespace))
+        ident.append(disco.DiscoFeature(constants.NS_JABBERLINK_STREAM))
+        for feature in self.features:
+            ident.append(disco.DiscoFeature(feature))
         return defer.succeed(ident)
 
     def getDiscoItems(self, requestor, target, nodeIdentifier=''):
@@ -132,6 +167,7 @@ class LinkHandler(XMPPHandler):
 
         self.xmlstream.addObserver(XPATH_AUTHENTICATE, self.onAuthenticate)
         self.xmlstream.addObserver(XPATH_FRAME, self.onFrame)
+        self.xmlstream.addObserver(XPATH_STREAM, self.onStreamOffer)
 
         self._getRoster()
         self._fireCallback('connected')
@@ -188,6 +224,87 @@ class LinkHandler(XMPPHandler):
             error = StanzaError('not-authorized')
             self.send(error.toResponse(iq))
 
+    def discoverNeighbor(self, neighbor):
+        """Fetch the disco features of a newly authenticated neighbor."""
+        d = self.parent._handlers['disco'].requestInfo(neighbor.jid)
+
+        @d.addCallback
+        def got_info(info):
+            neighbor.features = frozenset(info.features)
+            if not neighbor.initiating:
+                return self.offerStream(neighbor)
+
+        d.addErrback(logFailure, "Error discovering features of neighbor "
+                "%s:" % neighbor.jid.full())
+
+    # Direct streams
+
+    def offerStream(self, neighbor):
+        """
+        Invite C{neighbor} to open a direct stream to this end, if this end
+        accepts streams and the neighbor's disco info says it can open them.
+        """
+        if not self.streamPort:
+            return
+        if constants.NS_JABBERLINK_STREAM not in neighbor.features:
+            log.debug("Neighbor %s does not support direct streams",
+                    neighbor.jid.full())
+            return
+        address = self.streamAddress
+        if not address:
+            address = self.xmlstream.transport.getHost().host
+        if neighbor.streamToken:
+            self._streamTokens.pop(neighbor.streamToken, None)
+        token = neighbor.streamToken = os.urandom(16).encode('hex')
+        self._streamTokens[token] = neighbor
+
+        iq = IQ(self.xmlstream, 'set')
+        offer = iq.addElement('stream', constants.NS_JABBERLINK_STREAM)
+        offer['host'] = unicode(address)
+        offer['port'] = unicode(self.streamPort)
+        offer['token'] = unicode(token)
+        return iq.send(neighbor.jid.full())
+
+    def onStreamOffer(self, iq):
+        iq.handled = True
+        jid = toJID(iq['from'])
+        neighbor = self._findNeighbor(jid)
+        if not neighbor or not neighbor.isAuthenticated:
+            error = StanzaError('not-authorized')
+            self.send(error.toResponse(iq))
+            return
+        offer = iq.firstChildElement()
+        try:
+            host = str(offer['host'])
+            port = int(offer['port'])
+            token = str(offer['token'])
+        except (KeyError, ValueError):
+            error = StanzaError('bad-request')
+            self.send(error.toResponse(iq))
+            return
+        self.send(toResponse(iq, 'result'))
+
+        from twisted.internet import reactor
+        creator = protocol.ClientCreator(reactor, StreamProtocol, self,
+                neighbor, token)
+        d = creator.connectTCP(host, port, timeout=30)
+
+        @d.addErrback
+        def connect_failed(failure):
+            log.warning("Could not open a direct stream to %s at %s:%s, "
+                    "using XMPP: %s", neighbor.jid.full(), host, port,
+                    failure.getErrorMessage())
+
+    def claimStreamToken(self, token):
+        """Return the neighbor that was offered C{token}, if any."""
+        neighbor = self._streamTokens.pop(token, None)
+        if neighbor is None or neighbor.streamToken != token:
+            return None
+        neighbor.streamToken = None
+        if not neighbor.isAuthenticated:
+            return None
+        return neighbor
+
     # API for Neighbor
 
     def onMessage(self, neighbor, message):
@@ -211,8 +328,32 @@ class LinkHandler(XMPPHandler):
 
 
 class Neighbor(object):
-
-    window_size = 4
+    """
+    One peer node, and the ordered stream of frames exchanged with it.
+
+    Once a direct stream is open, each message is sent whole over it instead
+    of as frames, but keeps the sequence numbers its frames would have had.
+    The receiver acknowledges stream messages too, and those still
+    unacknowledged when the stream is lost are resent as frames. The
+    receiver drops any it had already received.
+
+    Up to C{window} frames are sent before waiting for acknowledgements. The
+    window grows by one frame per acknowledgement until C{slow_start_max},
+    then by one frame per round trip. When the smoothed round trip time
+    climbs well above the shortest seen, frames are queueing somewhere on
+    the way, and the window is halved; it is halved at most once per round
+    trip.
+    """
+
+    window_size = 4  # Initial window
+    min_window = 2
+    max_window = 256
+    slow_start_max = 64
+    # Halve the window when the smoothed RTT exceeds the smallest RTT seen
+    # by this factor.
+    rtt_backoff = 2.0
+
+    _now = staticmethod(time.time)
 
     def __init__(self, link, jid, initiating):
         self.link = link
@@ -227,8 +368,22 @@ class Neighbor(object):
         self.out_seq_sent = 0  # Seq of first unsent frame
         self.out_seq_new = 0  # Seq of first uncreated frame
         self.in_seq_recv = -1  # Seq of last frame received
-        self.out_buf = []
-        self.in_buf = []
+        self.out_buf = collections.deque()
+        # Send time and size of each unacknowledged frame
+        self.out_times = collections.deque()
+        # Frames of the message being received
+        self.in_buf = collections.deque()
+        self._resetWindow()
+
+        # Direct binary stream to the neighbor, used instead of IQ frames
+        # once it is open.
+        self.stream = None
+        self.streamToken = None
+        # Messages sent over the stream and not yet acknowledged
+        self.stream_unacked = collections.deque()
+
+        # Disco features advertised by the neighbor
+        self.features = frozenset()
 
         self.callbacks = {}
 
@@ -251,8 +406,45 @@ class Neighbor(object):
         self.out_seq_sent = 0
         self.out_seq_new = 0
         self.in_seq_recv = -1
-        self.out_buf = []
-        self.in_buf = []
+        self.out_buf.clear()
+        self.out_times.clear()
+        self.in_buf.clear()
+        self._resetWindow()
+        self.stream_unacked.clear()
+        self.features = frozenset()
+        if self.streamToken:
+            self.link._streamTokens.pop(self.streamToken, None)
+            self.streamToken = None
+        if self.stream:
+            self.stream.transport.loseConnection()
+            self.stream = None
+
+    def _resetWindow(self):
+        self.window = float(self.window_size)
+        self.srtt = None
+        self.min_rtt = None
+        self.window_cut = None  # Time of last window reduction
+        self.bytes_sent = self.bytes_acked = 0
+        self.frames_sent = self.messages_sent = 0
+        self.throughput = 0.0
+        self._rate_start = self._rate_bytes = None
+
+    def getStats(self):
+        """Return a dictionary of transfer statistics for this neighbor."""
+        return dict(
+                window=int(self.window),
+                srtt=self.srtt,
+                min_rtt=self.min_rtt,
+                unacked=self.out_seq_sent - self.out_seq_ackd,
+                stream_unacked=len(self.stream_unacked),
+                queued=len(self.out_buf),
+                frames_sent=self.frames_sent,
+                messages_sent=self.messages_sent,
+                bytes_sent=self.bytes_sent,
+                bytes_acked=self.bytes_acked,
+                throughput=self.throughput,
+                stream=self.stream is not None,
+                )
 
     # Authentication
 
@@ -276,6 +468,7 @@ class Neighbor(object):
         self._updateJID(fullJID)
         self.isAuthenticated = True
         self.link.onNeighborUp(self.jid)
+        self.link.discoverNeighbor(self)
 
     def _do_authenticate(self):
         iq = IQ(self.link.xmlstream, 'set')
@@ -309,7 +502,21 @@ class Neighbor(object):
     # Sending
 
     def send(self, message):
+        if self.stream and self.out_seq_ackd == self.out_seq_new:
+            # Messages already queued as frames must go first, so the
+            # stream is only used once they have all been acknowledged.
+            data = message.to_binary(self.out_seq_new)
+            # Messages too big for the stream go as frames instead.
+            if len(data) < self.stream.MAX_LENGTH:
+                self.out_seq_new += message.frame_count()
+                self.out_seq_sent = self.out_seq_ackd = self.out_seq_new
+                self.stream_unacked.append(message)
+                self.messages_sent += 1
+                self.bytes_sent += len(data)
+                self.stream.sendMessage(data)
+                return
         frames = message.split(self.out_seq_new)
+        self.messages_sent += 1
         self.out_buf.extend(frames)
         self.out_seq_new += len(frames)
         assert frames[-1].seq == (self.out_seq_new - 1)
@@ -322,16 +529,25 @@ class Neighbor(object):
         if self.out_seq_new == self.out_seq_sent:
             # Nothing to send
             return
-        # Send up to "window_size" frames before waiting for an ack
-        max_seq = min(self.out_seq_new, self.out_seq_ackd + self.window_size)
+        # Send up to "window" frames before waiting for an ack
+        max_seq = min(self.out_seq_new,
+                self.out_seq_ackd + int(self.window))
+        now = self._now()
         for send_seq in xrange(self.out_seq_sent, max_seq):
-            frame = self.out_buf.pop(0)
+            frame = self.out_buf.popleft()
             assert frame.seq == send_seq
-            iq = frame.to_dom(self.link.xmlstream)
-            d = iq.send(self.jid.full())
-            d.addCallback(self._ack_received, send_seq)
+            d = self._send_frame(frame)
+            d.addCallbacks(self._ack_received, self._ack_failed,
+                    callbackArgs=(send_seq,))
             d.addErrback(logFailure)
             self.out_seq_sent += 1
+            self.out_times.append((now, len(frame.payload)))
+            self.frames_sent += 1
+            self.bytes_sent += len(frame.payload)
+
+    def _send_frame(self, frame):
+        iq = frame.to_dom(self.link.xmlstream)
+        return iq.send(self.jid.full())
 
     def _ack_received(self, dummy, seq_num):
         if seq_num != self.out_seq_ackd:
@@ -339,8 +555,57 @@ class Neighbor(object):
                     self.jid.full())
             return
         self.out_seq_ackd += 1
+        if self.out_times:
+            sent, size = self.out_times.popleft()
+            self._update_window(self._now(), sent, size)
         self._do_send()
 
+    def _ack_failed(self, failure):
+        # Most likely a timeout or the neighbor going away; either way,
+        # don't keep as much in flight.
+        self._cut_window(self._now())
+        return failure
+
+    def _update_window(self, now, sent, size):
+        rtt = now - sent
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += (rtt - self.srtt) / 8
+        self.bytes_acked += size
+
+        # Measure throughput over roughly one round trip at a time.
+        if self._rate_start is None:
+            self._rate_start, self._rate_bytes = sent, 0
+        self._rate_bytes += size
+        elapsed = now - self._rate_start
+        if elapsed > 0 and elapsed >= self.srtt:
+            sample = self._rate_bytes / elapsed
+            if self.throughput:
+                self.throughput += (sample - self.throughput) / 4
+            else:
+                self.throughput = sample
+            self._rate_start, self._rate_bytes = now, 0
+
+        threshold = self.min_rtt * self.rtt_backoff
+        if (self.min_rtt and self.srtt > threshold and rtt > threshold
+                and self.out_seq_sent - self.out_seq_ackd >= self.min_window):
+            self._cut_window(now)
+        elif self.window < self.slow_start_max:
+            self.window += 1
+        else:
+            self.window += 1 / self.window
+        self.window = min(self.window, self.max_window)
+
+    def _cut_window(self, now):
+        if (self.window_cut is not None and self.srtt is not None
+                and now - self.window_cut < self.srtt):
+            return
+        self.window = max(self.min_window, self.window / 2)
+        self.window_cut = now
+
     def sendWithCallbacks(self, message, callback, *args, **kwargs):
         self.send(message)
         self.callbacks.setdefault(message.seq, []).append((callback, args,
@@ -362,7 +627,12 @@ class Neighbor(object):
     def onFrame(self, iq):
         iq.handled = True
         frame = Frame.from_dom(iq)
-        if frame.seq != self.in_seq_recv + 1:
+        if frame.seq <= self.in_seq_recv and not self.in_buf:
+            # Resent after a direct stream was lost, but the message had
+            # already arrived over it.
+            self.link.send(toResponse(iq, 'result'))
+            return
+        elif frame.seq != self.in_seq_recv + 1:
             log.warning("Ignoring out-of-sequence frame from %s",
                     self.jid.full())
             error = StanzaError('bad-request')
@@ -371,36 +641,188 @@ class Neighbor(object):
 
         # ACK
         self.in_buf.append(frame)
-        self.in_seq_recv += 1
+        self.in_seq_recv = frame.seq
         self.link.send(toResponse(iq, 'result'))
 
         if not frame.more:
-            self._do_recv()
-
-    def _do_recv(self):
-        while self.in_buf:
-            for n, frame in enumerate(self.in_buf):
-                if not frame.more:
-                    n += 1
-                    break
+            # Frames arrive in order, so the buffer holds exactly the
+            # frames of this message.
+            frames = list(self.in_buf)
+            self.in_buf.clear()
+            message = Message.join(frames)
+            if message:
+                self._deliver(message)
+
+    def _deliver(self, message):
+        message.sender = self.jid
+
+        usedCallback = False
+        if message.in_reply_to in self.callbacks:
+            for func, args, kwargs in self.callbacks[message.in_reply_to]:
+                func(message, *args, **kwargs)
+                usedCallback = True
+            if not message.more:
+                del self.callbacks[message.in_reply_to]
+
+        if not usedCallback:
+            self.link.onMessage(self, message)
+
+    # Direct streams
+
+    def attachStream(self, stream):
+        if self.stream and self.stream is not stream:
+            old, self.stream = self.stream, None
+            old.transport.loseConnection()
+            self._resendStreamMessages()
+        log.debug("Opened direct stream to neighbor %s", self.jid.full())
+        self.stream = stream
+
+    def streamLost(self, stream):
+        if self.stream is stream:
+            log.debug("Direct stream to neighbor %s closed",
+                    self.jid.full())
+            self.stream = None
+            self._resendStreamMessages()
+
+    def _resendStreamMessages(self):
+        """Queue the messages the lost stream didn't deliver as frames."""
+        if not self.stream_unacked:
+            return
+        # The stream is only used when no frames are outstanding, so these
+        # are the only messages not yet acknowledged.
+        assert not self.out_buf
+        frames = []
+        for message in self.stream_unacked:
+            frames.extend(message.split(message.seq))
+        self.stream_unacked.clear()
+        assert frames[-1].seq == self.out_seq_new - 1
+        log.debug("Resending %d messages to %s as frames", len(frames),
+                self.jid.full())
+        self.out_buf.extend(frames)
+        self.out_seq_ackd = self.out_seq_sent = frames[0].seq
+        self._do_send()
+
+    def onStreamAck(self, seq):
+        while self.stream_unacked:
+            message = self.stream_unacked[0]
+            if message.seq + message.frame_count() - 1 > seq:
+                break
+            self.stream_unacked.popleft()
+
+    def onStreamMessage(self, stream, data, offset=0):
+        try:
+            message = Message.from_binary(data, offset)
+        except (ValueError, KeyError, UnicodeDecodeError, struct.error):
+            log.exception("Discarding malformed message from %s:",
+                    self.jid.full())
+            return
+        if message.seq <= self.in_seq_recv and not self.in_buf:
+            # Sent again over a new stream after the old one was lost.
+            stream.sendAck(self.in_seq_recv)
+            return
+        if message.seq != self.in_seq_recv + 1 or self.in_buf:
+            log.warning("Ignoring out-of-sequence message from %s",
+                    self.jid.full())
+            return
+        self.in_seq_recv = message.seq + message.frame_count() - 1
+        stream.sendAck(self.in_seq_recv)
+        self._deliver(message)
+
+
+class StreamProtocol(Int32StringReceiver):
+    """
+    Direct binary stream between two neighbors, carrying one length-prefixed
+    message or acknowledgement per string.
+
+    The end that accepted the stream offer connects and sends the token it
+    was offered; the offering end answers with its own hello before either
+    sends messages.
+    """
+
+    implements(interfaces.IPushProducer)
+
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, link, neighbor=None, token=None):
+        self.link = link
+        self.neighbor = neighbor
+        self.token = token
+        self.attached = False
+        # Messages sent while the transport's buffer is full
+        self.paused = False
+        self.held = 0
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        if self.token:
+            self.sendString(STREAM_HELLO + self.token)
+
+    def sendMessage(self, data):
+        if self.paused:
+            self.held += 1
+        # Avoid copying what may be a large message just to add the
+        # record type.
+        self.transport.writeSequence([
+            struct.pack(self.structFormat, len(data) + 1),
+            RECORD_MESSAGE, data])
+
+    def sendAck(self, seq):
+        self.sendString(RECORD_ACK + _ackRecord.pack(seq))
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.held = 0
+
+    def stopProducing(self):
+        pass
+
+    def stringReceived(self, data):
+        if self.attached:
+            kind = data[:1]
+            if kind == RECORD_MESSAGE:
+                self.neighbor.onStreamMessage(self, data, 1)
+            elif kind == RECORD_ACK and len(data) == 1 + _ackRecord.size:
+                self.neighbor.onStreamAck(_ackRecord.unpack_from(data, 1)[0])
             else:
-                # No terminating frame received
+                log.warning("Closing direct stream with bad record")
+                self.transport.loseConnection()
+        elif not data.startswith(STREAM_HELLO):
+            log.warning("Closing direct stream with bad hello")
+            self.transport.loseConnection()
+        elif self.token:
+            # Connecting end
+            self._attach()
+        else:
+            self.neighbor = self.link.claimStreamToken(
+                    data[len(STREAM_HELLO):])
+            if self.neighbor is None:
+                log.warning("Closing direct stream with unknown token")
+                self.transport.loseConnection()
                 return
+            self.sendString(STREAM_HELLO)
+            self._attach()
 
-            frames, self.in_buf = self.in_buf[:n], self.in_buf[n:]
-            message = Message.join(frames)
-            if not message:
-                continue
+    def _attach(self):
+        self.attached = True
+        self.neighbor.attachStream(self)
+
+    def lengthLimitExceeded(self, length):
+        log.error("Closing direct stream after oversized message of %d "
+                "bytes", length)
+        self.transport.loseConnection()
 
-            message.sender = self.jid
+    def connectionLost(self, reason):
+        if self.attached:
+            self.neighbor.streamLost(self)
 
-            usedCallback = False
-            if message.in_reply_to in self.callbacks:
-                for func, args, kwargs in self.callbacks[message.in_reply_to]:
-                    func(message, *args, **kwargs)
-                    usedCallback = True
-                if not message.more:
-                    del self.callbacks[message.in_reply_to]
 
-            if not usedCallback:
-                self.link.onMessage(self, message)
+class StreamFactory(protocol.ServerFactory):
+
+    def __init__(self, link):
+        self.link = link
+
+    def buildProtocol(self, addr):
+        return StreamProtocol(self.link)
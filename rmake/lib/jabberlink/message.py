@@ -17,12 +17,17 @@
 
 import base64
 import logging
+import struct
 from twisted.words.protocols.jabber.xmlstream import IQ
 
 from rmake.lib.jabberlink import constants
 
 log = logging.getLogger(__name__)
 
+# seq, number of headers
+_binaryHeader = struct.Struct('!qH')
+_binaryLength = struct.Struct('!H')
+
 
 class Message(object):
 
@@ -42,6 +47,11 @@ class Message(object):
 
         self.sender = None
 
+    def frame_count(self):
+        """Return the number of frames L{split} divides the message into."""
+        size = (len(self.payload) + 2) / 3 * 4
+        return max(1, (size + self.max_frame - 1) / self.max_frame)
+
     def split(self, seq):
         self.seq = seq
         payload = base64.b64encode(self.payload)
@@ -91,6 +101,56 @@ class Message(object):
         return cls(message_type, payload, headers, in_reply_to, more,
                 frames[0].seq)
 
+    def to_binary(self, seq):
+        """
+        Encode the message as a single string for a direct stream, with the
+        payload as-is instead of base64 and unsplit.
+
+        The message still takes up L{frame_count} sequence numbers starting
+        at C{seq}, so that it can be resent as frames if the stream is lost.
+        """
+        self.seq = seq
+        headers = dict(self.headers)
+        headers['type'] = unicode(self.message_type)
+        if self.in_reply_to is not None:
+            headers['in-reply-to'] = unicode(self.in_reply_to)
+        if self.more:
+            headers['more'] = 'true'
+        out = [_binaryHeader.pack(seq, len(headers))]
+        for name, value in headers.iteritems():
+            for item in (name, value):
+                item = unicode(item).encode('utf8')
+                out.append(_binaryLength.pack(len(item)))
+                out.append(item)
+        out.append(self.payload)
+        return ''.join(out)
+
+    @classmethod
+    def from_binary(cls, data, offset=0):
+        """Decode a message encoded by L{to_binary}, starting at C{offset}
+        in C{data}."""
+        seq, count = _binaryHeader.unpack_from(data, offset)
+        offset += _binaryHeader.size
+        headers = {}
+        for n in range(count):
+            item = []
+            for m in range(2):
+                length, = _binaryLength.unpack_from(data, offset)
+                offset += _binaryLength.size
+                if offset + length > len(data):
+                    raise ValueError("Truncated message header")
+                item.append(data[offset:offset + length].decode('utf8'))
+                offset += length
+            headers[item[0]] = item[1]
+        payload = data[offset:]
+
+        message_type = headers.pop('type')
+        in_reply_to = headers.pop('in-reply-to', None)
+        if in_reply_to is not None:
+            in_reply_to = long(in_reply_to)
+        more = headers.pop('more', '').lower() == 'true'
+        return cls(message_type, payload, headers, in_reply_to, more, seq)
+
 
 class Frame(object):
 
@@ -42,4 +42,8 @@ def main(childClassName):
     reactor.run()
 
 
-main(sys.argv[1])
+if sys.argv[1] == '--zygote':
+    from rmake.lib.proc_pool import zygote
+    zygote.main(sys.argv[2])
+else:
+    main(sys.argv[1])
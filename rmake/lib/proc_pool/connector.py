@@ -15,10 +15,13 @@
 #
 
 
+import errno
 import logging
+import os
 from twisted.internet import defer
 from twisted.internet import error
 from twisted.internet import protocol
+from twisted.python import failure
 
 log = logging.getLogger(__name__)
 
@@ -109,3 +112,112 @@ class ProcessConnector(protocol.ProcessProtocol):
             self.stderrLog = logging.getLogger(logBase + '.stderr')
         else:
             self.stdoutLog = self.stderrLog = None
+
+
+class ForkedConnector(object):
+    """
+    Counterpart to L{ProcessConnector} for a child forked by a zygote
+    process rather than spawned by this one.
+
+    The child connects back over a UNIX socket once it has been forked, so
+    anything written before then is held until it does. The zygote, being
+    the child's real parent, reports its exit status.
+    """
+
+    disconnecting = False
+
+    def __init__(self, prot):
+        self.finished = defer.Deferred()
+        self.protocol = prot
+        self.logBase = None
+        self.pid = None
+        self.channel = None
+        self.pendingData = []
+        self.channelClosed = False
+        self.exitReason = None
+        self.ended = False
+        self.protocol.makeConnection(self)
+
+    def __repr__(self):
+        return '<ForkedConnector %s>' % (self.pid or hex(id(self)))
+
+    # For the zygote starter
+
+    def attach(self, channel, pid):
+        """The forked child connected back over C{channel}."""
+        self.channel = channel
+        self.pid = pid
+        data, self.pendingData = ''.join(self.pendingData), None
+        if data:
+            channel.transport.write(data)
+        if self.disconnecting:
+            channel.transport.loseConnection()
+
+    def channelLost(self):
+        self.channelClosed = True
+        self._checkEnded()
+
+    def childExited(self, reason):
+        """The child exited, or its fate can no longer be known."""
+        if self.exitReason is None:
+            self.exitReason = reason
+        self._checkEnded()
+
+    def _checkEnded(self):
+        if self.ended or self.exitReason is None:
+            return
+        if self.channel is not None and not self.channelClosed:
+            # Wait for everything the child sent to be delivered.
+            return
+        self.ended = True
+        self.protocol.connectionLost(self.exitReason)
+        if self.exitReason.check(error.ProcessDone):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(self.exitReason)
+
+    def dataReceived(self, data):
+        self.protocol.dataReceived(data)
+
+    # For parent transport
+
+    def signalProcess(self, sig):
+        if self.pid is None:
+            # Not forked yet, or never will be.
+            self.childExited(failure.Failure(
+                error.ProcessTerminated(signal=sig)))
+            return
+        try:
+            os.kill(self.pid, sig)
+        except OSError, err:
+            if err.errno != errno.ESRCH:
+                raise
+
+    # For child protocol
+
+    def write(self, data):
+        if self.channel is not None:
+            self.channel.transport.write(data)
+        elif self.pendingData is not None:
+            self.pendingData.append(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+        if self.channel is not None:
+            self.channel.transport.loseConnection()
+
+    def getPeer(self):
+        return ('subprocess',)
+
+    def getHost(self):
+        return ('no host',)
+
+    # For other callers
+
+    def callRemote(self, command, **kwargs):
+        return self.protocol.callRemote(command, **kwargs)
+
+    def setLogBase(self, logBase):
+        # Output of forked children goes to the zygote's stdout and stderr,
+        # so it can't be attributed to a task.
+        self.logBase = logBase
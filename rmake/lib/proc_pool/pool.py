@@ -20,12 +20,14 @@
 # Copyright (c) 2009 Canonical Ltd.
 
 
+import collections
 import imp
 import logging
 import os
 import random
 import signal
 import sys
+import time
 from twisted.application import service
 from twisted.internet import defer
 from twisted.internet import error
@@ -39,32 +41,66 @@ log = logging.getLogger(__name__)
 
 
 class ProcessPool(service.Service):
+    """
+    Pool of worker processes that are started ahead of time.
+
+    Starting a worker means loading plugins and configuration into a new
+    interpreter, so enough idle workers are kept to absorb the largest burst
+    of tasks seen over the last C{rateWindow} seconds, where a burst is the
+    tasks that arrived within one worker startup time of each other. There
+    are always at least C{minIdleProcs} and at most C{maxIdleProcs} idle
+    workers.
+    """
 
     childFactory = None
     parentFactory = None
     minIdleProcs = 1
+    maxIdleProcs = 4
     maxIdleTime = 15
     recycleAfter = 500
+    rateWindow = 300
 
     pool = None
 
-    def __init__(self, starter=None, args=(), debug=False):
+    _now = staticmethod(time.time)
+
+    def __init__(self, starter=None, args=(), debug=False, minIdle=None,
+            maxIdle=None, forkServer=False):
+        self.args = dict(args)
         if starter is None:
             # Current package might be rmake or rmake3, so use __name__.
             packages = ['twisted', __name__.split('.')[0]]
-            starter = ProcessStarter(packages=packages, debug=debug)
+            if forkServer:
+                from rmake.lib.proc_pool import zygote
+                starter = zygote.ZygoteStarter(self.args, packages=packages,
+                        debug=debug)
+            else:
+                starter = ProcessStarter(packages=packages, debug=debug)
         self.starter = starter
-        self.args = dict(args)
+        if minIdle is not None:
+            self.minIdleProcs = minIdle
+        if maxIdle is not None:
+            self.maxIdleProcs = maxIdle
+        self.maxIdleProcs = max(self.maxIdleProcs, self.minIdleProcs)
 
         self.finished = False
         self.started = False
         self.processes = set()
+        # Workers still loading plugins and configuration.
+        self.starting = {}
+        # Workers given a task before they finished starting.
+        self.waiting = {}
         self.ready = set()
         self.busy = set()
         self.maint = task.LoopingCall(self.rebalance)
         self.maint.start(self.maxIdleTime, now=False)
         self.calls = {}
 
+        self.arrivals = collections.deque()
+        self.spawnTime = None
+        self.stats = dict(spawned=0, coldStarts=0, tasks=0,
+                spawnTimeMax=0.0, waitTime=0.0)
+
     def startService(self):
         """Start the process pool and spawn the first set of workers."""
         from twisted.internet import reactor
@@ -80,32 +116,103 @@ class ProcessPool(service.Service):
         def cb_stopped(_):
             if self.maint.running:
                 self.maint.stop()
+            self.starter.stop()
         return defer.DeferredList(l).addCallback(cb_stopped)
 
+    def _pruneArrivals(self):
+        cutoff = self._now() - self.rateWindow
+        while self.arrivals and self.arrivals[0] < cutoff:
+            self.arrivals.popleft()
+
+    def getArrivalRate(self):
+        """Return the number of tasks per second started recently."""
+        self._pruneArrivals()
+        return len(self.arrivals) / float(self.rateWindow)
+
+    def getBurstSize(self):
+        """
+        Return the most tasks that arrived within one worker startup time of
+        each other during the last C{rateWindow} seconds.
+        """
+        self._pruneArrivals()
+        arrivals = list(self.arrivals)
+        window = self.spawnTime or 0
+        best = first = 0
+        for last, arrived in enumerate(arrivals):
+            while arrived - arrivals[first] > window:
+                first += 1
+            best = max(best, last - first + 1)
+        return best
+
+    def getIdleTarget(self):
+        """Return the number of idle workers that should be kept."""
+        return max(self.minIdleProcs,
+                min(self.maxIdleProcs, self.getBurstSize()))
+
     def rebalance(self):
-        """Start or stop workers to match the configured pool size."""
+        """Start or stop workers to match the wanted number of idle
+        workers."""
         if self.finished:
             return
-        while len(self.ready) < self.minIdleProcs:
+        target = self.getIdleTarget()
+        log.debug("Worker pool: %(idle)d idle, %(starting)d starting, "
+                "%(busy)d busy, want %(idleTarget)d idle; %(coldStarts)d of "
+                "%(tasks)d tasks waited for a worker to start", self.getStats())
+        while len(self.ready) + len(self.starting) < target:
             self.startAWorker()
-        while len(self.ready) > self.minIdleProcs:
+        while self.ready and len(self.ready) + len(self.starting) > target:
             self.stopAWorker()
 
+    def getStats(self):
+        """Return counters describing how quickly workers are supplied."""
+        stats = dict(self.stats)
+        stats.update(
+                processes=len(self.processes),
+                idle=len(self.ready),
+                starting=len(self.starting),
+                busy=len(self.busy),
+                idleTarget=self.getIdleTarget(),
+                arrivalRate=self.getArrivalRate(),
+                burstSize=self.getBurstSize(),
+                spawnTime=self.spawnTime,
+                )
+        return stats
+
     def startAWorker(self):
-        """Start one worker and place it into the idle pool."""
+        """Start one worker. It joins the idle pool once it has started."""
         if self.finished:
             return
         child = self.starter.startProcess(self.childFactory,
                 self.parentFactory)
         self.processes.add(child)
-        self.ready.add(child)
+        started = self.starting[child] = self._now()
         self.calls[child] = 0
+        self.stats['spawned'] += 1
         log.debug("Starting worker %r", child)
         child.callRemote('startup', **self.args
-                ).addErrback(logger.logFailure,
-                        "Error starting worker subprocess:")
+                ).addCallbacks(self._started, logger.logFailure,
+                        callbackArgs=(child, started), errbackArgs=(
+                            "Error starting worker subprocess:",))
         child.finished.addBoth(self._pruneProcess, child)
 
+    def _started(self, result, child, started):
+        now = self._now()
+        elapsed = now - started
+        if self.spawnTime is None:
+            self.spawnTime = elapsed
+        else:
+            self.spawnTime += 0.3 * (elapsed - self.spawnTime)
+        self.stats['spawnTimeMax'] = max(self.stats['spawnTimeMax'],
+                elapsed)
+        log.debug("Worker %r started in %.2f seconds", child, elapsed)
+
+        waitingSince = self.waiting.pop(child, None)
+        if waitingSince is not None:
+            # A task was already handed to this worker.
+            self.stats['waitTime'] += now - waitingSince
+        elif self.starting.pop(child, None) is not None:
+            self.ready.add(child)
+
     def stopAWorker(self, child=None):
         """Stop one worker, preferring idle workers if there are any."""
         from twisted.internet import reactor
@@ -145,14 +252,27 @@ class ProcessPool(service.Service):
     def _pruneProcess(self, _, child):
         log.debug("Removing worker %r", child)
         self.processes.discard(child)
+        self.starting.pop(child, None)
+        self.waiting.pop(child, None)
         self.ready.discard(child)
         self.busy.discard(child)
         self.calls.pop(child, None)
 
     def doWork(self, command, **kwargs):
-        if not self.ready:
-            self.startAWorker()
-        child = self.ready.pop()
+        now = self._now()
+        self.arrivals.append(now)
+        self.stats['tasks'] += 1
+        if self.ready:
+            child = self.ready.pop()
+        else:
+            # No worker is ready, so take the one that will be ready the
+            # soonest. The command is queued behind its startup.
+            self.stats['coldStarts'] += 1
+            if not self.starting:
+                self.startAWorker()
+            child = min(self.starting, key=self.starting.get)
+            del self.starting[child]
+            self.waiting[child] = now
         self.rebalance()
         self.busy.add(child)
         self.calls[child] += 1
@@ -199,10 +319,17 @@ class ProcessStarter(object):
         return path
 
     def startProcess(self, childClass, parentClass):
-        from twisted.internet import reactor
-        childClassPath = self._checkRoundTrip(childClass)
         prot = self.connectorFactory(parentClass())
+        self._spawn(prot, [self._checkRoundTrip(childClass)])
+        return prot
+
+    def stop(self):
+        pass
 
+    def _spawn(self, prot, bootstrapArgs):
+        """Run the bootstrap script with C{bootstrapArgs} in a new
+        interpreter attached to process protocol C{prot}."""
+        from twisted.internet import reactor
         bootstrapPath = os.path.join(os.path.dirname(__file__), 'bootstrap.py')
 
         # Insert required modules into PYTHONPATH if they lie outside the
@@ -218,11 +345,10 @@ class ProcessStarter(object):
         pythonPath.extend(env.get('PYTHONPATH', '').split(os.pathsep))
         env['PYTHONPATH'] = os.pathsep.join(pythonPath)
 
-        args = (sys.executable, bootstrapPath, childClassPath)
+        args = [sys.executable, bootstrapPath] + list(bootstrapArgs)
         fds = {connector.TO_CHILD: 'w', connector.FROM_CHILD: 'r'}
         if self.debug:
             fds.update({0: 0, 1: 1, 2: 2})
         else:
             fds.update({0: 'w', 1: 'r', 2: 'r'})
         reactor.spawnProcess(prot, sys.executable, args, env, childFDs=fds)
-        return prot
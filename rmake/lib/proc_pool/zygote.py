@@ -0,0 +1,338 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Start pool workers by forking them from a "zygote" process that has already
+imported everything and run the worker's startup, instead of executing a
+fresh interpreter for each one.
+
+The zygote is spawned like any other worker and takes commands from the pool
+over the usual pipes. It does not run a reactor, since Twisted state must
+not leak into the forked children: each child connects back to the pool over
+a UNIX socket, identifies itself with the token it was forked for, and then
+starts a reactor of its own around the preloaded worker protocol.
+
+If loading the worker imports the reactor, forking is not safe, and the pool
+falls back to executing each worker.
+"""
+
+import cPickle
+import errno
+import itertools
+import logging
+import os
+import select
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+from twisted.internet import error
+from twisted.internet import protocol
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import failure
+from twisted.python import reflect
+
+from rmake.lib import logger
+from rmake.lib.proc_pool import connector
+from rmake.lib.proc_pool.pool import ProcessStarter
+
+log = logging.getLogger(__name__)
+
+
+class ZygoteStarter(ProcessStarter):
+    """
+    Process starter that forks workers from a zygote once one is ready, and
+    executes them as usual until then.
+
+    @param preloadArgs: Keyword arguments for the worker's C{preload}
+        method, run once in the zygote.
+    """
+
+    def __init__(self, preloadArgs, packages=(), debug=False):
+        ProcessStarter.__init__(self, packages=packages, debug=debug)
+        self.preloadArgs = preloadArgs
+        self.zygote = None
+        self.ready = False
+        self.failed = False
+        self.children = {}
+        self.tokens = itertools.count()
+        self.socketDir = self.listener = None
+
+    def startProcess(self, childClass, parentClass):
+        if self.failed:
+            return ProcessStarter.startProcess(self, childClass, parentClass)
+        if self.zygote is None:
+            self._startZygote(childClass)
+        if not self.ready:
+            return ProcessStarter.startProcess(self, childClass, parentClass)
+        token = str(self.tokens.next())
+        child = self.children[token] = connector.ForkedConnector(
+                parentClass())
+        self.zygote.protocol.sendCommand('fork', token=token)
+        return child
+
+    def stop(self):
+        self.failed = True
+        if self.zygote is not None:
+            self.zygote.loseConnection()
+        if self.listener is not None:
+            self.listener.stopListening()
+            self.listener = None
+        if self.socketDir is not None:
+            shutil.rmtree(self.socketDir, ignore_errors=True)
+            self.socketDir = None
+
+    def _startZygote(self, childClass):
+        from twisted.internet import reactor
+        if self.listener is None:
+            self.socketDir = tempfile.mkdtemp(prefix='rmake-zygote-')
+            self.listener = reactor.listenUNIX(
+                    os.path.join(self.socketDir, 'socket'),
+                    ChannelFactory(self))
+        prot = connector.ProcessConnector(ZygoteParent(self))
+        self._spawn(prot, ['--zygote', self._checkRoundTrip(childClass)])
+        self.zygote = prot
+        prot.protocol.sendCommand('preload',
+                socketPath=self.listener.getHost().name,
+                args=self.preloadArgs)
+
+    def zygoteReady(self):
+        log.info("Worker zygote %r is ready; forking workers from it",
+                self.zygote)
+        self.ready = True
+
+    def zygoteUnsupported(self, reason):
+        log.warning("Not forking workers from a zygote: %s", reason)
+        self.failed = True
+        self.zygote.loseConnection()
+
+    def zygoteLost(self, reason):
+        if not self.ready and not self.failed:
+            log.warning("Worker zygote exited before it was ready; starting "
+                    "workers without it")
+            self.failed = True
+        elif not self.failed:
+            log.warning("Worker zygote exited; restarting it")
+        self.zygote = None
+        self.ready = False
+        # Exit statuses of children forked from it will never arrive.
+        for child in self.children.values():
+            child.childExited(failure.Failure(error.ProcessTerminated()))
+        self.children.clear()
+
+    def childExited(self, token, status):
+        child = self.children.pop(token, None)
+        if child is None:
+            return
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            reason = error.ProcessDone(status)
+        else:
+            exitCode = sig = None
+            if os.WIFEXITED(status):
+                exitCode = os.WEXITSTATUS(status)
+            elif os.WIFSIGNALED(status):
+                sig = os.WTERMSIG(status)
+            reason = error.ProcessTerminated(exitCode, sig, status)
+        child.childExited(failure.Failure(reason))
+
+
+class ZygoteParent(Int32StringReceiver):
+    """Pool end of the connection to the zygote."""
+
+    def __init__(self, starter):
+        self.starter = starter
+
+    def sendCommand(self, command, **kwargs):
+        self.sendString(cPickle.dumps((command, kwargs), 2))
+
+    def stringReceived(self, data):
+        event, kwargs = cPickle.loads(data)
+        if event == 'ready':
+            self.starter.zygoteReady()
+        elif event == 'unsupported':
+            self.starter.zygoteUnsupported(**kwargs)
+        elif event == 'exited':
+            self.starter.childExited(**kwargs)
+        else:
+            log.error("Ignoring unknown zygote event %r", event)
+
+    def connectionLost(self, reason):
+        self.starter.zygoteLost(reason)
+
+
+class ChannelProtocol(protocol.Protocol):
+    """
+    Pool end of the connection to a forked child. The child first sends its
+    token and process ID on a line of their own.
+    """
+
+    child = None
+
+    def __init__(self):
+        self.buffer = ''
+
+    def dataReceived(self, data):
+        if self.child is None:
+            self.buffer += data
+            if '\n' not in self.buffer:
+                if len(self.buffer) > 100:
+                    self.transport.loseConnection()
+                return
+            hello, data = self.buffer.split('\n', 1)
+            self.buffer = None
+            try:
+                token, pid = hello.split()
+                pid = int(pid)
+            except ValueError:
+                self.transport.loseConnection()
+                return
+            child = self.factory.starter.children.get(token)
+            if child is None or child.channel is not None:
+                self.transport.loseConnection()
+                return
+            self.child = child
+            child.attach(self, pid)
+            if not data:
+                return
+        self.child.dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self.child is not None:
+            self.child.channelLost()
+
+
+class ChannelFactory(protocol.ServerFactory):
+
+    protocol = ChannelProtocol
+
+    def __init__(self, starter):
+        self.starter = starter
+
+
+class Zygote(object):
+    """
+    Forks preloaded workers on command. Runs in its own process, without a
+    reactor.
+    """
+
+    def __init__(self, childClass, inFd=connector.TO_CHILD,
+            outFd=connector.FROM_CHILD):
+        self.childClass = childClass
+        self.inFd = inFd
+        self.outFd = outFd
+        self.buffer = ''
+        self.prototype = None
+        self.socketPath = None
+        # pid -> token
+        self.children = {}
+
+    def run(self):
+        while True:
+            try:
+                readable = select.select([self.inFd], [], [], 1)[0]
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            if readable:
+                data = os.read(self.inFd, 65536)
+                if not data:
+                    # The pool went away. Children carry on by themselves.
+                    break
+                self.buffer += data
+                while len(self.buffer) >= 4:
+                    length, = struct.unpack('!I', self.buffer[:4])
+                    if len(self.buffer) < 4 + length:
+                        break
+                    command, kwargs = cPickle.loads(
+                            self.buffer[4:4 + length])
+                    self.buffer = self.buffer[4 + length:]
+                    getattr(self, 'cmd_' + command)(**kwargs)
+            self._reap()
+
+    def send(self, event, **kwargs):
+        data = cPickle.dumps((event, kwargs), 2)
+        data = struct.pack('!I', len(data)) + data
+        while data:
+            data = data[os.write(self.outFd, data):]
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, err:
+                if err.errno != errno.ECHILD:
+                    raise
+                return
+            if not pid:
+                return
+            token = self.children.pop(pid, None)
+            if token is not None:
+                self.send('exited', token=token, status=status)
+
+    def cmd_preload(self, socketPath, args):
+        self.socketPath = socketPath
+        self.prototype = self.childClass()
+        preload = getattr(self.prototype, 'preload', None)
+        if preload is not None:
+            preload(**args)
+        if 'twisted.internet.reactor' in sys.modules:
+            self.send('unsupported', reason="loading the worker installed "
+                    "a reactor")
+            return
+        self.send('ready')
+
+    def cmd_fork(self, token):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = token
+            return
+        status = 70
+        try:
+            try:
+                self._runChild(token)
+                status = 0
+            except:
+                log.exception("Error in forked worker:")
+        finally:
+            os._exit(status)
+
+    def _runChild(self, token):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socketPath)
+        sock.sendall('%s %d\n' % (token, os.getpid()))
+        # Replace the pipes to the pool with the socket, so the worker
+        # starts exactly as if it had been spawned.
+        os.dup2(sock.fileno(), connector.TO_CHILD)
+        os.dup2(sock.fileno(), connector.FROM_CHILD)
+        sock.close()
+
+        from twisted.internet import reactor
+        from twisted.internet import stdio
+        logger.setupLogging(withTwisted=True, consoleLevel=logging.INFO)
+        stdio.StandardIO(self.prototype, connector.TO_CHILD,
+                connector.FROM_CHILD)
+        reactor.run()
+
+
+def main(childClassName):
+    logger.setupLogging(consoleLevel=logging.INFO)
+    # See bootstrap.main
+    os.setpgrp()
+    childClass = reflect.namedAny(childClassName)
+    Zygote(childClass).run()
@@ -19,13 +19,23 @@
 Cache of changesets.
 """
 from StringIO import StringIO
+import errno
+import fcntl
+import logging
+import marshal
 import os
 import itertools
+import re
 import tempfile
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
+from conary import files
 from conary import trove
 
 from conary.deps import deps
+from conary.lib import digestlib
 from conary.lib import sha1helper
 from conary.lib import util
 from conary.repository import changeset
@@ -33,13 +43,120 @@ from conary.repository import datastore
 from conary.repository import errors
 from conary.repository import filecontents
 
+log = logging.getLogger(__name__)
+
+# Subdirectory of the cache holding dependency results. They are expired by
+# age rather than by use, since they describe the groups at the time they
+# were resolved.
+DEPS_DIR = 'deps'
+
+# Partial downloads older than this many seconds were abandoned.
+TEMP_MAX_AGE = 86400
+
+_entryRE = re.compile('^[0-9a-f]{38}$')
+_dirRE = re.compile('^[0-9a-f]{2}$')
+
+# Default size of the in-memory tier, in trove tuples.
+DEFAULT_MEMORY_LIMIT = 100000
+
+# In-memory tiers shared by every cache on the same directory in a process.
+_memoryCaches = {}
+
+# Hits and misses of every cache on the same directory in a process, not yet
+# added to its CacheStatistics.
+_pendingStats = {}
+
+
+def getMemoryCache(cacheDir, limit=DEFAULT_MEMORY_LIMIT):
+    """
+    Return the in-memory tier for the cache in C{cacheDir}, creating it with
+    the given limit if needed. Returns C{None} if C{limit} is 0.
+    """
+    if not limit:
+        return None
+    cacheDir = os.path.abspath(cacheDir)
+    memory = _memoryCaches.get(cacheDir)
+    if memory is None:
+        memory = _memoryCaches[cacheDir] = MemoryCache(limit)
+    else:
+        memory.limit = limit
+    return memory
+
+
+def _getPendingStats(cacheDir):
+    return _pendingStats.setdefault(os.path.abspath(cacheDir), [0, 0])
+
+
+def saveStats(cacheDir):
+    """
+    Add the hits and misses counted by this process for the cache in
+    C{cacheDir} to the statistics shared with other processes.
+    """
+    pending = _getPendingStats(cacheDir)
+    if not (pending[0] or pending[1]):
+        return
+    CacheStatistics(cacheDir).update(dict(hits=pending[0],
+        misses=pending[1]))
+    pending[:] = [0, 0]
+
+
+class MemoryCache(object):
+    """
+    Least-recently-used map of decoded cache entries.
+
+    Each entry has a weight, roughly the number of trove tuples it holds, and
+    the oldest entries are dropped once the total weight exceeds C{limit}.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value, weight = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value, weight
+        self.hits += 1
+        return value
+
+    def set(self, key, value, weight=1):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self._entries[key] = value, weight
+        self.size += weight
+        while self.size > self.limit and self._entries:
+            oldKey, (oldValue, oldWeight) = self._entries.popitem(last=False)
+            self.size -= oldWeight
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def getStats(self):
+        return dict(entries=len(self._entries), size=self.size,
+                limit=self.limit, hits=self.hits, misses=self.misses)
+
 
 class CachingTroveSource:
-    def __init__(self, troveSource, cacheDir, readOnly=False, depsOnly=False):
+    def __init__(self, troveSource, cacheDir, readOnly=False, depsOnly=False,
+            memoryLimit=DEFAULT_MEMORY_LIMIT, peers=None):
         self._troveSource = troveSource
         util.mkdirChain(cacheDir)
         self._depsOnly = depsOnly
-        self._cache = RepositoryCache(cacheDir, readOnly=readOnly)
+        self._cache = RepositoryCache(cacheDir, readOnly=readOnly,
+                memory=getMemoryCache(cacheDir, memoryLimit), peers=peers)
 
     def __getattr__(self, key):
         return getattr(self._troveSource, key)
@@ -73,6 +190,9 @@ class CachingTroveSource:
                                                        groupTroves,
                                                        depList)
 
+    def getCacheStats(self):
+        return self._cache.getStats()
+
     def getFileContents(self, fileList, callback = None):
         if self._depsOnly:
             return self._troveSource.getFileContents(fileList,
@@ -92,24 +212,189 @@ class RepositoryCache(object):
         We cache changeset files by component.  When conary is fixed, we'll
         be able to combine the download of these troves.
     """
-    def __init__(self, cacheDir, readOnly=False, depsOnly=False):
+    # Number of group lists whose hashes are remembered.
+    GROUP_HASHES = 64
+
+    def __init__(self, cacheDir, readOnly=False, depsOnly=False, memory=None,
+            fetchThreads=1, fetchBatchSize=10, peers=None):
         self.root = cacheDir
         self.store = DataStore(cacheDir)
+        depDir = os.path.join(cacheDir, DEPS_DIR)
+        if not readOnly:
+            util.mkdirChain(depDir)
+        self.depStore = DataStore(depDir)
         self.readOnly = readOnly
         self.depsOnly = depsOnly
         self.fileCache = LazyFileCache(100)
-
-    def hashGroupDeps(self, groupTroves, depClass, dependency):
+        # Optional MemoryCache holding decoded dependency results and
+        # known-present troves, checked before the datastore.
+        self.memory = memory
+        self._groupHashes = OrderedDict()
+        # Changesets missing from the cache are fetched in batches of
+        # fetchBatchSize by up to fetchThreads threads.
+        self.fetchThreads = fetchThreads
+        self.fetchBatchSize = max(fetchBatchSize, 1)
+        # Optional cacheserver.CachePeers asked for missing entries before
+        # going to the repository.
+        self.peers = peers
+        # Hits and misses not yet added to the shared statistics.
+        self._pending = _getPendingStats(cacheDir)
+
+    def _hashGroup(self, groupTroves):
+        key = tuple(x.getNameVersionFlavor() for x in groupTroves)
+        groupHash = self._groupHashes.pop(key, None)
+        if groupHash is None:
+            groupHash = ''.join(sorted(self.hashTrove(withFiles=False,
+                                                      withFileContents=False,
+                                                      *x)
+                                       for x in key))
+            if len(self._groupHashes) >= self.GROUP_HASHES:
+                self._groupHashes.popitem(last=False)
+        self._groupHashes[key] = groupHash
+        return groupHash
+
+    def hashGroupDeps(self, groupTroves, depClass, dependency,
+            groupHash=None):
         depSet = deps.DependencySet()
         depSet.addDep(depClass, dependency)
         frz = depSet.freeze()
-        troveList = sorted(self.hashTrove(withFiles=False,
-                                          withFileContents=False,
-                                          *x.getNameVersionFlavor())
-                           for x in groupTroves)
-        str = '[1]%s%s%s' % (len(frz), frz, ''.join(troveList))
+        if groupHash is None:
+            groupHash = self._hashGroup(groupTroves)
+        str = '[1]%s%s%s' % (len(frz), frz, groupHash)
         return sha1helper.sha1ToString(sha1helper.sha1String(str))
 
+    def getStats(self):
+        stats = {}
+        if self.memory is not None:
+            stats.update(self.memory.getStats())
+        if self.peers is not None:
+            stats.update(peerHits=self.peers.hits,
+                    peerMisses=self.peers.misses)
+        return stats
+
+    def _fetchFromPeers(self, hashes, verify):
+        """
+        Copy whichever of C{hashes} other nodes have into the store, and
+        return the set of hashes that were found.
+
+        @param verify: Called as C{verify(hash, path)} for each entry
+            before it is added; it returns C{False} if the entry is not
+            what was asked for.
+        """
+        if self.peers is None or self.readOnly:
+            return set()
+        hashes = list(hashes)
+        if not hashes:
+            return set()
+        return self.peers.fetch(hashes, self.store, verify)
+
+    def _verifyChangeSet(self, path, job):
+        """
+        Return C{True} if the changeset at C{path} holds exactly the trove
+        installed by C{job}, with intact trove digests and file streams.
+        File contents are not hashed here.
+        """
+        name, (version, flavor) = job[0], job[2]
+        try:
+            cs = changeset.ChangeSetFromFile(path)
+            troveCsList = list(cs.iterNewTroveList())
+            if len(troveCsList) != 1:
+                return False
+            troveCs = troveCsList[0]
+            if (troveCs.getName(), troveCs.getNewVersion(),
+                    troveCs.getNewFlavor()) != (name, version, flavor):
+                return False
+            trv = trove.Trove(troveCs)
+            if not trv.verifyDigests():
+                return False
+            for pathId, _, fileId, _ in trv.iterFileList():
+                stream = cs.getFileChange(None, fileId)
+                if stream is None:
+                    return False
+                if files.ThawFile(stream, pathId).fileId() != fileId:
+                    return False
+        except Exception, err:
+            log.warning("Changeset for %s=%s[%s] from a cache peer is "
+                    "corrupt: %s", name, version, flavor, err)
+            return False
+        return True
+
+    def _verifyFileContents(self, path, sha1):
+        """Return C{True} if the file at C{path} has SHA-1 digest C{sha1}."""
+        digest = digestlib.sha1()
+        fobj = open(path, 'rb')
+        try:
+            while True:
+                buf = fobj.read(1 << 20)
+                if not buf:
+                    break
+                digest.update(buf)
+        finally:
+            fobj.close()
+        return digest.digest() == sha1
+
+    def _recordHit(self, hash):
+        """Count a hit and mark the entry as just used, for
+        least-recently-used eviction."""
+        self._pending[0] += 1
+        if self.readOnly:
+            return
+        try:
+            os.utime(self.store.hashToPath(hash), None)
+        except OSError:
+            # Evicted since it was opened, or not ours to touch.
+            pass
+
+    def saveStats(self):
+        if not self.readOnly:
+            saveStats(self.root)
+
+    def collect(self, maxSize=0, depMaxAge=0):
+        """
+        Remove dependency results older than C{depMaxAge} seconds, then the
+        least recently used changesets and file contents until they take up
+        no more than C{maxSize} bytes. A limit of 0 means no limit.
+
+        Returns a dictionary of the number of entries expired and evicted
+        and the bytes freed.
+        """
+        now = time.time()
+        expired = evicted = freed = 0
+        if depMaxAge:
+            for path, size, mtime in _listEntries(self.depStore.top, now):
+                if mtime < now - depMaxAge and _remove(path):
+                    expired += 1
+                    freed += size
+        if maxSize:
+            entries = sorted(_listEntries(self.root, now),
+                    key=lambda x: x[2])
+            total = sum(x[1] for x in entries)
+            for path, size, mtime in entries:
+                if total <= maxSize:
+                    break
+                total -= size
+                if _remove(path):
+                    evicted += 1
+                    freed += size
+        result = dict(expired=expired, evicted=evicted, freed=freed)
+        CacheStatistics(self.root).update(result, lastCollect=now)
+        return result
+
+    def getDiskStats(self):
+        """
+        Return the size and number of entries in the cache along with the
+        statistics shared by all processes using it.
+        """
+        stats = CacheStatistics(self.root).read()
+        now = time.time()
+        entries = list(_listEntries(self.root, now))
+        depEntries = list(_listEntries(self.depStore.top, now))
+        stats.update(entries=len(entries),
+                size=sum(x[1] for x in entries),
+                depEntries=len(depEntries),
+                depSize=sum(x[1] for x in depEntries))
+        return stats
+
     def hashFile(self, fileId, fileVersion):
         # we add extra delimiters here because we can be sure they they
         # will result in a unique string for each n,v,f
@@ -151,6 +436,8 @@ class RepositoryCache(object):
         allToFind = []
         allFound = []
         allMissing = []
+        groupHash = self._hashGroup(groupTroves)
+        memory = self.memory
         for depSet in depList:
             d = {}
             toFind = deps.DependencySet()
@@ -160,13 +447,22 @@ class RepositoryCache(object):
             allFound.append(found)
             allMissing.append(missingIdx)
             for idx, (depClass, dependency) in enumerate(depSet.iterDeps(sort=True)):
-                depHash = str(self.hashGroupDeps(groupTroves, depClass, 
-                                                 dependency))
-                if self.store.hasFile(depHash):
-                    outFile = self.store.openFile(depHash)
+                depHash = str(self.hashGroupDeps(groupTroves, depClass,
+                                                 dependency, groupHash))
+                results = None
+                if memory is not None:
+                    results = memory.get(depHash)
+                if results is not None:
+                    found.append(list(results))
+                elif self.depStore.hasFile(depHash):
+                    outFile = self.depStore.openFile(depHash)
                     results = DependencyResultList(outFile.read()).get()
+                    outFile.close()
+                    self._pending[0] += 1
+                    self._remember(depHash, results)
                     found.append(results)
                 else:
+                    self._pending[1] += 1
                     toFind.addDep(depClass, dependency)
                     found.append(None)
                     missingIdx.append((idx, depHash))
@@ -182,6 +478,7 @@ class RepositoryCache(object):
                                       allResults[toFind])
                 for (idx, depHash), (depClass, dependency), resultList in iter:
                     found[idx] = resultList
+                    self._remember(depHash, resultList)
                     if self.readOnly:
                         continue
                     depResultList = DependencyResultList()
@@ -189,16 +486,29 @@ class RepositoryCache(object):
                     s = StringIO()
                     s.write(depResultList.freeze())
                     s.seek(0)
-                    self.store.addFile(s, depHash, integrityCheck=False)
+                    self.depStore.addFile(s, depHash, integrityCheck=False)
         allResults = {}
         for result, depSet in itertools.izip(allFound, depList):
             allResults[depSet] = result
         return allResults
 
+    def _remember(self, key, value, weight=None):
+        if self.memory is None:
+            return
+        if weight is None:
+            weight = 1 + len(value)
+        # Store a copy, as callers are free to modify what they are given.
+        self.memory.set(key, tuple(value), weight)
+
     def hasTroves(self, repos, troveList):
         results = {}
         needed = []
+        memory = self.memory
         for troveTup in troveList:
+            # Only presence is remembered; a missing trove may show up later.
+            if memory is not None and memory.get(('has', troveTup)):
+                results[troveTup] = True
+                continue
             n,v,f = troveTup
             csHash = str(self.hashTrove(n,v,f,
                                         withFiles=False,
@@ -213,12 +523,41 @@ class RepositoryCache(object):
                     results[troveTup] = True
                 else:
                     needed.append(troveTup)
-        hasTroves = repos.hasTroves(needed)
-        results.update(hasTroves)
+        if needed:
+            hasTroves = repos.hasTroves(needed)
+            if isinstance(hasTroves, list):
+                hasTroves = dict(itertools.izip(needed, hasTroves))
+            results.update(hasTroves)
+        if memory is not None:
+            for troveTup, present in results.iteritems():
+                if present:
+                    memory.set(('has', troveTup), True)
         return results
 
     def getChangeSets(self, repos, jobList, withFiles=True,
-                      withFileContents=True, callback=None):
+                      withFileContents=True, callback=None,
+                      reposFactory=None):
+        changesets = [None for x in jobList]
+        for idx, cs in self.iterChangeSets(repos, jobList, withFiles,
+                                           withFileContents, callback,
+                                           reposFactory):
+            changesets[idx] = cs
+        return changesets
+
+    def iterChangeSets(self, repos, jobList, withFiles=True,
+                       withFileContents=True, callback=None,
+                       reposFactory=None):
+        """
+        Yield C{(index, changeset)} for each job in C{jobList} as soon as it
+        is available: cached changesets first, then the rest as they are
+        fetched.
+
+        Missing changesets are fetched C{fetchBatchSize} at a time. Conary
+        repository clients are not thread safe, so they are only fetched in
+        parallel, by up to C{fetchThreads} threads, if C{reposFactory} is
+        given to create a client for each batch. Complete changesets are
+        written straight into the store as they download.
+        """
         for job in jobList:
             if job[1][0]:
                 raise CacheError('can only cache install,'
@@ -226,62 +565,146 @@ class RepositoryCache(object):
             if job[3]:
                 raise CacheError('Cannot cache absolute changesets')
 
-        changesets = [None for x in jobList]
         needed = []
         for idx, job in enumerate(jobList):
             csHash = str(self.hashTrove(job[0], job[2][0], job[2][1],
                                         withFiles, withFileContents))
             if self.store.hasFile(csHash):
-                outFile = self.fileCache.open(self.store.hashToPath(csHash))
-                #outFile = self.store.openRawFile(csHash)
-                changesets[idx] = changeset.ChangeSetFromFile(outFile)
+                self._recordHit(csHash)
+                yield idx, self._openChangeSet(csHash)
             else:
+                self._pending[1] += 1
                 needed.append((job, csHash, idx))
-
+        # Changesets without files can't be checked against their trove
+        # digests, so only complete ones are taken from other nodes.
+        fetched = set()
+        if withFiles:
+            jobsByHash = dict((x[1], x[0]) for x in needed)
+            fetched = self._fetchFromPeers(jobsByHash,
+                    lambda hash, path: self._verifyChangeSet(path,
+                        jobsByHash[hash]))
+        if fetched:
+            for job, csHash, idx in needed:
+                if csHash in fetched:
+                    yield idx, self._openChangeSet(csHash)
+            needed = [ x for x in needed if x[1] not in fetched ]
+        if not needed:
+            return
 
         total = len(needed)
-        for idx, (job, csHash, csIndex) in enumerate(needed):
-            if callback:
-                callback.setChangesetHunk(idx + 1, total)
-
-            cs = repos.createChangeSet([job], recurse=False,
-                                       callback=callback, withFiles=withFiles,
-                                       withFileContents=withFileContents)
-            if self.readOnly:
-                changesets[csIndex] = cs
-                continue
-
-            hashPath = self.store.hashToPath(csHash)
-            self.store.makeDir(hashPath)
-            dirPath = os.path.dirname(hashPath)
-            fileName = os.path.basename(hashPath)
-            tmpFd, tmpName = tempfile.mkstemp(prefix=fileName, dir=dirPath)
-            os.close(tmpFd)
-            cs.writeToFile(tmpName)
-            del cs
-            # we could use this changeset, but 
-            # cs.reset() is not necessarily reliable,
-            # so instead we re-read from disk
-            self.store.addFileFromTemp(csHash, tmpName)
-
-            outFile = self.fileCache.open(self.store.hashToPath(csHash))
-            #outFile = self.store.openRawFile(csHash)
-            changesets[csIndex] = changeset.ChangeSetFromFile(outFile)
-
-        return changesets
+        batches = [ needed[x:x + self.fetchBatchSize]
+                    for x in range(0, total, self.fetchBatchSize) ]
+        threads = min(self.fetchThreads, len(batches))
+        if threads <= 1 or reposFactory is None:
+            # Fetch in this thread, reporting progress as each changeset
+            # starts downloading.
+            done = 0
+            for batch in batches:
+                for job, csHash, csIndex in batch:
+                    done += 1
+                    if callback:
+                        callback.setChangesetHunk(done, total)
+                    cs = self._fetchChangeSet(repos, job, csHash,
+                            withFiles, withFileContents, callback)
+                    if cs is None:
+                        cs = self._openChangeSet(csHash)
+                    yield csIndex, cs
+            return
+
+        # Conary callbacks are not thread safe, so progress is only reported
+        # from this thread as changesets arrive.
+        def fetchBatch(batch):
+            batchRepos = reposFactory()
+            return [ (csIndex, csHash, self._fetchChangeSet(batchRepos, job,
+                        csHash, withFiles, withFileContents, None))
+                     for job, csHash, csIndex in batch ]
+        pool = ThreadPool(threads)
+        try:
+            done = 0
+            for results in pool.imap_unordered(fetchBatch, batches):
+                for csIndex, csHash, cs in results:
+                    done += 1
+                    if callback:
+                        callback.setChangesetHunk(done, total)
+                    if cs is None:
+                        cs = self._openChangeSet(csHash)
+                    yield csIndex, cs
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _openChangeSet(self, csHash):
+        outFile = self.fileCache.open(self.store.hashToPath(csHash))
+        return changeset.ChangeSetFromFile(outFile)
+
+    def _fetchChangeSet(self, repos, job, csHash, withFiles,
+                        withFileContents, callback):
+        """
+        Fetch one changeset. It is returned if the cache is read-only,
+        otherwise it is added to the store and C{None} is returned.
+        """
+        if self.readOnly:
+            return repos.createChangeSet([job], recurse=False,
+                                         callback=callback,
+                                         withFiles=withFiles,
+                                         withFileContents=withFileContents)
+
+        hashPath = self.store.hashToPath(csHash)
+        self.store.makeDir(hashPath)
+        dirPath = os.path.dirname(hashPath)
+        fileName = os.path.basename(hashPath)
+        tmpFd, tmpName = tempfile.mkstemp(prefix=fileName, dir=dirPath)
+        os.close(tmpFd)
+        try:
+            if (withFiles and withFileContents
+                    and hasattr(repos, 'createChangeSetFile')):
+                # Stream the changeset straight into the store instead of
+                # building it in memory first.
+                repos.createChangeSetFile([job], tmpName, recurse=False,
+                                          callback=callback)
+            else:
+                cs = repos.createChangeSet([job], recurse=False,
+                                           callback=callback,
+                                           withFiles=withFiles,
+                                           withFileContents=withFileContents)
+                cs.writeToFile(tmpName)
+                del cs
+        except:
+            util.removeIfExists(tmpName)
+            raise
+        # we could use this changeset, but
+        # cs.reset() is not necessarily reliable,
+        # so instead it is re-read from disk by the caller
+        self.store.addFileFromTemp(csHash, tmpName)
+        return None
 
     def getFileContents(self, repos, fileList, callback=None):
         contents = []
         needed = []
+        if self.peers is not None:
+            # Only contents whose file object, and so digest, is known can
+            # be checked and taken from other nodes.
+            digests = {}
+            for item in fileList:
+                if len(item) < 3 or item[2] is None:
+                    continue
+                fileHash = str(self.hashFile(*item[0:2]))
+                if not self.store.hasFile(fileHash):
+                    digests[fileHash] = item[2].contents.sha1()
+            self._fetchFromPeers(digests,
+                    lambda hash, path: self._verifyFileContents(path,
+                        digests[hash]))
         for idx, item in enumerate(fileList):
             fileId, fileVersion = item[0:2]
 
             fileHash = str(self.hashFile(fileId, fileVersion))
             if self.store.hasFile(fileHash):
+                self._recordHit(fileHash)
                 f = self.store.openFile(fileHash)
                 content = filecontents.FromFile(f)
                 contents.append(content)
             else:
+                self._pending[1] += 1
                 contents.append(None)
                 needed.append((idx, (fileId, fileVersion), fileHash))
 
@@ -321,6 +744,96 @@ class DataStore(datastore.DataStore):
 class CacheError(Exception):
     pass
 
+
+def _listEntries(top, now):
+    """
+    Yield the path, size and modification time of each entry in the
+    datastore at C{top}, removing partial downloads that were abandoned.
+    """
+    try:
+        subDirs = os.listdir(top)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return
+    for subDir in subDirs:
+        if not _dirRE.match(subDir):
+            continue
+        dirPath = os.path.join(top, subDir)
+        for name in os.listdir(dirPath):
+            path = os.path.join(dirPath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if _entryRE.match(name):
+                yield path, st.st_size, st.st_mtime
+            elif st.st_mtime < now - TEMP_MAX_AGE:
+                _remove(path)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+class CacheStatistics(object):
+    """
+    Hit, miss and eviction counters of a repository cache, shared by every
+    process using it and kept in a file in the cache directory.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.path = os.path.join(cacheDir, 'stats')
+        self.lockPath = os.path.join(cacheDir, 'stats.lock')
+
+    def read(self):
+        state = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0,
+                'freed': 0, 'lastCollect': None}
+        try:
+            fobj = open(self.path, 'rb')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return state
+        try:
+            try:
+                version, saved = marshal.loads(fobj.read())
+                if version == self.VERSION:
+                    state.update(saved)
+            except (EOFError, ValueError, TypeError):
+                log.warning("Discarding corrupt repository cache statistics "
+                        "file %s", self.path)
+        finally:
+            fobj.close()
+        return state
+
+    def update(self, counts, **values):
+        """Add C{counts} to the counters and set C{values}, while holding
+        the lock."""
+        util.mkdirChain(self.cacheDir)
+        lockFile = open(self.lockPath, 'a')
+        try:
+            fcntl.lockf(lockFile, fcntl.LOCK_EX)
+            state = self.read()
+            for key, value in counts.iteritems():
+                state[key] += value
+            state.update(values)
+            fobj = util.AtomicFile(self.path, 'wb', chmod=0644)
+            fobj.write(marshal.dumps((self.VERSION, state)))
+            fobj.commit()
+        finally:
+            lockFile.close()
+
+
 class LazyFileCache(util.LazyFileCache):
     # derive from util LazyFileCache which tries to read /proc/self/fd 
     # to get the total number of open files.  Unfortunately, when you 
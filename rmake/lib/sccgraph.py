@@ -0,0 +1,290 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Incrementally maintained strongly connected components of a directed graph.
+
+Edges point from a node to the nodes it depends on, so a "leaf" component is
+one with no edges leading out of it. Adding an edge only searches the part of
+the graph reachable from the new edge's target, and removing nodes or edges
+only re-examines the component they belonged to, so keeping the components
+current costs time proportional to the change rather than to the whole graph.
+"""
+
+
+class Component(object):
+    """A set of nodes that are all reachable from each other.
+
+    Components compare by identity, so they can be kept in sets while their
+    membership changes.
+    """
+
+    __slots__ = ('members', 'outEdges')
+
+    def __init__(self, members):
+        self.members = set(members)
+        # Number of edges from a member to a node outside the component.
+        self.outEdges = 0
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, node):
+        return node in self.members
+
+    def __repr__(self):
+        return 'Component(%r)' % (sorted(self.members),)
+
+
+def stronglyConnected(nodes, getChildren):
+    """
+    Return the strongly connected components of the subgraph made of
+    C{nodes}, as a list of sets. Only edges between members of C{nodes} are
+    followed. Components are returned children first.
+    """
+    nodes = set(nodes)
+    index = {}
+    lowlink = {}
+    stack = []
+    onStack = set()
+    result = []
+    counter = 0
+    for root in nodes:
+        if root in index:
+            continue
+        # Iterative version of Tarjan's algorithm, since dependency chains
+        # can be far deeper than the recursion limit.
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        onStack.add(root)
+        work = [(root, iter(getChildren(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in nodes:
+                    continue
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(getChildren(child))))
+                    break
+                elif child in onStack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    comp = set()
+                    while True:
+                        member = stack.pop()
+                        onStack.discard(member)
+                        comp.add(member)
+                        if member == node:
+                            break
+                    result.append(comp)
+    return result
+
+
+class ComponentTracker(object):
+    """Directed graph that keeps its strongly connected components current."""
+
+    def __init__(self):
+        self.children = {}
+        self.parents = {}
+        self.components = {}
+        self.leaves = set()
+
+    def __contains__(self, node):
+        return node in self.children
+
+    def __len__(self):
+        return len(self.children)
+
+    def getComponent(self, node):
+        return self.components[node]
+
+    def iterComponents(self):
+        seen = set()
+        for comp in self.components.itervalues():
+            if comp not in seen:
+                seen.add(comp)
+                yield comp
+
+    def getLeaves(self):
+        """Return the components that have no edges leading out of them."""
+        return list(self.leaves)
+
+    def getChildComponents(self, comp):
+        result = set()
+        for node in comp:
+            for child in self.children[node]:
+                result.add(self.components[child])
+        result.discard(comp)
+        return result
+
+    def getParentComponents(self, comp):
+        result = set()
+        for node in comp:
+            for parent in self.parents[node]:
+                result.add(self.components[parent])
+        result.discard(comp)
+        return result
+
+    ## Mutators
+
+    def addNode(self, node):
+        if node in self.children:
+            return
+        self.children[node] = set()
+        self.parents[node] = set()
+        comp = self.components[node] = Component([node])
+        self.leaves.add(comp)
+
+    def addEdge(self, fromNode, toNode):
+        self.addNode(fromNode)
+        self.addNode(toNode)
+        if fromNode == toNode or toNode in self.children[fromNode]:
+            return
+        self.children[fromNode].add(toNode)
+        self.parents[toNode].add(fromNode)
+        fromComp = self.components[fromNode]
+        toComp = self.components[toNode]
+        if fromComp is toComp:
+            return
+        self._addOutEdges(fromComp, 1)
+
+        # A new cycle exists if the target can already reach the source.
+        # Every component on such a path joins the cycle.
+        reachable = self._reachableFrom(toComp, fromComp)
+        if fromComp not in reachable:
+            return
+        merged = self._reachingWithin(fromComp, reachable)
+        self._merge(merged)
+
+    def delete(self, node):
+        """Remove C{node} and all edges to or from it."""
+        if node not in self.children:
+            return
+        comp = self.components[node]
+        for child in self.children.pop(node):
+            self.parents[child].discard(node)
+            if self.components[child] is not comp:
+                self._addOutEdges(comp, -1)
+        for parent in self.parents.pop(node):
+            self.children[parent].discard(node)
+            parentComp = self.components[parent]
+            if parentComp is not comp:
+                self._addOutEdges(parentComp, -1)
+        del self.components[node]
+        comp.members.discard(node)
+        if comp.members:
+            self._split(comp)
+        else:
+            self.leaves.discard(comp)
+
+    def deleteEdges(self, node):
+        """Remove all edges leading out of C{node}."""
+        if node not in self.children:
+            return
+        comp = self.components[node]
+        internal = False
+        for child in self.children[node]:
+            self.parents[child].discard(node)
+            if self.components[child] is comp:
+                internal = True
+            else:
+                self._addOutEdges(comp, -1)
+        self.children[node] = set()
+        if internal:
+            self._split(comp)
+
+    ## Internals
+
+    def _addOutEdges(self, comp, count):
+        comp.outEdges += count
+        if comp.outEdges:
+            self.leaves.discard(comp)
+        else:
+            self.leaves.add(comp)
+
+    def _reachableFrom(self, start, stop):
+        """Return the components reachable from C{start}.
+
+        The search does not continue past C{stop}.
+        """
+        seen = set([start])
+        todo = [start]
+        while todo:
+            comp = todo.pop()
+            if comp is stop:
+                continue
+            for child in self.getChildComponents(comp):
+                if child not in seen:
+                    seen.add(child)
+                    todo.append(child)
+        return seen
+
+    def _reachingWithin(self, target, allowed):
+        """Return the members of C{allowed} that can reach C{target}."""
+        seen = set([target])
+        todo = [target]
+        while todo:
+            comp = todo.pop()
+            for parent in self.getParentComponents(comp):
+                if parent not in seen and parent in allowed:
+                    seen.add(parent)
+                    todo.append(parent)
+        return seen
+
+    def _merge(self, comps):
+        members = set()
+        for comp in comps:
+            members.update(comp.members)
+            self.leaves.discard(comp)
+        new = Component(members)
+        for node in members:
+            self.components[node] = new
+        self._countOutEdges(new)
+
+    def _split(self, comp):
+        """Recompute the components of the nodes formerly in C{comp}."""
+        self.leaves.discard(comp)
+        for members in stronglyConnected(comp.members, self.children.get):
+            new = Component(members)
+            for node in members:
+                self.components[node] = new
+            self._countOutEdges(new)
+
+    def _countOutEdges(self, comp):
+        comp.outEdges = 0
+        for node in comp:
+            for child in self.children[node]:
+                if child not in comp.members:
+                    comp.outEdges += 1
+        if comp.outEdges:
+            self.leaves.discard(comp)
+        else:
+            self.leaves.add(comp)
+
@@ -18,15 +18,34 @@
 """
 Write and read logs that can be re-parsed back into mostly intact records,
 regardless of the contents of the log message.
+
+Each log has a sidecar index, named after it with C{INDEX_SUFFIX} appended,
+so that readers can seek straight to a point in time instead of parsing the
+whole log. A log is made of segments within which timestamps never go
+backwards; records from different sources can arrive out of order, and each
+time one does a new segment begins. The index holds fixed-size entries of
+C{(segment, flags, timestamp, offset)} for the first record of each segment,
+every C{BulkHandler.indexInterval}th record after that, and the last record of
+each segment that was ended cleanly, which is flagged with C{INDEX_LAST}.
 """
 
 
+import bisect
+import errno
+import heapq
 import logging
 import os
+import struct
 import time
 from collections import namedtuple
 from conary.lib import util
 
+INDEX_SUFFIX = '.idx'
+
+INDEX_LAST = 1
+
+_indexEntry = struct.Struct('!IBdQ')
+
 
 class StructuredLogFormatter(logging.Formatter):
 
@@ -90,43 +109,58 @@ class StructuredLogParser(object):
                 buf + payload)
 
         if self.asRecords:
-            # Trick strptime into parsing UTC timestamps
-            # [1970-01-01T00:00:00.000000Z] -> 1970-01-01T00:00:00 UTC
-            parseable = timestamp[1:-9] + ' UTC'
-            timetup = time.strptime(parseable, '%Y-%m-%dT%H:%M:%S %Z')
-            microseconds = int(timestamp[-8:-2])
-
-            # Trick mktime into epoch-izing UTC timestamps
-            timetup = timetup[:8] + (0,)  # Set DST off
-            epoch = time.mktime(timetup) - time.timezone
-            epoch += microseconds / 1e6  # Add microseconds
-
-            record = logging.LogRecord(
-                    name=name,
-                    level=int(level),
-                    pathname=None,
-                    lineno=-1,
-                    msg=message,
-                    args=None,
-                    exc_info=None,
-                    )
-            record.created = epoch
-            record.msecs = (epoch - long(epoch)) * 1000
-            record.relativeCreated = 0
-            return record
+            return _toRecord(logLine)
         else:
             return logLine
 
 
+_lastSecond = [None, None]
+
+
+def _parseTimestamp(timestamp):
+    """Convert a formatted timestamp back to seconds since the epoch."""
+    second = timestamp[1:-9]
+    if second != _lastSecond[0]:
+        # Trick strptime into parsing UTC timestamps
+        # [1970-01-01T00:00:00.000000Z] -> 1970-01-01T00:00:00 UTC
+        parseable = second + ' UTC'
+        timetup = time.strptime(parseable, '%Y-%m-%dT%H:%M:%S %Z')
+
+        # Trick mktime into epoch-izing UTC timestamps
+        timetup = timetup[:8] + (0,)  # Set DST off
+        _lastSecond[:] = [second, time.mktime(timetup) - time.timezone]
+    microseconds = int(timestamp[-8:-2])
+    return _lastSecond[1] + microseconds / 1e6  # Add microseconds
+
+
+def _toRecord(logLine):
+    epoch = _parseTimestamp(logLine.timestamp)
+    record = logging.LogRecord(
+            name=logLine.name,
+            level=logLine.level,
+            pathname=None,
+            lineno=-1,
+            msg=logLine.message,
+            args=None,
+            exc_info=None,
+            )
+    record.created = epoch
+    record.msecs = (epoch - long(epoch)) * 1000
+    record.relativeCreated = 0
+    return record
+
+
 class BulkHandler(object):
 
     formatter = StructuredLogFormatter()
     level = logging.NOTSET
+    indexInterval = 256
 
     def __init__(self, path, mode='a'):
         self.path = path
         self.mode = mode
         self.stream = None
+        self.index = None
         self.lastUsed = 0
 
     def _open(self):
@@ -135,6 +169,37 @@ class BulkHandler(object):
             os.makedirs(dirpath)
         return open(self.path, self.mode)
 
+    def _openIndex(self):
+        self.offset = os.fstat(self.stream.fileno()).st_size
+        # Always start a new segment, since the last timestamp written
+        # before the log was closed isn't known.
+        self.segment = -1
+        self.lastCreated = self.lastOffset = self.lastEntry = None
+        self.sinceEntry = 0
+        indexPath = self.path + INDEX_SUFFIX
+        if 'a' not in self.mode or not self.offset:
+            self.index = open(indexPath, 'wb')
+            return
+        try:
+            index = open(indexPath, 'r+b')
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            # The log was written without an index, so don't start one
+            # partway through.
+            return
+        index.seek(0, 2)
+        size = index.tell()
+        size -= size % _indexEntry.size
+        if not size:
+            index.close()
+            return
+        # Drop any entry that was only partly written.
+        index.truncate(size)
+        index.seek(size - _indexEntry.size)
+        self.segment = _indexEntry.unpack(index.read(_indexEntry.size))[0]
+        self.index = index
+
     def emit(self, record):
         self.emitMany([record])
     handle = emit
@@ -143,14 +208,47 @@ class BulkHandler(object):
         self.lastUsed = time.time()
         if self.stream is None:
             self.stream = self._open()
+            self._openIndex()
+        entries = []
         for record in records:
-            self.stream.write(self.formatter.format(record) + '\n')
+            data = self.formatter.format(record) + '\n'
+            if self.lastCreated is None or record.created < self.lastCreated:
+                # Timestamp went backwards, start a new segment
+                entries.extend(self._endSegment())
+                self.segment += 1
+                self.sinceEntry = self.indexInterval
+            if self.sinceEntry >= self.indexInterval:
+                entries.append(_indexEntry.pack(self.segment, 0,
+                    record.created, self.offset))
+                self.sinceEntry = 0
+            self.stream.write(data)
+            self.sinceEntry += 1
+            self.lastCreated = record.created
+            self.lastOffset = self.offset
+            self.offset += len(data)
         self.stream.flush()
+        # Only index records that are already in the log.
+        self._writeIndex(entries)
+
+    def _endSegment(self):
+        if self.lastCreated is None:
+            return []
+        return [_indexEntry.pack(self.segment, INDEX_LAST, self.lastCreated,
+            self.lastOffset)]
+
+    def _writeIndex(self, entries):
+        if self.index and entries:
+            self.index.write(''.join(entries))
+            self.index.flush()
 
     def close(self):
         if self.stream:
             self.stream.close()
             self.stream = None
+        if self.index:
+            self._writeIndex(self._endSegment())
+            self.index.close()
+            self.index = None
 
 
 class JobLogManager(object):
@@ -182,9 +280,36 @@ class JobLogManager(object):
             out.append(self.getPath(name))
         return out
 
+    def listPaths(self):
+        """Return the paths of all logs written for the job so far."""
+        try:
+            names = os.listdir(self.basePath)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return []
+        return [os.path.join(self.basePath, x) for x in sorted(names)
+                if x == 'job.log' or (x.startswith('task-')
+                    and x.endswith('.log'))]
+
     def emitMany(self, records, task_uuid=None):
         self._get(task_uuid).emitMany(records)
 
+    def query(self, task_uuids=None, start=None, end=None):
+        """
+        Iterate over the records of the job, in time order.
+
+        @param task_uuids: If given, only read the logs of these tasks. Use
+            C{None} in the list for the job's own log.
+        @param start: Earliest record timestamp to return.
+        @param end: Latest record timestamp to return.
+        """
+        if task_uuids is None:
+            paths = self.listPaths()
+        else:
+            paths = [self.getPath(x) for x in task_uuids]
+        return queryLogs(paths, start, end)
+
     def getLogger(self, task_uuid=None, name='dispatcher'):
         handler = self._get(task_uuid)
         logger = logging.Logger(name, level=logging.DEBUG)
@@ -210,10 +335,10 @@ def _softIter(iterable):
         return None
 
 
-def _splitLog(inFile):
+def _scanSegments(inFile):
     """
-    Split a logfile into a series of subfiles at each boundary where the
-    timestamp goes backwards
+    Return the C{(start, end)} byte range of each segment of a log by parsing
+    the whole thing.
     """
     firstByte = 0
     lastByte = 0
@@ -225,12 +350,170 @@ def _splitLog(inFile):
             # Timestamp went backwards, start a new segment
             regions.append((firstByte, lastByte))
             firstByte = lastByte
-        lastByte = inFile.tell()
+        lastByte = record.endPos
         lastStamp = timestamp
     if firstByte != lastByte:
         regions.append((firstByte, lastByte))
+    return regions
+
+
+def _splitLog(inFile):
+    """
+    Split a logfile into a series of subfiles at each boundary where the
+    timestamp goes backwards
+    """
     return [util.SeekableNestedFile(inFile, end - start, start)
-            for (start, end) in regions]
+            for (start, end) in _scanSegments(inFile)]
+
+
+def readIndex(path):
+    """
+    Return the segments of the log at C{path} according to its index, as a
+    list of C{(times, offsets, closed)} tuples where C{times} and C{offsets}
+    are the timestamps and positions of the indexed records, and C{closed}
+    is true if the last indexed record is known to be the last one in the
+    segment.
+
+    Returns C{None} if the log has no usable index.
+    """
+    try:
+        fobj = open(path + INDEX_SUFFIX, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        data = fobj.read()
+    finally:
+        fobj.close()
+    segments = []
+    lastSegment = None
+    for pos in xrange(0, len(data) - _indexEntry.size + 1, _indexEntry.size):
+        segment, flags, created, offset = _indexEntry.unpack_from(data, pos)
+        if segment != lastSegment:
+            segments.append([[], [], False])
+            lastSegment = segment
+        segments[-1][0].append(created)
+        segments[-1][1].append(offset)
+        segments[-1][2] = bool(flags & INDEX_LAST)
+    if not segments or segments[0][1][0] != 0:
+        return None
+    return [tuple(x) for x in segments]
+
+
+def _seekSegment(times, offsets, start):
+    """Return the position of the last indexed record before C{start}."""
+    if start is None:
+        return offsets[0]
+    n = bisect.bisect_left(times, start)
+    return offsets[max(n - 1, 0)]
+
+
+def findOffset(path, start):
+    """
+    Return a byte offset into the log at C{path} such that every record
+    before it is older than C{start}, or C{None} if the log has no index.
+    """
+    segments = readIndex(path)
+    if segments is None:
+        return None
+    for times, offsets, closed in segments:
+        if closed and times[-1] < start:
+            # The whole segment is older.
+            continue
+        return _seekSegment(times, offsets, start)
+    return os.path.getsize(path)
+
+
+def _iterRegion(fobj, start, end, startTime=None, endTime=None,
+        bufferSize=65536):
+    """
+    Parse records between byte offsets C{start} and C{end} of C{fobj}, which
+    are in time order. C{end} may be C{None} to read to the end of the file.
+
+    The file is re-positioned before each read so that several regions of
+    the same file can be read at once.
+    """
+    pos = start
+    buf = ''
+    i = 0
+    while True:
+        space = buf.find(' ', i)
+        if space < 0 or len(buf) < space + 1 + int(buf[i:space], 16):
+            if end is not None and pos >= end:
+                return
+            fobj.seek(pos)
+            size = bufferSize
+            if end is not None:
+                size = min(size, end - pos)
+            data = fobj.read(size)
+            if not data:
+                return
+            pos += len(data)
+            buf = buf[i:] + data
+            i = 0
+            continue
+        i = space + 1 + int(buf[i:space], 16)
+        timestamp, level, name, message = buf[space + 1:i].split(' ', 3)
+        if endTime is not None or startTime is not None:
+            created = _parseTimestamp(timestamp)
+            if endTime is not None and created > endTime:
+                return
+            if startTime is not None and created < startTime:
+                continue
+        yield _toRecord(_LogLine(timestamp, int(level), name, message[:-1],
+            None, None, None))
+
+
+def _merge(iterators):
+    """Lazily merge iterators of records that are each in time order."""
+    def keyed(n, iterator):
+        for seq, record in enumerate(iterator):
+            yield record.created, n, seq, record
+    for item in heapq.merge(*[keyed(n, x) for (n, x) in enumerate(iterators)]):
+        yield item[-1]
+
+
+def queryLogs(paths, start=None, end=None):
+    """
+    Iterate over the records of the logs at C{paths}, merged into time
+    order, optionally limited to those between timestamps C{start} and
+    C{end}. Logs that have an index are read starting at the indexed record
+    nearest C{start}; others are parsed in full. Missing logs are skipped.
+    """
+    files = []
+    iterators = []
+    try:
+        for path in paths:
+            try:
+                fobj = open(path, 'rb')
+            except IOError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            files.append(fobj)
+            segments = readIndex(path)
+            if segments is None:
+                for first, last in _scanSegments(fobj):
+                    iterators.append(_iterRegion(fobj, first, last,
+                        start, end))
+                continue
+            for n, (times, offsets, closed) in enumerate(segments):
+                if closed and start is not None and times[-1] < start:
+                    continue
+                if end is not None and times[0] > end:
+                    continue
+                if n + 1 < len(segments):
+                    last = segments[n + 1][1][0]
+                else:
+                    last = None
+                iterators.append(_iterRegion(fobj,
+                    _seekSegment(times, offsets, start), last, start, end))
+        for record in _merge(iterators):
+            yield record
+    finally:
+        for fobj in files:
+            fobj.close()
 
 
 def mergeLogs(inFiles, sort=True):
@@ -243,14 +526,6 @@ def mergeLogs(inFiles, sort=True):
         for inFile in inFiles:
             splitFiles.extend(_splitLog(inFile))
         inFiles = splitFiles
-    # Get the first record from each file
     parsers = [StructuredLogParser(fobj, asRecords=True) for fobj in inFiles]
-    nextRecord = [_softIter(x) for x in parsers]
-    while True:
-        if not any(nextRecord):
-            break
-        # Find which record from all files that has the lowest timestamp
-        n = min((x.created, n) for (n, x) in enumerate(nextRecord) if x)[1]
-        yield nextRecord[n]
-        # Grab the next one from the same file
-        nextRecord[n] = _softIter(parsers[n])
+    for record in _merge(parsers):
+        yield record
@@ -26,7 +26,7 @@ from rmake.lib.jabberlink import cred as jcred
 from rmake.lib.jabberlink import client as jclient
 from rmake.lib.jabberlink import message as jmessage
 from rmake.lib.jabberlink.handlers import link as jlink
-from rmake.messagebus.common import NS_RMAKE
+from rmake.messagebus.common import NS_RMAKE, NS_RMAKE_COMPACT
 from rmake.messagebus import message as rmessage
 
 
@@ -63,12 +63,17 @@ class _BaseService(jclient.LinkClient):
                 secure=cfg.xmppSecure,
                 )
         self.link.permissive = self.cfg.xmppPermissive
+        if self.cfg.xmppStreamPort:
+            self.listenStreams(self.cfg.xmppStreamPort,
+                    self.cfg.xmppStreamAddress)
         for jid in self.cfg.xmppPermit:
             self.listenNeighbor(jid)
         self.link.addMessageHandler(MessageHandler(self))
+        self.link.features.add(NS_RMAKE_COMPACT)
 
     def sendTo(self, jid, message, wait=False):
-        jmsg = message.to_jmessage()
+        compact = NS_RMAKE_COMPACT in self.link.getFeatures(jid)
+        jmsg = message.to_jmessage(compact=compact)
         if wait:
             return self.link.sendWithDeferred(jid, jmsg)
         else:
@@ -107,3 +112,16 @@ class BusClientService(_BaseService):
     def isConnected(self):
         neighbor = self.link._findNeighbor(self.targetJID)
         return neighbor and neighbor.isAuthenticated
+
+    def getBacklog(self):
+        """Return the number of frames queued to the target but not yet
+        acknowledged by it."""
+        neighbor = self.link._findNeighbor(self.targetJID)
+        if not neighbor:
+            return 0
+        backlog = neighbor.out_seq_new - neighbor.out_seq_ackd
+        if neighbor.stream:
+            # Messages on a direct stream are not acknowledged, so count
+            # those sent since the connection's send buffer filled up.
+            backlog += neighbor.stream.held
+        return backlog
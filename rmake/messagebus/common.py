@@ -21,6 +21,8 @@ Constants and simple functions shared by message bus components.
 
 # Element namespaces
 NS_RMAKE = 'http://rpath.com/permanent/xmpp/rmake-3.0'
+# Feature advertised by nodes that can read compact message payloads
+NS_RMAKE_COMPACT = 'http://rpath.com/permanent/xmpp/rmake-3.0#compact'
 
 # XPath expressions
 XPATH_IM = "/message/body"
@@ -62,6 +62,13 @@ class BusConfig(ConfigFile):
     xmppPort            = (cfgtypes.CfgInt, 5222)
     xmppSecure          = (cfgtypes.CfgBool, True,
             "Secure the XMPP connection with TLS")
+    xmppStreamPort      = (cfgtypes.CfgInt, 0,
+            "Port on which to accept direct connections from nodes, to send "
+            "messages without going through the XMPP server. Traffic on "
+            "these connections is not encrypted. (0 to disable)")
+    xmppStreamAddress   = (cfgtypes.CfgString, None,
+            "Address that nodes should use to connect to xmppStreamPort, if "
+            "different from the address of the XMPP connection.")
 
 
 class BusClientConfig(BusConfig):
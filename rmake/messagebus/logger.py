@@ -15,74 +15,243 @@
 #
 
 
+"""
+Ship log records from worker processes to the dispatcher.
+
+Records travel as tuples of C{(created, levelno, name, message, exc_text)},
+which is everything the dispatcher's log files keep, and are sent over the
+bus in batches encoded column by column and compressed, since log lines from
+one task repeat the same few logger names and much of the same text.
+"""
+
 import logging
 import time
+import zlib
+
+from rmake.lib import bincodec
+from rmake.messagebus.message import LogBatch
+
+ENCODING_VERSION = 2
+# Largest batch that will be decompressed, well above anything a LogRelay
+# sends.
+MAX_DECODED_SIZE = 16 * 1024 * 1024
+
+
+def _formatException(ei):
+    return logging._defaultFormatter.formatException(ei)
+
+
+def recordToTuple(record):
+    """Reduce a log record to the parts that are shipped."""
+    # Don't send traceback objects over the wire if it can be helped.
+    if record.exc_info and not record.exc_text:
+        record.exc_text = _formatException(record.exc_info)
+    record.exc_info = None
+    message = record.getMessage()
+    if isinstance(message, unicode):
+        message = message.encode('utf8', 'replace')
+    return (record.created, record.levelno, record.name, message,
+            record.exc_text)
+
+
+def encodeRecords(records):
+    """Encode a list of record tuples into a compressed string."""
+    names = {}
+    nameIdx = []
+    levels = []
+    times = []
+    messages = []
+    excs = {}
+    base = records and records[0][0] or 0
+    for n, (created, levelno, name, message, exc_text) in enumerate(records):
+        nameIdx.append(names.setdefault(name, len(names)))
+        levels.append(levelno)
+        # Microseconds since the first record.
+        times.append(int(round((created - base) * 1e6)))
+        messages.append(message)
+        if exc_text:
+            excs[n] = exc_text
+    nameList = sorted(names, key=names.get)
+    data = bincodec.dumps((ENCODING_VERSION, base, nameList, nameIdx, levels,
+        times, messages, excs))
+    return zlib.compress(data, 6)
+
+
+def decodeRecords(data):
+    """
+    Decode a string from L{encodeRecords} into C{logging.LogRecord}s.
 
-from rmake.messagebus.message import LogRecords
+    Raises C{ValueError} if the data is malformed or would decompress to
+    more than C{MAX_DECODED_SIZE} bytes.
+    """
+    try:
+        decomp = zlib.decompressobj()
+        data = decomp.decompress(data, MAX_DECODED_SIZE)
+    except zlib.error, err:
+        raise ValueError("Invalid log batch: %s" % (err,))
+    if decomp.unconsumed_tail:
+        raise ValueError("Log batch is larger than %d bytes"
+                % MAX_DECODED_SIZE)
+    fields = bincodec.loads(data)
+    if not isinstance(fields, tuple) or len(fields) != 8:
+        raise ValueError("Invalid log batch")
+    (version, base, nameList, nameIdx, levels, times, messages, excs
+            ) = fields
+    if version != ENCODING_VERSION:
+        raise ValueError("Unsupported log encoding version %r" % (version,))
+    count = len(messages)
+    if not (len(nameIdx) == len(levels) == len(times) == count
+            and isinstance(excs, dict)):
+        raise ValueError("Invalid log batch")
+    if [x for x in nameIdx if not 0 <= x < len(nameList)]:
+        raise ValueError("Invalid logger name in log batch")
+    records = []
+    try:
+        for n, message in enumerate(messages):
+            record = logging.LogRecord(
+                    name=nameList[nameIdx[n]],
+                    level=levels[n],
+                    pathname=None,
+                    lineno=-1,
+                    msg=message,
+                    args=None,
+                    exc_info=None,
+                    )
+            record.created = base + times[n] / 1e6
+            record.msecs = (record.created - long(record.created)) * 1000
+            record.relativeCreated = 0
+            record.exc_text = excs.get(n)
+            records.append(record)
+    except TypeError:
+        raise ValueError("Invalid log batch")
+    return records
 
 
 class LogRelay(object):
     """
     Relay log records to a message bus server.
 
-    Records will be sent at most once every 0.25 seconds.
+    Records are sent once C{MAX_BATCH} records or C{MAX_BYTES} bytes of
+    messages have been collected, or C{DEADLINE} seconds after the previous
+    batch, whichever comes first.
+
+    Task status and heartbeats go onto the bus as soon as they are sent, so
+    while more than C{MAX_BACKLOG} frames are already waiting to go to the
+    bus, logs are held back instead, so that a noisy task can't delay them.
+    If more than C{MAX_BUFFERED} bytes are held back, the oldest records are
+    dropped.
     """
 
     DEADLINE = 0.25
+    MAX_BATCH = 5000
+    MAX_BYTES = 256 * 1024
+    MAX_BACKLOG = 16
+    MAX_BUFFERED = 16 * 1024 * 1024
+    _now = staticmethod(time.time)
 
-    def __init__(self, sendFunc, task):
+    def __init__(self, sendFunc, task, backlogFunc=None):
         self.sendFunc = sendFunc
         self.task = task
+        self.backlogFunc = backlogFunc
         self.buffered = []
+        self.bufferedBytes = 0
+        self.dropped = 0
         self.last_send = 0
         self.delayed_call = None
 
-    def _formatException(self, ei):
-        return logging._defaultFormatter.formatException(ei)
-
     def emitMany(self, records):
+        """Queue log records, either C{logging.LogRecord} objects or tuples
+        from L{recordToTuple}."""
         for record in records:
-            # Don't send traceback objects over the wire if it can be helped.
-            if record.exc_info and not record.exc_text:
-                record.exc_text = self._formatException(record.exc_info)
-            record.exc_info = None
+            if isinstance(record, logging.LogRecord):
+                record = recordToTuple(record)
             self.buffered.append(record)
+            self.bufferedBytes += len(record[3]) + len(record[4] or '')
+        if self.bufferedBytes > self.MAX_BUFFERED:
+            self._dropOldest()
         self.maybeFlush()
 
     def emit(self, record):
         self.emitMany([record])
 
+    def _dropOldest(self):
+        drop = 0
+        while self.bufferedBytes > self.MAX_BUFFERED / 2:
+            record = self.buffered[drop]
+            self.bufferedBytes -= len(record[3]) + len(record[4] or '')
+            drop += 1
+        del self.buffered[:drop]
+        self.dropped += drop
+
+    def _isCongested(self):
+        return (self.backlogFunc is not None
+                and self.backlogFunc() > self.MAX_BACKLOG)
+
     def maybeFlush(self):
-        if self.delayed_call or not self.buffered:
-            # Nothing to do, or there's already a delayed call scheduled.
+        if not self.buffered:
+            return
+        full = (len(self.buffered) >= self.MAX_BATCH
+                or self.bufferedBytes >= self.MAX_BYTES)
+        if self.delayed_call and not full:
+            # There's already a delayed call scheduled.
             return
         deadline = self.last_send + self.DEADLINE
-        now = time.time()
-        if now > deadline:
-            # It's been long enough so go ahead and send it immediately.
+        now = self._now()
+        if (now >= deadline or full) and not self._isCongested():
+            # It's been long enough, or there's plenty to send, so go ahead
+            # and send it immediately.
             self.flush()
             return
+        if self.delayed_call:
+            return
 
-        # Not long enough to send immediately, so schedule a call.
+        # Not long enough to send immediately, or the bus is busy, so
+        # schedule a call.
         from twisted.internet import reactor
-        delay = deadline - now
-        self.delayed_call = reactor.callLater(delay, self.flush)
+        delay = max(deadline - now, self.DEADLINE / 5)
+        self.delayed_call = reactor.callLater(delay, self._delayedFlush)
 
-    def flush(self):
-        if not self.buffered:
-            return
+    def _delayedFlush(self):
+        self.delayed_call = None
+        self.maybeFlush()
 
-        # If there's a delayed flush in-flight (or if this *is* the delayed
-        # flush) then cancel and clear it.
+    def flush(self, force=False):
+        """
+        Send one batch of records, or all of them if C{force} is set. Any
+        left over are sent later so that other messages can go in between.
+        """
+        # If there's a delayed flush in-flight then cancel and clear it.
         if self.delayed_call:
             if self.delayed_call.active():
                 self.delayed_call.cancel()
             self.delayed_call = None
+        while self.buffered or self.dropped:
+            records = self._takeBatch()
+            msg = LogBatch(encodeRecords(records), self.task.job_uuid,
+                    self.task.task_uuid)
+            self.sendFunc(msg)
+            self.last_send = self._now()
+            if not force:
+                break
+        if self.buffered:
+            from twisted.internet import reactor
+            self.delayed_call = reactor.callLater(0, self._delayedFlush)
 
-        records, self.buffered = self.buffered, []
-        msg = LogRecords(records, self.task.job_uuid, self.task.task_uuid)
-        self.sendFunc(msg)
-        self.last_send = time.time()
+    def _takeBatch(self):
+        count = size = 0
+        for record in self.buffered:
+            if count >= self.MAX_BATCH or size >= self.MAX_BYTES:
+                break
+            count += 1
+            size += len(record[3]) + len(record[4] or '')
+        records, self.buffered = self.buffered[:count], self.buffered[count:]
+        self.bufferedBytes -= size
+        if self.dropped:
+            records.insert(0, (records and records[0][0] or self._now(),
+                logging.WARNING, __name__, "%d log records were dropped "
+                "because the message bus is congested" % self.dropped, None))
+            self.dropped = 0
+        return records
 
     def close(self):
-        self.flush()
+        self.flush(force=True)
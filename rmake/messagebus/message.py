@@ -16,13 +16,21 @@
 
 
 import logging
+import struct
 
+from rmake.lib import bincodec
 from rmake.lib import chutney
 from rmake.lib.jabberlink import message as jmessage
 from rmake.messagebus.common import NS_RMAKE
 
 log = logging.getLogger(__name__)
 
+CONTENT_PICKLE = 'application/python-pickle'
+CONTENT_COMPACT = 'application/x-rmake-compact'
+
+# Codec version, number of payload slots, bitmask of slots that are set
+_compactHeader = struct.Struct('!BBI')
+
 
 class _MessageTypeRegistrar(type):
 
@@ -73,16 +81,69 @@ class Message(object):
         className = type(self).__name__
         return '<%s>' % (className,)
 
-    def to_jmessage(self):
+    def to_jmessage(self, compact=False):
+        """
+        Convert to a jabberlink message.
+
+        If C{compact} is true, the payload is encoded with L{bincodec}
+        according to the message's payload slots, unless it holds something
+        that can't be, in which case it is pickled as usual. Only use it for
+        recipients that advertise L{NS_RMAKE_COMPACT}.
+        """
         headers = {}
         if self.payload.__dict__:
-            headers['content-type'] = 'application/python-pickle'
             headers['rmake-type'] = self.messageType
-            payload = chutney.dumps(self.payload)
+            payload = None
+            if compact:
+                payload = self._encodeCompact()
+            if payload is not None:
+                headers['content-type'] = CONTENT_COMPACT
+            else:
+                headers['content-type'] = CONTENT_PICKLE
+                payload = chutney.dumps(self.payload)
         else:
             payload = ''
         return jmessage.Message(NS_RMAKE, payload, headers)
 
+    def _encodeCompact(self):
+        slots = self._payload_slots or ()
+        values = self.payload.__dict__
+        if len(values) > len(slots) or len(slots) > 32:
+            return None
+        encoder = bincodec.Encoder()
+        present = 0
+        try:
+            for n, slot in enumerate(slots):
+                if slot in values:
+                    present |= 1 << n
+                    encoder.encode(values[slot])
+        except bincodec.EncodeError:
+            return None
+        if len(values) != bin(present).count('1'):
+            # Something other than a payload slot was set.
+            return None
+        return (_compactHeader.pack(bincodec.VERSION, len(slots), present)
+                + encoder.getvalue())
+
+    @classmethod
+    def _decodeCompact(cls, data):
+        version, count, present = _compactHeader.unpack_from(data)
+        slots = cls._payload_slots or ()
+        if version != bincodec.VERSION:
+            raise bincodec.DecodeError("Unsupported encoding version %d" %
+                    version)
+        if count != len(slots):
+            raise bincodec.DecodeError("Message has %d payload slots, "
+                    "expected %d" % (count, len(slots)))
+        payload = MessagePayload()
+        decoder = bincodec.Decoder(data, _compactHeader.size)
+        for n, slot in enumerate(slots):
+            if present & (1 << n):
+                setattr(payload, slot, decoder.decode())
+        if decoder.offset != len(data):
+            raise bincodec.DecodeError("Trailing data")
+        return payload
+
     @classmethod
     def from_jmessage(cls, jmsg):
         sender = jmsg.sender.full()
@@ -97,13 +158,20 @@ class Message(object):
         if payloadType is None:
             msg.payload = None
         else:
-            if payloadType == 'application/python-pickle':
+            if payloadType == CONTENT_PICKLE:
                 try:
                     msg.payload = chutney.loads(jmsg.payload)
                 except:
                     log.warning("Failed to unpickle message from %s:", sender,
                             exc_info=1)
                     return None
+            elif payloadType == CONTENT_COMPACT:
+                try:
+                    msg.payload = messageClass._decodeCompact(jmsg.payload)
+                except (bincodec.DecodeError, struct.error):
+                    log.warning("Failed to decode message from %s:", sender,
+                            exc_info=1)
+                    return None
             else:
                 log.warning("Unknown payload type %s from %s", payloadType,
                         sender)
@@ -162,6 +230,18 @@ class Heartbeat(Message):
     _payload_slots = ('caps', 'tasks', 'slots', 'addresses')
 
 
+class WorkerStats(Message):
+    """Statistics reported by each launcher plugin, keyed by plugin name."""
+    messageType = 'worker-stats'
+    _payload_slots = ('stats',)
+
+
 class LogRecords(Message):
     messageType = 'logging'
     _payload_slots = ('records', 'job_uuid', 'task_uuid')
+
+
+class LogBatch(Message):
+    """Log records encoded by L{rmake.messagebus.logger.encodeRecords}."""
+    messageType = 'log-batch'
+    _payload_slots = ('data', 'job_uuid', 'task_uuid')
@@ -68,6 +68,8 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
         self.csCache = csCache
         self.chrootCache = chrootCache
         self.chrootFingerprint = None
+        self.baseFingerprint = None
+        self.troveFingerprints = []
         self.oldRoot = oldRoot
         if targetFlavor is not None:
             cfg.initializeFlavors()
@@ -115,9 +117,10 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
     def install(self):
         self.cfg.root = self.root
         self._lock(self.root, fcntl.LOCK_SH)
+        reusedRoot = False
         if self.oldRoot:
             if self.serverCfg.reuseChroots:
-                self._moveOldRoot(self.oldRoot, self.root)
+                reusedRoot = self._moveOldRoot(self.oldRoot, self.root)
         if not self.jobList and not self.crossJobList:
             # should only be true in debugging situations
             return
@@ -135,6 +138,19 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
                 self.logger.info('chroot fingerprint %s '
                          'restore done', strFingerprint)
                 return
+            if not reusedRoot:
+                # Start from the closest cached chroot, if any. Installing
+                # with migrate below then only applies the difference, just
+                # as it does for a reused old root.
+                closest = self.chrootCache.findClosest(self.baseFingerprint,
+                        self.troveFingerprints)
+                if closest:
+                    strFingerprint = sha1helper.sha1ToString(closest)
+                    self.logger.info('restoring closest cached chroot with '
+                            'fingerprint %s', strFingerprint)
+                    self.chrootCache.restore(closest, self.cfg.root)
+                    self.logger.info('chroot fingerprint %s '
+                             'restore done', strFingerprint)
 
         def _install(jobList):
             self.cfg.flavor = []
@@ -146,9 +162,12 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
             client = conaryclient.ConaryClient(self.cfg)
             client.setUpdateCallback(self.callback)
             if self.csCache:
+                cfg = self.cfg
                 changeSetList = self.csCache.getChangeSets(client.getRepos(),
-                                                           jobList,
-                                                           callback=self.callback)
+                        jobList, callback=self.callback,
+                        reposFactory=lambda: conaryclient.ConaryClient(
+                            cfg).getRepos())
+                self.csCache.saveStats()
             else:
                 changeSetList = []
 
@@ -209,6 +228,8 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
             self.logger.info('caching chroot with fingerprint %s',
                     strFingerprint)
             self.chrootCache.store(self.chrootFingerprint, self.cfg.root)
+            self.chrootCache.recordTroves(self.chrootFingerprint,
+                    self.baseFingerprint, self.troveFingerprints)
             self.logger.info('caching chroot %s done',
                     strFingerprint)
 
@@ -312,13 +333,19 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
 
         # version 1 or later fingerprint
         blob = ''.join(fingerprints[:a])  # jobList
+        base = ''
         if (self.crossJobList or self.bootstrapJobList or
                 self.cfg.rpmRequirements):
             # version 2 or later fingerprint
-            blob += '\n'
-            blob += ''.join(fingerprints[a:b]) + '\n'  # crossJobList
-            blob += ''.join(fingerprints[b:]) + '\n'  # bootstrapJobList
-            blob += '\t'.join(str(x) for x in self.cfg.rpmRequirements) + '\n'
+            base += '\n'
+            base += ''.join(fingerprints[a:b]) + '\n'  # crossJobList
+            base += ''.join(fingerprints[b:]) + '\n'  # bootstrapJobList
+            base += '\t'.join(str(x) for x in self.cfg.rpmRequirements) + '\n'
+            blob += base
+        # Everything but the buildreqs must match for a cached chroot to be
+        # used as a starting point for this one.
+        self.baseFingerprint = sha1helper.sha1String(base)
+        self.troveFingerprints = fingerprints[:a]
         return sha1helper.sha1String(blob)
 
     def invalidateCachedChroot(self):
@@ -427,6 +454,7 @@ class rMakeChroot(ConaryBasedChroot):
                 newPath = path[oldRootLen:]
                 self.copyFile(path, '/tmp/cscache/' + newPath,
                               mode=0755)
+            self.csCache.saveStats()
 
 
     def _copyInRmake(self):
@@ -16,6 +16,8 @@
 
 
 import copy
+import errno
+import marshal
 import os
 import stat
 import sys
@@ -32,10 +34,123 @@ from rmake import constants
 from rmake import errors
 from rmake.worker.chroot import rootserver
 from rmake.worker.chroot import rootfactory
+from rmake.lib import cacheserver
 from rmake.lib import flavorutil
 from rmake.lib import logger as logger_
 from rmake.lib import repocache
 
+class ChrootContentsIndex(object):
+    """
+    Troves installed in each chroot, by name, label and flavor.
+
+    Opening a chroot's conary database and listing its troves is slow, so
+    the contents of each chroot are kept in memory and in a file alongside
+    the chroots, and only read again when the database has changed. An
+    inverted index from trove to chroots makes scoring all the old chroots
+    against a set of build requirements cheap.
+    """
+
+    VERSION = 1
+    DB_PATH = '/var/lib/conarydb'
+
+    def __init__(self, path):
+        self.path = path
+        # chroot path -> (database stat key, frozenset of NLF tuples)
+        self._contents = {}
+        # NLF tuple -> set of chroot paths
+        self._byTrove = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            fobj = open(self.path, 'rb')
+        except IOError, err:
+            if err.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            try:
+                version, contents = marshal.loads(fobj.read())
+            except (EOFError, ValueError, TypeError):
+                return
+        finally:
+            fobj.close()
+        if version != self.VERSION:
+            return
+        for chrootPath, (key, troves) in contents.iteritems():
+            if os.path.isdir(chrootPath):
+                self._set(chrootPath, key, troves)
+            else:
+                self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        util.mkdirChain(os.path.dirname(self.path))
+        contents = dict((chrootPath, (key, tuple(troves)))
+                for chrootPath, (key, troves) in self._contents.iteritems())
+        fobj = util.AtomicFile(self.path, 'wb', chmod=0600)
+        fobj.write(marshal.dumps((self.VERSION, contents)))
+        fobj.commit()
+        self._dirty = False
+
+    def update(self, chrootPath):
+        """Re-read the contents of C{chrootPath} if its database changed."""
+        try:
+            st = os.stat(chrootPath + self.DB_PATH + '/conarydb')
+            key = (st.st_ino, st.st_mtime, st.st_size)
+        except OSError:
+            key = None
+        cached = self._contents.get(chrootPath)
+        if cached and cached[0] == key:
+            return
+        if key is None:
+            troves = ()
+        else:
+            db = database.Database(chrootPath, self.DB_PATH)
+            troves = [(x[0], str(x[1].trailingLabel()), str(x[2]))
+                    for x in db.iterAllTroves()]
+        self._set(chrootPath, key, troves)
+        self._dirty = True
+
+    def discard(self, chrootPath):
+        cached = self._contents.pop(chrootPath, None)
+        if not cached:
+            return
+        for nlf in cached[1]:
+            paths = self._byTrove[nlf]
+            paths.discard(chrootPath)
+            if not paths:
+                del self._byTrove[nlf]
+        self._dirty = True
+
+    def _set(self, chrootPath, key, troves):
+        self.discard(chrootPath)
+        troves = frozenset(tuple(x) for x in troves)
+        self._contents[chrootPath] = (key, troves)
+        for nlf in troves:
+            self._byTrove.setdefault(nlf, set()).add(chrootPath)
+
+    def score(self, chrootPaths, troves):
+        """
+        Return a dictionary mapping each of C{chrootPaths} to twice the
+        number of C{troves} it contains minus the number of other troves
+        it contains, so that an empty chroot is better than one with lots
+        of wrong troves.
+        """
+        for chrootPath in chrootPaths:
+            self.update(chrootPath)
+        common = dict.fromkeys(chrootPaths, 0)
+        for nlf in troves:
+            for chrootPath in self._byTrove.get(nlf, ()):
+                if chrootPath in common:
+                    common[chrootPath] += 1
+        return dict((chrootPath, 3 * count -
+                    len(self._contents[chrootPath][1]))
+                for chrootPath, count in common.iteritems())
+
+
 class ChrootQueue(object):
     def __init__(self, root, slots):
         self.root = root
@@ -43,6 +158,7 @@ class ChrootQueue(object):
         self.chroots = {}
         self.toRemove = {}  # chroots that are scheduled for removal
         self.badChroots = {}
+        self.contents = ChrootContentsIndex(root + '/.chroot-contents')
 
     def reset(self):
         self.chroots = {}
@@ -102,11 +218,18 @@ class ChrootQueue(object):
 
     def chrootFinished(self, chrootPath):
         self.chroots.pop(chrootPath, False)
+        if chrootPath and os.path.isdir(chrootPath):
+            # Index the new contents now rather than when the next slot is
+            # requested.
+            self.contents.update(chrootPath)
+            self.contents.save()
 
     def deleteChroot(self, chrootPath):
         self.chroots.pop(chrootPath, False)
         self.toRemove.pop(chrootPath, False)
         self.badChroots.pop(chrootPath, False)
+        self.contents.discard(chrootPath)
+        self.contents.save()
 
     def markBadChroot(self, chrootPath):
         # we tried to remove this chroot but it failed.
@@ -122,25 +245,19 @@ class ChrootQueue(object):
             If goodRootsOnly is True, be more discerning about which chroot
             to use - only use ones that have more than half matching packages.
         """
+        oldChroots = self.listOldChroots()
+        if not oldChroots:
+            return None
         if not reuseRoot:
-            for chroot in self.listOldChroots():
-                # return oldest directory
-                return sorted(self.listOldChroots(),
-                              key=lambda x: os.stat(x)[stat.ST_MTIME])[0]
-        buildReqsByNLF = set([(x[0], x[1].trailingLabel(), x[2]) 
+            # return oldest directory
+            return min(oldChroots, key=lambda x: os.stat(x)[stat.ST_MTIME])
+        buildReqsByNLF = set([(x[0], str(x[1].trailingLabel()), str(x[2]))
                              for x in buildReqs])
-        matches = {}
-        for chrootPath in self.listOldChroots():
-            db = database.Database(chrootPath, '/var/lib/conarydb')
-            chrootContents = db.iterAllTroves()
-            trovesByNLF = set([(x[0], x[1].trailingLabel(), x[2]) for x in chrootContents])
-            # matches = 2*matches - extras - so an empty chroot is better than 
-            # a chroot with lots of wrong troves.
-            matches[chrootPath] = 2 * len(trovesByNLF.intersection(buildReqsByNLF)) - len(trovesByNLF.difference(buildReqsByNLF))
-        if matches:
-            rank, best = sorted((x[1], x[0]) for x in matches.iteritems())[-1]
-            if rank >= len(buildReqsByNLF) or not goodRootsOnly:
-                return best
+        matches = self.contents.score(oldChroots, buildReqsByNLF)
+        self.contents.save()
+        rank, best = max((x[1], x[0]) for x in matches.iteritems())
+        if rank >= len(buildReqsByNLF) or not goodRootsOnly:
+            return best
 
     def requestSlot(self, troveName, buildReqs, reuseChroots):
         if self.slots > 0 and len(self.chroots) >= self.slots:
@@ -178,7 +295,10 @@ class ChrootManager(object):
         cacheDir = serverCfg.getCacheDir()
         util.mkdirChain(cacheDir)
         if self.serverCfg.useCache:
-            self.csCache = repocache.RepositoryCache(cacheDir)
+            self.csCache = repocache.RepositoryCache(cacheDir,
+                    fetchThreads=serverCfg.changesetFetchThreads,
+                    fetchBatchSize=serverCfg.changesetFetchBatchSize,
+                    peers=cacheserver.getPeers(serverCfg.cachePeers))
         else:
             self.csCache = None
         self.chrootCache = serverCfg.getChrootCache()
@@ -197,6 +317,11 @@ class ChrootManager(object):
     def chrootFinished(self, chrootPath):
         self.queue.chrootFinished(chrootPath)
 
+    def getChrootCacheStats(self):
+        if not self.chrootCache:
+            return {}
+        return self.chrootCache.getStats()
+
     def getRootFactory(self, cfg, buildReqList, crossReqList, bootstrapReqs,
             buildTrove):
         cfg = copy.deepcopy(cfg)
@@ -20,12 +20,61 @@ Daemon entry point for the rMake worker node.
 """
 
 import sys
+import time
 from conary.lib import options
 from rmake import compat
 from rmake.lib import daemon
+from rmake.lib import repocache
 from rmake.worker import launcher
 
 
+class CacheCommand(daemon.DaemonCommand):
+    commands = ['cache']
+
+    help = 'Show repository cache usage'
+
+    docs = {'clean': "Remove expired and least recently used entries now"}
+
+    def addParameters(self, argDef):
+        daemon.DaemonCommand.addParameters(self, argDef)
+        argDef["clean"] = options.NO_PARAM
+
+    def runCommand(self, daemon, cfg, argSet, args):
+        # Cache settings belong to the build plugin.
+        from rmake.build import nodecfg
+        daemon.plugins.setOptions(cfg.pluginOption)
+        if not daemon.plugins.hasPlugin('build'):
+            sys.exit("error: The build plugin is not loaded.")
+        plugin = daemon.plugins.getPlugin('build')
+        nodeCfg = plugin.populateConfigFromOptions(
+                nodecfg.NodeConfiguration())
+        cache = repocache.RepositoryCache(nodeCfg.getCacheDir(),
+                readOnly=True)
+        if argSet.pop('clean', False):
+            result = cache.collect(maxSize=nodeCfg.cacheMaxSize * 1024 * 1024,
+                    depMaxAge=nodeCfg.cacheDepsMaxAge * 3600)
+            print ("Removed %(expired)d expired and %(evicted)d least "
+                    "recently used entries (%(freed)d bytes)" % result)
+        stats = cache.getDiskStats()
+        lookups = stats['hits'] + stats['misses']
+        print "Repository cache %s" % nodeCfg.getCacheDir()
+        print "  Changesets and files: %d entries, %.1f MiB" % (
+                stats['entries'], stats['size'] / 1048576.0),
+        if nodeCfg.cacheMaxSize:
+            print "of %d MiB" % nodeCfg.cacheMaxSize
+        else:
+            print "(no limit)"
+        print "  Dependency results:   %d entries, %.1f MiB" % (
+                stats['depEntries'], stats['depSize'] / 1048576.0)
+        print "  Lookups: %d hits, %d misses (%.1f%% hit rate)" % (
+                stats['hits'], stats['misses'],
+                lookups and 100.0 * stats['hits'] / lookups or 0)
+        print "  Removed: %d expired, %d least recently used" % (
+                stats['expired'], stats['evicted'])
+        if stats['lastCollect']:
+            print "  Last cleaned up: %s" % time.ctime(stats['lastCollect'])
+
+
 class WorkerDaemon(daemon.DaemonService, daemon.LoggingMixin,
         daemon.PluginsMixin):
 
@@ -33,6 +82,7 @@ class WorkerDaemon(daemon.DaemonService, daemon.LoggingMixin,
     configClass = launcher.WorkerConfig
     logFileName = 'rmake-node.log'
     pluginTypes = ('launcher', 'worker')
+    commandList = list(daemon.DaemonService.commandList) + [CacheCommand]
 
     def setup(self, **kwargs):
         for name in ('dispatcherJID', 'xmppIdentFile'):
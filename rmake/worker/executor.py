@@ -32,7 +32,7 @@ from rmake.core.types import JobStatus
 from rmake.lib import logger
 from rmake.lib import osutil
 from rmake.lib import pluginlib
-from rmake.messagebus.logger import LogRelay
+from rmake.messagebus.logger import LogRelay, recordToTuple
 
 log = logging.getLogger(__name__)
 
@@ -94,7 +94,8 @@ class WorkerParent(WorkerProtocol):
         """Snoop launch commands to keep track of the current task."""
         self.task = kwargs['task']
         self.launcher = kwargs.pop('launcher')
-        self.logRelay = LogRelay(self.launcher.bus.sendToTarget, self.task)
+        self.logRelay = LogRelay(self.launcher.bus.sendToTarget, self.task,
+                backlogFunc=self.launcher.bus.getBacklog)
 
         # Fail tasks that exited cleanly but didn't report success.
         def cb_checkResult(result):
@@ -135,6 +136,9 @@ class WorkerParent(WorkerProtocol):
             log.warning("Dropping worker status report for wrong task.")
             return
         self.task = task
+        if task.status.final:
+            # The dispatcher stops taking logs for a job once it finishes.
+            self.logRelay.flush(force=True)
         log.debug("Setting task %s status: %s %s",
                 task.task_uuid.short, task.status.code, task.status.text)
         self.launcher.forwardTaskStatus(task)
@@ -142,7 +146,7 @@ class WorkerParent(WorkerProtocol):
     def cmd_push_logs(self, ctr, records):
         if not self.task:
             return
-        self.launcher.forwardTaskLogs(self.task, records)
+        self.logRelay.emitMany(records)
 
 
 class WorkerChild(WorkerProtocol):
@@ -215,8 +219,9 @@ class WorkerChild(WorkerProtocol):
             return result
         return d
 
-    def cmd_startup(self, ctr, pluginDirs, disabledPlugins, pluginOptions,
-            cfgBlob):
+    def preload(self, pluginDirs, disabledPlugins, pluginOptions, cfgBlob):
+        """Load plugins and configuration. When forking from a zygote this
+        is done once, before forking."""
         self.plugins = pluginlib.PluginManager(pluginDirs, disabledPlugins,
                 supportedTypes=self.pluginTypes)
         self.plugins.loadPlugins()
@@ -228,6 +233,9 @@ class WorkerChild(WorkerProtocol):
             for task_type, task_handler in tasks.items():
                 self.task_types[task_type] = (plugin, task_handler)
 
+    def cmd_startup(self, ctr, **kwargs):
+        if self.plugins is None:
+            self.preload(**kwargs)
         self.sendCommand(ctr, 'ack')
 
     def cmd_shutdown(self, ctr):
@@ -236,6 +244,9 @@ class WorkerChild(WorkerProtocol):
         self.transport.loseConnection()
 
     def sendTask(self, task):
+        if self.logger:
+            # Keep logs in order with the status.
+            self.logger.flush()
         task = task.thaw()
         task.times.ticks = self.task.times.ticks + 1
         self.task = task.freeze()
@@ -257,25 +268,61 @@ class WorkerChild(WorkerProtocol):
 
 
 class ChildLogger(logging.Handler):
+    """
+    Collect log records from the task and pass them to the parent in
+    batches, once C{WINDOW} seconds have passed since the first record of a
+    batch or C{MAX_BATCH} records are waiting, whichever comes first.
+    """
+
+    WINDOW = 0.2
+    MAX_BATCH = 1000
 
     def __init__(self, sendFunc):
         logging.Handler.__init__(self, logging.NOTSET)
         self.sendFunc = sendFunc
+        self.buffered = []
+        self.delayed_call = None
 
     def emit(self, record):
         if not self.sendFunc:
             return
-        # Don't send traceback objects over the wire if it can be helped.
-        if record.exc_info and not record.exc_text:
-            record.exc_text = self._formatException(record.exc_info)
-        record.exc_info = None
+        record = recordToTuple(record)
 
         # All logging is going to be happening in the worker thread, but all IO
         # needs to happen in the main thread.
         from twisted.internet import reactor
-        reactor.callFromThread(self.sendFunc, [record])
+        self.acquire()
+        try:
+            self.buffered.append(record)
+            count = len(self.buffered)
+        finally:
+            self.release()
+        if count == 1:
+            reactor.callFromThread(self._schedule)
+        elif count == self.MAX_BATCH:
+            reactor.callFromThread(self.flush)
+
+    def _schedule(self):
+        if self.delayed_call is None and self.sendFunc:
+            from twisted.internet import reactor
+            self.delayed_call = reactor.callLater(self.WINDOW, self.flush)
+
+    def flush(self):
+        """Send all buffered records. Must be called from the main thread."""
+        if self.delayed_call:
+            if self.delayed_call.active():
+                self.delayed_call.cancel()
+            self.delayed_call = None
+        self.acquire()
+        try:
+            records, self.buffered = self.buffered, []
+        finally:
+            self.release()
+        if records and self.sendFunc:
+            self.sendFunc(records)
 
     def close(self):
+        self.flush()
         self.sendFunc = None
         logging.Handler.close(self)
 
@@ -86,7 +86,11 @@ class LauncherService(MultiService):
                     pluginOptions=self.cfg.pluginOption,
                     cfgBlob=cPickle.dumps(self.cfg, 2),
                     ),
-                debug=self.debug)
+                debug=self.debug,
+                minIdle=self.cfg.minIdleWorkers,
+                maxIdle=self.cfg.maxIdleWorkers,
+                forkServer=self.cfg.forkWorkers,
+                )
         self.pool.setServiceParent(self)
 
     def launch(self, msg):
@@ -116,14 +120,6 @@ class LauncherService(MultiService):
         msg = message.TaskStatus(task.freeze())
         self.bus.sendToTarget(msg)
 
-    def forwardTaskLogs(self, task, records):
-        msg = message.LogRecords(
-                records=records,
-                job_uuid=task.job_uuid,
-                task_uuid=task.task_uuid,
-                )
-        self.bus.sendToTarget(msg)
-
 
 class LauncherBusService(BusClientService):
 
@@ -150,11 +146,16 @@ class LauncherBusService(BusClientService):
 
 class HeartbeatService(TimerService):
 
+    # Plugin statistics change slowly, so they are only sent with every
+    # this many heartbeats.
+    statsEvery = 12
+
     def __init__(self, launcher, interval=5):
         self.launcher = launcher
         TimerService.__init__(self, interval, self.heartbeat)
         self.sent_hello = False
         self.netlink = netlink.RoutingNetlink()
+        self.beats = 0
 
     def heartbeat(self):
         tasks = self.launcher.pool.getTaskList()
@@ -163,6 +164,18 @@ class HeartbeatService(TimerService):
         msg = message.Heartbeat(caps=self.launcher.caps, tasks=tasks,
                 slots=slots, addresses=addresses)
         self.launcher.bus.sendToTarget(msg)
+        if self.beats % self.statsEvery == 0:
+            self.sendStats()
+        self.beats += 1
+
+    def sendStats(self):
+        stats = {}
+        for name, value in self.launcher.plugins.p.launcher.get_stats(
+                self.launcher).items():
+            if value is not None:
+                stats[name] = value
+        if stats:
+            self.launcher.bus.sendToTarget(message.WorkerStats(stats=stats))
 
 
 class PoolService(pool.ProcessPool):
@@ -193,6 +206,16 @@ class WorkerConfig(BusClientConfig):
     slots               = (cfgtypes.CfgInt, 2)
     slotsByType         = cfgtypes.CfgDict(cfgtypes.CfgInt)
     zone                = (cfgtypes.CfgList(cfgtypes.CfgString), [])
+    minIdleWorkers      = (cfgtypes.CfgInt, 1,
+            "Number of started worker processes always kept waiting for "
+            "tasks")
+    maxIdleWorkers      = (cfgtypes.CfgInt, 4,
+            "Most worker processes kept waiting for tasks when tasks arrive "
+            "in bursts")
+    forkWorkers         = (cfgtypes.CfgBool, False,
+            "Fork worker processes from a process that has already loaded "
+            "plugins and configuration, rather than starting each one from "
+            "scratch")
 
     # Plugins
     pluginDirs          = (cfgtypes.CfgPathList, [])
@@ -43,6 +43,10 @@ class LauncherPlugin(pluginlib.Plugin):
     def launcher_post_setup(self, launcher):
         pass
 
+    def launcher_get_stats(self, launcher):
+        """Return statistics to report to the dispatcher, or C{None}."""
+        return None
+
 
 class WorkerPlugin(pluginlib.Plugin):
 
@@ -18,15 +18,18 @@
 import copy
 import itertools
 import time
+from collections import OrderedDict
+from StringIO import StringIO
 
 from conary import conaryclient
 from conary.deps import deps
+from conary.lib import digestlib
 from conary.lib import log
 from conary.local import database
 from conary.repository import trovesource
 
 from rmake.lib import flavorutil, recipeutil
-from rmake.lib.apiutils import freeze, thaw
+from rmake.lib.apiutils import freeze, register, thaw
 from rmake.worker import resolvesource
 
 class ResolveResult(object):
@@ -101,14 +104,242 @@ class ResolveResult(object):
                                  for x in self.missingBuildReqs]
         return self
 
+register(ResolveResult)
+
+
+def getContextKey(cfg):
+    """
+    Return a hash of the parts of C{cfg} that a L{ResolveContext} depends on:
+    the conary configuration used to reach the repositories and the
+    resolveTroves being searched.
+    """
+    out = StringIO()
+    cfg.storeConaryCfg(out)
+    inputs = [
+            out.getvalue(),
+            str(bool(cfg.resolveTrovesOnly)),
+            '\1'.join('\0'.join(str(y) for y in x)
+                for x in cfg.resolveTroveTups),
+            ]
+    return digestlib.sha1('\2'.join(inputs)).hexdigest()
+
+
+class SharedDepSource(object):
+    """
+    Repository wrapper that remembers the answers to
+    C{resolveDependenciesByGroups}.
+
+    Those answers only depend on the contents of the groups searched, so
+    every trove resolved against the same resolveTroves can share them. Each
+    distinct dependency is asked for once, and the dependencies missing from
+    a request are sent in a single query. If C{maxEntries} is set, only that
+    many of the most recently used answers are kept.
+    """
+
+    def __init__(self, repos, maxEntries=None):
+        self._repos = repos
+        self.maxEntries = maxEntries
+        # (sorted group tuples, depSet) -> suggestions or None, ordered
+        # least to most recently used.
+        self._results = OrderedDict()
+
+    def __getattr__(self, key):
+        return getattr(self._repos, key)
+
+    def resolveDependenciesByGroups(self, groupTroves, depList):
+        if not (groupTroves and depList):
+            return {}
+        groupKey = tuple(sorted(x.getNameVersionFlavor()
+                                for x in groupTroves))
+        results = {}
+        missing = []
+        for depSet in set(depList):
+            key = groupKey, depSet
+            if key in self._results:
+                results[depSet] = self._results[key] = self._results.pop(key)
+            else:
+                missing.append(depSet)
+        if missing:
+            found = self._repos.resolveDependenciesByGroups(groupTroves,
+                                                            missing)
+            for depSet in missing:
+                results[depSet] = self._results[groupKey, depSet] = \
+                        found.get(depSet)
+        self.trim()
+        # Callers may modify the suggestion lists, so hand out copies.
+        return dict((x, [ list(y) for y in results[x] ]) for x in depList
+                    if results[x] is not None)
+
+    def trim(self, maxEntries=None):
+        """
+        Forget the least recently used answers until at most C{maxEntries},
+        or C{self.maxEntries} if not given, are left.
+        """
+        if maxEntries is None:
+            maxEntries = self.maxEntries
+            if maxEntries is None:
+                return
+        while len(self._results) > max(maxEntries, 0):
+            self._results.popitem(last=False)
+
+    def __len__(self):
+        return len(self._results)
+
+
+class ResolveContext(object):
+    """
+    Conary client and resolveTroves contents that can be shared by every
+    resolve run with the same configuration.
+
+    Nothing held here depends on the trove being resolved or on the troves
+    built so far, so the trove sources built from it in
+    L{DependencyResolver.getSources} are still created for each run.
+    """
+
+    def __init__(self, cfg, repos=None, wrapRepos=None, maxTroves=0):
+        self.key = getContextKey(cfg)
+        self.maxTroves = maxTroves
+        self.client = conaryclient.ConaryClient(cfg)
+        if repos is None:
+            repos = self.client.getRepos()
+            if wrapRepos:
+                repos = wrapRepos(repos)
+        repos = SharedDepSource(repos, maxEntries=maxTroves or None)
+        self.client.repos = repos
+        self.repos = repos
+        self._resolveTroves = None
+        self._resolveTroveCount = 0
+
+    @property
+    def size(self):
+        """
+        Number of trove tuples and dependency answers held, used to bound
+        the memory kept warm.
+        """
+        return self._resolveTroveCount + len(self.repos)
+
+    def getResolveTroves(self, cfg):
+        """
+        Return the troves named by C{cfg.resolveTroveTups}, as a list of
+        lists in the same shape.
+        """
+        if self._resolveTroves is None:
+            allResolveTroveTups = list(itertools.chain(*cfg.resolveTroveTups))
+            allResolveTroves = self.repos.getTroves(allResolveTroveTups,
+                                                    withFiles=False)
+            resolveTrovesByTup = dict((x.getNameVersionFlavor(), x)
+                                      for x in allResolveTroves)
+            self._resolveTroves = [[resolveTrovesByTup[x] for x in tupList]
+                                   for tupList in cfg.resolveTroveTups]
+            self._resolveTroveCount = sum(
+                    1 + len(list(x.iterTroveList(weakRefs=True,
+                                                 strongRefs=True)))
+                    for x in allResolveTroves)
+            if self.maxTroves:
+                # Leave room for the resolveTroves themselves.
+                self.repos.maxEntries = max(
+                        self.maxTroves - self._resolveTroveCount, 0)
+                self.repos.trim()
+        return self._resolveTroves
+
+    def trim(self, maxSize):
+        """Forget dependency answers until C{size} is at most C{maxSize}."""
+        self.repos.trim(maxSize - self._resolveTroveCount)
+
+    def close(self):
+        self.client.close()
+        self._resolveTroves = None
+
+
+class ResolveContextCache(object):
+    """
+    Least-recently-used set of L{ResolveContext} objects kept by a long-lived
+    worker process.
+
+    At most C{maxContexts} contexts are kept, and older ones are dropped once
+    their resolveTroves and remembered dependency answers add up to more
+    than C{maxTroves} entries. Limits are checked each time a context is
+    requested. The most recently used context is never dropped; instead it
+    forgets dependency answers so that it fits within C{maxTroves} by itself.
+    """
+
+    def __init__(self, maxContexts=4, maxTroves=0, wrapRepos=None):
+        self.maxContexts = maxContexts
+        self.maxTroves = maxTroves
+        self.wrapRepos = wrapRepos
+        # Ordered oldest to newest.
+        self._contexts = []
+        self.hits = self.misses = 0
+
+    def get(self, cfg):
+        """Return a warm context for C{cfg}, creating one if needed."""
+        key = getContextKey(cfg)
+        for context in self._contexts:
+            if context.key == key:
+                self._contexts.remove(context)
+                self._contexts.append(context)
+                self.hits += 1
+                self.trim()
+                return context
+        self.misses += 1
+        context = ResolveContext(cfg, wrapRepos=self.wrapRepos,
+                maxTroves=self.maxTroves)
+        self._contexts.append(context)
+        self.trim()
+        return context
+
+    def trim(self):
+        """Drop old contexts until the cache is within its limits."""
+        while len(self._contexts) > 1 and (
+                len(self._contexts) > self.maxContexts
+                or self.maxTroves and self.getSize() > self.maxTroves):
+            self._contexts.pop(0).close()
+        if self._contexts and self.maxTroves:
+            self._contexts[-1].trim(self.maxTroves)
+
+    def getSize(self):
+        return sum(x.size for x in self._contexts)
+
+    def invalidate(self, cfg=None):
+        """
+        Drop the context for C{cfg}, or every context if C{cfg} is not
+        given.
+        """
+        if cfg is None:
+            contexts, self._contexts = self._contexts, []
+        else:
+            key = getContextKey(cfg)
+            contexts = [x for x in self._contexts if x.key == key]
+            self._contexts = [x for x in self._contexts if x.key != key]
+        for context in contexts:
+            context.close()
+
+    def __len__(self):
+        return len(self._contexts)
+
 
 class DependencyResolver(object):
     """
         Resolves dependencies for one trove.
+
+        If a L{ResolveContext} is given, its client, repository and
+        resolveTroves are used instead of being set up again for each trove.
     """
-    def __init__(self, logger, repos=None):
+    def __init__(self, logger, repos=None, context=None):
         self.logger = logger
+        if repos is None and context is not None:
+            repos = context.repos
         self.repos = repos
+        self.context = context
+
+    def _getClient(self, cfg):
+        if self.context is not None:
+            return self.context.client
+        return conaryclient.ConaryClient(cfg)
+
+    def _closeClient(self, client):
+        if self.context is None or client is not self.context.client:
+            client.close()
 
     def getSources(self, resolveJob, cross=False):
         cfg = resolveJob.getConfig()
@@ -156,18 +387,20 @@ class DependencyResolver(object):
 
     def getSourcesWithResolveTroves(self, cfg, resolveTroveTups,
                                     builtTroveSource):
-        resolveTroves = []
-        searchSourceTroves = []
-        allResolveTroveTups = list(itertools.chain(*cfg.resolveTroveTups))
-        allResolveTroves = self.repos.getTroves(allResolveTroveTups,
-                                                withFiles=False)
-        resolveTrovesByTup = dict((x.getNameVersionFlavor(), x)
-                                  for x in allResolveTroves)
-
-        for resolveTupList in cfg.resolveTroveTups:
-            resolveTroves = [ resolveTrovesByTup[x]
-                              for x in resolveTupList ]
-            searchSourceTroves.append(resolveTroves)
+        if self.context is not None:
+            searchSourceTroves = self.context.getResolveTroves(cfg)
+        else:
+            searchSourceTroves = []
+            allResolveTroveTups = list(itertools.chain(*resolveTroveTups))
+            allResolveTroves = self.repos.getTroves(allResolveTroveTups,
+                                                    withFiles=False)
+            resolveTrovesByTup = dict((x.getNameVersionFlavor(), x)
+                                      for x in allResolveTroves)
+
+            for resolveTupList in resolveTroveTups:
+                resolveTroves = [ resolveTrovesByTup[x]
+                                  for x in resolveTupList ]
+                searchSourceTroves.append(resolveTroves)
         if cfg.resolveTrovesOnly:
             repos = None
         else:
@@ -201,7 +434,7 @@ class DependencyResolver(object):
         log.setMinVerbosity(log.DEBUG)
         trv = resolveJob.getTrove()
         cfg = resolveJob.getConfig()
-        client = conaryclient.ConaryClient(cfg)
+        client = self._getClient(cfg)
         if not self.repos:
             self.repos = client.repos
         else:
@@ -237,7 +470,7 @@ class DependencyResolver(object):
             if success:
                 buildReqJobs = results
             else:
-                client.close()
+                self._closeClient(client)
                 searchSource.close()
                 resolveSource.close()
                 return resolveResult
@@ -252,7 +485,7 @@ class DependencyResolver(object):
             if success:
                 crossReqJobs = results
             else:
-                client.close()
+                self._closeClient(client)
                 searchSource.close()
                 resolveSource.close()
                 return resolveResult
@@ -263,7 +496,7 @@ class DependencyResolver(object):
             if success:
                 bootstrapJobs = results
             else:
-                client.close()
+                self._closeClient(client)
                 searchSource.close()
                 resolveSource.close()
                 return resolveResult
@@ -275,7 +508,7 @@ class DependencyResolver(object):
             # All troves came from resolveTroves therefore the result is
             # cacheable.
             resolveResult.jobHash = resolveJob.getJobHash()
-        client.close()
+        self._closeClient(client)
         searchSource.close()
         resolveSource.close()
         self.logger.debug('   took %s seconds' % (time.time() - start))
@@ -303,7 +536,7 @@ class DependencyResolver(object):
     def _resolve(self, cfg, resolveResult, trove, searchSource, resolveSource,
                  installLabelPath, searchFlavor, reqs, isCross=False):
         resolveSource.setLabelPath(installLabelPath)
-        client = conaryclient.ConaryClient(cfg)
+        client = self._getClient(cfg)
 
         # we allow build requirements to be matched against anywhere on the
         # install label.  Create a list of all of this trove's labels,
@@ -354,11 +587,11 @@ class DependencyResolver(object):
         if cannotResolve or depList:
             self.logger.info('Missing: %s' % ((depList + cannotResolve),))
             resolveResult.troveMissingDependencies(isCross, depList + cannotResolve)
-            client.close()
+            self._closeClient(client)
             return False, resolveResult
 
         self._addPackages(searchSource, jobSet)
-        client.close()
+        self._closeClient(client)
         return True, jobSet
 
     def _addPackages(self, searchSource, jobSet):
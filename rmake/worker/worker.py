@@ -171,6 +171,9 @@ class Worker(server.Server):
     def listChrootsWithHost(self):
         return [('_local_', x) for x in self.chrootManager.listChroots()]
 
+    def getChrootCacheStats(self):
+        return self.chrootManager.getChrootCacheStats()
+
     def _checkForResults(self):
         return self._serveLoopHook()
 
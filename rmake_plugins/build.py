@@ -20,7 +20,12 @@ This plugin serves as the entry point to the basic build functionality of rMake.
 """
 
 import logging
+from twisted.application.internet import TimerService
+from twisted.internet import threads
+
+from rmake.build import buildtimes
 from rmake.build import constants as buildconst
+from rmake.build import dephandler
 from rmake.build import disp_handler
 from rmake.build import nodecfg
 from rmake.build import repos
@@ -28,28 +33,78 @@ from rmake.build import server
 from rmake.build import servercfg
 from rmake.build import worker
 from rmake.core import plug_dispatcher
+from rmake.lib import cacheserver
+from rmake.lib import repocache
 from rmake.worker import plug_worker
 
 log = logging.getLogger(__name__)
 
 
-class BuildPlugin(plug_dispatcher.DispatcherPlugin, plug_worker.WorkerPlugin):
+class BuildPlugin(plug_dispatcher.DispatcherPlugin, plug_worker.WorkerPlugin,
+        plug_worker.LauncherPlugin):
 
     cfg = None
+    chrootCache = None
+    buildTimes = None
+    resolverCache = None
+    resolveContexts = None
+    # Seconds between writes of new resolver results to disk.
+    resolverCacheFlushInterval = 10
+    # Seconds between writes of newly recorded build times to disk.
+    buildTimesSaveInterval = 60
 
     # Dispatcher
 
     def dispatcher_pre_setup(self, dispatcher):
         disp_handler.register()
 
-        self.cfg = self.configFromOptions(servercfg.rMakeConfiguration)
-        self.server = server.BuildServer(dispatcher, self.cfg)
+        self.cfg = self.populateConfigFromOptions(
+                servercfg.rMakeConfiguration())
+        if self.cfg.recordBuildTimes:
+            self.buildTimes = buildtimes.BuildTimeStore(
+                    self.cfg.getBuildTimesPath())
+        else:
+            self.buildTimes = buildtimes.BuildTimeStore()
+        if self.cfg.useResolverCache:
+            self.resolverCache = dephandler.ResolverCache(
+                    self.cfg.getResolverCachePath(),
+                    maxAge=self.cfg.resolverCacheMaxAge * 86400,
+                    maxSize=self.cfg.resolverCacheMaxSize * 1024 * 1024,
+                    writeBehind=True)
+        self.server = server.BuildServer(dispatcher, self.cfg,
+                self.buildTimes)
         dispatcher._addChild('build', self.server)
 
     def dispatcher_post_setup(self, dispatcher):
         from twisted.internet import reactor
         reactor.callWhenRunning(self._start_servers)
         self.server._post_setup()
+        if self.resolverCache is not None:
+            TimerService(self.resolverCacheFlushInterval,
+                    self._flushResolverCache).setServiceParent(dispatcher)
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                    self._flushResolverCache)
+        if self.buildTimes.path:
+            TimerService(self.buildTimesSaveInterval,
+                    self._saveBuildTimes).setServiceParent(dispatcher)
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                    self._saveBuildTimes)
+
+    def _saveBuildTimes(self):
+        d = threads.deferToThread(self.buildTimes.save)
+        def save_failed(failure):
+            log.error("Error saving build times:\n%s",
+                    failure.getTraceback())
+        d.addErrback(save_failed)
+        return d
+
+    def _flushResolverCache(self):
+        d = threads.deferToThread(self.resolverCache.flush)
+        def flush_failed(failure):
+            log.error("Error writing to the resolver cache:\n%s",
+                    failure.getTraceback())
+        d.addErrback(flush_failed)
+        return d
 
     def _start_servers(self):
         from twisted.internet import reactor
@@ -62,6 +117,47 @@ class BuildPlugin(plug_dispatcher.DispatcherPlugin, plug_worker.WorkerPlugin):
             log.exception("Error starting server:")
             reactor.stop()
 
+    # Launcher
+
+    def launcher_post_setup(self, launcher):
+        cfg = self.populateConfigFromOptions(nodecfg.NodeConfiguration())
+        self.chrootCache = cfg.getChrootCache()
+        if cfg.useCache and cfg.cacheServerPort:
+            log.info("Sharing repository cache on port %d",
+                    cfg.cacheServerPort)
+            cacheserver.createService(cfg.getCacheDir(), cfg.cacheServerPort,
+                    interface=cfg.cacheServerInterface,
+                    allowed=cfg.cacheServerAllow).setServiceParent(launcher)
+        if cfg.useCache and cfg.cacheCollectInterval and (
+                cfg.cacheMaxSize or cfg.cacheDepsMaxAge):
+            TimerService(cfg.cacheCollectInterval * 60, self._collectCache,
+                    cfg).setServiceParent(launcher)
+
+    def launcher_get_stats(self, launcher):
+        if self.chrootCache is None:
+            return None
+        try:
+            return {'chrootCache': self.chrootCache.getStats()}
+        except:
+            log.exception("Error reading chroot cache statistics:")
+            return None
+
+    def _collectCache(self, cfg):
+        cache = repocache.RepositoryCache(cfg.getCacheDir())
+        d = threads.deferToThread(cache.collect,
+                maxSize=cfg.cacheMaxSize * 1024 * 1024,
+                depMaxAge=cfg.cacheDepsMaxAge * 3600)
+        def collected(result):
+            if result['expired'] or result['evicted']:
+                log.info("Removed %(expired)d expired and %(evicted)d least "
+                        "recently used entries (%(freed)d bytes) from the "
+                        "repository cache", result)
+        def collect_failed(failure):
+            log.error("Error cleaning up the repository cache:\n%s",
+                    failure.getTraceback())
+        d.addCallbacks(collected, collect_failed)
+        return d
+
     # Worker
 
     def worker_get_task_types(self):
@@ -72,4 +168,12 @@ class BuildPlugin(plug_dispatcher.DispatcherPlugin, plug_worker.WorkerPlugin):
                 }
 
     def worker_pre_build(self, handler):
-        handler.cfg = self.configFromOptions(nodecfg.NodeConfiguration)
+        handler.cfg = self.populateConfigFromOptions(
+                nodecfg.NodeConfiguration())
+        if isinstance(handler, worker.ResolveTask):
+            # Worker processes are reused, so keep resolver setup warm for
+            # the next task.
+            if self.resolveContexts is None:
+                self.resolveContexts = worker.createResolveContextCache(
+                        handler.cfg)
+            handler.resolveContexts = self.resolveContexts
@@ -0,0 +1,180 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from twisted.internet import defer
+from twisted.internet import task as tw_task
+from twisted.trial import unittest
+
+from rmake.build import disp_handler
+from rmake.core import types
+
+
+class FakeConfig(object):
+
+    def __init__(self, resolveBatchSize):
+        self.resolveBatchSize = resolveBatchSize
+
+
+class FakeTrove(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.resolved = []
+        self.failed = []
+
+    def getTroveString(self):
+        return self.name
+
+    def troveQueued(self, message):
+        pass
+
+    def troveResolved(self, result):
+        self.resolved.append(result)
+
+    def troveFailed(self, reason):
+        self.failed.append(reason)
+
+
+class FakeResolveJob(object):
+
+    def __init__(self, name, cfg):
+        self.trove = FakeTrove(name)
+        self.cfg = cfg
+
+    def getTrove(self):
+        return self.trove
+
+    def getConfig(self):
+        return self.cfg
+
+
+class FakeTask(object):
+
+    def __init__(self, name, data):
+        self.task_name = name
+        self.data = data
+        self.watchers = []
+        self.deferred = defer.Deferred()
+        self.status = types.JobStatus(100, 'Queued')
+        self.task_data = None
+
+    def update(self, code, data=None):
+        self.status = types.JobStatus(code, 'status')
+        self.task_data = types.ThawedObject(data)
+        for func in self.watchers:
+            func(self)
+        if self.status.final:
+            self.deferred.callback(self)
+
+
+class FakeBuildHandler(disp_handler.BuildHandler):
+    """Build handler that records tasks instead of dispatching them."""
+
+    def __init__(self, resolveBatchSize=10):
+        self.cfg = FakeConfig(resolveBatchSize)
+        self.clock = tw_task.Clock()
+        self.created = []
+        self.failures = []
+        self.loops = 0
+
+    def newTask(self, taskName, taskType, data, zone=None, priority=0):
+        task = FakeTask(taskName, data)
+        self.created.append(task)
+        return task
+
+    def watchTask(self, task, func, *args, **kwargs):
+        task.watchers.append(lambda task: func(task, *args, **kwargs))
+
+    def waitForTask(self, task):
+        return task.deferred
+
+    def failJob(self, reason, message=None, failHard=False):
+        self.failures.append(reason)
+
+    def _do_loop(self):
+        self.loops += 1
+
+
+class BuildHandlerTest(unittest.TestCase):
+
+    def _jobs(self, count, cfg, prefix='foo'):
+        return [FakeResolveJob('%s%d' % (prefix, x), cfg)
+                for x in range(count)]
+
+    def _names(self, batches):
+        return [[x.getTrove().name for x in batch] for batch in batches]
+
+    def test_batchResolveJobs(self):
+        handler = FakeBuildHandler(resolveBatchSize=3)
+        cfgA, cfgB = object(), object()
+        a = self._jobs(5, cfgA, 'a')
+        b = self._jobs(2, cfgB, 'b')
+        jobs = a[:3] + b[:1] + a[3:4] + b[1:] + a[4:]
+        self.assertEqual(self._names(handler._batchResolveJobs(jobs)), [
+            ['a0', 'a1', 'a2'],
+            ['b0', 'b1'],
+            ['a3', 'a4'],
+            ])
+
+        # A batch size below 1 still makes progress.
+        handler.cfg.resolveBatchSize = 0
+        self.assertEqual(self._names(handler._batchResolveJobs(a[:2])),
+                [['a0'], ['a1']])
+
+    def test_resolveBatch(self):
+        """Partial results are used as they arrive, and the final results
+        fill in the rest without repeating them."""
+        handler = FakeBuildHandler()
+        jobs = self._jobs(3, object())
+        troves = [x.getTrove() for x in jobs]
+        handler._do_resolve_batch(jobs)
+        task, = handler.created
+        self.assertEqual(task.data.resolveJobs, jobs)
+
+        task.update(101, [(1, 'result1', None)])
+        self.assertEqual([x.resolved for x in troves], [[], ['result1'], []])
+        handler.clock.advance(0)
+        self.assertEqual(handler.loops, 1)
+
+        task.update(200, [
+            (0, 'result0', None),
+            (1, 'result1', None),
+            (2, None, 'Traceback: oops'),
+            ])
+        self.assertEqual([x.resolved for x in troves],
+                [['result0'], ['result1'], []])
+        self.assertEqual([len(x.failed) for x in troves], [0, 0, 1])
+        self.assertIn('oops', str(troves[2].failed[0]))
+        handler.clock.advance(0)
+        self.assertEqual(handler.loops, 2)
+        self.assertEqual(handler.failures, [])
+
+    def test_resolveBatchFailed(self):
+        """If the task fails, only troves without a result fail."""
+        handler = FakeBuildHandler()
+        jobs = self._jobs(3, object())
+        troves = [x.getTrove() for x in jobs]
+        handler._do_resolve_batch(jobs)
+        task, = handler.created
+
+        task.update(101, [(0, 'result0', None)])
+        task.update(400)
+        self.assertEqual([x.resolved for x in troves], [['result0'], [], []])
+        self.assertEqual([len(x.failed) for x in troves], [0, 1, 1])
+        handler.clock.advance(0)
+        self.assertEqual(handler.loops, 2)
+        self.assertEqual(handler.failures, [])
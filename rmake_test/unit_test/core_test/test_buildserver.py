@@ -0,0 +1,107 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from rmake.build import buildtrove
+from rmake.build import client
+from rmake.build import server
+
+
+class FakeJobStore(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def getTroveStates(self, job_uuid):
+        return defer.succeed(self.rows)
+
+
+class FakeProxy(object):
+
+    def __init__(self, server):
+        self.build = self
+        self.server = server
+
+    def listTrovesByState(self, job_uuid, state=None):
+        results = []
+        d = self.server.listTrovesByState(job_uuid, state)
+        d.addCallback(results.append)
+        return results[0]
+
+
+class BuildServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.version = '/a@b:c/1234567890.000:1-1'
+        self.server = server.BuildServer(None, None)
+        self.server.db = FakeJobStore([
+            ('foo:source', self.version, 'is: x86', '',
+                buildtrove.TroveState.BUILT, 'Trove Built'),
+            ('bar:source', self.version, 'is: x86', 'x86_64',
+                buildtrove.TroveState.BUILDING, 'Building'),
+            ('baz:source', self.version, '', '', None, None),
+            ])
+
+    def test_listTrovesByState(self):
+        d = self.server.listTrovesByState('uuid')
+        def check(result):
+            self.assertEqual(result, {
+                buildtrove.TroveState.BUILT: [
+                    ('foo:source', self.version, 'is: x86', '')],
+                buildtrove.TroveState.BUILDING: [
+                    ('bar:source', self.version, 'is: x86', 'x86_64')],
+                # Never saved
+                buildtrove.TroveState.INIT: [
+                    ('baz:source', self.version, '', '')],
+                })
+        d.addCallback(check)
+        return d
+
+    def test_listTrovesByState_filtered(self):
+        d = self.server.listTrovesByState('uuid',
+                buildtrove.TroveState.BUILT)
+        def check(result):
+            self.assertEqual(result, {buildtrove.TroveState.BUILT: [
+                ('foo:source', self.version, 'is: x86', '')]})
+        d.addCallback(check)
+        return d
+
+    def test_clientListTrovesByState(self):
+        rmakeClient = client.rMakeClient.__new__(client.rMakeClient)
+        rmakeClient.proxy = FakeProxy(self.server)
+        result = rmakeClient.listTrovesByState('uuid')
+        self.assertEqual(sorted(result), sorted([
+            buildtrove.TroveState.BUILT,
+            buildtrove.TroveState.BUILDING,
+            buildtrove.TroveState.INIT,
+            ]))
+        (name, version, flavor, context), = result[
+                buildtrove.TroveState.BUILDING]
+        self.assertEqual(name, 'bar:source')
+        self.assertEqual(version.freeze(), self.version)
+        self.assertEqual(flavor.freeze(), 'is: x86')
+        self.assertEqual(context, 'x86_64')
+
+        result = rmakeClient.listTrovesByState('uuid',
+                buildtrove.TroveState.INIT)
+        (name, version, flavor, context), = result[
+                buildtrove.TroveState.INIT]
+        self.assertEqual(name, 'baz:source')
+        self.assertEqual(context, '')
@@ -0,0 +1,160 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import time
+from twisted.internet import threads
+from twisted.trial import unittest
+
+from rmake.build import buildtimes
+from rmake.build.buildtimes import RESOLVE, CHROOT, BUILD
+
+
+class FakeTrove(object):
+
+    def __init__(self, name='foo:source', flavor='is: x86'):
+        self.name = name
+        self.flavor = flavor
+        self.chrootHost = ''
+        self.start = 0
+        self.finish = 0
+        self.prebuilt = False
+
+    def getName(self):
+        return self.name
+
+    def getFlavor(self):
+        return self.flavor
+
+    def getChrootHost(self):
+        return self.chrootHost
+
+    def isPrebuilt(self):
+        return self.prebuilt
+
+
+class BuildTimeStoreTest(unittest.TestCase):
+
+    def test_record(self):
+        store = buildtimes.BuildTimeStore()
+        self.assertEqual(store.get('foo'), None)
+        store.record('foo:source', 'is: x86', 'node1', BUILD, 100)
+        self.assertEqual(store.get('foo', 'is: x86', 'node1'),
+                (None, None, 100))
+        store.record('foo:source', 'is: x86', 'node1', BUILD, 200)
+        self.assertEqual(store.get('foo', 'is: x86', 'node1')[BUILD],
+                100 + buildtimes.SMOOTHING * 100)
+        self.assertEqual(store.getBuildTimes(), {'foo': 130})
+
+    def test_fallback(self):
+        store = buildtimes.BuildTimeStore()
+        store.record('foo', 'is: x86', 'node1', RESOLVE, 5)
+        store.record('foo', 'is: x86', 'node1', CHROOT, 10)
+        store.record('foo', 'is: x86_64', 'node2', BUILD, 100)
+        # Unknown flavor or node uses the per-name summary.
+        self.assertEqual(store.get('foo', 'is: ppc'), (5, 10, 100))
+        self.assertEqual(store.get('foo', 'is: x86', 'node2'), (5, 10, 100))
+        # Phases missing for a known key are filled in from the summary.
+        self.assertEqual(store.get('foo', 'is: x86', 'node1'), (5, 10, 100))
+        self.assertEqual(store.getBuildTime('foo', 'is: x86', 'node1'), 110)
+
+    def test_saveLoad(self):
+        path = os.path.join(self.mktemp(), 'buildtimes')
+        store = buildtimes.BuildTimeStore(path)
+        store.record('foo', 'is: x86', 'node1', CHROOT, 10)
+        store.record('foo', 'is: x86', 'node1', BUILD, 100)
+        store.record('bar', '', '', BUILD, 50)
+        store.save()
+        store = buildtimes.BuildTimeStore(path)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get('foo', 'is: x86', 'node1'),
+                (None, 10, 100))
+        self.assertEqual(store.getBuildTimes(), {'foo': 110, 'bar': 50})
+
+    def test_saveInThread(self):
+        path = os.path.join(self.mktemp(), 'buildtimes')
+        store = buildtimes.BuildTimeStore(path)
+        store.record('foo', '', '', BUILD, 100)
+        d = threads.deferToThread(store.save)
+        def saved(_):
+            self.assertEqual(
+                    buildtimes.BuildTimeStore(path).getBuildTimes(),
+                    {'foo': 100})
+            # Nothing new to write
+            os.utime(path, (0, 0))
+            store.save()
+            self.assertEqual(os.stat(path).st_mtime, 0)
+        d.addCallback(saved)
+        return d
+
+    def test_loadCorrupt(self):
+        path = self.mktemp()
+        open(path, 'wb').write('garbage')
+        store = buildtimes.BuildTimeStore(path)
+        self.assertEqual(len(store), 0)
+
+
+class BuildTimeRecorderTest(unittest.TestCase):
+
+    def test_sameNode(self):
+        """All phases are recorded under the node that built the trove."""
+        store = buildtimes.BuildTimeStore()
+        recorder = buildtimes.BuildTimeRecorder(store)
+        trove = FakeTrove()
+        recorder.troveResolving(trove)
+        recorder.troveResolved(trove)
+        # The chroot host is only known once a chroot is being prepared.
+        trove.chrootHost = 'node1'
+        recorder.trovePreparing(trove)
+        trove.start = time.time()
+        recorder.troveBuilding(trove)
+        trove.finish = trove.start + 100
+        recorder.troveBuilt(trove)
+
+        self.assertEqual(store._times.keys(), [('foo', 'is: x86', 'node1')])
+        times = store.get('foo', 'is: x86', 'node1')
+        self.assertNotEqual(times[RESOLVE], None)
+        self.assertNotEqual(times[CHROOT], None)
+        self.assertEqual(times[BUILD], 100)
+
+    def test_prebuilt(self):
+        store = buildtimes.BuildTimeStore()
+        recorder = buildtimes.BuildTimeRecorder(store)
+        trove = FakeTrove()
+        trove.prebuilt = True
+        recorder.troveResolving(trove)
+        recorder.troveResolved(trove)
+        recorder.troveBuilt(trove)
+        times = store.get('foo', 'is: x86')
+        self.assertNotEqual(times[RESOLVE], None)
+        self.assertEqual(times[BUILD], None)
+        self.assertEqual(recorder._started, {})
+        self.assertEqual(recorder._resolved, {})
+
+    def test_failed(self):
+        store = buildtimes.BuildTimeStore()
+        recorder = buildtimes.BuildTimeRecorder(store)
+        trove = FakeTrove()
+        recorder.troveResolving(trove)
+        recorder.troveResolved(trove)
+        trove.chrootHost = 'node1'
+        recorder.trovePreparing(trove)
+        recorder.troveFailed(trove)
+        times = store.get('foo', 'is: x86', 'node1')
+        self.assertNotEqual(times[RESOLVE], None)
+        self.assertEqual(times[CHROOT], None)
+        self.assertEqual(recorder._started, {})
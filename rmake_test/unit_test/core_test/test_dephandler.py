@@ -0,0 +1,136 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from twisted.trial import unittest
+
+from rmake.build import dephandler
+
+
+class FakeTrove(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name + ':source'
+
+    def getPrebuiltTime(self):
+        return 0
+
+    def __repr__(self):
+        return self.name
+
+
+class FakeBuildState(object):
+
+    popBuildableTrove = dephandler.DependencyBasedBuildState.__dict__[
+            'popBuildableTrove']
+
+    def __init__(self):
+        self.depGraph = dephandler.DependencyGraph()
+        self.buildReqTroves = {}
+
+
+class CriticalPathTest(unittest.TestCase):
+
+    def _handler(self, buildTimes, criticalPath=True):
+        handler = dephandler.DependencyHandler.__new__(
+                dephandler.DependencyHandler)
+        handler.depState = FakeBuildState()
+        handler.buildTimes = buildTimes
+        handler.criticalPath = criticalPath
+        handler.priorities = []
+        handler._prioritized = set()
+        handler._criticalPaths = None
+        return handler
+
+    def _troves(self, handler, *names):
+        troves = [FakeTrove(x) for x in names]
+        for trove in troves:
+            handler.depState.depGraph.addNode(trove)
+        return troves
+
+    def _dependsOn(self, handler, trove, provider):
+        handler.depState.depGraph.addEdge(trove, provider)
+
+    def test_lengths(self):
+        handler = self._handler({'a': 10, 'b': 10, 'c': 10, 'd': 25, 'e': 5})
+        a, b, c, d = self._troves(handler, 'a', 'b', 'c', 'd')
+        # c needs b, which needs a.
+        self._dependsOn(handler, b, a)
+        self._dependsOn(handler, c, b)
+        self.assertEqual([handler.getCriticalPath(x) for x in (a, b, c, d)],
+                [30, 20, 10, 25])
+
+        # A trove needed by two chains counts the longer one.
+        e = self._troves(handler, 'e')[0]
+        self._dependsOn(handler, d, e)
+        self._dependsOn(handler, b, e)
+        self.assertEqual(handler.getCriticalPath(e), 5 + 25)
+        self.assertEqual(handler.getCriticalPath(a), 30)
+
+    def test_cycles(self):
+        handler = self._handler({'x': 5, 'y': 5, 'z': 1})
+        x, y, z = self._troves(handler, 'x', 'y', 'z')
+        self._dependsOn(handler, x, y)
+        self._dependsOn(handler, y, x)
+        self._dependsOn(handler, z, x)
+        # Everything in a cycle has to be built before what depends on it.
+        self.assertEqual([handler.getCriticalPath(t) for t in (x, y, z)],
+                [11, 11, 1])
+
+    def test_unknownBuildTime(self):
+        handler = self._handler({'a': 10, 'b': 30})
+        c, = self._troves(handler, 'c')
+        self.assertEqual(handler.getBuildTime(c), 20)
+        handler = self._handler({})
+        c, = self._troves(handler, 'c')
+        self.assertEqual(handler.getCriticalPath(c), 1)
+
+    def test_recomputedOnChange(self):
+        handler = self._handler({'a': 10, 'b': 10})
+        a, b = self._troves(handler, 'a', 'b')
+        self.assertEqual(handler.getCriticalPath(a), 10)
+        self._dependsOn(handler, b, a)
+        self.assertEqual(handler.getCriticalPath(a), 20)
+
+    def test_preferLongestChain(self):
+        handler = self._handler({'a': 10, 'b': 10, 'c': 10, 'd': 25})
+        a, b, c, d = self._troves(handler, 'a', 'b', 'c', 'd')
+        self._dependsOn(handler, b, a)
+        self._dependsOn(handler, c, b)
+        handler.depState.buildReqTroves = {a: 'a-reqs', d: 'd-reqs'}
+        # 'd' takes longer by itself, but 'a' has more waiting on it.
+        self.assertEqual(handler.popBuildableTrove(), (a, 'a-reqs'))
+        self.assertEqual(handler.popBuildableTrove(), (d, 'd-reqs'))
+
+        self.assertTrue(handler.getPriority(a) < handler.getPriority(d))
+        handler.criticalPath = False
+        self.assertEqual(handler.getPriority(a), handler.getPriority(d))
+
+    def test_prioritizedWinsTies(self):
+        handler = self._handler({'a': 10, 'b': 10, 'c': 10})
+        a, b, c = self._troves(handler, 'a', 'b', 'c')
+        handler.prioritize(b)
+        handler.depState.buildReqTroves = {a: 'a-reqs', b: 'b-reqs',
+                c: 'c-reqs'}
+        self.assertEqual(handler.popBuildableTrove(), (b, 'b-reqs'))
+        # Priority doesn't beat a longer chain.
+        handler.prioritize(c)
+        self._dependsOn(handler, b, a)
+        handler.depState.buildReqTroves = {a: 'a-reqs', c: 'c-reqs'}
+        self.assertEqual(handler.popBuildableTrove(), (a, 'a-reqs'))
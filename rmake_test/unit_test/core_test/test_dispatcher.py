@@ -114,9 +114,10 @@ class DispatcherTest(unittest.TestCase):
     def test_updateJob_normal(self):
         job = self.job.thaw()
         job.status.code = 100
-        def db_updateJob(newJob, frozen_handler):
+        def db_updateJob(newJob, frozen_handler, withData):
             self.assertEquals(newJob.job_uuid, job.job_uuid)
             self.assertEquals(frozen_handler, None)
+            self.assertEquals(withData, True)
             return defer.succeed(newJob.freeze())
         self.disp.db._mock.set(updateJob=db_updateJob)
         mock.mockMethod(self.disp.jobDone)
@@ -133,9 +134,10 @@ class DispatcherTest(unittest.TestCase):
     def test_updateJob_finished(self):
         job = self.job.thaw()
         job.status.code = 200
-        def db_updateJob(newJob, frozen_handler):
+        def db_updateJob(newJob, frozen_handler, withData):
             self.assertEquals(newJob.job_uuid, job.job_uuid)
             self.assertEquals(frozen_handler, None)
+            self.assertEquals(withData, True)
             return defer.succeed(newJob.freeze())
         self.disp.db._mock.set(updateJob=db_updateJob)
         mock.mockMethod(self.disp.jobDone)
@@ -170,6 +172,59 @@ class DispatcherTest(unittest.TestCase):
         self.disp.workerDown(w)
         self.assertEqual(self.disp.workers, {})
 
+    def test_workerHeartbeat_lostCaps(self):
+        """Buckets a worker stops serving are looked at again."""
+        w = jid.JID('ham@spam/eggs')
+        def h_msg(taskTypes):
+            return message.Heartbeat(caps=[types.TaskCapability(x)
+                for x in taskTypes] + list(self.caps),
+                tasks=[], addresses=[], slots={None: 1})
+        dirty = []
+        def assignTasks():
+            dirty.append(self.disp._dirtyKeys)
+            self.disp._dirtyKeys = set()
+        self.disp._assignTasks = assignTasks
+        self.disp.taskQueue.add(types.RmakeTask(uuid.uuid4(),
+            self.job.job_uuid, 'name', 'task.1'))
+        self.disp.taskQueue.add(types.RmakeTask(uuid.uuid4(),
+            self.job.job_uuid, 'name', 'task.2'))
+
+        self.disp.workerHeartbeat(w, h_msg(['task.1']))
+        self.disp.workerHeartbeat(w, h_msg(['task.2']))
+        self.assertEqual(dirty, [
+            set([('task.1', None)]),
+            set([('task.1', None), ('task.2', None)]),
+            ])
+
+    def test_workerStats(self):
+        w = jid.JID('ham@spam/eggs')
+        class h_msg(object):
+            caps = self.caps
+            tasks = {}
+            slots = {None: 0}
+            addresses = set()
+        cacheStats = {'count': 1, 'entries': []}
+        # Stats from a worker that hasn't heartbeated yet are dropped
+        self.disp.workerStats(w, {'build': {'chrootCache': cacheStats}})
+        self.assertEqual(self.disp.workers, {})
+
+        self.disp.workerHeartbeat(w, h_msg())
+        other = jid.JID('foo@bar/baz')
+        self.disp.workerHeartbeat(other, h_msg())
+        bus = support.DispatcherBusService.__new__(
+                support.DispatcherBusService)
+        bus.dispatcher = self.disp
+        msg = message.WorkerStats(stats={'build': {'chrootCache': cacheStats}})
+        msg.info.sender = w
+        bus.messageReceived(msg)
+        self.assertEqual(self.disp.workers[w].stats,
+                {'build': {'chrootCache': cacheStats}})
+
+        from rmake.build import server
+        buildServer = server.BuildServer(self.disp, None)
+        self.assertEqual(buildServer.getChrootCacheStats(),
+                {u'ham@spam/eggs': cacheStats})
+
     @skipTest("Not done yet.")
     def test_workerHeartbeat_assignTasks(self):
         """Tasks are assigned to a new worker, and failed on a dead worker."""
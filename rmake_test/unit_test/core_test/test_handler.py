@@ -16,6 +16,7 @@
 
 
 from testutils import mock
+from twisted.internet import defer
 from twisted.python import failure as tw_failure
 from twisted.trial import unittest
 
@@ -100,3 +101,29 @@ class DispatcherTest(unittest.TestCase):
         # make sure, we've touched "success" once the last callback fires.
         assert success
         self._raisePostponed()
+
+    def test_saveData(self):
+        """Job data is only written when it has changed."""
+        mock.mock(logger, 'logFailure')
+        saved = []
+        def updateJob(job, withData):
+            saved.append((job.job_uuid, job.times.ticks, withData))
+            return defer.succeed(job.freeze())
+        disp = mock.MockObject()
+        disp._mock.set(updateJob=updateJob)
+        handler = rmk_handler.JobHandler(disp, self.job.thaw(),
+                mock.MockObject())
+        job_uuid = self.job.job_uuid
+
+        handler.setStatus(101, 'spam')
+        handler.setData('eggs')
+        handler.setStatus(102, 'spam')
+        handler.setStatus(103, 'spam')
+        handler.saveData('sausage')
+        self.assertEquals(saved, [
+            (job_uuid, 0, False),
+            (job_uuid, 1, True),
+            (job_uuid, 2, False),
+            (job_uuid, 3, True),
+            ])
+        self.assertEquals(handler.savedData.getObject(), 'sausage')
@@ -0,0 +1,258 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import logging
+from twisted.trial import unittest
+
+from rmake.build import worker
+from rmake.worker import resolver
+
+
+class FakeTrove(object):
+
+    def __init__(self, name, children=0):
+        self.name = name
+        self.children = children
+
+    def getNameVersionFlavor(self):
+        return (self.name, '/localhost@rpl:linux/1-1', '')
+
+    def iterTroveList(self, weakRefs=False, strongRefs=False):
+        return iter(range(self.children))
+
+
+class FakeRepos(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def resolveDependenciesByGroups(self, groupTroves, depList):
+        self.queries.append(sorted(depList))
+        return dict((x, [[(x + '-provider', None, None)]]) for x in depList
+                if not x.startswith('missing'))
+
+    def getTroves(self, troveTups, withFiles=True):
+        return [FakeTrove(x[0], children=1) for x in troveTups]
+
+
+class FakeClient(object):
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.closed = False
+
+    def getRepos(self):
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConfig(object):
+
+    resolveTrovesOnly = False
+
+    def __init__(self, name, resolveTroveTups=()):
+        self.name = name
+        self.resolveTroveTups = list(resolveTroveTups)
+
+    def storeConaryCfg(self, out):
+        out.write('name %s\n' % self.name)
+
+
+class FakeResolveJob(object):
+
+    def __init__(self, cfg, fail=False):
+        self.cfg = cfg
+        self.fail = fail
+        self.trove = FakeTrove('foo:source')
+        self.trove.getTroveString = lambda: 'foo:source'
+
+    def getConfig(self):
+        return self.cfg
+
+
+class FakeResolver(object):
+
+    def __init__(self, logger, repos=None, context=None):
+        self.context = context
+
+    def resolve(self, resolveJob):
+        if resolveJob.fail:
+            raise RuntimeError("lost connection")
+        return 'result'
+
+
+class SharedDepSourceTest(unittest.TestCase):
+
+    def test_shared(self):
+        repos = FakeRepos()
+        source = resolver.SharedDepSource(repos)
+        group = [FakeTrove('group-dist')]
+        self.assertEqual(source.resolveDependenciesByGroups(group,
+            ['a', 'b', 'missing']), {
+                'a': [[('a-provider', None, None)]],
+                'b': [[('b-provider', None, None)]],
+                })
+        result = source.resolveDependenciesByGroups(group, ['b', 'c'])
+        self.assertEqual(sorted(result), ['b', 'c'])
+        # Only the dependency not seen before was asked for.
+        self.assertEqual(repos.queries, [['a', 'b', 'missing'], ['c']])
+        # Answers that were not found are remembered too.
+        source.resolveDependenciesByGroups(group, ['missing'])
+        self.assertEqual(len(repos.queries), 2)
+        # Callers get copies they can modify.
+        result['b'][0].append('junk')
+        self.assertEqual(source.resolveDependenciesByGroups(group, ['b']),
+                {'b': [[('b-provider', None, None)]]})
+        # Other groups are asked separately.
+        source.resolveDependenciesByGroups([FakeTrove('group-other')], ['a'])
+        self.assertEqual(repos.queries[-1], ['a'])
+        self.assertEqual(len(source), 5)
+
+    def test_maxEntries(self):
+        repos = FakeRepos()
+        source = resolver.SharedDepSource(repos, maxEntries=2)
+        group = [FakeTrove('group-dist')]
+        source.resolveDependenciesByGroups(group, ['a'])
+        source.resolveDependenciesByGroups(group, ['b'])
+        # Using 'a' makes 'b' the least recently used answer.
+        source.resolveDependenciesByGroups(group, ['a'])
+        source.resolveDependenciesByGroups(group, ['c'])
+        self.assertEqual(len(source), 2)
+        del repos.queries[:]
+        source.resolveDependenciesByGroups(group, ['a', 'b', 'c'])
+        self.assertEqual(repos.queries, [['b']])
+
+        # The answers for a request are returned even if they don't all fit.
+        result = source.resolveDependenciesByGroups(group, ['d', 'e', 'f'])
+        self.assertEqual(sorted(result), ['d', 'e', 'f'])
+        self.assertEqual(len(source), 2)
+
+
+class ResolveContextCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(resolver.conaryclient, 'ConaryClient', FakeClient)
+
+    def _cache(self, maxContexts=4, maxTroves=0):
+        return resolver.ResolveContextCache(maxContexts, maxTroves,
+                wrapRepos=lambda repos: FakeRepos())
+
+    def test_maxTroves(self):
+        """Dependency answers held by one context are capped, and contexts
+        are trimmed when a warm one is reused."""
+        cache = self._cache(maxTroves=3)
+        group = [FakeTrove('group-dist')]
+        cfgA, cfgB = FakeConfig('a'), FakeConfig('b')
+        contextA = cache.get(cfgA)
+        contextA.repos.resolveDependenciesByGroups(group,
+                ['d1', 'd2', 'd3', 'd4', 'd5'])
+        self.assertEqual(contextA.size, 3)
+
+        contextB = cache.get(cfgB)
+        self.assertEqual(len(cache), 2)
+        contextB.repos.resolveDependenciesByGroups(group, ['d1'])
+        self.assertEqual(cache.getSize(), 4)
+        self.assertEqual(cache.get(cfgB), contextB)
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(contextA.client.closed)
+
+    def test_trimMostRecent(self):
+        """The most recently used context is kept, but shrunk to fit."""
+        cache = self._cache(maxTroves=4)
+        group = [FakeTrove('group-dist')]
+        cfg = FakeConfig('a', [[group[0].getNameVersionFlavor()]])
+        context = cache.get(cfg)
+        context.repos.resolveDependenciesByGroups(group,
+                ['d1', 'd2', 'd3', 'd4'])
+        self.assertEqual(context.size, 4)
+        # Loading the resolveTroves leaves less room for answers.
+        context.getResolveTroves(cfg)
+        self.assertEqual(context.size, 4)
+        self.assertEqual(len(context.repos), 2)
+
+        cache.maxTroves = 3
+        self.assertEqual(cache.get(cfg), context)
+        self.assertEqual(context.size, 3)
+        self.assertFalse(context.client.closed)
+
+    def test_contextKey(self):
+        """Configurations that reach the same repositories and search the
+        same resolveTroves share a key."""
+        tups = [[('group-dist', '/localhost@rpl:linux/1-1', '')]]
+        key = resolver.getContextKey(FakeConfig('a', tups))
+        self.assertEqual(resolver.getContextKey(FakeConfig('a', tups)), key)
+        self.assertNotEqual(resolver.getContextKey(FakeConfig('b', tups)),
+                key)
+        self.assertNotEqual(resolver.getContextKey(FakeConfig('a')), key)
+        cfg = FakeConfig('a', tups)
+        cfg.resolveTrovesOnly = True
+        self.assertNotEqual(resolver.getContextKey(cfg), key)
+        # Grouping of resolveTroves matters, not just the troves.
+        tups = [[('group-a', '1', ''), ('group-b', '1', '')]]
+        self.assertNotEqual(
+                resolver.getContextKey(FakeConfig('a', tups)),
+                resolver.getContextKey(FakeConfig('a', [[x] for x in tups[0]])))
+
+        cache = self._cache()
+        context = cache.get(FakeConfig('a'))
+        self.assertEqual(cache.get(FakeConfig('a')), context)
+        self.assertNotEqual(cache.get(FakeConfig('b')), context)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_maxContexts(self):
+        cache = self._cache(maxContexts=2)
+        contextA = cache.get(FakeConfig('a'))
+        contextB = cache.get(FakeConfig('b'))
+        # Using 'a' again makes 'b' the least recently used.
+        cache.get(FakeConfig('a'))
+        contextC = cache.get(FakeConfig('c'))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(contextB.client.closed)
+        self.assertFalse(contextA.client.closed)
+        self.assertEqual(cache.get(FakeConfig('c')), contextC)
+
+    def test_invalidate(self):
+        cache = self._cache()
+        contextA = cache.get(FakeConfig('a'))
+        contextB = cache.get(FakeConfig('b'))
+        cache.invalidate(FakeConfig('a'))
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(contextA.client.closed)
+        self.assertNotEqual(cache.get(FakeConfig('a')), contextA)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertTrue(contextB.client.closed)
+
+    def test_invalidateOnFailure(self):
+        """A context used by a failed resolve is not reused."""
+        self.patch(resolver, 'DependencyResolver', FakeResolver)
+        cache = self._cache()
+        task = worker.ResolveTask.__new__(worker.ResolveTask)
+        task.resolveContexts = cache
+        task.log = logging.getLogger('test')
+        cfg = FakeConfig('a')
+
+        self.assertEqual(task._resolve(FakeResolveJob(cfg)), 'result')
+        context = cache.get(cfg)
+        self.assertRaises(RuntimeError, task._resolve,
+                FakeResolveJob(cfg, fail=True))
+        self.assertEqual(len(cache), 0)
+        self.assertTrue(context.client.closed)
+        self.assertEqual(task._resolve(FakeResolveJob(cfg)), 'result')
+        self.assertNotEqual(cache.get(cfg), context)
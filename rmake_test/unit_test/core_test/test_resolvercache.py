@@ -0,0 +1,150 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import xmlrpclib
+from twisted.internet import threads
+from twisted.trial import unittest
+
+from rmake.build import dephandler
+from rmake.lib.apiutils import freeze
+from rmake.worker.resolver import ResolveResult
+
+
+class FakeTrove(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+    def getVersion(self):
+        return '/localhost@rpl:linux/1-1'
+
+    def getFlavor(self):
+        return ''
+
+    def getContext(self):
+        return ''
+
+
+class ResolverCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def _result(self, jobHash):
+        result = ResolveResult()
+        result.troveResolved([], [], [])
+        result.jobHash = jobHash
+        return result
+
+    def test_sync(self):
+        cache = dephandler.ResolverCache(self.path)
+        trove = FakeTrove('foo:source')
+        cache.put(self._result('hash1'), trove)
+        self.assertEqual(cache.getStats()['entries'], 1)
+        self.assertEqual(cache.getStats()['pending'], 0)
+
+        other = dephandler.ResolverCache(self.path)
+        self.assertEqual(other.get('hash1').jobHash, 'hash1')
+        self.assertEqual(other.get('hash2'), None)
+        self.assertEqual((other.hits, other.misses), (1, 1))
+
+    def test_writeBehind(self):
+        cache = dephandler.ResolverCache(self.path, writeBehind=True)
+        troves = [FakeTrove('foo:source'), FakeTrove('bar:source')]
+        cache.put(self._result('hash1'), troves[0])
+        cache.put(self._result('hash2'), troves[1])
+        # Nothing is written until the cache is flushed, but queued
+        # results are still found.
+        self.assertEqual(cache.getStats()['entries'], 0)
+        self.assertEqual(sorted(cache.prefetch(troves)), ['hash1', 'hash2'])
+        self.assertEqual(cache.get('hash1').jobHash, 'hash1')
+        # Results that were never prefetched are misses rather than disk
+        # lookups.
+        self.assertEqual(cache.get('hash3', {}), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        self.assertEqual(cache.flush(), 2)
+        self.assertEqual(cache.getStats()['pending'], 0)
+        self.assertEqual(cache.flush(), 0)
+        other = dephandler.ResolverCache(self.path, writeBehind=True)
+        prefetched = other.prefetch(troves)
+        self.assertEqual(sorted(prefetched), ['hash1', 'hash2'])
+        self.assertEqual(other.get('hash2', prefetched).jobHash, 'hash2')
+
+    def test_flushInThread(self):
+        cache = dephandler.ResolverCache(self.path, writeBehind=True)
+        trove = FakeTrove('foo:source')
+        cache.put(self._result('hash1'), trove)
+        # Open the database in this thread first.
+        self.assertEqual(cache.prefetch([trove]).keys(), ['hash1'])
+        d = threads.deferToThread(cache.flush)
+        def flushed(count):
+            self.assertEqual(count, 1)
+            self.assertEqual(cache.getStats()['entries'], 1)
+        d.addCallback(flushed)
+        return d
+
+    def test_lastUsed(self):
+        cache = dephandler.ResolverCache(self.path, maxAge=60,
+                writeBehind=True)
+        trove = FakeTrove('foo:source')
+        cache.put(self._result('hash1'), trove)
+        cache.flush()
+        db = cache._getDb()
+        db.execute("UPDATE results SET last_used = 0")
+        db.commit()
+        cache.get('hash1', cache.prefetch([trove]))
+        cache.flush()
+        # The use was recorded, so the entry isn't expired.
+        self.assertEqual(cache.evict(), 0)
+        self.assertEqual(cache.getStats()['entries'], 1)
+
+    def _writeLegacy(self, jobHash):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fobj = open(os.path.join(self.path, jobHash), 'w')
+        fobj.write(xmlrpclib.dumps((freeze('ResolveResult',
+            self._result(jobHash)),)))
+        fobj.close()
+
+    def test_legacy(self):
+        self._writeLegacy('hash1')
+        cache = dephandler.ResolverCache(self.path)
+        self.assertEqual(cache.get('hash1').jobHash, 'hash1')
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'hash1')))
+        self.assertEqual(cache.getStats()['entries'], 1)
+
+    def test_legacyWriteBehind(self):
+        self._writeLegacy('hash1')
+        self._writeLegacy('hash2')
+        cache = dephandler.ResolverCache(self.path, writeBehind=True)
+        foo, bar = FakeTrove('foo:source'), FakeTrove('bar:source')
+        # Old results are migrated on the first prefetch and offered to
+        # every job until used.
+        prefetched = cache.prefetch([foo])
+        self.assertEqual(sorted(prefetched), ['hash1', 'hash2'])
+        self.assertEqual(sorted(os.listdir(self.path)), ['results.db'])
+        self.assertEqual(cache.get('hash1', prefetched, foo).jobHash,
+                'hash1')
+        cache.flush()
+        # Once used, a result belongs to the trove that used it.
+        self.assertEqual(sorted(cache.prefetch([bar])), ['hash2'])
+        self.assertEqual(sorted(cache.prefetch([foo])), ['hash1', 'hash2'])
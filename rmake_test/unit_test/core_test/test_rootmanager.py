@@ -0,0 +1,137 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+from twisted.trial import unittest
+
+from rmake.worker.chroot import rootmanager
+
+
+class FakeVersion(object):
+
+    def __init__(self, label):
+        self.label = label
+
+    def trailingLabel(self):
+        return self.label
+
+
+class FakeDatabase(object):
+    """Conary database whose contents are set by the test."""
+
+    contents = {}
+    opened = []
+
+    def __init__(self, root, path):
+        self.root = root
+        self.opened.append(root)
+
+    def iterAllTroves(self):
+        for name, label, flavor in self.contents[self.root]:
+            yield name, FakeVersion(label), flavor
+
+
+def _req(name, label='localhost@rpl:linux', flavor=''):
+    return (name, FakeVersion(label), flavor)
+
+
+class ChrootContentsIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.abspath(self.mktemp())
+        FakeDatabase.contents = {}
+        FakeDatabase.opened = []
+        self.patch(rootmanager.database, 'Database', FakeDatabase)
+        self.indexPath = self.root + '/.chroot-contents'
+
+    def _chroot(self, name, troves):
+        path = self.root + '/' + name
+        dbDir = path + rootmanager.ChrootContentsIndex.DB_PATH
+        os.makedirs(dbDir)
+        open(dbDir + '/conarydb', 'w').write(name)
+        FakeDatabase.contents[path] = [(x, 'localhost@rpl:linux', '')
+                for x in troves]
+        return path
+
+    def test_roundTrip(self):
+        foo = self._chroot('foo', ['gcc:runtime', 'make:runtime'])
+        bar = self._chroot('bar', [])
+        index = rootmanager.ChrootContentsIndex(self.indexPath)
+        index.update(foo)
+        index.update(bar)
+        index.save()
+        self.assertEqual(sorted(FakeDatabase.opened), [bar, foo])
+
+        index2 = rootmanager.ChrootContentsIndex(self.indexPath)
+        self.assertEqual(index2._contents, index._contents)
+        self.assertEqual(index2._byTrove, index._byTrove)
+        # Unchanged databases aren't read again.
+        index2.update(foo)
+        self.assertEqual(len(FakeDatabase.opened), 2)
+
+        # Chroots that went away are dropped when loading.
+        os.rename(bar, bar + '.gone')
+        index3 = rootmanager.ChrootContentsIndex(self.indexPath)
+        self.assertEqual(index3._contents.keys(), [foo])
+
+    def test_changedDatabase(self):
+        foo = self._chroot('foo', ['gcc:runtime'])
+        index = rootmanager.ChrootContentsIndex(self.indexPath)
+        index.update(foo)
+        FakeDatabase.contents[foo] = [('make:runtime',
+            'localhost@rpl:linux', '')]
+        open(foo + index.DB_PATH + '/conarydb', 'a').write('more')
+        index.update(foo)
+        self.assertEqual(index._contents[foo][1],
+                frozenset([('make:runtime', 'localhost@rpl:linux', '')]))
+        self.assertEqual(index._byTrove.keys(),
+                [('make:runtime', 'localhost@rpl:linux', '')])
+
+    def test_corrupt(self):
+        os.makedirs(self.root)
+        for data in ['garbage', '', rootmanager.marshal.dumps((99, {}))]:
+            open(self.indexPath, 'wb').write(data)
+            index = rootmanager.ChrootContentsIndex(self.indexPath)
+            self.assertEqual(index._contents, {})
+        # It still works after starting over.
+        foo = self._chroot('foo', ['gcc:runtime'])
+        index.update(foo)
+        index.save()
+        index = rootmanager.ChrootContentsIndex(self.indexPath)
+        self.assertEqual(index._contents.keys(), [foo])
+
+    def test_bestOldChroot(self):
+        queue = rootmanager.ChrootQueue(self.root, 4)
+        exact = self._chroot('exact', ['gcc:runtime', 'make:runtime'])
+        self._chroot('crowded', ['gcc:runtime', 'make:runtime', 'perl:lib',
+            'python:lib', 'ruby:lib', 'tcl:lib'])
+        self._chroot('partial', ['gcc:runtime'])
+        self._chroot('empty', [])
+        buildReqs = [_req('gcc:runtime'), _req('make:runtime')]
+        self.assertEqual(queue._getBestOldChroot(buildReqs, True), exact)
+        self.assertEqual(queue._getBestOldChroot(buildReqs, True,
+            goodRootsOnly=True), exact)
+
+        # Nothing matching well enough.
+        buildReqs = [_req('gcc:runtime'), _req('bash:runtime'),
+                _req('sed:runtime')]
+        self.assertEqual(queue._getBestOldChroot(buildReqs, True,
+            goodRootsOnly=True), None)
+        self.assertNotEqual(queue._getBestOldChroot(buildReqs, True), None)
+        # The scores were saved for the next process.
+        index = rootmanager.ChrootContentsIndex(queue.contents.path)
+        self.assertEqual(len(index._contents), 4)
@@ -0,0 +1,101 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import jid
+
+from rmake.core import dispatcher
+from rmake.core import scheduler
+from rmake.core import types
+from rmake.lib import uuid
+
+
+class TaskQueueTest(unittest.TestCase):
+
+    def _task(self, job_uuid, name, zone=None, priority=0):
+        return types.RmakeTask(None, job_uuid, name, 'task.1',
+                task_zone=zone, task_priority=priority)
+
+    def test_order(self):
+        job = uuid.uuid4()
+        queue = scheduler.TaskQueue()
+        t1 = self._task(job, 'a', priority=1)
+        t2 = self._task(job, 'b', priority=0)
+        t3 = self._task(job, 'c', zone='zone.1', priority=0)
+        t4 = self._task(job, 'd', priority=0)
+        for task in (t1, t2, t3, t4):
+            queue.add(task)
+        self.assertEqual(list(queue), [t2, t3, t4, t1])
+        self.assertEqual(sorted(queue.keys()), [
+            ('task.1', None), ('task.1', 'zone.1')])
+
+        entries = queue.drain([('task.1', None)])
+        self.assertEqual([x[2] for x in entries], [t2, t4, t1])
+        self.assertEqual(list(queue), [t3])
+        queue.requeue(entries[-1])
+        self.assertEqual(list(queue), [t3, t1])
+
+    def test_discardJob(self):
+        job1, job2 = uuid.uuid4(), uuid.uuid4()
+        queue = scheduler.TaskQueue()
+        t1 = self._task(job1, 'a')
+        t2 = self._task(job2, 'b')
+        queue.add(t1)
+        queue.add(t2)
+        self.assertEqual(queue.discardJob(job1), [t1])
+        self.assertEqual(list(queue), [t2])
+        self.assertEqual(queue.discardJob(job2), [t2])
+        self.assertEqual(queue.keys(), [])
+
+
+class WorkerIndexTest(unittest.TestCase):
+
+    def _worker(self, name, caps):
+        worker = dispatcher.WorkerInfo(jid.JID(name))
+        worker.caps = types.CapabilitySet(caps)
+        worker.active = True
+        return worker
+
+    def test_candidates(self):
+        w1 = self._worker('ham@spam/eggs', [
+            types.TaskCapability('task.1'),
+            types.ZoneCapability('zone.1'),
+            ])
+        w2 = self._worker('foo@bar/baz', [
+            types.TaskCapability('task.1'),
+            types.TaskCapability('task.2'),
+            ])
+        index = scheduler.WorkerIndex()
+        assert index.update(w1)
+        assert index.update(w2)
+        assert not index.update(w2)
+
+        self.assertEqual(index.candidates('task.1', None),
+                (set([w1.jid, w2.jid]), False))
+        self.assertEqual(index.candidates('task.1', 'zone.1'),
+                (set([w1.jid]), False))
+        self.assertEqual(index.candidates('task.2', 'zone.1'),
+                (set(), True))
+        self.assertEqual(index.candidates('task.3', None), (set(), False))
+        self.assertEqual(index.keysFor(w2.jid, [('task.1', 'zone.1'),
+            ('task.2', None)]), set([('task.2', None)]))
+
+        w1.active = False
+        assert index.update(w1)
+        self.assertEqual(index.candidates('task.1', 'zone.1'), (set(), True))
+        index.remove(w2)
+        self.assertEqual(index.candidates('task.1', None), (set(), False))
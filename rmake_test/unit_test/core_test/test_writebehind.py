@@ -0,0 +1,108 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from rmake.core import types
+from rmake.core import writebehind
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.writer = writebehind.WriteBehind(self._writeOne,
+                self._writeMany)
+
+    def _writeOne(self, item):
+        d = defer.Deferred()
+        self.calls.append(([item], d))
+        return d
+
+    def _writeMany(self, items):
+        d = defer.Deferred()
+        self.calls.append((items, d))
+        return d
+
+    def _finish(self, index, results=None):
+        items, d = self.calls[index]
+        if results is None:
+            results = items
+        if len(items) == 1 and len(results) == 1:
+            d.callback(results[0])
+        else:
+            d.callback(results)
+
+    def _results(self, d):
+        out = []
+        d.addCallback(out.append)
+        return out
+
+    def test_immediate(self):
+        d = self.writer.write('a', 1, 'a1')
+        self.assertEqual([x[0] for x in self.calls], [['a1']])
+        result = self._results(d)
+        self._finish(0)
+        self.assertEqual(result, ['a1'])
+
+    def test_coalesce(self):
+        self.writer.write('a', 1, 'a1')
+        d2 = self.writer.write('a', 2, 'a2')
+        d3 = self.writer.write('a', 3, 'a3')
+        d4 = self.writer.write('b', 1, 'b1')
+        # Older than what is already waiting, so never written.
+        d5 = self.writer.write('a', 2, 'a2-late')
+        r2, r3, r4, r5 = [self._results(x) for x in (d2, d3, d4, d5)]
+        self.assertEqual(r2, [None])
+        self.assertEqual(r5, [None])
+        self.assertEqual(len(self.calls), 1)
+
+        self._finish(0)
+        self.assertEqual([x[0] for x in self.calls], [['a1'], ['a3', 'b1']])
+        self._finish(1, ['a3', None])
+        self.assertEqual(r3, ['a3'])
+        self.assertEqual(r4, [None])
+        self.assertEqual(self.writer.batches, 2)
+        self.assertEqual(self.writer.superseded, 2)
+
+    def test_override(self):
+        self.writer.write('a', 1, 'a1')
+        self.writer.write('a', 5, 'a5')
+        self.writer.write('a', types.JobTimes.TICK_OVERRIDE, 'final')
+        self._finish(0)
+        self.assertEqual(self.calls[1][0], ['final'])
+
+    def test_merge(self):
+        self.writer.merge = lambda old, new: old + new
+        self.writer.write('a', 1, 'x')
+        self.writer.write('a', 2, 'y')
+        self.writer.write('a', 3, 'z')
+        self._finish(0)
+        self.assertEqual(self.calls[1][0], ['yz'])
+
+    def test_error(self):
+        d1 = self.writer.write('a', 1, 'a1')
+        d2 = self.writer.write('b', 1, 'b1')
+        d3 = self.writer.write('c', 1, 'c1')
+        self.calls[0][1].errback(RuntimeError("boom"))
+        # The failed write doesn't stop the next batch.
+        self.assertEqual(self.calls[1][0], ['b1', 'c1'])
+        self.calls[1][1].errback(RuntimeError("boom"))
+        return defer.gatherResults([self.assertFailure(x, RuntimeError)
+            for x in (d1, d2, d3)])
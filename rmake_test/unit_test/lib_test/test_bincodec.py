@@ -0,0 +1,143 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import datetime
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.jid import JID
+
+from rmake.core import types
+from rmake.lib import bincodec
+from rmake.lib import uuid
+from rmake.messagebus import message
+
+
+class BinCodecTest(unittest.TestCase):
+
+    def test_values(self):
+        tz = bincodec._FixedOffset(-300)
+        values = [
+                None, True, False, 0, -1, 127, -129, 1 << 40, 1 << 70,
+                -(1 << 70), 1.5, '', 'x' * 300, u'\u2603', [1, [2]],
+                (1, 'a'), set([1, 2]), frozenset(['a']), {'a': {1: None}},
+                uuid.uuid4(), datetime.datetime(2010, 4, 1, 12, 30, 5, 7),
+                datetime.datetime(2010, 4, 1, 12, 30, 5, 7, tz),
+                datetime.timedelta(-3, 5, 6),
+                ]
+        for value in values:
+            result = bincodec.loads(bincodec.dumps(value))
+            self.assertEqual(result, value)
+            self.assertEqual(type(result), type(value))
+
+    def test_records(self):
+        task = types.RmakeTask(None, uuid.uuid4(), 'spam', 'test',
+                task_data=types.FrozenObject('pickle:ham')).freeze()
+        data = bincodec.dumps([task, task])
+        result = bincodec.loads(data)
+        self.assertEqual(result, [task, task])
+        self.assertEqual(type(result[0]), types.FrozenRmakeTask)
+        self.assertEqual(type(result[0].status), types.FrozenJobStatus)
+        # Type names are only written the first time
+        self.assertEqual(data.count('FrozenRmakeTask'), 1)
+
+    def test_errors(self):
+        self.assertRaises(bincodec.EncodeError, bincodec.dumps, object())
+        data = bincodec.dumps({'a': [1, 2, 3]})
+        for n in range(len(data)):
+            self.assertRaises(bincodec.DecodeError, bincodec.loads, data[:n])
+        self.assertRaises(bincodec.DecodeError, bincodec.loads, data + 'N')
+        data = bincodec.dumps(types.VersionCapability((3,)))
+        self.assertRaises(bincodec.DecodeError, bincodec.loads,
+                data.replace('VersionCapability', 'VersionCapabilitx'))
+
+    def test_malformed(self):
+        version = chr(bincodec.VERSION)
+        count = bincodec._count.pack
+        # Not a number
+        self.assertRaises(bincodec.DecodeError, bincodec.loads,
+                version + 'L\x03abc')
+        # Unhashable dict key and set member
+        self.assertRaises(bincodec.DecodeError, bincodec.loads,
+                version + 'm' + count(1) + 'l' + count(0) + 'N')
+        self.assertRaises(bincodec.DecodeError, bincodec.loads,
+                version + 'e' + count(1) + 'l' + count(0))
+        # Fields the record type won't accept
+        obj = Checked(1)
+        self.assertEqual(bincodec.loads(bincodec.dumps(obj)).value, 1)
+        obj.value = 'x'
+        self.assertRaises(bincodec.DecodeError, bincodec.loads,
+                bincodec.dumps(obj))
+
+
+class Checked(object):
+
+    def __init__(self, value):
+        self.value = int(value)
+
+bincodec.register(Checked, reduce=lambda obj: [obj.value],
+        construct=lambda values: Checked(*values),
+        name='test_bincodec.Checked')
+
+
+class CompactMessageTest(unittest.TestCase):
+
+    def _roundTrip(self, msg, compact=True):
+        jmsg = msg.to_jmessage(compact=compact)
+        jmsg.sender = JID('foo@bar/baz')
+        return jmsg, message.Message.from_jmessage(jmsg)
+
+    def test_heartbeat(self):
+        caps = set([types.VersionCapability((3,)),
+            types.ZoneCapability('zone.1')])
+        msg = message.Heartbeat(caps=caps, tasks=[uuid.uuid4()],
+                slots={None: 2}, addresses=set(['::1']))
+        jmsg, msg2 = self._roundTrip(msg)
+        self.assertEqual(jmsg.headers['content-type'],
+                message.CONTENT_COMPACT)
+        self.assertEqual(type(msg2), message.Heartbeat)
+        for slot in msg._payload_slots:
+            self.assertEqual(getattr(msg2, slot), getattr(msg, slot))
+
+    def test_unset_slots(self):
+        msg = message.LogBatch()
+        msg.payload.data = 'x'
+        jmsg, msg2 = self._roundTrip(msg)
+        self.assertEqual(msg2.data, 'x')
+        self.assertFalse(hasattr(msg2.payload, 'task_uuid'))
+
+    def test_fallback(self):
+        # Not encodable, so pickled even if asked to be compact
+        msg = message.Event(event='foo', args=(1,), kwargs={'a': object})
+        jmsg = msg.to_jmessage(compact=True)
+        self.assertEqual(jmsg.headers['content-type'],
+                message.CONTENT_PICKLE)
+        msg = message.TaskStatus(task=None)
+        jmsg, msg2 = self._roundTrip(msg, compact=False)
+        self.assertEqual(jmsg.headers['content-type'],
+                message.CONTENT_PICKLE)
+        self.assertEqual(msg2.task, None)
+
+    def test_malformed(self):
+        msg = message.Heartbeat(caps=set(), tasks=[], slots={None: 1},
+                addresses=set())
+        jmsg = msg.to_jmessage(compact=True)
+        jmsg.sender = JID('foo@bar/baz')
+        header = message._compactHeader.size
+        # A list as a member of the set of caps
+        jmsg.payload = jmsg.payload[:header] + 'e' + (
+                bincodec._count.pack(1) + 'l' + bincodec._count.pack(0))
+        self.assertEqual(message.Message.from_jmessage(jmsg), None)
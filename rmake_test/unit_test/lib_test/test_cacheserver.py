@@ -0,0 +1,131 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.trial import unittest
+from twisted.web.server import Site
+
+from rmake.lib import cacheserver
+from rmake.lib import repocache
+
+
+class CacheServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.serverStore = repocache.DataStore(
+                os.path.abspath(self.mktemp()))
+        self.clientStore = repocache.DataStore(
+                os.path.abspath(self.mktemp()))
+        self.resource = cacheserver.CacheResource(self.serverStore)
+        self.port = reactor.listenTCP(0, Site(self.resource),
+                interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % self.port.getHost().port
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def _addEntry(self, store, hash, data):
+        path = store.hashToPath(hash)
+        store.makeDir(path)
+        open(path, 'wb').write(data)
+
+    def testFetch(self):
+        big = os.urandom(200000)
+        self._addEntry(self.serverStore, 'a' * 40, 'small')
+        self._addEntry(self.serverStore, 'b' * 40, big)
+        self._addEntry(self.serverStore, 'c' * 40, '')
+        peers = cacheserver.CachePeers([self.url])
+        d = threads.deferToThread(peers.fetch,
+                ['a' * 40, 'b' * 40, 'c' * 40, 'd' * 40], self.clientStore,
+                lambda hash, path: True)
+        def check(fetched):
+            self.assertEqual(fetched, set(['a' * 40, 'b' * 40, 'c' * 40]))
+            read = lambda hash: open(
+                    self.clientStore.hashToPath(hash), 'rb').read()
+            self.assertEqual(read('a' * 40), 'small')
+            self.assertEqual(read('b' * 40), big)
+            self.assertEqual(read('c' * 40), '')
+            self.failIf(os.path.exists(
+                self.clientStore.hashToPath('d' * 40)))
+            self.assertEqual((peers.hits, peers.misses), (3, 1))
+            self.assertEqual(self.resource.served, 3)
+        d.addCallback(check)
+        return d
+
+    def testPeerDown(self):
+        peers = cacheserver.CachePeers(['http://127.0.0.1:1/', self.url])
+        self._addEntry(self.serverStore, 'a' * 40, 'data')
+        d = threads.deferToThread(peers.fetch, ['a' * 40], self.clientStore,
+                lambda hash, path: True)
+        def check(fetched):
+            self.assertEqual(fetched, set(['a' * 40]))
+            # The dead peer is skipped until it is due to be retried.
+            self.assertEqual(peers._livePeers(), [self.url])
+        d.addCallback(check)
+        return d
+
+    def testVerify(self):
+        self._addEntry(self.serverStore, 'a' * 40, 'good')
+        self._addEntry(self.serverStore, 'b' * 40, 'bad')
+        peers = cacheserver.CachePeers([self.url])
+        def verify(hash, path):
+            return open(path, 'rb').read() == 'good'
+        d = threads.deferToThread(peers.fetch, ['a' * 40, 'b' * 40],
+                self.clientStore, verify)
+        def check(fetched):
+            # A peer serving a bad entry is not trusted for the rest
+            self.assertEqual(fetched, set(['a' * 40]))
+            self.failIf(os.path.exists(
+                self.clientStore.hashToPath('b' * 40)))
+            self.failIf(os.listdir(os.path.dirname(
+                self.clientStore.hashToPath('b' * 40))))
+            self.assertEqual(peers._livePeers(), [])
+        d.addCallback(check)
+        return d
+
+    def testRefused(self):
+        self.resource.networks = cacheserver.parseNetworks(['10.0.0.0/8'])
+        self._addEntry(self.serverStore, 'a' * 40, 'data')
+        peers = cacheserver.CachePeers([self.url])
+        d = threads.deferToThread(peers.fetch, ['a' * 40], self.clientStore,
+                lambda hash, path: True)
+        def check(fetched):
+            self.assertEqual(fetched, set())
+            self.assertEqual(self.resource.refused, 1)
+            self.assertEqual(self.resource.served, 0)
+        d.addCallback(check)
+        return d
+
+    def testAddressAllowed(self):
+        networks = cacheserver.parseNetworks(['10.0.0.0/8', '192.168.1.5',
+            'fd00::/8'])
+        allowed = lambda x: cacheserver.addressAllowed(x, networks)
+        self.failUnless(allowed('10.1.2.3'))
+        self.failUnless(allowed('::ffff:10.1.2.3'))
+        self.failUnless(allowed('192.168.1.5'))
+        self.failIf(allowed('192.168.1.6'))
+        self.failIf(allowed('11.0.0.1'))
+        self.failUnless(allowed('fd12::1'))
+        self.failIf(allowed('fe80::1'))
+        self.failIf(allowed('bogus'))
+        self.failUnless(cacheserver.addressAllowed('0.0.0.0',
+            cacheserver.parseNetworks(['0.0.0.0/0'])))
+        self.assertRaises(ValueError, cacheserver.parseNetworks,
+                ['10.0.0.0/33'])
+        self.assertRaises(ValueError, cacheserver.parseNetworks, ['node2'])
@@ -0,0 +1,275 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+from twisted.trial import unittest
+
+from rmake.lib import chrootcache
+from rmake.lib import compression
+
+
+class ChrootCacheTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix='rmake-test-')
+        self.cacheDir = os.path.join(self.workDir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def _makeTree(self, name, extra=''):
+        root = os.path.join(self.workDir, name)
+        os.makedirs(os.path.join(root, 'usr/bin'))
+        os.makedirs(os.path.join(root, 'etc'))
+        open(os.path.join(root, 'usr/bin/tool'), 'w').write('#!/bin/sh\n')
+        os.chmod(os.path.join(root, 'usr/bin/tool'), 0755)
+        open(os.path.join(root, 'etc/config'), 'w').write('config' + extra)
+        os.link(os.path.join(root, 'etc/config'),
+                os.path.join(root, 'etc/config.link'))
+        os.symlink('../usr/bin', os.path.join(root, 'etc/bin'))
+        os.utime(os.path.join(root, 'etc/config'), (1000, 1000))
+        return root
+
+    def _listTree(self, root):
+        result = []
+        for dirPath, dirNames, fileNames in os.walk(root):
+            for name in sorted(dirNames + fileNames):
+                path = os.path.join(dirPath, name)
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    info = os.readlink(path)
+                elif stat.S_ISREG(st.st_mode):
+                    info = open(path).read()
+                else:
+                    info = None
+                result.append((path[len(root):], stat.S_IMODE(st.st_mode),
+                    info))
+        return sorted(result)
+
+
+class ContentChrootCacheTest(ChrootCacheTestBase):
+
+    def _objects(self, cache):
+        return sorted(os.path.join(x, y)
+                for x in os.listdir(cache.objectDir)
+                for y in os.listdir(os.path.join(cache.objectDir, x)))
+
+    def testStoreRestore(self):
+        cache = chrootcache.ContentChrootCache(self.cacheDir)
+        root = self._makeTree('one')
+        fingerprint = '\1' * 20
+        self.failIf(cache.hasChroot(fingerprint))
+        cache.store(fingerprint, root)
+        self.failUnless(cache.hasChroot(fingerprint))
+        # The two links to etc/config share one object
+        self.assertEqual(len(self._objects(cache)), 2)
+
+        target = os.path.join(self.workDir, 'restored')
+        cache.restore(fingerprint, target)
+        self.assertEqual(self._listTree(target), self._listTree(root))
+        config = os.stat(os.path.join(target, 'etc/config'))
+        self.assertEqual(config.st_mtime, 1000)
+        self.assertEqual(config.st_nlink, 2)
+
+        # Restored files are independent copies
+        open(os.path.join(target, 'usr/bin/tool'), 'w').write('changed')
+        target2 = os.path.join(self.workDir, 'restored2')
+        cache.restore(fingerprint, target2)
+        self.assertEqual(self._listTree(target2), self._listTree(root))
+
+    def testHardlinkRestore(self):
+        cache = chrootcache.ContentChrootCache(self.cacheDir, hardlink=True)
+        root = self._makeTree('one')
+        cache.store('\1' * 20, root)
+        target = os.path.join(self.workDir, 'restored')
+        cache.restore('\1' * 20, target)
+        self.assertEqual(self._listTree(target), self._listTree(root))
+        tool = os.stat(os.path.join(target, 'usr/bin/tool'))
+        self.assertEqual(tool.st_nlink, 2)
+        # Files under etc are rewritten in place during setup, so they get
+        # private copies
+        config = os.stat(os.path.join(target, 'etc/config'))
+        self.assertEqual(config.st_nlink, 2)
+        self.assertEqual(config.st_mtime, 1000)
+        os.unlink(os.path.join(target, 'etc/config.link'))
+        self.assertEqual(os.stat(os.path.join(target, 'etc/config')).st_nlink,
+                1)
+
+    def testSetuidObjects(self):
+        cache = chrootcache.ContentChrootCache(self.cacheDir, hardlink=True)
+        root = self._makeTree('one')
+        os.chmod(os.path.join(root, 'usr/bin/tool'), 04755)
+        cache.store('\1' * 20, root)
+        self.assertEqual(stat.S_IMODE(os.stat(cache.objectDir).st_mode), 0700)
+        for name in self._objects(cache):
+            st = os.stat(os.path.join(cache.objectDir, name))
+            self.failIf(st.st_mode & (stat.S_ISUID | stat.S_ISGID))
+        target = os.path.join(self.workDir, 'restored')
+        cache.restore('\1' * 20, target)
+        self.assertEqual(self._listTree(target), self._listTree(root))
+        # Restored as a copy with the setuid bit put back
+        tool = os.stat(os.path.join(target, 'usr/bin/tool'))
+        self.assertEqual(tool.st_nlink, 1)
+        self.assertEqual(stat.S_IMODE(tool.st_mode), 04755)
+
+    def testDedupAndPrune(self):
+        cache = chrootcache.ContentChrootCache(self.cacheDir)
+        cache.PRUNE_GRACE = -1
+        cache.store('\1' * 20, self._makeTree('one'))
+        cache.store('\2' * 20, self._makeTree('two', extra='2'))
+        # usr/bin/tool is shared
+        self.assertEqual(len(self._objects(cache)), 3)
+        cache.remove('\2' * 20)
+        self.failIf(cache.hasChroot('\2' * 20))
+        self.assertEqual(len(self._objects(cache)), 2)
+        cache.remove('\1' * 20)
+        self.assertEqual(self._objects(cache), [])
+
+    def testStats(self):
+        cache = chrootcache.ContentChrootCache(self.cacheDir)
+        root = self._makeTree('one')
+        self.failIf(cache.hasChroot('\1' * 20))
+        cache.store('\1' * 20, root)
+        cache.restore('\1' * 20, os.path.join(self.workDir, 'restored'))
+        stats = cache.getStats()
+        self.assertEqual((stats['count'], stats['hits'], stats['misses'],
+            stats['evictions']), (1, 1, 1, 0))
+        # etc/config.link is a hard link to etc/config
+        self.assertEqual(stats['size'], len('#!/bin/sh\n') + len('config'))
+        self.assertEqual([x[0] for x in stats['entries']], ['01' * 20])
+        cache.remove('\1' * 20)
+        self.assertEqual(cache.getStats()['count'], 0)
+
+
+class LocalChrootCacheTest(ChrootCacheTestBase):
+
+    def _testStoreRestore(self, codec, storeAsync=False):
+        cache = chrootcache.LocalChrootCache(self.cacheDir, codec=codec,
+                threads=2, storeAsync=storeAsync)
+        root = self._makeTree('one')
+        fingerprint = '\1' * 20
+        cache.store(fingerprint, root)
+        if storeAsync:
+            for x in range(500):
+                if cache.hasChroot(fingerprint):
+                    break
+                time.sleep(0.01)
+        self.failUnless(cache.hasChroot(fingerprint))
+        self.assertEqual([x for x in os.listdir(self.cacheDir)
+            if x.startswith('.')], [])
+
+        target = os.path.join(self.workDir, 'restored')
+        os.mkdir(target)
+        cache.restore(fingerprint, target)
+        self.assertEqual(self._listTree(target), self._listTree(root))
+        config = os.stat(os.path.join(target, 'etc/config'))
+        self.assertEqual(config.st_mtime, 1000)
+        self.assertEqual(config.st_nlink, 2)
+
+        cache.remove(fingerprint)
+        self.failIf(cache.hasChroot(fingerprint))
+
+    def testStoreRestore(self):
+        for codec in compression.getCodecs():
+            self._testStoreRestore(codec)
+            shutil.rmtree(os.path.join(self.workDir, 'one'))
+            shutil.rmtree(os.path.join(self.workDir, 'restored'))
+
+    def testStoreAsync(self):
+        self._testStoreRestore('gzip', storeAsync=True)
+
+    def testSnapshot(self):
+        cache = chrootcache.LocalChrootCache(self.cacheDir)
+        root = self._makeTree('one')
+        os.chmod(os.path.join(root, 'usr/bin/tool'), 04755)
+        snapshot = cache._snapshot(root)
+        self.assertEqual(self._listTree(snapshot), self._listTree(root))
+        self.assertEqual(os.stat(os.path.join(snapshot,
+            'etc/config')).st_nlink, 2)
+        # Changes made to the chroot after the snapshot don't leak into it
+        open(os.path.join(root, 'etc/config'), 'a').write('more')
+        self.assertEqual(open(os.path.join(snapshot, 'etc/config')).read(),
+                'config')
+
+    def testOtherCodec(self):
+        # Archives written with a different codec can still be restored
+        root = self._makeTree('one')
+        chrootcache.LocalChrootCache(self.cacheDir, codec='bzip2').store(
+                '\1' * 20, root)
+        cache = chrootcache.LocalChrootCache(self.cacheDir)
+        self.failUnless(cache.hasChroot('\1' * 20))
+        target = os.path.join(self.workDir, 'restored')
+        cache.restore('\1' * 20, target)
+        self.assertEqual(self._listTree(target), self._listTree(root))
+
+    def testEviction(self):
+        cache = chrootcache.LocalChrootCache(self.cacheDir, maxCount=2)
+        root = self._makeTree('one')
+        cache.store('\1' * 20, root)
+        cache.store('\2' * 20, root)
+        # Restoring the first chroot makes the second the least recently used
+        cache.restore('\1' * 20, os.path.join(self.workDir, 'restored'))
+        self.failIf(cache.hasChroot('\4' * 20))
+        cache.store('\3' * 20, root)
+        self.failUnless(cache.hasChroot('\1' * 20))
+        self.failIf(cache.hasChroot('\2' * 20))
+        self.failUnless(cache.hasChroot('\3' * 20))
+
+        stats = cache.getStats()
+        self.assertEqual((stats['count'], stats['hits'], stats['misses'],
+            stats['evictions']), (2, 1, 2, 1))
+        self.assertEqual([x[0] for x in stats['entries']],
+                ['03' * 20, '01' * 20])
+        self.assertEqual(stats['size'], sum(x[1] for x in stats['entries']))
+
+        # A size limit evicts everything except the new chroot
+        cache.maxCount, cache.maxSize = 0, 1
+        cache.store('\2' * 20, root)
+        stats = cache.getStats()
+        self.assertEqual([x[0] for x in stats['entries']], ['02' * 20])
+        self.assertEqual(stats['evictions'], 3)
+
+
+class ChrootIndexTest(ChrootCacheTestBase):
+
+    def testFindClosest(self):
+        index = chrootcache.ChrootIndex(os.path.join(self.cacheDir, 'index'))
+        cached = set(['\1' * 20, '\2' * 20, '\3' * 20])
+        index.add('\1' * 20, 'base', ['a', 'b', 'c'])
+        index.add('\2' * 20, 'base', ['a', 'b', 'c', 'd', 'x', 'y'])
+        index.add('\3' * 20, 'other', ['a', 'b', 'c', 'd'])
+        find = lambda troves: index.findClosest('base', troves,
+                cached.__contains__)
+        self.assertEqual(find(['a', 'b', 'c', 'd']), '\1' * 20)
+        self.assertEqual(find(['a', 'b', 'c', 'd', 'x']), '\2' * 20)
+        # Too little in common to be worth it
+        self.assertEqual(find(['a', 'e', 'f', 'g', 'h']), None)
+        # Entries whose chroot is gone are skipped
+        cached.discard('\1' * 20)
+        self.assertEqual(find(['a', 'b', 'c', 'd']), '\2' * 20)
+        index.remove('\2' * 20)
+        self.assertEqual(find(['a', 'b', 'c', 'd']), None)
+        # Changes made by other processes are picked up
+        index2 = chrootcache.ChrootIndex(index.indexDir)
+        index2.add('\1' * 20, 'base', ['a', 'b', 'c', 'd'])
+        cached.add('\1' * 20)
+        self.assertEqual(find(['a', 'b', 'c', 'd']), '\1' * 20)
@@ -0,0 +1,61 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import os
+import random
+from StringIO import StringIO
+from twisted.trial import unittest
+
+from rmake.lib import compression
+
+
+class CompressionTest(unittest.TestCase):
+
+    def _roundTrip(self, codec, data, threads, readSize):
+        out = StringIO()
+        writer = compression.CompressedWriter(out, codec, threads=threads,
+                blockSize=1000)
+        for start in xrange(0, len(data), 777):
+            writer.write(data[start:start + 777])
+        writer.close()
+        reader = compression.DecompressedReader(StringIO(out.getvalue()),
+                codec, chunkSize=123)
+        parts = []
+        while True:
+            part = reader.read(readSize)
+            if not part:
+                break
+            parts.append(part)
+        self.assertEqual(''.join(parts), data)
+        return out.getvalue()
+
+    def testRoundTrip(self):
+        rng = random.Random(1)
+        data = ''.join(rng.choice('abcdefgh') for x in xrange(20000))
+        for codec in compression.getCodecs().values():
+            for threads in (1, 4):
+                for readSize in (-1, 1, 511, 100000):
+                    self._roundTrip(codec, data, threads, readSize)
+            self._roundTrip(codec, '', 2, -1)
+
+    def testGzipCompatible(self):
+        import gzip
+        data = os.urandom(5000) + 'x' * 5000
+        blob = self._roundTrip(compression.getCodec('gzip'), data, 3, -1)
+        # Concatenated members are still one valid gzip stream
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(blob)).read(), data)
@@ -0,0 +1,236 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.jid import JID
+
+from rmake.lib.jabberlink.handlers import link
+from rmake.lib.jabberlink.message import Message
+
+
+class MessageTest(unittest.TestCase):
+
+    def test_binary(self):
+        payload = ''.join(chr(x) for x in range(256)) * 1000
+        msg = Message('urn:test', payload, headers={u'x-h\xe9': u'v\xe9'},
+                in_reply_to=7, more=True)
+        data = msg.to_binary(42)
+        self.assertEqual(msg.seq, 42)
+        # Payload is carried as-is
+        self.assertTrue(len(data) < len(payload) + 100)
+
+        msg2 = Message.from_binary(data)
+        self.assertEqual(msg2.seq, 42)
+        self.assertEqual(msg2.message_type, 'urn:test')
+        self.assertEqual(msg2.payload, payload)
+        self.assertEqual(msg2.headers, {u'x-h\xe9': u'v\xe9'})
+        self.assertEqual(msg2.in_reply_to, 7)
+        self.assertEqual(msg2.more, True)
+
+    def test_binary_matches_frames(self):
+        msg = Message('urn:test', 'x' * 100000, headers={'a': 'b'})
+        joined = Message.join(msg.split(3))
+        binary = Message.from_binary(msg.to_binary(3))
+        for name in ('seq', 'message_type', 'payload', 'headers',
+                'in_reply_to', 'more'):
+            self.assertEqual(getattr(joined, name), getattr(binary, name))
+
+    def test_binary_truncated(self):
+        data = Message('urn:test', 'x', headers={'a': 'b' * 50}).to_binary(0)
+        self.assertRaises(ValueError, Message.from_binary, data[:30])
+
+
+class FakeNeighbor(link.Neighbor):
+
+    def __init__(self):
+        link.Neighbor.__init__(self, None, JID('peer@example.com/r'), True)
+        self.isAvailable = self.isAuthenticated = True
+        self.now = 1000.0
+        self._now = lambda: self.now
+        self.inflight = []
+        self.frames = []
+
+    def _send_frame(self, frame):
+        d = defer.Deferred()
+        self.inflight.append(d)
+        self.frames.append(frame)
+        return d
+
+    def ackAll(self, rtt):
+        self.now += rtt
+        acks, self.inflight = self.inflight, []
+        for d in acks:
+            d.callback(None)
+
+
+class NeighborTest(unittest.TestCase):
+
+    def _queue(self, neighbor, frames):
+        neighbor.send(Message('urn:test', 'x' * (Message.max_frame * 3 / 4)
+            * frames))
+
+    def test_window_grows(self):
+        neighbor = FakeNeighbor()
+        self._queue(neighbor, 200)
+        self.assertEqual(len(neighbor.inflight), neighbor.window_size)
+        neighbor.ackAll(0.1)
+        # One more frame per acknowledgement while starting up
+        self.assertEqual(len(neighbor.inflight), neighbor.window_size * 2)
+        neighbor.ackAll(0.1)
+        self.assertEqual(len(neighbor.inflight), neighbor.window_size * 4)
+        stats = neighbor.getStats()
+        self.assertEqual(stats['window'], neighbor.window_size * 4)
+        self.assertAlmostEqual(stats['srtt'], 0.1)
+        self.assertEqual(stats['bytes_acked'],
+                neighbor.window_size * 3 * Message.max_frame)
+        self.assertTrue(stats['throughput'] > 0)
+
+    def test_window_shrinks(self):
+        neighbor = FakeNeighbor()
+        self._queue(neighbor, 500)
+        for n in range(4):
+            neighbor.ackAll(0.1)
+        window = neighbor.window
+        # Round trips get much longer as frames queue up on the way.
+        for n in range(8):
+            neighbor.ackAll(1.0)
+        self.assertTrue(neighbor.window < window)
+        self.assertTrue(neighbor.window >= neighbor.min_window)
+
+    def test_reassembly(self):
+        neighbor = FakeNeighbor()
+        received = []
+        class FakeLink(object):
+            def send(self, iq):
+                pass
+            def onMessage(self, neighbor, message):
+                received.append(message)
+        neighbor.link = FakeLink()
+        payload = 'y' * (Message.max_frame * 2)
+        for msg in [Message('urn:test', payload), Message('urn:test', 'z')]:
+            for frame in msg.split(neighbor.in_seq_recv + 1):
+                neighbor.onFrame(frame.to_dom(None))
+        self.assertEqual([x.payload for x in received], [payload, 'z'])
+        self.assertEqual(len(neighbor.in_buf), 0)
+
+
+class FakeStream(object):
+
+    MAX_LENGTH = link.StreamProtocol.MAX_LENGTH
+
+    def __init__(self):
+        self.sent = []
+        self.acks = []
+
+    def sendMessage(self, data):
+        self.sent.append(data)
+
+    def sendAck(self, seq):
+        self.acks.append(seq)
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        received = self.received
+        class FakeLink(object):
+            def send(self, iq):
+                pass
+            def onMessage(self, neighbor, message):
+                received.append(message.payload)
+        self.sender = FakeNeighbor()
+        self.sender.stream = FakeStream()
+        self.receiver = FakeNeighbor()
+        self.receiver.link = FakeLink()
+        self.receiverStream = FakeStream()
+
+    def _deliver(self, data):
+        self.receiver.onStreamMessage(self.receiverStream, data)
+
+    def test_frame_count(self):
+        for size in (0, 1, Message.max_frame * 3 / 4,
+                Message.max_frame * 3 / 4 + 1, Message.max_frame * 2):
+            msg = Message('urn:test', 'x' * size)
+            self.assertEqual(msg.frame_count(), len(msg.split(0)))
+
+    def test_resend_on_loss(self):
+        big = 'y' * (Message.max_frame * 2)
+        for payload in ('one', big, 'three'):
+            self.sender.send(Message('urn:test', payload))
+        stream = self.sender.stream
+        self.assertEqual(len(stream.sent), 3)
+        self.assertEqual(self.sender.inflight, [])
+
+        # The first two arrive, but only the first is acknowledged before
+        # the stream goes away.
+        self._deliver(stream.sent[0])
+        self._deliver(stream.sent[1])
+        self.assertEqual(self.receiverStream.acks, [0, 3])
+        self.sender.onStreamAck(0)
+        self.assertEqual(self.sender.getStats()['stream_unacked'], 2)
+        self.sender.streamLost(stream)
+        self.assertEqual(self.sender.stream, None)
+        self.assertEqual(self.sender.getStats()['stream_unacked'], 0)
+
+        # The rest are resent as frames with the same sequence numbers, and
+        # the receiver skips the one it already has.
+        self.assertEqual([x.seq for x in self.sender.frames], [1, 2, 3, 4])
+        for frame in self.sender.frames:
+            self.receiver.onFrame(frame.to_dom(None))
+        self.assertEqual(self.received, ['one', big, 'three'])
+        self.sender.ackAll(0.1)
+        self.assertEqual(self.sender.out_seq_ackd, 5)
+
+    def test_large_message_uses_frames(self):
+        self.sender.stream.MAX_LENGTH = 1000
+        self.sender.send(Message('urn:test', 'x' * 2000))
+        self.assertEqual(self.sender.stream.sent, [])
+        self.assertEqual(len(self.sender.inflight), 1)
+        # Later messages wait behind the frames
+        self.sender.send(Message('urn:test', 'small'))
+        self.assertEqual(self.sender.stream.sent, [])
+        self.sender.ackAll(0.1)
+        self.sender.ackAll(0.1)
+        self.sender.send(Message('urn:test', 'small'))
+        self.assertEqual(len(self.sender.stream.sent), 1)
+
+    def test_records(self):
+        sender = link.StreamProtocol(None, token='t')
+        sender.makeConnection(StringTransport())
+        calls = []
+        class Recorder(object):
+            def onStreamMessage(self, stream, data, offset):
+                calls.append(('message', Message.from_binary(data,
+                    offset).payload))
+            def onStreamAck(self, seq):
+                calls.append(('ack', seq))
+        receiver = link.StreamProtocol(None, neighbor=Recorder())
+        receiver.makeConnection(StringTransport())
+        receiver.attached = True
+        sender.transport.clear()
+        sender.sendMessage(Message('urn:test', 'payload').to_binary(7))
+        sender.sendAck(12)
+        receiver.dataReceived(sender.transport.value())
+        self.assertEqual(calls, [('message', 'payload'), ('ack', 12)])
+
+        # Anything else closes the stream
+        receiver.dataReceived('\0\0\0\1x')
+        self.assertTrue(receiver.transport.disconnecting)
@@ -0,0 +1,152 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import logging
+import zlib
+from twisted.internet import task
+from twisted.trial import unittest
+
+from rmake.lib import bincodec
+from rmake.messagebus import logger
+
+
+class FakeTask(object):
+    job_uuid = 'job'
+    task_uuid = 'task'
+
+
+class LogRelayTest(unittest.TestCase):
+
+    def _record(self, msg, name='test', level=logging.INFO, exc_text=None):
+        record = logging.LogRecord(name, level, __file__, 1, msg, None, None)
+        record.exc_text = exc_text
+        return record
+
+    def _relay(self, backlog=0):
+        self.sent = []
+        self.backlog = backlog
+        relay = logger.LogRelay(self.sent.append, FakeTask(),
+                backlogFunc=lambda: self.backlog)
+        self.clock = task.Clock()
+        from twisted.internet import reactor
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        relay._now = self.clock.seconds
+        return relay
+
+    def _received(self):
+        records = []
+        for msg in self.sent:
+            records.extend(logger.decodeRecords(msg.data))
+        return records
+
+    def testRoundTrip(self):
+        records = [
+                self._record('hello %s', 'a.b'),
+                self._record(u'caf\xe9', 'c', logging.ERROR,
+                    exc_text='Traceback...'),
+                self._record('again', 'a.b', logging.DEBUG),
+                ]
+        records[0].args = ('world',)
+        records[1].created += 1.5
+        tuples = [logger.recordToTuple(x) for x in records]
+        decoded = logger.decodeRecords(logger.encodeRecords(tuples))
+        self.assertEqual([(x.name, x.levelno, x.getMessage(), x.exc_text)
+            for x in decoded], [
+                ('a.b', logging.INFO, 'hello world', None),
+                ('c', logging.ERROR, 'caf\xc3\xa9', 'Traceback...'),
+                ('a.b', logging.DEBUG, 'again', None),
+                ])
+        for old, new in zip(records, decoded):
+            self.assertAlmostEqual(old.created, new.created, 5)
+        self.assertEqual(logger.decodeRecords(logger.encodeRecords([])), [])
+
+    def testMalformed(self):
+        good = logger.encodeRecords([(1000.0, logging.INFO, 'a', 'msg', None)])
+        for data in [
+                'garbage',
+                good[:len(good) // 2],
+                zlib.compress('garbage'),
+                zlib.compress(bincodec.dumps((logger.ENCODING_VERSION,))),
+                # Index past the end of the logger names
+                zlib.compress(bincodec.dumps((logger.ENCODING_VERSION, 0.0,
+                    ['a'], [1], [logging.INFO], [0], ['msg'], {}))),
+                # Columns of different lengths
+                zlib.compress(bincodec.dumps((logger.ENCODING_VERSION, 0.0,
+                    ['a'], [0, 0], [logging.INFO], [0], ['msg'], {}))),
+                zlib.compress(bincodec.dumps((logger.ENCODING_VERSION, 'x',
+                    ['a'], [0], [logging.INFO], [0], ['msg'], {}))),
+                ]:
+            self.assertRaises(ValueError, logger.decodeRecords, data)
+
+    def testTooLarge(self):
+        self.patch(logger, 'MAX_DECODED_SIZE', 1000)
+        tuples = [(1000.0, logging.INFO, 'a', 'x' * 2000, None)]
+        data = logger.encodeRecords(tuples)
+        self.assertTrue(len(data) < 1000)
+        self.assertRaises(ValueError, logger.decodeRecords, data)
+
+    def testCompresses(self):
+        tuples = [(1000.0 + x, logging.INFO, 'rmake.build',
+            'Building package number %d of many' % x, None)
+            for x in range(1000)]
+        data = logger.encodeRecords(tuples)
+        self.assertTrue(len(data) < sum(len(x[3]) for x in tuples) / 5)
+
+    def testBatching(self):
+        relay = self._relay()
+        relay.MAX_BATCH = 10
+        relay.last_send = self.clock.seconds()
+        relay.emitMany([self._record('x%d' % x) for x in range(5)])
+        # Not enough records and not long enough since the last send.
+        self.assertEqual(self.sent, [])
+        relay.emitMany([self._record('y%d' % x) for x in range(25)])
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(self._received()), 10)
+        relay.close()
+        received = [x.getMessage() for x in self._received()]
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(received[:5], ['x0', 'x1', 'x2', 'x3', 'x4'])
+        self.assertEqual(received[-1], 'y24')
+        self.assertEqual(self.sent[0].job_uuid, 'job')
+        self.assertEqual(self.sent[0].task_uuid, 'task')
+
+    def testDeadline(self):
+        relay = self._relay()
+        relay.last_send = self.clock.seconds()
+        relay.emit(self._record('late'))
+        self.assertEqual(self.sent, [])
+        self.clock.advance(relay.DEADLINE)
+        self.assertEqual([x.getMessage() for x in self._received()],
+                ['late'])
+
+    def testBackpressure(self):
+        relay = self._relay(backlog=100)
+        relay.MAX_BATCH = 2
+        relay.MAX_BUFFERED = 100
+        relay.emitMany([self._record('%03d' % x) for x in range(50)])
+        self.clock.advance(10)
+        # Nothing goes out while the bus is congested, and the oldest
+        # records are dropped to keep the buffer bounded.
+        self.assertEqual(self.sent, [])
+        self.assertTrue(relay.bufferedBytes <= relay.MAX_BUFFERED)
+        self.backlog = 0
+        self.clock.advance(relay.DEADLINE)
+        received = self._received()
+        self.assertEqual(received[0].levelno, logging.WARNING)
+        self.assertTrue('dropped' in received[0].getMessage())
+        self.assertEqual(received[-1].getMessage(), '049')
@@ -0,0 +1,172 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.python import failure
+from twisted.trial import unittest
+
+from rmake.lib.proc_pool import connector
+from rmake.lib.proc_pool import pool
+from rmake.lib.proc_pool import zygote
+
+
+class FakeChild(object):
+
+    def __init__(self):
+        self.finished = defer.Deferred()
+        self.calls = []
+
+    def callRemote(self, command, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((command, d))
+        return d
+
+    def setLogBase(self, logBase):
+        pass
+
+    def finishStartup(self):
+        command, d = self.calls[0]
+        assert command == 'startup'
+        d.callback(None)
+
+
+class FakeStarter(object):
+
+    def __init__(self):
+        self.children = []
+
+    def startProcess(self, childClass, parentClass):
+        child = FakeChild()
+        self.children.append(child)
+        return child
+
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.starter = FakeStarter()
+        self.pool = pool.ProcessPool(self.starter, minIdle=1, maxIdle=3)
+        self.pool.maint.stop()
+        self.pool._now = lambda: self.now
+
+    def testPrewarm(self):
+        self.pool.rebalance()
+        child, = self.starter.children
+        # Not handed out as idle until it has finished starting.
+        self.assertEqual(self.pool.ready, set())
+        self.now += 2
+        child.finishStartup()
+        self.assertEqual(self.pool.ready, set([child]))
+        self.assertEqual(self.pool.spawnTime, 2)
+
+        self.pool.doWork('launch')
+        self.assertEqual(self.pool.busy, set([child]))
+        self.assertEqual(self.pool.getStats()['coldStarts'], 0)
+        # A replacement is started straight away.
+        self.assertEqual(len(self.pool.starting), 1)
+
+    def testColdStart(self):
+        self.pool.doWork('launch')
+        child = self.starter.children[0]
+        self.assertEqual(self.pool.busy, set([child]))
+        self.now += 3
+        child.finishStartup()
+        # The worker went to the task rather than the idle pool.
+        self.failIf(child in self.pool.ready)
+        stats = self.pool.getStats()
+        self.assertEqual((stats['coldStarts'], stats['waitTime']), (1, 3))
+
+    def testBurst(self):
+        self.pool.spawnTime = 2
+        for x in range(5):
+            self.pool.arrivals.append(self.now)
+        self.now += 10
+        self.pool.arrivals.append(self.now)
+        self.assertEqual(self.pool.getBurstSize(), 5)
+        self.assertEqual(self.pool.getIdleTarget(), 3)
+        self.pool.rebalance()
+        self.assertEqual(len(self.pool.starting), 3)
+        # The burst is forgotten once it falls out of the window.
+        self.now += self.pool.rateWindow
+        self.assertEqual(self.pool.getIdleTarget(), 1)
+
+
+class FakeProtocol(object):
+
+    def __init__(self):
+        self.received = []
+        self.lost = None
+
+    def makeConnection(self, transport):
+        self.transport = transport
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+    def connectionLost(self, reason):
+        self.lost = reason
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.written = []
+        self.transport = self
+
+    def write(self, data):
+        self.written.append(data)
+
+    def loseConnection(self):
+        pass
+
+
+class ForkedConnectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prot = FakeProtocol()
+        self.conn = connector.ForkedConnector(self.prot)
+        self.channel = FakeChannel()
+
+    def testBuffering(self):
+        self.prot.transport.write('startup')
+        self.conn.attach(self.channel, 1234)
+        self.prot.transport.write('launch')
+        self.assertEqual(self.channel.written, ['startup', 'launch'])
+        self.assertEqual(self.conn.pid, 1234)
+
+    def testExit(self):
+        self.conn.attach(self.channel, 1234)
+        self.conn.childExited(failure.Failure(error.ProcessDone(0)))
+        # Not finished until everything the child sent has arrived.
+        self.assertEqual(self.prot.lost, None)
+        self.conn.dataReceived('result')
+        self.conn.channelLost()
+        self.assertEqual(self.prot.received, ['result'])
+        self.failUnless(self.prot.lost.check(error.ProcessDone))
+        return self.conn.finished
+
+    def testExitStatus(self):
+        starter = zygote.ZygoteStarter({})
+        starter.children['0'] = self.conn
+        # Killed by SIGTERM
+        starter.childExited('0', 15)
+        self.failUnless(self.prot.lost.check(error.ProcessTerminated))
+        self.assertEqual(self.prot.lost.value.signal, 15)
+        return self.assertFailure(self.conn.finished,
+                error.ProcessTerminated)
@@ -0,0 +1,156 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import time
+from twisted.trial import unittest
+
+from rmake.lib import repocache
+
+
+class MemoryCacheTest(unittest.TestCase):
+
+    def testEviction(self):
+        memory = repocache.MemoryCache(10)
+        memory.set('a', 1, 4)
+        memory.set('b', 2, 4)
+        self.assertEqual(memory.get('a'), 1)
+        # 'b' is now the least recently used entry.
+        memory.set('c', 3, 4)
+        self.assertEqual(memory.get('b'), None)
+        self.assertEqual(memory.get('a'), 1)
+        self.assertEqual(memory.get('c'), 3)
+        self.assertEqual(memory.size, 8)
+        stats = memory.getStats()
+        self.assertEqual((stats['hits'], stats['misses']), (3, 1))
+
+    def testReplace(self):
+        memory = repocache.MemoryCache(10)
+        memory.set('a', 1, 6)
+        memory.set('a', 2, 3)
+        self.assertEqual(memory.size, 3)
+        self.assertEqual(len(memory), 1)
+        memory.clear()
+        self.assertEqual(memory.size, 0)
+        self.failIf('a' in memory)
+
+    def testShared(self):
+        memory = repocache.getMemoryCache('/tmp/cache-a', 50)
+        self.assertIdentical(repocache.getMemoryCache('/tmp/cache-a/', 50),
+                memory)
+        self.failIfIdentical(repocache.getMemoryCache('/tmp/cache-b', 50),
+                memory)
+        self.assertEqual(repocache.getMemoryCache('/tmp/cache-a', 0), None)
+
+
+class FakeRepos(object):
+
+    def __init__(self):
+        self.fetched = []
+
+    def createChangeSetFile(self, jobList, path, recurse=True,
+            callback=None):
+        self.fetched.extend(jobList)
+        open(path, 'w').write(jobList[0][0])
+
+
+class ChangeSetFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        cacheDir = os.path.abspath(self.mktemp())
+        self.cache = repocache.RepositoryCache(cacheDir, fetchThreads=3,
+                fetchBatchSize=2)
+        self.cache._openChangeSet = lambda csHash: open(
+                self.cache.store.hashToPath(csHash)).read()
+
+    def _jobs(self, count):
+        return [('foo%d:runtime' % x, (None, None), ('/v/1', ''), False)
+                for x in range(count)]
+
+    def testSerial(self):
+        repos = FakeRepos()
+        jobs = self._jobs(5)
+        result = self.cache.getChangeSets(repos, jobs)
+        self.assertEqual(result, [x[0] for x in jobs])
+        # A second fetch is served entirely from the store.
+        self.assertEqual(self.cache.getChangeSets(repos, jobs), result)
+        self.assertEqual(len(repos.fetched), 5)
+
+    def testParallel(self):
+        repos = [FakeRepos() for x in range(3)]
+        factory = iter(repos).next
+        jobs = self._jobs(6)
+        result = self.cache.getChangeSets(None, jobs, reposFactory=factory)
+        self.assertEqual(result, [x[0] for x in jobs])
+        self.assertEqual(sorted(len(x.fetched) for x in repos), [2, 2, 2])
+
+
+class CollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDir = os.path.abspath(self.mktemp())
+        self.cache = repocache.RepositoryCache(self.cacheDir)
+        self.now = time.time()
+
+    def _addEntry(self, store, hash, size, age):
+        path = store.hashToPath(hash)
+        store.makeDir(path)
+        open(path, 'wb').write('x' * size)
+        mtime = self.now - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def testEviction(self):
+        old = self._addEntry(self.cache.store, 'a' * 40, 100, 300)
+        used = self._addEntry(self.cache.store, 'b' * 40, 100, 200)
+        new = self._addEntry(self.cache.store, 'c' * 40, 100, 100)
+        # Using an entry makes it the most recently used.
+        self.cache._recordHit('b' * 40)
+        result = self.cache.collect(maxSize=250)
+        self.assertEqual(result, dict(expired=0, evicted=1, freed=100))
+        self.failIf(os.path.exists(old))
+        self.failUnless(os.path.exists(used))
+        result = self.cache.collect(maxSize=150)
+        self.failIf(os.path.exists(new))
+        self.failUnless(os.path.exists(used))
+
+    def testDepsExpire(self):
+        stale = self._addEntry(self.cache.depStore, 'a' * 40, 10, 7200)
+        fresh = self._addEntry(self.cache.depStore, 'b' * 40, 10, 60)
+        changeset = self._addEntry(self.cache.store, 'c' * 40, 10, 7200)
+        # An abandoned download is cleaned up along the way.
+        partial = self._addEntry(self.cache.store, 'd' * 40 + 'tmp', 10,
+                2 * repocache.TEMP_MAX_AGE)
+        result = self.cache.collect(depMaxAge=3600)
+        self.assertEqual(result, dict(expired=1, evicted=0, freed=10))
+        self.failIf(os.path.exists(stale))
+        self.failUnless(os.path.exists(fresh))
+        self.failUnless(os.path.exists(changeset))
+        stats = self.cache.getDiskStats()
+        self.failIf(os.path.exists(partial))
+        self.assertEqual((stats['entries'], stats['depEntries']), (1, 1))
+        self.assertEqual(stats['expired'], 1)
+
+    def testStats(self):
+        self.cache._recordHit('a' * 40)
+        self.cache._pending[1] += 3
+        self.cache.saveStats()
+        # Counts are shared by every cache on the directory.
+        self.cache._pending[0] += 1
+        repocache.saveStats(self.cacheDir)
+        stats = repocache.CacheStatistics(self.cacheDir).read()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
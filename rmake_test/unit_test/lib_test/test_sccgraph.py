@@ -0,0 +1,80 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+from twisted.trial import unittest
+
+from rmake.lib import sccgraph
+
+
+class ComponentTrackerTest(unittest.TestCase):
+
+    def _components(self, tracker):
+        return sorted(sorted(x) for x in tracker.iterComponents())
+
+    def _leaves(self, tracker):
+        return sorted(sorted(x) for x in tracker.getLeaves())
+
+    def _check(self, tracker):
+        """Compare the tracker's state against a full recomputation."""
+        children = tracker.children
+        comps = sccgraph.stronglyConnected(children, children.get)
+        self.assertEqual(self._components(tracker),
+                sorted(sorted(x) for x in comps))
+        leaves = [x for x in comps
+                if not [c for n in x for c in children[n] if c not in x]]
+        self.assertEqual(self._leaves(tracker),
+                sorted(sorted(x) for x in leaves))
+
+    def test_cycle(self):
+        tracker = sccgraph.ComponentTracker()
+        tracker.addEdge('a', 'b')
+        tracker.addEdge('b', 'c')
+        self.assertEqual(self._leaves(tracker), [['c']])
+        tracker.addEdge('c', 'a')
+        self.assertEqual(self._components(tracker), [['a', 'b', 'c']])
+        self.assertEqual(self._leaves(tracker), [['a', 'b', 'c']])
+
+        tracker.addEdge('d', 'a')
+        tracker.addEdge('c', 'e')
+        self.assertEqual(self._leaves(tracker), [['e']])
+
+        # Breaking the cycle splits it back up.
+        tracker.deleteEdges('b')
+        self.assertEqual(self._components(tracker),
+                [['a'], ['b'], ['c'], ['d'], ['e']])
+        self.assertEqual(self._leaves(tracker), [['b'], ['e']])
+
+        tracker.delete('b')
+        self.assertEqual(self._leaves(tracker), [['a'], ['e']])
+        self._check(tracker)
+
+    def test_random(self):
+        rand = random.Random(1)
+        tracker = sccgraph.ComponentTracker()
+        for n in range(40):
+            tracker.addNode(n)
+        for step in range(400):
+            choice = rand.random()
+            nodes = sorted(tracker.children)
+            if choice < 0.7 or len(nodes) < 2:
+                tracker.addEdge(rand.choice(nodes or [0]), rand.randrange(40))
+            elif choice < 0.85:
+                tracker.deleteEdges(rand.choice(nodes))
+            else:
+                tracker.delete(rand.choice(nodes))
+            self._check(tracker)
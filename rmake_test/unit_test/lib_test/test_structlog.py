@@ -0,0 +1,111 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import logging
+import os
+import random
+from twisted.trial import unittest
+
+from rmake.lib import structlog
+
+
+class StructLogTest(unittest.TestCase):
+
+    def _record(self, created, msg, name='test'):
+        record = logging.LogRecord(name, logging.INFO, __file__, 1, msg,
+                None, None)
+        record.created = created
+        record.msecs = (created - long(created)) * 1000
+        return record
+
+    def _write(self, path, times, interval=4, prefix=''):
+        handler = structlog.BulkHandler(path, 'ab')
+        handler.indexInterval = interval
+        handler.emitMany([self._record(x, '%s%.1f\nline two' % (prefix, x))
+            for x in times])
+        handler.close()
+
+    def _query(self, paths, start=None, end=None):
+        return [(round(x.created, 3), x.getMessage()) for x in
+                structlog.queryLogs(paths, start, end)]
+
+    def testIndex(self):
+        path = os.path.join(self.mktemp(), 'task.log')
+        times = [1000 + x for x in range(10)] + [1003.5, 1020]
+        self._write(path, times)
+        segments = structlog.readIndex(path)
+        self.assertEqual([(x[0], x[2]) for x in segments], [
+            ([1000, 1004, 1008, 1009], True),
+            ([1003.5, 1020], True),
+            ])
+        # Reopening starts a new segment
+        self._write(path, [1030, 1031])
+        segments = structlog.readIndex(path)
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(segments[2][0], [1030, 1031])
+        self.assertEqual(self._query([path], 1003, 1008.5), [
+            (1003.0, '1003.0\nline two'),
+            (1003.5, '1003.5\nline two'),
+            (1004.0, '1004.0\nline two'),
+            (1005.0, '1005.0\nline two'),
+            (1006.0, '1006.0\nline two'),
+            (1007.0, '1007.0\nline two'),
+            (1008.0, '1008.0\nline two'),
+            ])
+        # Tailing from 1009 can skip most of the first segment, but not the
+        # second, which has later records.
+        offset = structlog.findOffset(path, 1009)
+        fobj = open(path, 'rb')
+        fobj.seek(offset)
+        parsed = [x.created for x in structlog.StructuredLogParser(fobj)]
+        self.assertEqual(parsed[0], 1008)
+        self.assertEqual(parsed[-4:], [1003.5, 1020, 1030, 1031])
+
+    def testMerge(self):
+        base = self.mktemp()
+        rng = random.Random(2)
+        paths = []
+        expected = []
+        for n in range(3):
+            times = sorted(1000 + rng.randint(0, 10000) / 10.0
+                    for x in range(200))
+            # Out of order arrivals
+            times[100:100] = [1005, 1001]
+            path = os.path.join(base, 'task-%d.log' % n)
+            self._write(path, times, prefix='%d:' % n)
+            paths.append(path)
+            expected.extend((x, '%d:%.1f\nline two' % (n, x)) for x in times)
+        expected.sort()
+        self.assertEqual(self._query(paths), expected)
+        self.assertEqual(self._query(paths, 1500, 2000),
+                [x for x in expected if 1500 <= x[0] <= 2000])
+
+        # Logs written before indexing are scanned instead
+        os.unlink(paths[1] + structlog.INDEX_SUFFIX)
+        self.assertEqual(structlog.readIndex(paths[1]), None)
+        self.assertEqual(self._query(paths, 1500, 2000),
+                [x for x in expected if 1500 <= x[0] <= 2000])
+        # and stay unindexed when appended to.
+        self._write(paths[1], [3000])
+        self.assertEqual(structlog.readIndex(paths[1]), None)
+
+        manager = structlog.JobLogManager(base)
+        self.assertEqual(manager.listPaths(), paths)
+        self.assertEqual([x.created for x in manager.query(start=2000)],
+                [x[0] for x in expected if x[0] >= 2000] + [3000])
+        self.assertEqual(list(manager.query(task_uuids=[None])), [])
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Benchmark cycle tracking on a synthetic bootstrap-style dependency graph.
+
+Builds a graph of NODES troves made of many interlocking cycles, then
+simulates a build: repeatedly take a leaf, "build" it if it is a single trove
+or break the cycle at one trove otherwise, until the graph is empty. The same
+sequence is timed with the incremental component tracker used by
+DependencyGraph and with a full recomputation of the components after every
+step, as DependencyHandler did before.
+"""
+
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.realpath(__file__ + '/../..'))
+
+from rmake.lib import sccgraph
+
+
+def makeGraph(nodes, cycleSize, extraEdges, seed):
+    rand = random.Random(seed)
+    edges = []
+    # Rings of troves that all require each other.
+    for start in range(0, nodes, cycleSize):
+        ring = range(start, min(start + cycleSize, nodes))
+        for a, b in zip(ring, ring[1:] + ring[:1]):
+            edges.append((a, b))
+    # Random requirements on earlier troves, plus a few on later ones that
+    # merge rings into bigger cycles.
+    for n in range(extraEdges):
+        a = rand.randrange(nodes)
+        b = rand.randrange(nodes)
+        if rand.random() > 0.02:
+            a, b = max(a, b), min(a, b)
+        edges.append((a, b))
+    return edges
+
+
+def simulate(edges, nodes, incremental):
+    tracker = sccgraph.ComponentTracker()
+    children = dict((x, set()) for x in range(nodes))
+    parents = dict((x, set()) for x in range(nodes))
+    for node in range(nodes):
+        tracker.addNode(node)
+    for a, b in edges:
+        tracker.addEdge(a, b)
+        if a != b:
+            children[a].add(b)
+            parents[b].add(a)
+
+    def fullLeaves():
+        comps = sccgraph.stronglyConnected(children, children.get)
+        return [comp for comp in comps
+                if not [c for n in comp for c in children[n]
+                        if c not in comp]]
+
+    steps = 0
+    start = time.time()
+    while children:
+        if incremental:
+            leaves = [frozenset(x.members) for x in tracker.getLeaves()]
+        else:
+            leaves = fullLeaves()
+        leaf = min(leaves, key=min)
+        trove = min(leaf)
+        if len(leaf) == 1:
+            # Built: remove it from the graph.
+            tracker.delete(trove)
+            for parent in parents.pop(trove):
+                children[parent].discard(trove)
+            for child in children.pop(trove):
+                parents[child].discard(trove)
+        else:
+            # Broke the cycle by resolving this trove without its deps.
+            tracker.deleteEdges(trove)
+            for child in children[trove]:
+                parents[child].discard(trove)
+            children[trove] = set()
+        steps += 1
+    return steps, time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--nodes', type='int', default=5000)
+    parser.add_option('--cycle-size', type='int', default=8)
+    parser.add_option('--extra-edges', type='int', default=15000)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--skip-full', action='store_true',
+            help="Don't time full recomputation (it is slow)")
+    options, args = parser.parse_args()
+
+    edges = makeGraph(options.nodes, options.cycle_size, options.extra_edges,
+            options.seed)
+    print 'Graph: %d troves, %d edges' % (options.nodes, len(edges))
+
+    steps, elapsed = simulate(edges, options.nodes, incremental=True)
+    print 'incremental: %d steps in %.2fs (%.3f ms/step)' % (steps, elapsed,
+            1000 * elapsed / steps)
+    if not options.skip_full:
+        steps, elapsed = simulate(edges, options.nodes, incremental=False)
+        print 'full:        %d steps in %.2fs (%.3f ms/step)' % (steps,
+                elapsed, 1000 * elapsed / steps)
+
+
+if __name__ == '__main__':
+    main()
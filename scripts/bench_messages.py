@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+"""
+Benchmark encoding of the busiest message bus messages.
+
+Builds a heartbeat, a task status update and a log batch like those a busy
+worker sends, then times encoding and decoding each with the pickle-based
+payload format and with the compact one, and reports the encoded sizes.
+"""
+
+import logging
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.realpath(__file__ + '/../..'))
+
+from twisted.words.protocols.jabber.jid import JID
+
+from rmake.core import types
+from rmake.lib import uuid
+from rmake.messagebus import logger
+from rmake.messagebus import message
+
+
+def makeMessages(tasks):
+    job_uuid = uuid.uuid4()
+    caps = set([types.VersionCapability((3,)),
+        types.ZoneCapability('zone.1')])
+    caps.update(types.TaskCapability('task.%d' % n) for n in range(10))
+    heartbeat = message.Heartbeat(caps=caps,
+            tasks=[uuid.uuid4() for n in range(tasks)],
+            slots={None: 4, 'build': 2}, addresses=set(['10.0.0.1', '::1']))
+
+    task = types.RmakeTask(None, job_uuid, 'build:foo:x86_64', 'build.trove',
+            task_data=types.FrozenObject('pickle:' + 'x' * 200),
+            node_assigned='node1', task_zone='zone.1')
+    task.status = types.JobStatus(101, 'Building foo', None)
+    task.times.ticks = 42
+    status = message.TaskStatus(task=task.freeze())
+
+    records = []
+    for n in range(100):
+        record = logging.LogRecord('rmake.build', logging.INFO, __file__, n,
+                'Building file %d of %d', (n, 100), None)
+        records.append(logger.recordToTuple(record))
+    batch = message.LogBatch(data=logger.encodeRecords(records),
+            job_uuid=job_uuid, task_uuid=task.task_uuid)
+    return [('heartbeat', heartbeat), ('task-status', status),
+            ('log-batch', batch)]
+
+
+def timeIt(func, count):
+    start = time.time()
+    for n in xrange(count):
+        func()
+    return (time.time() - start) / count * 1e6
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--count', type='int', default=20000)
+    parser.add_option('--tasks', type='int', default=8,
+            help="Number of running tasks listed in the heartbeat")
+    options, args = parser.parse_args()
+
+    sender = JID('worker@example.com/rmake')
+    print '%-12s %-8s %8s %10s %10s' % ('message', 'format', 'bytes',
+            'encode us', 'decode us')
+    for name, msg in makeMessages(options.tasks):
+        for compact in (False, True):
+            jmsg = msg.to_jmessage(compact=compact)
+            jmsg.sender = sender
+            encode = timeIt(lambda: msg.to_jmessage(compact=compact),
+                    options.count)
+            decode = timeIt(lambda: message.Message.from_jmessage(jmsg),
+                    options.count)
+            print '%-12s %-8s %8d %10.1f %10.1f' % (name,
+                    compact and 'compact' or 'pickle', len(jmsg.payload),
+                    encode, decode)
+
+
+if __name__ == '__main__':
+    main()